@@ -0,0 +1,576 @@
+"""Async serving mode: the merchant API on Starlette + asyncpg.
+
+    python asgi_server.py --port 5000
+    uvicorn asgi_server:app --host 0.0.0.0 --port 5000 --workers 2
+
+Exposes the same routes and JSON as api_server.py. Both are built from the
+same sections (sections.SECTIONS plan/shape) and the same SQL (queries.py),
+so the two modes cannot drift apart. The differences are in how it runs:
+
+- One event loop serves every request of a process. While a request waits
+  on Postgres the loop serves others, so hundreds of requests can be in
+  flight on a pool of ASYNC_POOL_MAX connections.
+- The independent statements of a section (e.g. the three insights queries)
+  run concurrently, each on its own pooled connection. The dashboard runs
+  the statements of all its sections at once.
+
+Responses go through the same response cache (cache.py, keyed by data
+version) and get the same ETags, 304s and compression as the Flask app
+(conditional.py).
+"""
+import argparse
+import asyncio
+import json
+import os
+import re
+import time
+from contextlib import asynccontextmanager
+from functools import lru_cache, wraps
+
+import asyncpg
+from starlette.applications import Starlette
+from starlette.background import BackgroundTask
+from starlette.middleware import Middleware
+from starlette.middleware.cors import CORSMiddleware
+from starlette.responses import Response, StreamingResponse
+from starlette.routing import Route
+from werkzeug.datastructures import MultiDict
+
+from db_connection import POOL_MIN_SIZE, POOL_TIMEOUT
+from serialization import dumps, iso_timestamp
+from cache import get_cache, cache_stats, storable, CACHE_COUNTERS, CACHE_DEFAULT_TTL, CACHE_VERSION_CHECK, SCOPE_VERSIONS, TTLS
+import conditional
+import data_analytics
+import exports
+import instrumentation
+import queries
+import sections
+
+# Connections per process; requests beyond this wait for a free one (up to
+# DB_POOL_TIMEOUT seconds) instead of opening more
+ASYNC_POOL_MAX = int(os.getenv('ASYNC_POOL_MAX', '20'))
+
+_pool = None
+
+
+# DATABASE
+
+async def _init_connection(conn):
+    # Same JSON-ready values as serialization.fetch_rows: NUMERIC as float,
+    # DATE and TIMESTAMP as ISO strings, decoded straight from Postgres' text
+    await conn.set_type_codec('numeric', schema='pg_catalog', format='text', encoder=str, decoder=float)
+    await conn.set_type_codec('date', schema='pg_catalog', format='text', encoder=str, decoder=str)
+    await conn.set_type_codec('timestamp', schema='pg_catalog', format='text', encoder=str, decoder=iso_timestamp)
+
+
+async def create_pool():
+    return await asyncpg.create_pool(
+        host=os.getenv('DB_HOST', 'localhost'),
+        database=os.getenv('DB_NAME', 'grab_merchant_db'),
+        user=os.getenv('DB_USER', 'postgres'),
+        password=os.getenv('DB_PASSWORD', '123'),
+        min_size=min(POOL_MIN_SIZE, ASYNC_POOL_MAX),
+        max_size=ASYNC_POOL_MAX,
+        init=_init_connection,
+    )
+
+
+def pool_stats():
+    if _pool is None:
+        return {}
+    return {
+        "driver": "asyncpg",
+        "min_size": _pool.get_min_size(),
+        "max_size": _pool.get_max_size(),
+        "size": _pool.get_size(),
+        "idle": _pool.get_idle_size(),
+    }
+
+
+_PLACEHOLDER = re.compile(r"%\((\w+)\)s|%s|%%")
+
+
+@lru_cache(maxsize=256)
+def _convert(sql):
+    """psycopg2 placeholders -> asyncpg's $n, plus the order of named params"""
+    order = []
+    counter = iter(range(1, 10000))
+
+    def replace(match):
+        if match.group(0) == '%%':
+            return '%'
+        if match.group(1) is None:
+            return f"${next(counter)}"
+        name = match.group(1)
+        if name not in order:
+            order.append(name)
+        return f"${order.index(name) + 1}"
+
+    return _PLACEHOLDER.sub(replace, sql), tuple(order)
+
+
+def to_asyncpg(sql, params):
+    """A statement written for psycopg2 (queries.py) as asyncpg (sql, args)"""
+    if isinstance(params, dict):
+        converted, order = _convert(sql)
+        return converted, [params[name] for name in order]
+    converted, _ = _convert(sql)
+    return converted, list(params or ())
+
+
+async def fetch_rows(sql, params=None):
+    """Run one statement on a pooled connection and return its rows as dicts"""
+    statement, args = to_asyncpg(sql, params)
+    started = time.perf_counter()
+    async with _pool.acquire(timeout=POOL_TIMEOUT) as conn:
+        acquired = time.perf_counter()
+        instrumentation.add_phase('pool_wait', acquired - started)
+        rows = await conn.fetch(statement, *args)
+        seconds = time.perf_counter() - acquired
+        plan = None
+        if instrumentation.is_slow(seconds) and instrumentation.SLOW_QUERY_EXPLAIN:
+            plan = [row[0] for row in await conn.fetch("EXPLAIN " + statement, *args)]
+    instrumentation.record_statement(sql, params, seconds, plan=plan)
+    return [dict(row) for row in rows]
+
+
+async def _statement_rows(sql, sql_params):
+    """Rows of a section statement, from the columnar engine when it handles it"""
+    if sections.in_memory(sql):
+        # Off the event loop: a (re)load of the engine takes a while
+        started = time.perf_counter()
+        rows = await asyncio.to_thread(sections.columnar.answer, sql, sql_params, await _data_version())
+        instrumentation.record_statement(sql, sql_params, time.perf_counter() - started, engine='columnar')
+        return rows
+    return await fetch_rows(sql, sql_params)
+
+
+async def _timed_query(sql, sql_params):
+    started = time.monotonic()
+    rows = await _statement_rows(sql, sql_params)
+    finished = time.monotonic()
+    return rows, finished - started, finished
+
+
+# SECTIONS
+
+async def run_section(name, merchant_id, args):
+    """Run one section's statements concurrently and shape the result"""
+    params, plan, shape = sections.SECTIONS[name]
+    p = params(args)
+    statements = plan(merchant_id, p)
+    rows = await asyncio.gather(*(_statement_rows(sql, sql_params) for sql, sql_params in statements.values()))
+    with instrumentation.phase('shape'):
+        return shape(merchant_id, p, dict(zip(statements, rows)))
+
+
+async def run_dashboard(merchant_id, names, args):
+    """Async counterpart of sections.run_dashboard, with the same payload"""
+    started = time.monotonic()
+
+    pending = {}
+    for name in names:
+        params, plan, _ = sections.SECTIONS[name]
+        p = params(args)
+        tasks = {
+            key: asyncio.ensure_future(_timed_query(sql, sql_params))
+            for key, (sql, sql_params) in plan(merchant_id, p).items()
+        }
+        pending[name] = (p, tasks)
+
+    result, errors, timings = {}, {}, {}
+    for name, (p, tasks) in pending.items():
+        shape = sections.SECTIONS[name][2]
+        # Sections rejecting their arguments plan no statements
+        if tasks:
+            await asyncio.wait(tasks.values())
+        try:
+            results = {key: task.result()[0] for key, task in tasks.items()}
+            with instrumentation.phase('shape'):
+                result[name] = shape(merchant_id, p, results)
+        except sections.SectionError as e:
+            errors[name] = dict(e.payload, status=e.status)
+        except asyncio.TimeoutError:
+            errors[name] = {"error": "Server busy, please retry", "status": 503}
+        except Exception as e:
+            print(f"Error in dashboard section {name}: {str(e)}")
+            errors[name] = {"error": str(e), "status": 500}
+        done = [task.result() for task in tasks.values() if task.exception() is None]
+        timings[name] = {
+            "queries_ms": {
+                key: round(task.result()[1] * 1000, 2)
+                for key, task in tasks.items() if task.exception() is None
+            },
+            "ready_ms": round((max((d[2] for d in done), default=started) - started) * 1000, 2),
+        }
+
+    return {
+        "merchant_id": merchant_id,
+        "sections": result,
+        "errors": errors,
+        "timings_ms": timings,
+        "total_ms": round((time.monotonic() - started) * 1000, 2),
+    }
+
+
+# RESPONSES
+
+def json_response(payload, status=200):
+    with instrumentation.phase('serialize'):
+        body = dumps(payload)
+    return Response(body, status_code=status, media_type='application/json')
+
+
+def _conditional(request, response):
+    """ETag / 304 / compression, as conditional.init_app does for Flask"""
+    if request.method != 'GET' or response.status_code != 200 or isinstance(response, StreamingResponse):
+        return response
+    body = response.body
+    encoding = None
+    if len(body) >= conditional.COMPRESS_MIN_BYTES:
+        encoding = conditional.choose_encoding(request.headers.get('accept-encoding', ''))
+        response.headers['Vary'] = 'Accept-Encoding'
+
+    if request.url.path.startswith(conditional.CONDITIONAL_PREFIXES):
+        etag = response.headers.get('etag', '').strip('"') or conditional.content_etag(body)
+        if encoding:
+            etag = f"{etag}-{'br' if encoding == 'br' else 'gz'}"
+        response.headers['ETag'] = f'"{etag}"'
+        response.headers.setdefault('Cache-Control', 'no-cache')
+        if_none_match = request.headers.get('if-none-match', '')
+        if if_none_match.strip() == '*' or f'"{etag}"' in [t.strip() for t in if_none_match.split(',')]:
+            return Response(status_code=304, headers={
+                k: v for k, v in response.headers.items() if k.lower() not in ('content-length', 'content-type')
+            })
+
+    if encoding:
+        response.body = conditional.compress(body, encoding)
+        response.headers['Content-Encoding'] = encoding
+        response.headers['Content-Length'] = str(len(response.body))
+    return response
+
+
+_version = {"value": None, "checked": 0.0}
+
+
+async def _data_version():
+    """data_version read through the async pool, re-read every CACHE_VERSION_CHECK seconds"""
+    now = time.monotonic()
+    if _version["value"] is None or now - _version["checked"] >= CACHE_VERSION_CHECK:
+        async with _pool.acquire(timeout=POOL_TIMEOUT) as conn:
+            value = await conn.fetchval("SELECT version FROM data_version")
+        _version.update(value=value or 0, checked=now)
+    return _version["value"]
+
+
+_scopes = {}  # endpoint -> (version, checked)
+
+
+async def _scope_version(endpoint):
+    """The endpoint's cache.SCOPE_VERSIONS value through the async pool (None when it has none)"""
+    if endpoint not in SCOPE_VERSIONS:
+        return None
+    now = time.monotonic()
+    value, checked = _scopes.get(endpoint, (None, 0.0))
+    if value is None or now - checked >= CACHE_VERSION_CHECK:
+        async with _pool.acquire(timeout=POOL_TIMEOUT) as conn:
+            value = await conn.fetchval(SCOPE_VERSIONS[endpoint]) or 0
+        _scopes[endpoint] = (value, now)
+    return value
+
+
+def cached(endpoint):
+    """Serve a handler through the shared response cache under its Flask endpoint name,
+    so both serving modes read and fill the same entries"""
+    def decorate(handler):
+        @wraps(handler)
+        async def wrapper(request):
+            cache = get_cache()
+            if not cache.enabled:
+                return await handler(request)
+
+            key = cache.key(endpoint, request.path_params, request.query_params.multi_items(),
+                            version=await _data_version(), scope=await _scope_version(endpoint))
+            ttl = TTLS.get(endpoint, CACHE_DEFAULT_TTL)
+            # The shared backend (Redis) is a blocking client
+            hit = await asyncio.to_thread(cache.get, key, ttl) if cache.shared else cache.get(key, ttl)
+            if hit is not None:
+                entry = json.loads(hit)
+                response = Response(entry['body'], status_code=200, media_type=entry['mimetype'])
+                response.headers['ETag'] = f'"{entry["etag"]}"'
+                response.headers['X-Cache'] = 'HIT'
+                return response
+
+            response = await handler(request)
+            if response.status_code == 200 and storable(response.headers):
+                body = response.body.decode('utf-8')
+                etag = conditional.content_etag(body)
+                response.headers['ETag'] = f'"{etag}"'
+                entry = json.dumps({"body": body, "mimetype": response.media_type, "etag": etag})
+                if cache.shared:
+                    await asyncio.to_thread(cache.set, key, entry, ttl)
+                else:
+                    cache.set(key, entry, ttl)
+            response.headers['X-Cache'] = 'MISS'
+            return response
+
+        return wrapper
+
+    return decorate
+
+
+def _args(request):
+    # sections read arguments the way Flask's request.args does (get(name, default, type)),
+    # path parameters other than merchant_id (e.g. item_id) included
+    args = MultiDict(request.query_params.multi_items())
+    for key, value in request.path_params.items():
+        if key != 'merchant_id':
+            args.setlist(key, [value])
+    return args
+
+
+async def _section_response(request, name, label):
+    merchant_id = request.path_params['merchant_id']
+    try:
+        return json_response(await run_section(name, merchant_id, _args(request)))
+    except sections.SectionError as e:
+        return json_response(e.payload, e.status)
+    except asyncio.TimeoutError:
+        raise
+    except Exception as e:
+        print(f"Error in {label}: {str(e)}")
+        return json_response({"error": str(e)}, 500)
+
+
+def route(path, handler):
+    """GET route whose responses get ETags, 304s and compression, timed under
+    the Flask form of its path so both modes report the same route labels"""
+    label = re.sub(r'\{(\w+)(?::(\w+))?\}', lambda m: f"<{m[2]}:{m[1]}>" if m[2] else f"<{m[1]}>", path)
+
+    async def endpoint(request):
+        started, token = time.perf_counter(), instrumentation.start_request()
+        status = 500
+        try:
+            response = _conditional(request, await handler(request))
+            status = response.status_code
+            return response
+        except asyncio.TimeoutError:
+            # Answered by pool_exhausted, after this finally has run
+            status = 503
+            raise
+        finally:
+            instrumentation.finish_request(token, label, status, time.perf_counter() - started)
+    return Route(path, endpoint, methods=['GET'], name=handler.__name__)
+
+
+def section_route(path, name, endpoint):
+    """Route serving one section under the Flask route's path and endpoint name"""
+    async def handler(request):
+        return await _section_response(request, name, endpoint)
+    handler.__name__ = endpoint
+    return route(path, cached(endpoint)(handler))
+
+
+# ROUTES
+
+async def health_check(request):
+    return json_response({"status": "ok", "message": "Merchant Assistant API is running", "pool": pool_stats()})
+
+
+async def cache_statistics(request):
+    return json_response(cache_stats())
+
+
+async def metrics(request):
+    return Response(instrumentation.render(), media_type=instrumentation.PROMETHEUS_CONTENT_TYPE)
+
+
+async def slow_queries(request):
+    return json_response({"threshold_ms": instrumentation.SLOW_QUERY_MS, "queries": instrumentation.slow_queries()})
+
+
+@cached('merchant_dashboard')
+async def merchant_dashboard(request):
+    """Several sections in one round trip (see api_server.merchant_dashboard)"""
+    merchant_id = request.path_params['merchant_id']
+    requested = request.query_params.get('sections')
+    names = [n.strip() for n in requested.split(',') if n.strip()] if requested else sections.DEFAULT_DASHBOARD_SECTIONS
+    unknown = [n for n in names if n not in sections.SECTIONS]
+    if unknown:
+        return json_response({"error": f"Unknown sections: {', '.join(unknown)}",
+                              "available": list(sections.SECTIONS)}, 400)
+    try:
+        result = await run_dashboard(merchant_id, names, _args(request))
+        response = json_response(result)
+        if sections.dashboard_failed(result):
+            response.headers['Cache-Control'] = 'no-store'
+        return response
+    except Exception as e:
+        print(f"Error in merchant_dashboard: {str(e)}")
+        return json_response({"error": str(e)}, 500)
+
+
+async def merchant_transactions(request):
+    """Orders a page at a time, or streamed (see api_server.merchant_transactions)"""
+    merchant_id = request.path_params['merchant_id']
+    p = sections.transactions_params(_args(request))
+    if "error" in p or p["format"] == 'json':
+        return await _section_response(request, 'transactions', 'merchant_transactions')
+
+    statement, args = to_asyncpg(*sections.transactions_statement(merchant_id, p, p["limit"]))
+    positions = [queries.TRANSACTION_COLUMNS.index(c) for c in p["columns"]]
+    # Taken before answering, so a busy pool is still a 503
+    conn = await _pool.acquire(timeout=POOL_TIMEOUT)
+    released = False
+
+    async def release():
+        # From the body's finally or the response's close(), whichever comes
+        # first; the body may never be iterated (client gone)
+        nonlocal released
+        if not released:
+            released = True
+            await _pool.release(conn)
+
+    async def chunks():
+        try:
+            # asyncpg cursors only live inside a transaction
+            async with conn.transaction(readonly=True):
+                cursor = await conn.cursor(statement, *args)
+                yield exports.header(p["columns"], p["format"])
+                while True:
+                    rows = await cursor.fetch(exports.EXPORT_BATCH_ROWS)
+                    if not rows:
+                        break
+                    yield exports.encode(rows, p["columns"], positions, p["format"])
+        except Exception as e:
+            print(f"Error streaming transactions export: {str(e)}")
+            raise
+        finally:
+            await release()
+
+    body = chunks()
+
+    async def close():
+        # Starlette stops iterating the body of a client that went away but
+        # does not close it: end the transaction here, on this connection,
+        # rather than when the generator is garbage-collected after the
+        # connection has gone back to the pool
+        await body.aclose()
+        await release()
+
+    return StreamingResponse(body, media_type=exports.FORMATS[p["format"]], headers={
+        'Content-Disposition': f'attachment; filename="{exports.filename("transactions", merchant_id, p["format"])}"',
+    }, background=BackgroundTask(close))
+
+
+async def analytics_status(request):
+    """Last refresh, duration and staleness of every materialized view"""
+    def status():
+        from db_connection import pooled_connection
+        with pooled_connection() as conn:
+            return data_analytics.view_status(conn)
+    try:
+        # Rarely called; reuses the synchronous helper off the event loop
+        return json_response({"views": await asyncio.to_thread(status)})
+    except Exception as e:
+        print(f"Error in analytics_status: {str(e)}")
+        return json_response({"error": str(e)}, 500)
+
+
+@cached('list_merchants')
+async def list_merchants(request):
+    try:
+        merchants = await fetch_rows(queries.LIST_MERCHANTS)
+        if not merchants:
+            return json_response({"message": "No merchants found in database"}, 404)
+        result = [{"merchant_id": row['merchant_id'], "name": row['merchant_name']} for row in merchants]
+        return json_response({"merchants": result})
+    except Exception as e:
+        print(f"Error listing merchants: {str(e)}")
+        return json_response({"error": str(e)}, 500)
+
+
+async def debug_merchant(request):
+    merchant_id = request.path_params['merchant_id']
+    try:
+        merchant_info, tables = await asyncio.gather(
+            fetch_rows("SELECT * FROM merchants WHERE merchant_id = %s", (merchant_id,)),
+            fetch_rows("""
+            SELECT tablename FROM pg_catalog.pg_tables
+            WHERE schemaname != 'pg_catalog' AND schemaname != 'information_schema'
+            """),
+        )
+        if not merchant_info:
+            return json_response({"error": "Merchant not found", "id_requested": merchant_id}, 404)
+        return json_response({
+            "merchant_data": merchant_info[0],
+            "available_tables": [row['tablename'] for row in tables]
+        })
+    except Exception as e:
+        return json_response({"error": str(e)}, 500)
+
+
+async def pool_exhausted(request, exc):
+    """No connection freed up within DB_POOL_TIMEOUT; same 503 as the Flask app"""
+    print(f"Connection pool exhausted: {str(exc) or 'acquire timed out'}")
+    response = json_response({"error": "Server busy, please retry"}, 503)
+    response.headers['Retry-After'] = '1'
+    return response
+
+
+@asynccontextmanager
+async def lifespan(app):
+    global _pool
+    _pool = await create_pool()
+    try:
+        yield
+    finally:
+        await _pool.close()
+        _pool = None
+
+
+routes = [
+    route('/api/health', health_check),
+    route('/api/cache/stats', cache_statistics),
+    route('/api/metrics', metrics),
+    route('/api/metrics/slow', slow_queries),
+    section_route('/api/merchant/{merchant_id}/summary', 'summary', 'merchant_summary'),
+    route('/api/merchant/{merchant_id}/dashboard', merchant_dashboard),
+    section_route('/api/merchant/{merchant_id}/sales/daily', 'sales_daily', 'daily_sales'),
+    section_route('/api/merchant/{merchant_id}/sales/hourly', 'sales_hourly', 'hourly_sales'),
+    section_route('/api/merchant/{merchant_id}/sales/metrics', 'sales_metrics', 'sales_metrics'),
+    section_route('/api/merchant/{merchant_id}/items', 'items', 'merchant_items'),
+    section_route('/api/merchant/{merchant_id}/items/performance', 'items_performance', 'item_performance'),
+    section_route('/api/merchant/{merchant_id}/items/{item_id:int}/pairs', 'item_pairs', 'item_pairs'),
+    section_route('/api/merchant/{merchant_id}/insights', 'insights', 'merchant_insights'),
+    section_route('/api/merchant/{merchant_id}/keywords', 'keywords', 'merchant_keywords'),
+    section_route('/api/merchant/{merchant_id}/keywords/search', 'keyword_search', 'keyword_search'),
+    section_route('/api/merchant/{merchant_id}/analytics/daily', 'analytics_daily', 'analytics_daily'),
+    section_route('/api/merchant/{merchant_id}/analytics/products', 'analytics_products', 'analytics_products'),
+    section_route('/api/merchant/{merchant_id}/peers', 'peers', 'merchant_peers'),
+    section_route('/api/merchant/{merchant_id}/forecast', 'forecast', 'sales_forecast'),
+    route('/api/merchant/{merchant_id}/transactions', merchant_transactions),
+    route('/api/analytics/status', analytics_status),
+    route('/api/merchants', list_merchants),
+    route('/api/debug/merchant/{merchant_id}', debug_merchant),
+]
+
+instrumentation.register_gauges('api_db_pool', pool_stats)
+instrumentation.register_gauges('api_cache', cache_stats, counters=CACHE_COUNTERS)
+
+app = Starlette(
+    routes=routes,
+    middleware=[Middleware(CORSMiddleware, allow_origins=['*'], expose_headers=['ETag'])],
+    exception_handlers={asyncio.TimeoutError: pool_exhausted},
+    lifespan=lifespan,
+)
+
+if __name__ == '__main__':
+    import uvicorn
+
+    parser = argparse.ArgumentParser(description="Serve the merchant API on an ASGI server")
+    parser.add_argument("--host", default='0.0.0.0')
+    parser.add_argument("--port", type=int, default=5000)
+    parser.add_argument("--workers", type=int, default=1, help="processes, each with its own event loop and pool")
+    args = parser.parse_args()
+    uvicorn.run('asgi_server:app', host=args.host, port=args.port, workers=args.workers)
@@ -0,0 +1,250 @@
+"""Frequently-bought-together pairs from the items of each order.
+
+item_pairs holds, for every item, the BASKET_TOP_N items most often found in
+the same orders, so /api/merchant/<id>/items/<item_id>/pairs reads at most
+BASKET_TOP_N rows of one primary key range whatever the order history.
+
+The rebuild is one pass over transaction_items read through a named cursor
+in (merchant_id, order_id) order. Each order's distinct items are counted
+into a sparse item x item co-occurrence dict of the current merchant only;
+when the merchant changes its pairs are scored, written out and the dict is
+dropped. Memory is therefore bounded by the busiest merchant's catalogue
+(its distinct co-ordered pairs), not by the table, and the sort behind the
+cursor spills to disk on the server like any other. Rows go to item_pairs in
+COPY chunks of BASKET_COPY_ROWS inside the transaction that deleted the old
+ones, so readers see the previous pairs until it commits.
+
+For items A and B of a merchant with N orders (containing any item):
+
+    support     orders with A and B / N
+    confidence  orders with A and B / orders with A     P(B | A)
+    lift        confidence / (orders with B / N)        > 1: bought together more than by chance
+
+Pairs seen in fewer than BASKET_MIN_ORDERS orders are not kept. Each item's
+pairs are ranked by confidence, then lift. The importer rebuilds the pairs
+after every import.
+
+    python basket.py                           # rebuild
+    python basket.py --item ID                 # one item's pairs
+    python basket.py --check [--merchant ID]   # stored pairs against a SQL self-join
+"""
+import argparse
+import io
+import os
+import sys
+import time
+from itertools import combinations
+
+from db_connection import get_db_connection
+
+BASKET_TOP_N = int(os.getenv('BASKET_TOP_N', '10'))
+BASKET_MIN_ORDERS = int(os.getenv('BASKET_MIN_ORDERS', '2'))
+BASKET_BATCH_ROWS = int(os.getenv('BASKET_BATCH_ROWS', '10000'))
+BASKET_COPY_ROWS = int(os.getenv('BASKET_COPY_ROWS', '50000'))
+
+# Units of the same item in an order are one occurrence
+_ORDER_ITEMS = '''
+SELECT merchant_id, order_id, item_id
+FROM transaction_items
+WHERE merchant_id IS NOT NULL AND order_id IS NOT NULL AND item_id IS NOT NULL
+ORDER BY merchant_id, order_id
+'''
+
+_COPY_PAIRS = '''
+COPY item_pairs (item_id, rank, paired_item_id, pair_orders, item_orders, merchant_orders, support, confidence, lift)
+FROM STDIN
+'''
+
+
+def score(item_orders, pair_orders, merchant_orders, top_n=BASKET_TOP_N, min_orders=BASKET_MIN_ORDERS):
+    """Top pairs of one merchant's items: {item_id: [(paired_item_id, pair_orders, support, confidence, lift)]}"""
+    candidates = {}
+    for (a, b), n in pair_orders.items():
+        if n < min_orders:
+            continue
+        support = n / merchant_orders
+        for item, other in ((a, b), (b, a)):
+            confidence = n / item_orders[item]
+            lift = confidence * merchant_orders / item_orders[other]
+            candidates.setdefault(item, []).append((other, n, support, confidence, lift))
+    for item, pairs in candidates.items():
+        pairs.sort(key=lambda pair: (-pair[3], -pair[4], pair[0]))
+        del pairs[top_n:]
+    return candidates
+
+
+def _merchant_lines(item_orders, pair_orders, merchant_orders):
+    for item, pairs in score(item_orders, pair_orders, merchant_orders).items():
+        for rank, (other, n, support, confidence, lift) in enumerate(pairs, 1):
+            yield (f"{item}\t{rank}\t{other}\t{n}\t{item_orders[item]}\t{merchant_orders}\t"
+                   f"{support:.6g}\t{confidence:.6g}\t{lift:.6g}\n")
+
+
+def rebuild(cur):
+    """Recompute item_pairs in one pass over transaction_items; commits with the caller's transaction"""
+    reader = cur.connection.cursor(name='basket_order_items')
+    reader.itersize = BASKET_BATCH_ROWS
+    reader.execute(_ORDER_ITEMS)
+    cur.execute("DELETE FROM item_pairs")
+
+    out, pending = io.StringIO(), 0
+    stats = {"order_items": 0, "orders": 0, "merchants": 0, "pairs": 0}
+
+    def flush():
+        nonlocal out, pending
+        if pending:
+            out.seek(0)
+            cur.copy_expert(_COPY_PAIRS, out)
+        out, pending = io.StringIO(), 0
+
+    def finish_merchant():
+        nonlocal pending
+        if not merchant_orders:
+            return
+        for line in _merchant_lines(item_orders, pair_orders, merchant_orders):
+            out.write(line)
+            pending += 1
+            stats["pairs"] += 1
+        stats["merchants"] += 1
+        stats["orders"] += merchant_orders
+        if pending >= BASKET_COPY_ROWS:
+            flush()
+
+    def finish_order():
+        nonlocal merchant_orders
+        if not basket:
+            return
+        merchant_orders += 1
+        for item in basket:
+            item_orders[item] = item_orders.get(item, 0) + 1
+        for pair in combinations(sorted(basket), 2):
+            pair_orders[pair] = pair_orders.get(pair, 0) + 1
+
+    merchant, order = None, None
+    item_orders, pair_orders, merchant_orders, basket = {}, {}, 0, set()
+    try:
+        for merchant_id, order_id, item_id in reader:
+            stats["order_items"] += 1
+            if order_id != order or merchant_id != merchant:
+                finish_order()
+                basket = set()
+                order = order_id
+            if merchant_id != merchant:
+                finish_merchant()
+                item_orders, pair_orders, merchant_orders = {}, {}, 0
+                merchant = merchant_id
+            basket.add(item_id)
+        finish_order()
+        finish_merchant()
+        flush()
+    finally:
+        reader.close()
+    return stats
+
+
+def rebuild_pairs(conn=None):
+    own_conn = conn is None
+    if own_conn:
+        conn = get_db_connection()
+    try:
+        cur = conn.cursor()
+        started = time.monotonic()
+        stats = rebuild(cur)
+        conn.commit()
+        cur.execute("ANALYZE item_pairs")
+        conn.commit()
+        cur.close()
+        print(f"  item pairs: {stats['order_items']:,} order items of {stats['orders']:,} orders, "
+              f"{stats['pairs']:,} pairs for {stats['merchants']:,} merchants in {time.monotonic() - started:.2f}s")
+        return stats
+    finally:
+        if own_conn:
+            conn.close()
+
+
+# Pair counts of one merchant straight from transaction_items, for --check
+_EXACT_PAIRS = '''
+WITH baskets AS (
+    SELECT DISTINCT order_id, item_id
+    FROM transaction_items
+    WHERE merchant_id = %(merchant_id)s AND order_id IS NOT NULL AND item_id IS NOT NULL
+)
+SELECT
+    a.item_id,
+    b.item_id AS paired_item_id,
+    COUNT(*) AS pair_orders,
+    (SELECT COUNT(*) FROM baskets x WHERE x.item_id = a.item_id) AS item_orders,
+    (SELECT COUNT(DISTINCT order_id) FROM baskets) AS merchant_orders
+FROM baskets a
+JOIN baskets b ON b.order_id = a.order_id AND b.item_id <> a.item_id
+GROUP BY a.item_id, b.item_id
+'''
+
+_STORED_PAIRS = '''
+SELECT p.item_id, p.paired_item_id, p.pair_orders, p.item_orders, p.merchant_orders, p.confidence, p.lift
+FROM item_pairs p
+WHERE p.item_id IN (SELECT item_id FROM transaction_items WHERE merchant_id = %(merchant_id)s)
+'''
+
+
+def check(conn, merchant_id=None):
+    """Compare item_pairs with pair counts from a self-join; returns the number of failures"""
+    cur = conn.cursor()
+    if merchant_id:
+        merchants = [merchant_id]
+    else:
+        cur.execute("SELECT DISTINCT merchant_id FROM transaction_items WHERE merchant_id IS NOT NULL")
+        merchants = sorted(row[0] for row in cur.fetchall())
+    failures = compared = 0
+    for merchant in merchants:
+        cur.execute(_EXACT_PAIRS, {"merchant_id": merchant})
+        exact = {(a, b): (n, n_a, total) for a, b, n, n_a, total in cur.fetchall()}
+        cur.execute(_STORED_PAIRS, {"merchant_id": merchant})
+        stored = cur.fetchall()
+        per_item = {}
+        for a, b, n, n_a, total, confidence, lift in stored:
+            compared += 1
+            per_item[a] = per_item.get(a, 0) + 1
+            if exact.get((a, b)) != (n, n_a, total):
+                print(f"  {merchant} {a}->{b}: {n}/{n_a}/{total} orders, expected {exact.get((a, b))}")
+                failures += 1
+            elif abs(confidence - n / n_a) > 1e-5 * (n / n_a):
+                print(f"  {merchant} {a}->{b}: confidence {confidence}, expected {n / n_a}")
+                failures += 1
+        # Every item keeps min(top_n, its qualifying pairs)
+        qualifying = {}
+        for (a, _), (n, _, _) in exact.items():
+            if n >= BASKET_MIN_ORDERS:
+                qualifying[a] = qualifying.get(a, 0) + 1
+        for a, count in qualifying.items():
+            if per_item.get(a, 0) != min(count, BASKET_TOP_N):
+                print(f"  {merchant} item {a}: {per_item.get(a, 0)} pairs stored, expected {min(count, BASKET_TOP_N)}")
+                failures += 1
+    cur.close()
+    print(f"  {compared:,} stored pairs of {len(merchants):,} merchants compared")
+    return failures
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Rebuild, show or check the frequently-bought-together pairs")
+    parser.add_argument("--item", type=int, help="print this item's pairs instead of rebuilding")
+    parser.add_argument("--check", action="store_true", help="compare item_pairs with transaction_items")
+    parser.add_argument("--merchant", help="with --check, only this merchant")
+    args = parser.parse_args()
+
+    conn = get_db_connection()
+    failures = 0
+    try:
+        if args.item is not None:
+            from serialization import fetch_rows
+            for row in fetch_rows(conn, "SELECT * FROM item_pairs WHERE item_id = %s ORDER BY rank", (args.item,)):
+                print(f"  {row['rank']:>3}. item {row['paired_item_id']:<8} {row['pair_orders']:>6} orders  "
+                      f"confidence {row['confidence']:.3f}  lift {row['lift']:.2f}")
+        elif args.check:
+            failures = check(conn, args.merchant)
+            print("OK" if not failures else f"{failures} checks failed")
+        else:
+            rebuild_pairs(conn)
+    finally:
+        conn.close()
+    sys.exit(1 if failures else 0)
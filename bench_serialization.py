@@ -0,0 +1,128 @@
+"""Microbenchmark: pandas vs cursor-to-JSON serialization of API sections.
+
+    python bench_serialization.py --merchant ID [--repeat 50]
+
+For each section both paths run the same statements on the same connection:
+
+    pandas  pd.read_sql per statement, iterrows() with per-cell float()/int()
+            /pd.isna conversion, json.dumps (what the routes used to do)
+    cursor  serialization.fetch_rows + the section's shape + serialization.dumps
+
+and the median/p95 per request is printed. Cold start is measured by timing
+`import api_server` in a fresh interpreter, with and without pandas loaded.
+"""
+import argparse
+import json
+import statistics
+import subprocess
+import sys
+import time
+import warnings
+
+from werkzeug.datastructures import MultiDict
+
+from db_connection import get_db_connection
+from serialization import dumps
+import sections
+
+DEFAULT_SECTIONS = ['items_performance', 'keywords', 'sales_daily', 'items']
+
+# The old routes passed raw psycopg2 connections to read_sql too
+warnings.filterwarnings('ignore', message='pandas only supports SQLAlchemy')
+
+
+def _pandas_rows(pd, frame):
+    # The per-cell conversions the DataFrame routes did before jsonify
+    rows = []
+    for _, row in frame.iterrows():
+        out = {}
+        for column, value in row.items():
+            if pd.isna(value):
+                out[column] = None
+            elif hasattr(value, 'isoformat'):
+                out[column] = value.isoformat()
+            elif isinstance(value, (int, float)) or hasattr(value, 'as_integer_ratio'):
+                out[column] = float(value) if not float(value).is_integer() else int(value)
+            else:
+                out[column] = value if isinstance(value, str) else float(value)
+        rows.append(out)
+    return rows
+
+
+def run_pandas(conn, name, merchant_id, p):
+    import pandas as pd
+    _, plan, _ = sections.SECTIONS[name]
+    payload = {
+        key: _pandas_rows(pd, pd.read_sql(sql, conn, params=sql_params))
+        for key, (sql, sql_params) in plan(merchant_id, p).items()
+    }
+    return json.dumps(payload).encode('utf-8')
+
+
+def run_cursor(conn, name, merchant_id, p):
+    _, plan, shape = sections.SECTIONS[name]
+    results = {
+        key: sections.fetch_rows(conn, sql, sql_params)
+        for key, (sql, sql_params) in plan(merchant_id, p).items()
+    }
+    return dumps(shape(merchant_id, p, results))
+
+
+def _time(fn, repeat):
+    samples = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        fn()
+        samples.append((time.perf_counter() - started) * 1000)
+    samples.sort()
+    return statistics.median(samples), samples[int(len(samples) * 0.95) - 1]
+
+
+def bench_sections(merchant_id, names, repeat):
+    conn = get_db_connection()
+    try:
+        for name in names:
+            params, _, _ = sections.SECTIONS[name]
+            p = params(MultiDict())
+            try:
+                run_cursor(conn, name, merchant_id, p)
+            except sections.SectionError as e:
+                print(f"{name:<20} skipped ({e})")
+                continue
+            # Warm both paths (plans, pandas import) before timing
+            run_pandas(conn, name, merchant_id, p)
+            old = _time(lambda: run_pandas(conn, name, merchant_id, p), repeat)
+            new = _time(lambda: run_cursor(conn, name, merchant_id, p), repeat)
+            conn.rollback()
+            print(f"{name:<20} pandas {old[0]:7.2f} ms (p95 {old[1]:7.2f})"
+                  f"   cursor {new[0]:7.2f} ms (p95 {new[1]:7.2f})   x{old[0] / new[0]:.1f}")
+    finally:
+        conn.close()
+
+
+def bench_import(repeat=5):
+    cases = {
+        'api_server': 'import api_server',
+        'api_server + pandas': 'import pandas, api_server',
+    }
+    for label, code in cases.items():
+        samples = []
+        for _ in range(repeat):
+            started = time.perf_counter()
+            subprocess.run([sys.executable, '-c', code], check=True)
+            samples.append((time.perf_counter() - started) * 1000)
+        print(f"cold import {label:<22} {statistics.median(samples):7.0f} ms")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compare the pandas and cursor-to-JSON response paths")
+    parser.add_argument("--merchant", required=True, help="merchant_id to query")
+    parser.add_argument("--section", action="append", choices=list(sections.SECTIONS),
+                        help=f"section to time (repeatable, default: {', '.join(DEFAULT_SECTIONS)})")
+    parser.add_argument("--repeat", type=int, default=50, help="timed runs per path")
+    parser.add_argument("--skip-import", action="store_true", help="skip the cold import timing")
+    args = parser.parse_args()
+
+    bench_sections(args.merchant, args.section or DEFAULT_SECTIONS, args.repeat)
+    if not args.skip_import:
+        bench_import()
@@ -0,0 +1,293 @@
+"""Import throughput and API latency benchmark.
+
+Loads a data directory (usually from synthetic_data.py) into its own
+database, starts the API against it, drives every GET endpoint at a given
+concurrency and writes the results as JSON:
+
+    python synthetic_data.py --out /tmp/synthetic-10x --scale 10
+    python benchmark.py --data-dir /tmp/synthetic-10x --database grab_bench --reset
+    python benchmark.py --database grab_bench --skip-import --server asgi --concurrency 32
+    python benchmark.py --url http://localhost:5000 --skip-import     # a server already running
+    python benchmark.py ... --compare bench_results/<earlier run>.json
+
+For the import it reports rows/sec overall and per table; for each endpoint,
+requests/sec, p50/p95/p99 latency and errors (5xx or no response).
+Merchants are picked in proportion to their orders, like real traffic. The
+response cache is off unless --cache is given, so the database path is what
+is measured. With --compare, endpoints whose p50/p99 latency or throughput
+(or the import rate) got worse by more than --threshold are listed and the
+exit status is 1.
+"""
+import argparse
+import datetime
+import json
+import os
+import platform
+import random
+import subprocess
+import sys
+import time
+import urllib.error
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+
+import psycopg2
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+DEFAULT_OUTPUT_DIR = os.path.join(HERE, 'bench_results')
+# The database the app uses by default; --reset never drops it
+PROTECTED_DATABASE = 'grab_merchant_db'
+
+# Query strings for endpoints that need one
+QUERY_STRINGS = {
+    '/api/merchant/<merchant_id>/keywords/search': 'q=chi',
+}
+SKIPPED_PREFIXES = ('/api/debug/',)
+
+
+def reset_database(name):
+    """Drop and recreate `name` on the configured server"""
+    if name == PROTECTED_DATABASE:
+        raise SystemExit(f"Refusing to reset {PROTECTED_DATABASE}; benchmark into a database of its own")
+    conn = psycopg2.connect(host=os.getenv('DB_HOST', 'localhost'), database='postgres',
+                            user=os.getenv('DB_USER', 'postgres'), password=os.getenv('DB_PASSWORD', '123'))
+    conn.autocommit = True
+    cur = conn.cursor()
+    cur.execute(f'DROP DATABASE IF EXISTS "{name}"')
+    cur.execute(f'CREATE DATABASE "{name}"')
+    conn.close()
+
+
+def bench_import(data_dir, workers):
+    from import_data import import_to_db
+
+    started = time.monotonic()
+    result = import_to_db(data_dir, full=True, workers=workers)
+    seconds = time.monotonic() - started
+    tables = {
+        table: {"rows": stats['rows_loaded'], "seconds": round(stats['seconds'], 3),
+                "rows_per_sec": round(stats['rows_loaded'] / stats['seconds']) if stats['seconds'] else None}
+        for table, stats in result["tables"].items()
+    }
+    rows = sum(t["rows"] for t in tables.values())
+    return {
+        "seconds": round(seconds, 3),
+        "rows": rows,
+        "rows_per_sec": round(rows / seconds) if seconds else None,
+        "phases": {phase: round(s, 3) for phase, s in result["timings"].items()},
+        "tables": tables,
+    }
+
+
+def start_server(kind, port, asgi_workers, cache):
+    env = dict(os.environ, CACHE_ENABLED='1' if cache else '0')
+    if kind == 'asgi':
+        cmd = [sys.executable, 'asgi_server.py', '--host', '127.0.0.1', '--port', str(port),
+               '--workers', str(asgi_workers)]
+    else:
+        cmd = [sys.executable, '-c',
+               f"import api_server; api_server.app.run(host='127.0.0.1', port={port}, threaded=True)"]
+    server = subprocess.Popen(cmd, cwd=HERE, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    url = f"http://127.0.0.1:{port}"
+    deadline = time.monotonic() + 30
+    while time.monotonic() < deadline:
+        if server.poll() is not None:
+            raise RuntimeError(f"{kind} server exited with status {server.returncode}")
+        try:
+            urllib.request.urlopen(f"{url}/api/health", timeout=1).read()
+            return server, url
+        except OSError:
+            time.sleep(0.2)
+    server.terminate()
+    raise RuntimeError(f"{kind} server did not answer on {url} within 30s")
+
+
+def endpoints():
+    """GET routes of the API that need no more than a merchant, as (route, query string)"""
+    import api_server
+
+    routes = sorted(rule.rule for rule in api_server.app.url_map.iter_rules()
+                    if 'GET' in rule.methods and rule.rule.startswith('/api/')
+                    and not rule.rule.startswith(SKIPPED_PREFIXES)
+                    and rule.arguments <= {'merchant_id'})
+    return [(route, QUERY_STRINGS.get(route, '')) for route in routes]
+
+
+def merchant_weights():
+    """(merchant_ids, order counts) to pick request merchants from"""
+    from db_connection import get_db_connection
+
+    conn = get_db_connection()
+    try:
+        cur = conn.cursor()
+        cur.execute("""
+        SELECT m.merchant_id, COALESCE(SUM(r.order_count), 0) + 1
+        FROM merchants m LEFT JOIN sales_rollup r ON r.merchant_id = m.merchant_id
+        GROUP BY m.merchant_id ORDER BY m.merchant_id
+        """)
+        rows = cur.fetchall()
+    finally:
+        conn.close()
+    return [row[0] for row in rows], [row[1] for row in rows]
+
+
+def _get(url):
+    started = time.perf_counter()
+    try:
+        with urllib.request.urlopen(url, timeout=60) as response:
+            response.read()
+            status = response.status
+    except urllib.error.HTTPError as e:
+        status = e.code
+    except OSError:
+        status = None
+    return (time.perf_counter() - started) * 1000, status
+
+
+def _percentile(ordered, p):
+    return ordered[min(len(ordered) - 1, max(0, int(round(p / 100 * len(ordered))) - 1))]
+
+
+def drive(url, route, query, merchants, weights, requests, concurrency, rng):
+    urls = []
+    for _ in range(requests):
+        path = route.replace('<merchant_id>', rng.choices(merchants, weights=weights)[0])
+        urls.append(f"{url}{path}" + (f"?{query}" if query else ''))
+    # A few untimed requests so connections and plans are warm
+    for warm in urls[:concurrency]:
+        _get(warm)
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        results = list(pool.map(_get, urls))
+    seconds = time.perf_counter() - started
+    latencies = sorted(ms for ms, _ in results)
+    statuses = {}
+    for _, status in results:
+        statuses[str(status)] = statuses.get(str(status), 0) + 1
+    return {
+        "requests": requests,
+        "requests_per_sec": round(requests / seconds, 1),
+        "p50_ms": round(_percentile(latencies, 50), 2),
+        "p95_ms": round(_percentile(latencies, 95), 2),
+        "p99_ms": round(_percentile(latencies, 99), 2),
+        "max_ms": round(latencies[-1], 2),
+        "errors": sum(n for status, n in statuses.items() if status == 'None' or int(status) >= 500),
+        "statuses": statuses,
+    }
+
+
+def _git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=HERE, capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(old, new, threshold):
+    """Print the changes from an earlier result; returns the regressions"""
+    regressions = []
+
+    def check(label, before, after, higher_is_better):
+        if not before or after is None:
+            return
+        change = (after - before) / before
+        worse = -change if higher_is_better else change
+        flag = "  REGRESSION" if worse > threshold else ""
+        print(f"  {label:<58} {before:>10} -> {after:<10} {change:+7.1%}{flag}")
+        if flag:
+            regressions.append(label)
+
+    print(f"Compared with {old.get('started_at')} ({old.get('git_commit') or 'unknown commit'}):")
+    if old.get("import") and new.get("import"):
+        check("import rows/sec", old["import"]["rows_per_sec"], new["import"]["rows_per_sec"], True)
+    for route, result in new.get("endpoints", {}).items():
+        before = old.get("endpoints", {}).get(route)
+        if not before:
+            continue
+        check(f"{route} p50 ms", before["p50_ms"], result["p50_ms"], False)
+        check(f"{route} p99 ms", before["p99_ms"], result["p99_ms"], False)
+        check(f"{route} req/s", before["requests_per_sec"], result["requests_per_sec"], True)
+    return regressions
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the import and the API endpoints")
+    parser.add_argument("--data-dir", help="CSV directory to import (e.g. from synthetic_data.py)")
+    parser.add_argument("--database", default=os.getenv('DB_NAME', PROTECTED_DATABASE),
+                        help="database to import into and serve from")
+    parser.add_argument("--reset", action="store_true", help="drop and recreate --database first")
+    parser.add_argument("--skip-import", action="store_true", help="benchmark the data already loaded")
+    parser.add_argument("--workers", type=int, default=4, help="import connections")
+    parser.add_argument("--server", choices=["flask", "asgi"], default="flask", help="API server to start")
+    parser.add_argument("--asgi-workers", type=int, default=1, help="uvicorn processes for --server asgi")
+    parser.add_argument("--url", help="benchmark this running server instead of starting one")
+    parser.add_argument("--port", type=int, default=5099, help="port for the server started here")
+    parser.add_argument("--cache", action="store_true", help="leave the response cache on")
+    parser.add_argument("--requests", type=int, default=200, help="timed requests per endpoint")
+    parser.add_argument("--concurrency", type=int, default=8, help="requests in flight")
+    parser.add_argument("--endpoint", action="append", help="only routes containing this (repeatable)")
+    parser.add_argument("--seed", type=int, default=0, help="seed for the merchants requested")
+    parser.add_argument("--output", help=f"result file (default: {DEFAULT_OUTPUT_DIR}/<time>.json)")
+    parser.add_argument("--compare", help="earlier result file to compare with")
+    parser.add_argument("--threshold", type=float, default=0.10, help="relative change counted as a regression")
+    args = parser.parse_args()
+    if not args.skip_import and not args.data_dir:
+        parser.error("--data-dir is required unless --skip-import is given")
+
+    # Everything below (import, the server, merchant sampling) uses this database
+    os.environ['DB_NAME'] = args.database
+    started_at = datetime.datetime.now().isoformat(timespec='seconds')
+    results = {
+        "started_at": started_at,
+        "git_commit": _git_commit(),
+        "python": platform.python_version(),
+        "database": args.database,
+        "settings": {key: getattr(args, key) for key in
+                     ("server", "asgi_workers", "cache", "requests", "concurrency", "workers", "seed")},
+    }
+    manifest = os.path.join(args.data_dir, 'manifest.json') if args.data_dir else None
+    if manifest and os.path.exists(manifest):
+        with open(manifest) as f:
+            results["dataset"] = json.load(f)
+
+    if args.reset:
+        reset_database(args.database)
+    if not args.skip_import:
+        print(f"Importing {args.data_dir} into {args.database}...")
+        results["import"] = bench_import(args.data_dir, args.workers)
+        print(f"Import: {results['import']['rows']:,} rows in {results['import']['seconds']:.1f}s "
+              f"({results['import']['rows_per_sec']:,} rows/sec)")
+
+    server, url = None, args.url
+    if not url:
+        server, url = start_server(args.server, args.port, args.asgi_workers, args.cache)
+    try:
+        merchants, weights = merchant_weights()
+        rng = random.Random(args.seed)
+        results["endpoints"] = {}
+        print(f"{'endpoint':<48} {'req/s':>8} {'p50':>8} {'p95':>8} {'p99':>8} {'errors':>7}")
+        for route, query in endpoints():
+            if args.endpoint and not any(part in route for part in args.endpoint):
+                continue
+            result = drive(url, route, query, merchants, weights, args.requests, args.concurrency, rng)
+            results["endpoints"][route] = result
+            print(f"{route:<48} {result['requests_per_sec']:>8} {result['p50_ms']:>8} "
+                  f"{result['p95_ms']:>8} {result['p99_ms']:>8} {result['errors']:>7}")
+    finally:
+        if server:
+            server.terminate()
+            server.wait()
+
+    output = args.output or os.path.join(DEFAULT_OUTPUT_DIR, f"{started_at.replace(':', '')}.json")
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, 'w') as f:
+        json.dump(results, f, indent=2)
+    print(f"Results written to {output}")
+
+    if args.compare:
+        with open(args.compare) as f:
+            regressions = compare(json.load(f), results, args.threshold)
+        if regressions:
+            print(f"{len(regressions)} regressions beyond {args.threshold:.0%}")
+            sys.exit(1)
@@ -0,0 +1,561 @@
+"""Streaming COPY loader for the merchant CSV files.
+
+Files are read in bounded chunks of lines, transformed row by row in Python
+(column renames, dropped columns, type checks) and pushed to Postgres with
+COPY. A chunk that Postgres rejects is split in half and retried, so one bad
+row only costs a few extra COPYs instead of dropping the whole batch or
+falling back to row-at-a-time INSERTs. Rejected rows are written to a
+per-table reject file together with the error.
+
+Loads are incremental and resumable. Progress is tracked per table in
+import_state: the byte offset of the last committed chunk (committed in the
+same transaction as the chunk's rows) and a watermark on order_time. A
+re-run continues after the last committed chunk when the file is the same
+(crash resume, or an append-only file that has grown), or otherwise scans
+the new file and ingests new orders at/after the watermark along with
+updates to orders already loaded, whatever their time. Rows are merged
+with INSERT ... ON CONFLICT so overlapping deltas are harmless.
+"""
+import csv
+import datetime
+import hashlib
+import io
+import os
+import time
+
+import psycopg2
+
+import partitions
+import rollups
+
+DEFAULT_CHUNK_ROWS = int(os.getenv('IMPORT_CHUNK_ROWS', '50000'))
+
+# Bytes hashed before a checkpoint to recognise the same file on the next run
+FINGERPRINT_BYTES = 65536
+
+
+def _to_int(value):
+    if value == '':
+        return None
+    try:
+        return int(value)
+    except ValueError:
+        # pandas-written files sometimes carry integral floats such as "3.0"
+        number = float(value)
+        if not number.is_integer():
+            raise ValueError(f"not an integer: {value!r}")
+        return int(number)
+
+
+def _to_numeric(value):
+    if value == '':
+        return None
+    float(value)
+    return value
+
+
+def _to_text(value):
+    return value if value != '' else None
+
+
+# Per table: source file, target columns with the CSV column each is read
+# from and its converter, and how a chunk reaches the table:
+#   upsert   - staged, then merged with INSERT ... ON CONFLICT
+#   append   - no natural key; COPYed straight in on a first load, otherwise
+#              staged and merged while skipping orders already loaded
+#   snapshot - the file is the whole table; replaced atomically when it changes
+# `depends_on` lists the tables that must be loaded first (foreign keys), and
+# `since_column` names the timestamp compared against the watermark.
+# `partitioned` tables get the partitions a chunk needs before it is merged
+# (see partitions.py). `references` lists parent keys Postgres cannot enforce
+# with a foreign key (order_id alone is not unique in the partitioned
+# transaction_data); rows without a parent are removed after the load and
+# written to the reject file (see import_pipeline.remove_unreferenced).
+TABLES = {
+    'merchants': {
+        'file': 'merchant.csv',
+        'mode': 'upsert',
+        'depends_on': [],
+        'columns': [
+            ('merchant_id', 'merchant_id', _to_text),
+            ('merchant_name', 'merchant_name', _to_text),
+            ('join_date', 'join_date', _to_text),
+            ('city_id', 'city_id', _to_int),
+        ],
+        'merge': '''
+            INSERT INTO merchants AS m (merchant_id, merchant_name, join_date, city_id)
+            SELECT DISTINCT ON (merchant_id) merchant_id, merchant_name, join_date, city_id
+            FROM {stage}
+            ORDER BY merchant_id, ctid DESC
+            ON CONFLICT (merchant_id) DO UPDATE SET
+                merchant_name = EXCLUDED.merchant_name,
+                join_date = EXCLUDED.join_date,
+                city_id = EXCLUDED.city_id
+            WHERE (m.merchant_name, m.join_date, m.city_id)
+                IS DISTINCT FROM (EXCLUDED.merchant_name, EXCLUDED.join_date, EXCLUDED.city_id)
+        ''',
+    },
+    'items': {
+        'file': 'items.csv',
+        'mode': 'upsert',
+        'depends_on': ['merchants'],
+        'columns': [
+            ('item_id', 'item_id', _to_int),
+            ('cuisine_tag', 'cuisine_tag', _to_text),
+            ('item_name', 'item_name', _to_text),
+            ('item_price', 'item_price', _to_numeric),
+            ('merchant_id', 'merchant_id', _to_text),
+        ],
+        'merge': '''
+            INSERT INTO items AS i (item_id, cuisine_tag, item_name, item_price, merchant_id)
+            SELECT DISTINCT ON (item_id) item_id, cuisine_tag, item_name, item_price, merchant_id
+            FROM {stage}
+            ORDER BY item_id, ctid DESC
+            ON CONFLICT (item_id) DO UPDATE SET
+                cuisine_tag = EXCLUDED.cuisine_tag,
+                item_name = EXCLUDED.item_name,
+                item_price = EXCLUDED.item_price,
+                merchant_id = EXCLUDED.merchant_id
+            WHERE (i.cuisine_tag, i.item_name, i.item_price, i.merchant_id)
+                IS DISTINCT FROM (EXCLUDED.cuisine_tag, EXCLUDED.item_name, EXCLUDED.item_price, EXCLUDED.merchant_id)
+        ''',
+    },
+    'transaction_data': {
+        'file': 'transaction_data.csv',
+        'mode': 'upsert',
+        'depends_on': ['merchants'],
+        'since_column': 'order_time',
+        'partitioned': True,
+        'columns': [
+            ('order_id', 'order_id', _to_text),
+            ('order_time', 'order_time', _to_text),
+            ('driver_arrival_time', 'driver_arrival_time', _to_text),
+            ('driver_pickup_time', 'driver_pickup_time', _to_text),
+            ('delivery_time', 'delivery_time', _to_text),
+            ('order_value', 'order_value', _to_numeric),
+            ('eater_id', 'eater_id', _to_int),
+            ('merchant_id', 'merchant_id', _to_text),
+        ],
+        # The export repeats some order_ids, and deltas re-send orders whose
+        # driver timestamps were filled in later: the last occurrence wins
+        # (ctid follows COPY order in the freshly truncated stage). The key
+        # includes order_time, so an order whose order_time changed is
+        # deleted from its old partition and inserted into the new one.
+        # Below the watermark only orders already loaded are merged, so
+        # their late updates land without bringing back older orders.
+        'merge': '''
+            WITH latest AS (
+                SELECT DISTINCT ON (order_id) *
+                FROM {stage}
+                ORDER BY order_id, ctid DESC
+            ), wanted AS (
+                SELECT * FROM latest l
+                WHERE %(since)s::timestamp IS NULL OR l.order_time >= %(since)s::timestamp
+                OR l.order_time IS NULL
+                OR EXISTS (SELECT 1 FROM transaction_data td WHERE td.order_id = l.order_id)
+            ), moved AS (
+                DELETE FROM transaction_data td
+                USING wanted w
+                WHERE td.order_id = w.order_id AND td.order_time <> w.order_time
+            )
+            INSERT INTO transaction_data AS td
+            SELECT * FROM wanted
+            ON CONFLICT (order_id, order_time) DO UPDATE SET
+                driver_arrival_time = EXCLUDED.driver_arrival_time,
+                driver_pickup_time = EXCLUDED.driver_pickup_time,
+                delivery_time = EXCLUDED.delivery_time,
+                order_value = EXCLUDED.order_value,
+                eater_id = EXCLUDED.eater_id,
+                merchant_id = EXCLUDED.merchant_id
+            WHERE (td.driver_arrival_time, td.driver_pickup_time, td.delivery_time,
+                   td.order_value, td.eater_id, td.merchant_id)
+                IS DISTINCT FROM (EXCLUDED.driver_arrival_time, EXCLUDED.driver_pickup_time,
+                                  EXCLUDED.delivery_time, EXCLUDED.order_value, EXCLUDED.eater_id, EXCLUDED.merchant_id)
+        ''',
+    },
+    'transaction_items': {
+        'file': 'transaction_items.csv',
+        'mode': 'append',
+        'depends_on': ['transaction_data', 'items', 'merchants'],
+        # Items have no timestamp of their own; they follow their order's
+        # order_time, so their watermark is taken from transaction_data
+        'watermark_from': 'transaction_data',
+        'references': [(['order_id'], 'transaction_data', ['order_id'])],
+        'columns': [
+            ('order_id', 'order_id', _to_text),
+            ('item_id', 'item_id', _to_int),
+            ('merchant_id', 'merchant_id', _to_text),
+        ],
+        # Skip orders whose items were already present before this run
+        # (ids up to baseline_id); rows of the same order inserted earlier in
+        # this run are above the baseline, so orders split across chunks load
+        # completely. Orphans are kept until the reference check rejects them.
+        'merge': '''
+            INSERT INTO transaction_items (order_id, item_id, merchant_id)
+            SELECT s.order_id, s.item_id, s.merchant_id
+            FROM {stage} s
+            LEFT JOIN transaction_data td ON td.order_id = s.order_id
+            WHERE (td.order_id IS NULL OR %(since)s::timestamp IS NULL OR td.order_time >= %(since)s::timestamp)
+            AND NOT EXISTS (
+                SELECT 1 FROM transaction_items ti
+                WHERE ti.order_id = s.order_id AND ti.id <= %(baseline_id)s
+            )
+        ''',
+    },
+    'keywords': {
+        'file': 'keywords.csv',
+        'mode': 'snapshot',
+        'depends_on': [],
+        # The CSV starts with an unnamed pandas index column (ignored because
+        # it is not mapped) and calls the order count 'order'
+        'columns': [
+            ('keyword', 'keyword', _to_text),
+            ('view', 'view', _to_int),
+            ('menu', 'menu', _to_int),
+            ('checkout', 'checkout', _to_int),
+            ('order_count', 'order', _to_int),
+        ],
+        'merge': None,
+    },
+}
+
+# Parents before children so foreign keys resolve
+LOAD_ORDER = ['merchants', 'items', 'transaction_data', 'transaction_items', 'keywords']
+
+
+def read_chunks(path, chunk_rows=DEFAULT_CHUNK_ROWS, start_offset=None):
+    """Yield (header, rows, end_offset) for consecutive chunks of a CSV file.
+
+    Only `chunk_rows` lines are held in memory at a time. `end_offset` is the
+    byte position just after the chunk, so a load can later resume from it.
+    Quoted fields spanning lines are kept within one chunk.
+    """
+    with open(path, 'rb') as f:
+        header = next(csv.reader([f.readline().decode('utf-8-sig')]))
+        if start_offset:
+            f.seek(start_offset)
+
+        while True:
+            lines = []
+            for raw in f:
+                lines.append(raw)
+                if len(lines) >= chunk_rows and _balanced(lines):
+                    break
+            if not lines:
+                return
+            text = b''.join(lines).decode('utf-8')
+            rows = [row for row in csv.reader(io.StringIO(text)) if row]
+            yield header, rows, f.tell()
+
+
+def _balanced(lines):
+    # An odd number of quote characters means a quoted field is still open
+    return sum(line.count(b'"') for line in lines) % 2 == 0
+
+
+def file_fingerprint(path, offset):
+    """Hash of the header plus the bytes just before `offset`"""
+    with open(path, 'rb') as f:
+        header = f.readline()
+        start = max(len(header), offset - FINGERPRINT_BYTES)
+        f.seek(start)
+        tail = f.read(max(0, offset - start))
+    return hashlib.sha1(header + tail).hexdigest()
+
+
+def _column_indexes(spec, header):
+    positions = {name: i for i, name in enumerate(header)}
+    missing = [source for _, source, _ in spec['columns'] if source not in positions]
+    if missing:
+        raise ValueError(f"{spec['file']} is missing columns: {', '.join(missing)}")
+    return [(positions[source], convert) for _, source, convert in spec['columns']]
+
+
+def transform_rows(spec, header, rows, rejects):
+    """Map CSV rows onto the target columns; rows failing conversion go to `rejects`"""
+    indexes = _column_indexes(spec, header)
+    out = []
+    for row in rows:
+        try:
+            out.append(tuple(convert(row[i]) for i, convert in indexes))
+        except (ValueError, IndexError) as e:
+            rejects.append((row, f"transform: {e}"))
+    return out
+
+
+def _parse_time(value):
+    try:
+        return datetime.datetime.fromisoformat(value) if value else None
+    except ValueError:
+        return None
+
+
+def newest_row(spec, rows):
+    """Max (time, order_id) of the rows, the candidate watermark; None without a since_column.
+
+    Rows are not filtered here: the merge compares them with the watermark,
+    as only Postgres knows which older orders are already loaded.
+    """
+    column = spec.get('since_column')
+    if column is None:
+        return None
+    position = [name for name, _, _ in spec['columns']].index(column)
+
+    newest = None
+    for row in rows:
+        # Unparseable or missing times are left for Postgres to reject
+        stamp = _parse_time(row[position])
+        if stamp is None:
+            continue
+        key = (stamp, row[0] or '')
+        if newest is None or key > newest:
+            newest = key
+    return newest
+
+
+def _copy_buffer(rows):
+    buf = io.StringIO()
+    # None is written as an unquoted empty field, which COPY ... CSV reads as NULL
+    csv.writer(buf, lineterminator='\n').writerows(rows)
+    buf.seek(0)
+    return buf
+
+
+def _target_columns(spec):
+    return ', '.join(column for column, _, _ in spec['columns'])
+
+
+def _stage_name(table):
+    return f"stage_{table}"
+
+
+def prepare_stage(cur, table):
+    """Create the session-local staging table used for merged loads"""
+    spec = TABLES[table]
+    if spec['merge'] is None:
+        return
+    cur.execute(f'''
+    CREATE TEMP TABLE IF NOT EXISTS {_stage_name(table)}
+    AS SELECT {_target_columns(spec)} FROM {table} WITH NO DATA
+    ''')
+
+
+def _write_rows(cur, table, rows, params):
+    """COPY one batch (and merge it when staged); returns rows added to the table"""
+    spec = TABLES[table]
+    columns = _target_columns(spec)
+    if spec['merge'] is None or params.get('direct'):
+        cur.copy_expert(f"COPY {table} ({columns}) FROM STDIN WITH (FORMAT csv)", _copy_buffer(rows))
+        return cur.rowcount
+
+    stage = _stage_name(table)
+    cur.execute(f"TRUNCATE {stage}")
+    cur.copy_expert(f"COPY {stage} ({columns}) FROM STDIN WITH (FORMAT csv)", _copy_buffer(rows))
+    if spec.get('partitioned'):
+        partitions.ensure_for_stage(cur, stage)
+    for name in params.get('rollups', ()):
+        rollups.record_touched(cur, name, stage, table)
+    cur.execute(spec['merge'].format(stage=stage), params)
+    return cur.rowcount
+
+
+def load_batch(cur, table, rows, rejects, params=None):
+    """Load rows inside a savepoint, bisecting around rows Postgres refuses"""
+    if not rows:
+        return 0
+    params = params or {}
+    cur.execute("SAVEPOINT load_batch")
+    try:
+        added = _write_rows(cur, table, rows, params)
+        cur.execute("RELEASE SAVEPOINT load_batch")
+        return added
+    except psycopg2.Error as e:
+        cur.execute("ROLLBACK TO SAVEPOINT load_batch")
+        cur.execute("RELEASE SAVEPOINT load_batch")
+        if len(rows) == 1:
+            rejects.append((rows[0], (e.pgerror or str(e)).strip().splitlines()[0]))
+            return 0
+        middle = len(rows) // 2
+        return (load_batch(cur, table, rows[:middle], rejects, params)
+                + load_batch(cur, table, rows[middle:], rejects, params))
+
+
+def _write_rejects(reject_dir, table, rejects):
+    if not rejects or not reject_dir:
+        return None
+    os.makedirs(reject_dir, exist_ok=True)
+    path = os.path.join(reject_dir, f"{table}.rejects.csv")
+    with open(path, 'a', newline='') as f:
+        writer = csv.writer(f)
+        for row, error in rejects:
+            writer.writerow(list(row) + [error])
+    return path
+
+
+# IMPORT STATE
+
+STATE_COLUMNS = [
+    'source_file', 'status', 'byte_offset', 'fingerprint', 'rows_committed',
+    'watermark_time', 'watermark_order_id', 'run_since', 'run_max_time',
+    'run_max_order_id', 'run_baseline_id', 'started_at',
+]
+
+
+def get_state(cur, table):
+    cur.execute(f"SELECT {', '.join(STATE_COLUMNS)} FROM import_state WHERE table_name = %s", (table,))
+    row = cur.fetchone()
+    return dict(zip(STATE_COLUMNS, row)) if row else None
+
+
+def save_state(cur, table, **fields):
+    columns = ['table_name'] + list(fields)
+    placeholders = ', '.join(['%s'] * len(columns))
+    updates = ', '.join(f"{c} = EXCLUDED.{c}" for c in fields)
+    cur.execute(f'''
+    INSERT INTO import_state ({', '.join(columns)}, updated_at)
+    VALUES ({placeholders}, NOW())
+    ON CONFLICT (table_name) DO UPDATE SET {updates}, updated_at = NOW()
+    ''', [table] + list(fields.values()))
+
+
+def reset_state(cur, table=None):
+    """Forget checkpoints and watermarks so the next run reprocesses whole files"""
+    if table is None:
+        cur.execute("DELETE FROM import_state")
+    else:
+        cur.execute("DELETE FROM import_state WHERE table_name = %s", (table,))
+
+
+def plan_run(cur, table, path, state):
+    """Decide where this run starts: (start_offset, since, resumed)"""
+    if state is None:
+        return 0, None, False
+    size = os.path.getsize(path)
+    same_file = (
+        state['source_file'] == os.path.abspath(path)
+        and state['byte_offset'] <= size
+        and state['fingerprint'] == file_fingerprint(path, state['byte_offset'])
+    )
+    if same_file and state['status'] == 'running':
+        # Crashed or interrupted: carry on after the last committed chunk
+        return state['byte_offset'], state['run_since'], True
+    if same_file and TABLES[table]['mode'] != 'snapshot':
+        # Completed before; anything past the old end of file is new
+        return state['byte_offset'], None, True
+    # A different (or rewritten) file: scan it; the merge keeps new orders
+    # at/after the watermark and updates to ones already loaded
+    return 0, state['watermark_time'], False
+
+
+def load_table(conn, table, path, chunk_rows=DEFAULT_CHUNK_ROWS, reject_dir=None):
+    """Stream one CSV into its table, committing rows and checkpoint after every chunk"""
+    spec = TABLES[table]
+    cur = conn.cursor()
+    prepare_stage(cur, table)
+    # Rollups waiting for a full rebuild after a bulk load are left alone
+    maintained = [name for name in rollups.rollups_for(table) if not rollups.is_deferred(cur, name)]
+    for name in maintained:
+        rollups.prepare_touched(cur, name)
+    conn.commit()
+
+    stats = {"table": table, "rows_read": 0, "rows_loaded": 0, "rows_rejected": 0, "resumed": False}
+    state = get_state(cur, table)
+    size = os.path.getsize(path)
+
+    if state and state['status'] == 'completed' and state['byte_offset'] == size \
+            and state['source_file'] == os.path.abspath(path) \
+            and state['fingerprint'] == file_fingerprint(path, size):
+        print(f"  {table}: {path} unchanged since the last import, skipping")
+        conn.commit()
+        cur.close()
+        stats["seconds"] = 0.0
+        return stats
+
+    start_offset, since, resumed = plan_run(cur, table, path, state)
+    stats["resumed"] = resumed and start_offset > 0
+    if resumed and state['status'] == 'running':
+        baseline_id = state['run_baseline_id']
+        run_max = (state['run_max_time'], state['run_max_order_id'] or '') if state['run_max_time'] else None
+        rows_committed = state['rows_committed']
+        started_at = state['started_at']
+        print(f"  {table}: resuming at byte {start_offset:,} ({rows_committed:,} rows already committed)")
+    else:
+        baseline_id = None
+        if spec['mode'] == 'append':
+            cur.execute(f"SELECT COALESCE(MAX(id), 0) FROM {table}")
+            baseline_id = cur.fetchone()[0]
+        run_max, rows_committed, started_at = None, 0, datetime.datetime.now()
+        if start_offset:
+            print(f"  {table}: continuing after byte {start_offset:,} of a previously imported file")
+        elif since is not None:
+            print(f"  {table}: loading new rows at/after watermark {since} and updates to older ones")
+
+    params = {
+        "since": since,
+        "baseline_id": baseline_id,
+        # First load of an append-only table: nothing to de-duplicate against
+        # (and no rollup to keep current chunk by chunk)
+        "direct": spec['mode'] == 'append' and not baseline_id and since is None and not maintained,
+        "rollups": maintained,
+    }
+
+    if spec['mode'] == 'snapshot':
+        # Whole-table replacement in one transaction; readers keep seeing the
+        # old rows until the final commit
+        cur.execute(f"DELETE FROM {table}")
+
+    total_bytes = size or 1
+    started = time.monotonic()
+    offset = start_offset
+    for header, rows, offset in read_chunks(path, chunk_rows, start_offset):
+        rejects = []
+        batch = transform_rows(spec, header, rows, rejects)
+        newest = newest_row(spec, batch)
+        if newest is not None and (run_max is None or newest > run_max):
+            run_max = newest
+        stats["rows_loaded"] += load_batch(cur, table, batch, rejects, params)
+        for name in maintained:
+            rollups.refresh_touched(cur, name)
+
+        stats["rows_read"] += len(rows)
+        stats["rows_rejected"] += len(rejects)
+        rows_committed += len(rows)
+        if spec['mode'] != 'snapshot':
+            # Checkpoint in the same transaction as the chunk's rows
+            save_state(cur, table,
+                       source_file=os.path.abspath(path), status='running',
+                       byte_offset=offset, fingerprint=file_fingerprint(path, offset),
+                       rows_committed=rows_committed, run_since=since,
+                       run_max_time=run_max[0] if run_max else None,
+                       run_max_order_id=run_max[1] if run_max else None,
+                       run_baseline_id=baseline_id, started_at=started_at)
+            conn.commit()
+        _write_rejects(reject_dir, table, rejects)
+
+        elapsed = time.monotonic() - started
+        rate = stats["rows_read"] / elapsed if elapsed > 0 else 0
+        print(f"  {table}: {stats['rows_read']:,} rows read, {stats['rows_loaded']:,} loaded, "
+              f"{stats['rows_rejected']:,} rejected "
+              f"({offset / total_bytes:.0%}, {rate:,.0f} rows/s)")
+
+    # Advance the watermark only once the whole file is in
+    watermark_time = state['watermark_time'] if state else None
+    watermark_order_id = state['watermark_order_id'] if state else None
+    if spec.get('watermark_from'):
+        parent = get_state(cur, spec['watermark_from'])
+        if parent:
+            watermark_time, watermark_order_id = parent['watermark_time'], parent['watermark_order_id']
+    elif run_max is not None and (watermark_time is None or run_max > (watermark_time, watermark_order_id or '')):
+        watermark_time, watermark_order_id = run_max
+
+    save_state(cur, table,
+               source_file=os.path.abspath(path), status='completed',
+               byte_offset=offset, fingerprint=file_fingerprint(path, offset),
+               rows_committed=rows_committed, watermark_time=watermark_time,
+               watermark_order_id=watermark_order_id, run_since=None,
+               run_max_time=None, run_max_order_id=None, run_baseline_id=None,
+               started_at=started_at)
+    conn.commit()
+    cur.close()
+    stats["seconds"] = round(time.monotonic() - started, 3)
+    return stats
@@ -0,0 +1,366 @@
+"""Response cache for the merchant API.
+
+Responses are cached under the route, its URL arguments (merchant_id) and
+the sorted, re-encoded query string, prefixed with the current data version. The
+version lives in the data_version table and is bumped whenever an import
+or a view refresh changes what the endpoints would return, so entries from
+before an import simply stop matching and age out of the LRU.
+
+Two tiers:
+    LRUCache       bounded, per process, checked first
+    shared backend optional store shared by all API processes: Redis when
+                   configured (CACHE_BACKEND=redis), or MemoryBackend, an
+                   in-process stand-in with the same semantics for tests
+
+Each endpoint has its own TTL (TTLS), which also bounds how long answers
+relative to NOW()/CURRENT_DATE can lag behind the clock. Endpoints answering
+from data written outside imports (SCOPE_VERSIONS, e.g. the forecasting job)
+also key on a version of their own, so that writer does not have to bump
+data_version and flush every other endpoint.
+"""
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+from functools import wraps
+from urllib.parse import quote, urlencode
+
+from db_connection import pooled_connection
+from conditional import content_etag
+
+try:
+    import redis
+except ImportError:  # optional; only needed for CACHE_BACKEND=redis
+    redis = None
+
+CACHE_ENABLED = os.getenv('CACHE_ENABLED', '1') == '1'
+CACHE_MAX_ENTRIES = int(os.getenv('CACHE_MAX_ENTRIES', '1024'))
+CACHE_DEFAULT_TTL = float(os.getenv('CACHE_DEFAULT_TTL', '300'))
+CACHE_BACKEND = os.getenv('CACHE_BACKEND', 'local')
+CACHE_REDIS_URL = os.getenv('CACHE_REDIS_URL', 'redis://localhost:6379/0')
+# How often (seconds) a process re-reads data_version
+CACHE_VERSION_CHECK = float(os.getenv('CACHE_VERSION_CHECK', '2'))
+
+# Seconds per endpoint (Flask endpoint name)
+TTLS = {
+    'merchant_summary': 60,
+    'merchant_dashboard': 60,
+    'daily_sales': 300,
+    'hourly_sales': 900,
+    'sales_metrics': 300,
+    'merchant_items': 900,
+    'item_performance': 300,
+    'merchant_insights': 900,
+    'merchant_keywords': 900,
+    'keyword_search': 900,
+    'analytics_daily': 900,
+    'analytics_products': 900,
+    'merchant_peers': 900,
+    'sales_forecast': 900,
+    'item_pairs': 900,
+    'list_merchants': 900,
+}
+
+# Endpoint -> SQL reading its own version, re-read like data_version
+SCOPE_VERSIONS = {
+    'sales_forecast': "SELECT MAX(id) FROM forecast_runs",
+}
+
+
+class LRUCache:
+    """Thread-safe LRU of (value, expires_at) with hit/miss/eviction counters"""
+
+    def __init__(self, max_entries=CACHE_MAX_ENTRIES):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = self.misses = self.evictions = self.expirations = 0
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            value, expires_at = entry
+            if expires_at <= time.monotonic():
+                del self._entries[key]
+                self.expirations += 1
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def set(self, key, value, ttl):
+        with self._lock:
+            self._entries[key] = (value, time.monotonic() + ttl)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self._entries),
+                "max_entries": self.max_entries,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": round(self.hits / lookups, 4) if lookups else None,
+                "evictions": self.evictions,
+                "expirations": self.expirations,
+            }
+
+
+class MemoryBackend:
+    """In-process stand-in for the shared backend (TTL expiry, no eviction)"""
+
+    name = 'memory'
+
+    def __init__(self):
+        self._entries = {}
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[1] <= time.monotonic():
+                self._entries.pop(key, None)
+                return None
+            return entry[0]
+
+    def set(self, key, value, ttl):
+        with self._lock:
+            self._entries[key] = (value, time.monotonic() + ttl)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+class RedisBackend:
+    """Shared backend on Redis; entries expire through Redis TTLs"""
+
+    name = 'redis'
+
+    def __init__(self, url=CACHE_REDIS_URL, prefix='gma:'):
+        if redis is None:
+            raise RuntimeError("CACHE_BACKEND=redis needs the redis package")
+        self.client = redis.Redis.from_url(url, socket_timeout=0.2)
+        self.prefix = prefix
+
+    def get(self, key):
+        return self.client.get(self.prefix + key)
+
+    def set(self, key, value, ttl):
+        self.client.set(self.prefix + key, value, px=int(ttl * 1000))
+
+    def clear(self):
+        for key in self.client.scan_iter(self.prefix + '*'):
+            self.client.delete(key)
+
+
+def _make_backend(name):
+    if name == 'redis':
+        return RedisBackend()
+    if name == 'memory':
+        return MemoryBackend()
+    return None
+
+
+class ResponseCache:
+    """Local LRU in front of an optional shared backend, keyed by data version"""
+
+    def __init__(self, local=None, shared=None, enabled=CACHE_ENABLED):
+        self.local = local or LRUCache()
+        self.shared = shared
+        self.enabled = enabled
+        self.shared_hits = self.shared_misses = self.shared_errors = 0
+        self._version = None
+        self._version_checked = 0.0
+        self._scopes = {}  # endpoint -> (version, checked)
+        self._lock = threading.Lock()
+
+    def data_version(self):
+        """Current data_version, re-read at most every CACHE_VERSION_CHECK seconds"""
+        now = time.monotonic()
+        if self._version is None or now - self._version_checked >= CACHE_VERSION_CHECK:
+            with self._lock:
+                if self._version is None or now - self._version_checked >= CACHE_VERSION_CHECK:
+                    self._version = read_data_version()
+                    self._version_checked = now
+        return self._version
+
+    def scope_version(self, endpoint):
+        """The endpoint's SCOPE_VERSIONS value (None when it has none), re-read like data_version"""
+        if endpoint not in SCOPE_VERSIONS:
+            return None
+        now = time.monotonic()
+        value, checked = self._scopes.get(endpoint, (None, 0.0))
+        if value is None or now - checked >= CACHE_VERSION_CHECK:
+            value = read_scope_version(endpoint)
+            self._scopes[endpoint] = (value, now)
+        return value
+
+    def key(self, endpoint, view_args, query_args, version=None, scope=None):
+        """Cache key; callers that read data_version and the scope version
+        themselves (asgi_server) pass them in"""
+        if version is None:
+            version = self.data_version()
+        if scope is None:
+            scope = self.scope_version(endpoint)
+        # Values are quoted, so one carrying "&", "=" or "|" cannot pass for
+        # several arguments (?q=a%26limit%3D5 is not ?q=a&limit=5)
+        parts = [endpoint] + [f"{k}={quote(str(v), safe='')}" for k, v in sorted(view_args.items())]
+        if scope is not None:
+            parts.append(f"scope={scope}")
+        return f"v{version}|{'|'.join(parts)}?{urlencode(sorted(query_args))}"
+
+    def get(self, key, ttl=CACHE_DEFAULT_TTL):
+        value = self.local.get(key)
+        if value is not None or self.shared is None:
+            return value
+        try:
+            value = self.shared.get(key)
+        except Exception as e:
+            # A shared store outage must not take the API down
+            self.shared_errors += 1
+            print(f"Shared cache error: {str(e)}")
+            return None
+        if value is None:
+            self.shared_misses += 1
+            return None
+        self.shared_hits += 1
+        # Served by another process; keep a local copy for this one
+        self.local.set(key, value, ttl)
+        return value
+
+    def set(self, key, value, ttl):
+        self.local.set(key, value, ttl)
+        if self.shared is not None:
+            try:
+                self.shared.set(key, value, ttl)
+            except Exception as e:
+                self.shared_errors += 1
+                print(f"Shared cache error: {str(e)}")
+
+    def clear(self):
+        self.local.clear()
+        if self.shared is not None:
+            self.shared.clear()
+
+    def stats(self):
+        return {
+            "enabled": self.enabled,
+            "data_version": self._version,
+            "local": self.local.stats(),
+            "shared": None if self.shared is None else {
+                "backend": self.shared.name,
+                "hits": self.shared_hits,
+                "misses": self.shared_misses,
+                "errors": self.shared_errors,
+            },
+        }
+
+
+# DATA VERSION
+
+def read_data_version():
+    with pooled_connection() as conn:
+        cur = conn.cursor()
+        cur.execute("SELECT version FROM data_version")
+        row = cur.fetchone()
+        cur.close()
+        conn.rollback()
+    return row[0] if row else 0
+
+
+def read_scope_version(endpoint):
+    with pooled_connection() as conn:
+        cur = conn.cursor()
+        cur.execute(SCOPE_VERSIONS[endpoint])
+        row = cur.fetchone()
+        cur.close()
+        conn.rollback()
+    return row[0] if row and row[0] is not None else 0
+
+
+def bump_data_version(cur):
+    """Invalidate every cached response; commits with the caller's transaction"""
+    cur.execute("UPDATE data_version SET version = version + 1, bumped_at = NOW() RETURNING version")
+    return cur.fetchone()[0]
+
+
+# FLASK INTEGRATION
+
+_cache = None
+
+
+def get_cache():
+    global _cache
+    if _cache is None:
+        _cache = ResponseCache(shared=_make_backend(CACHE_BACKEND))
+    return _cache
+
+
+def configure_cache(cache):
+    """Swap the process-wide cache (e.g. a ResponseCache with a MemoryBackend in tests)"""
+    global _cache
+    _cache = cache
+
+
+# Flattened cache_stats() keys that only ever grow (exported as counters)
+CACHE_COUNTERS = (
+    "local_hits", "local_misses", "local_evictions", "local_expirations",
+    "shared_hits", "shared_misses", "shared_errors",
+)
+
+
+def cache_stats():
+    return get_cache().stats()
+
+
+def storable(headers):
+    """False for responses a view marked `Cache-Control: no-store` (e.g. a
+    dashboard with a failed section), which must not be replayed"""
+    return 'no-store' not in headers.get('Cache-Control', '')
+
+
+def cached(view):
+    """Cache successful JSON responses of a Flask view for its endpoint's TTL"""
+    from flask import request, make_response, Response
+
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        cache = get_cache()
+        if not cache.enabled:
+            return view(*args, **kwargs)
+
+        key = cache.key(request.endpoint, request.view_args or {}, request.args.items(multi=True))
+        ttl = TTLS.get(request.endpoint, CACHE_DEFAULT_TTL)
+        hit = cache.get(key, ttl)
+        if hit is not None:
+            entry = json.loads(hit)
+            response = Response(entry['body'], status=200, mimetype=entry['mimetype'])
+            response.set_etag(entry['etag'])
+            response.headers['X-Cache'] = 'HIT'
+            return response
+
+        response = make_response(view(*args, **kwargs))
+        if response.status_code == 200 and not response.is_streamed and storable(response.headers):
+            body = response.get_data(as_text=True)
+            etag = content_etag(body)
+            response.set_etag(etag)
+            entry = json.dumps({"body": body, "mimetype": response.mimetype, "etag": etag})
+            cache.set(key, entry, ttl)
+        response.headers['X-Cache'] = 'MISS'
+        return response
+
+    return wrapper
@@ -0,0 +1,430 @@
+"""In-memory columnar engine for the sales statements.
+
+Optional: with ANALYTICS_ENGINE=columnar each API process loads
+transaction_data into NumPy arrays and answers the daily, hourly, period
+and delivery statements of queries.py from memory instead of Postgres
+(sections.py asks `answer` before running a statement). Everything else
+still goes to the database.
+
+    python columnar.py --check           # compare with the SQL path for every merchant
+    python columnar.py --check --merchant ID
+
+Layout (one row per order with an order_time and a merchant_id):
+
+    merchants       sorted merchant_ids; a merchant's code is its position
+    offsets         the orders of merchant k are rows offsets[k]:offsets[k+1],
+                    sorted by order_time
+    order_time      int64 microseconds since 1970-01-01 of the (naive) TIMESTAMP
+    value_cents     int64 order_value * 100, has_value where it is not NULL
+    completed_*     delivery/arrival/preparation durations in microseconds of
+                    the completed orders, per merchant at completed_offsets
+
+Time ranges are binary searches on order_time, groups are bincounts.
+Results are the rows the SQL returns, so sections shapes them unchanged,
+and NUMERIC arithmetic is reproduced exactly: money is summed in integer
+cents and the averages follow Postgres' numeric division scale
+(_div_scale), so the floats are the same as the SQL path's.
+
+A process reloads its snapshot when data_version changes.
+"""
+import argparse
+import io
+import os
+import re
+import threading
+import time
+from datetime import datetime, timedelta
+
+import numpy as np
+
+from db_connection import get_db_connection, pooled_connection
+from cache import get_cache
+from serialization import fetch_rows
+import queries
+
+ENABLED = os.getenv('ANALYTICS_ENGINE', 'sql') == 'columnar'
+
+DAY_US = 86_400_000_000
+HOUR_US = 3_600_000_000
+MINUTE_US = 60_000_000
+EPOCH = datetime(1970, 1, 1)
+
+_COMPLETED = """delivery_time IS NOT NULL
+    AND driver_arrival_time IS NOT NULL
+    AND driver_pickup_time IS NOT NULL"""
+
+_LOADED = "order_time IS NOT NULL AND merchant_id IS NOT NULL"
+
+_LOAD_MERCHANTS = f"""
+SELECT merchant_id, COUNT(*), COUNT(*) FILTER (WHERE {_COMPLETED})
+FROM transaction_data
+WHERE {_LOADED}
+GROUP BY merchant_id
+ORDER BY merchant_id
+"""
+
+# Fixed-width BIGINT rows, read with one np.frombuffer (see read_binary_copy)
+_LOAD_ORDERS = f"""
+COPY (
+    SELECT
+        (EXTRACT(EPOCH FROM order_time) * 1000000)::BIGINT,
+        COALESCE((order_value * 100)::BIGINT, 0),
+        (order_value IS NOT NULL)::INTEGER::BIGINT
+    FROM transaction_data
+    WHERE {_LOADED}
+    ORDER BY merchant_id, order_time
+) TO STDOUT WITH (FORMAT binary)
+"""
+
+_LOAD_COMPLETED = f"""
+COPY (
+    SELECT
+        (EXTRACT(EPOCH FROM (delivery_time - order_time)) * 1000000)::BIGINT,
+        (EXTRACT(EPOCH FROM (driver_arrival_time - order_time)) * 1000000)::BIGINT,
+        (EXTRACT(EPOCH FROM (driver_pickup_time - driver_arrival_time)) * 1000000)::BIGINT
+    FROM transaction_data
+    WHERE {_LOADED} AND {_COMPLETED}
+    ORDER BY merchant_id
+) TO STDOUT WITH (FORMAT binary)
+"""
+
+
+def read_binary_copy(cur, sql, columns):
+    """Run a binary COPY of NOT NULL BIGINT columns into a (rows, columns) int64 array"""
+    buf = io.BytesIO()
+    cur.copy_expert(sql, buf)
+    data = buf.getbuffer()
+    # 11-byte signature, int32 flags, int32 header extension length
+    start = 19 + int.from_bytes(data[15:19], 'big')
+    fields = [('count', '>i2')]
+    for i in range(columns):
+        fields += [(f'len{i}', '>i4'), (f'col{i}', '>i8')]
+    rows = np.frombuffer(data, dtype=np.dtype(fields), offset=start, count=(len(data) - start - 2) // (2 + 12 * columns))
+    return np.stack([rows[f'col{i}'].astype(np.int64) for i in range(columns)], axis=1)
+
+
+# POSTGRES NUMERIC DIVISION
+#
+# numeric / numeric rounds the quotient (half away from zero) to a scale
+# chosen from the operands: at least 16 significant digits and at least the
+# operands' own scales (select_div_scale in Postgres' numeric.c). Digits are
+# base 10000, so "weight" and "first digit" are in that base.
+
+def _weight_and_first_digit(value, scale):
+    """Weight and leading base-10000 digit of |value| * 10^-scale (value an int)"""
+    value = abs(value)
+    if value == 0:
+        return 0, 0
+    padded = (scale + 3) // 4 * 4
+    value *= 10 ** (padded - scale)
+    ndigits = (len(str(value)) + 3) // 4
+    return ndigits - 1 - padded // 4, value // 10000 ** (ndigits - 1)
+
+
+def _div_scale(num, num_scale, den, den_scale=0):
+    weight1, first1 = _weight_and_first_digit(num, num_scale)
+    weight2, first2 = _weight_and_first_digit(den, den_scale)
+    qweight = weight1 - weight2 - (1 if first1 <= first2 else 0)
+    return min(max(16 - qweight * 4, num_scale, den_scale, 0), 1000)
+
+
+def _round_div(num, den):
+    """num / den rounded half away from zero (ints, den > 0)"""
+    quotient, remainder = divmod(abs(num), den)
+    if 2 * remainder >= den:
+        quotient += 1
+    return quotient if num >= 0 else -quotient
+
+
+def numeric_div(num, num_scale, den):
+    """float(num * 10^-num_scale / den) as Postgres computes `numeric / bigint`"""
+    scale = _div_scale(num, num_scale, den)
+    if scale >= num_scale:
+        quotient = _round_div(num * 10 ** (scale - num_scale), den)
+    else:
+        quotient = _round_div(num, den * 10 ** (num_scale - scale))
+    return float(f"{quotient}e-{scale}")
+
+
+def _minutes_scales(magnitude):
+    """Scale of EXTRACT(EPOCH FROM d) / 60 per duration (|d| in microseconds, vectorized)"""
+    # EXTRACT(EPOCH ...) is numeric with scale 6: |d| * 100 in units of 10^-8 (two base-10000 digits)
+    value = magnitude * 100
+    ndigits = np.ones(len(value), dtype=np.int64)
+    for k in range(1, 5):
+        ndigits += value >= 10000 ** k
+    first = value // np.power(10000, ndigits - 1)
+    qweight = (ndigits - 3) - (first <= 60)
+    # Zero has weight 0 and first digit 0
+    qweight = np.where(value == 0, -1, qweight)
+    return np.maximum(16 - qweight * 4, 6)
+
+
+def minutes_sum(durations):
+    """Exact SUM(EXTRACT(EPOCH FROM d) / 60) of durations in microseconds: (int, scale)
+
+    Every term is rounded by Postgres to its own scale before the (exact) sum.
+    A term is whole minutes plus the rounded remainder, and remainders repeat
+    (seconds-precision data has at most 60 of them), so the rounding is done
+    once per distinct (remainder, scale) and weighted by the signed count.
+    """
+    magnitude = np.abs(durations)
+    sign = np.sign(durations)
+    scales = _minutes_scales(magnitude)
+    total_scale = int(scales.max())
+
+    total = int((sign * (magnitude // MINUTE_US)).sum()) * 10 ** total_scale
+    keys, inverse = np.unique((magnitude % MINUTE_US) * 32 + scales, return_inverse=True)
+    counts = np.bincount(inverse, weights=sign).astype(np.int64)
+    for key, count in zip(keys.tolist(), counts.tolist()):
+        if count:
+            remainder, scale = divmod(key, 32)
+            rounded = _round_div(remainder * 10 ** scale, MINUTE_US)
+            total += count * rounded * 10 ** (total_scale - scale)
+    return total, total_scale
+
+
+# ENGINE
+
+class ColumnarEngine:
+    """Column arrays of transaction_data grouped by merchant and sorted by order_time"""
+
+    def __init__(self, merchants, offsets, order_time, value_cents, has_value,
+                 completed_offsets, completed, version, timezone):
+        self.merchants = merchants
+        self.codes = {merchant_id: k for k, merchant_id in enumerate(merchants)}
+        self.offsets = offsets
+        self.order_time = order_time
+        self.value_cents = value_cents
+        self.has_value = has_value
+        self.completed_offsets = completed_offsets
+        self.completed = completed
+        self.version = version
+        self.timezone = timezone
+
+    @classmethod
+    def load(cls, conn):
+        """Read one consistent snapshot of transaction_data"""
+        conn.set_session(isolation_level='REPEATABLE READ', readonly=True)
+        try:
+            cur = conn.cursor()
+            cur.execute("SELECT version FROM data_version")
+            row = cur.fetchone()
+            version = row[0] if row else 0
+            cur.execute("SHOW TimeZone")
+            timezone = cur.fetchone()[0]
+            cur.execute(_LOAD_MERCHANTS)
+            counts = cur.fetchall()
+            orders = read_binary_copy(cur, _LOAD_ORDERS, 3)
+            completed = read_binary_copy(cur, _LOAD_COMPLETED, 3)
+            cur.close()
+            conn.rollback()
+        finally:
+            conn.set_session(isolation_level='DEFAULT', readonly='DEFAULT')
+
+        merchants = [row[0] for row in counts]
+        offsets = np.zeros(len(counts) + 1, dtype=np.int64)
+        np.cumsum([row[1] for row in counts], out=offsets[1:])
+        completed_offsets = np.zeros(len(counts) + 1, dtype=np.int64)
+        np.cumsum([row[2] for row in counts], out=completed_offsets[1:])
+        return cls(
+            merchants, offsets,
+            np.ascontiguousarray(orders[:, 0]),
+            np.ascontiguousarray(orders[:, 1]),
+            orders[:, 2].astype(bool),
+            completed_offsets,
+            {name: np.ascontiguousarray(completed[:, i])
+             for i, name in enumerate(('delivery', 'arrival', 'preparation'))},
+            version, timezone,
+        )
+
+    def nbytes(self):
+        arrays = [self.offsets, self.order_time, self.value_cents, self.has_value, self.completed_offsets]
+        return sum(a.nbytes for a in arrays + list(self.completed.values()))
+
+    def now(self):
+        """LOCALTIMESTAMP in microseconds, in the server's TimeZone"""
+        try:
+            from zoneinfo import ZoneInfo
+            local = datetime.now(ZoneInfo(self.timezone)).replace(tzinfo=None)
+        except Exception:
+            # Not an IANA zone name; fall back to this machine's zone
+            local = datetime.now()
+        return (local - EPOCH) // timedelta(microseconds=1)
+
+    def _orders(self, merchant_id, lo=None, hi=None):
+        """Row range of a merchant's orders with lo <= order_time < hi"""
+        code = self.codes.get(merchant_id)
+        if code is None:
+            return 0, 0
+        start, end = int(self.offsets[code]), int(self.offsets[code + 1])
+        times = self.order_time[start:end]
+        first = start + int(np.searchsorted(times, lo, 'left')) if lo is not None else start
+        last = start + int(np.searchsorted(times, hi, 'left')) if hi is not None else end
+        return first, max(first, last)
+
+    def _sums(self, start, end, groups=None, ngroups=None):
+        """Order count, value sum (cents) and non-NULL value count, overall or per group"""
+        cents = np.where(self.has_value[start:end], self.value_cents[start:end], 0)
+        if groups is None:
+            return end - start, int(cents.sum()), int(self.has_value[start:end].sum())
+        # Float weights are exact for integer sums below 2^53 cents
+        return (
+            np.bincount(groups, minlength=ngroups),
+            np.bincount(groups, weights=cents, minlength=ngroups).astype(np.int64),
+            np.bincount(groups, weights=self.has_value[start:end], minlength=ngroups).astype(np.int64),
+        )
+
+    def daily_sales(self, merchant_id, lo, hi=None):
+        start, end = self._orders(merchant_id, lo, hi)
+        if start == end:
+            return []
+        days, groups = np.unique(self.order_time[start:end] // DAY_US, return_inverse=True)
+        orders, cents, valued = self._sums(start, end, groups, len(days))
+        return [
+            {
+                "sale_date": (EPOCH + timedelta(days=day)).date().isoformat(),
+                "daily_sales": c / 100 if v else None,
+                "transaction_count": n,
+            }
+            for day, n, c, v in zip(days.tolist(), orders.tolist(), cents.tolist(), valued.tolist())
+        ]
+
+    def hourly_sales(self, merchant_id):
+        start, end = self._orders(merchant_id)
+        if start == end:
+            return []
+        hours = (self.order_time[start:end] // HOUR_US) % 24
+        orders, cents, valued = self._sums(start, end, hours, 24)
+        return [
+            {"hour_of_day": hour, "hourly_sales": c / 100 if v else None, "order_count": n}
+            for hour, (n, c, v) in enumerate(zip(orders.tolist(), cents.tolist(), valued.tolist())) if n
+        ]
+
+    def period_metrics(self, merchant_id, lo, hi=None):
+        start, end = self._orders(merchant_id, lo, hi)
+        orders, cents, valued = self._sums(start, end)
+        return [{
+            "total_sales": cents / 100 if valued else None,
+            "order_count": orders,
+            "avg_order_value": numeric_div(cents, 2, valued) if valued else None,
+        }]
+
+    def delivery_metrics(self, merchant_id):
+        code = self.codes.get(merchant_id)
+        start, end = (int(self.completed_offsets[code]), int(self.completed_offsets[code + 1])) if code is not None else (0, 0)
+        row = {}
+        for name in ('delivery', 'arrival', 'preparation'):
+            if start == end:
+                row[f"avg_{name}_time"] = None
+                continue
+            total, scale = minutes_sum(self.completed[name][start:end])
+            row[f"avg_{name}_time"] = numeric_div(total, scale, end - start)
+        return [row]
+
+
+def _days_ago(now, days):
+    # (NOW() - days * INTERVAL '1 day')::TIMESTAMP
+    return now - days * DAY_US
+
+
+# Statement (from queries.py) -> answer(engine, params, now)
+HANDLERS = {
+    queries.DAILY_SALES: lambda e, p, now: e.daily_sales(p["merchant_id"], _days_ago(now, p["days"])),
+    queries.HOURLY_SALES: lambda e, p, now: e.hourly_sales(p["merchant_id"]),
+    queries.PERIOD_METRICS_CURRENT: lambda e, p, now: e.period_metrics(p["merchant_id"], _days_ago(now, p["days"])),
+    queries.PERIOD_METRICS_PREVIOUS: lambda e, p, now: e.period_metrics(
+        p["merchant_id"], _days_ago(now, p["days"]), _days_ago(now, p["until_days"])),
+    queries.DELIVERY_METRICS: lambda e, p, now: e.delivery_metrics(p["merchant_id"]),
+}
+
+
+def handles(sql):
+    return sql in HANDLERS
+
+
+_engine = None
+_load_lock = threading.Lock()
+
+
+def load_engine():
+    started = time.monotonic()
+    conn = get_db_connection()
+    try:
+        engine = ColumnarEngine.load(conn)
+    finally:
+        conn.close()
+    print(f"Columnar engine: {len(engine.order_time)} orders of {len(engine.merchants)} merchants "
+          f"(data version {engine.version}, {engine.nbytes() / 1e6:.1f} MB) in {time.monotonic() - started:.2f}s")
+    return engine
+
+
+def get_engine(version=None):
+    """Process-wide engine, reloaded when the data version moves on.
+
+    While one thread reloads, the others keep answering from the previous
+    snapshot (only the very first load makes callers wait).
+    """
+    global _engine
+    if version is None:
+        version = get_cache().data_version()
+    if _engine is not None and _engine.version == version:
+        return _engine
+    if _load_lock.acquire(blocking=_engine is None):
+        try:
+            if _engine is None or _engine.version != version:
+                _engine = load_engine()
+        finally:
+            _load_lock.release()
+    return _engine
+
+
+def answer(sql, params, version=None):
+    """Rows for a statement from memory, or None when the engine does not handle it"""
+    if not ENABLED or sql not in HANDLERS:
+        return None
+    engine = get_engine(version)
+    return HANDLERS[sql](engine, params, engine.now())
+
+
+def check(merchant_ids=None, days=(1, 7, 14, 30, 90, 365)):
+    """Compare every handled statement with Postgres; returns the mismatches"""
+    engine = load_engine()
+    mismatches = []
+    timings = {"sql": 0.0, "columnar": 0.0}
+    with pooled_connection() as conn:
+        for merchant_id in merchant_ids or engine.merchants:
+            params = [{"merchant_id": merchant_id}]
+            params += [{"merchant_id": merchant_id, "days": d} for d in days]
+            params += [{"merchant_id": merchant_id, "days": d * 2, "until_days": d} for d in days]
+            for sql, handler in HANDLERS.items():
+                names = set(re.findall(r"%\((\w+)\)s", sql))
+                for p in (p for p in params if set(p) == names):
+                    # Same NOW() for both sides: the SQL transaction's start
+                    started = time.monotonic()
+                    expected = fetch_rows(conn, sql, p)
+                    timings["sql"] += time.monotonic() - started
+                    now = fetch_rows(conn, "SELECT LOCALTIMESTAMP AS now")[0]["now"]
+                    now_us = (datetime.fromisoformat(now) - EPOCH) // timedelta(microseconds=1)
+                    started = time.monotonic()
+                    actual = handler(engine, p, now_us)
+                    timings["columnar"] += time.monotonic() - started
+                    if actual != expected:
+                        mismatches.append((merchant_id, p, expected, actual))
+                    conn.rollback()
+    return mismatches, timings
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Load the columnar engine and compare it with the SQL path")
+    parser.add_argument("--check", action="store_true", help="compare every handled statement with Postgres")
+    parser.add_argument("--merchant", action="append", help="only this merchant (repeatable)")
+    args = parser.parse_args()
+
+    if args.check:
+        mismatches, timings = check(args.merchant)
+        for merchant_id, p, expected, actual in mismatches[:20]:
+            print(f"MISMATCH {p}\n  sql:      {expected}\n  columnar: {actual}")
+        print(f"{len(mismatches)} mismatches; sql {timings['sql']:.2f}s, columnar {timings['columnar']:.2f}s")
+    else:
+        load_engine()
@@ -0,0 +1,99 @@
+"""Conditional GETs and response compression for the API.
+
+Every successful GET under /api/merchant/ and /api/merchants gets a strong
+ETag (a hash of the JSON body; cache.py stores it with cached responses so
+hits do not re-hash) and `Cache-Control: no-cache`, so clients revalidate
+with If-None-Match and get an empty 304 when nothing changed.
+
+Larger bodies are compressed with brotli (when the optional brotli package
+is installed) or gzip, following the client's Accept-Encoding. Each encoding
+is a different representation, so its ETag carries a suffix ("-br"/"-gz")
+as required for strong validators.
+"""
+import gzip
+import hashlib
+import os
+
+try:
+    import brotli
+except ImportError:  # optional; gzip is used when missing
+    brotli = None
+
+# Bodies smaller than this are sent as-is; compressing them costs more than it saves
+COMPRESS_MIN_BYTES = int(os.getenv('COMPRESS_MIN_BYTES', '1024'))
+GZIP_LEVEL = int(os.getenv('GZIP_LEVEL', '6'))
+BROTLI_QUALITY = int(os.getenv('BROTLI_QUALITY', '5'))
+
+CONDITIONAL_PREFIXES = ('/api/merchant/', '/api/merchants')
+
+
+def content_etag(body):
+    """Strong validator for a response body (str or bytes)"""
+    if isinstance(body, str):
+        body = body.encode('utf-8')
+    return hashlib.sha1(body).hexdigest()
+
+
+def _accepted(accept_encoding, coding):
+    # Honour explicit q=0 refusals ("gzip;q=0")
+    for part in accept_encoding.split(','):
+        name, _, params = part.strip().partition(';')
+        if name.strip().lower() == coding:
+            return params.replace(' ', '') not in ('q=0', 'q=0.0', 'q=0.00', 'q=0.000')
+    return False
+
+
+def choose_encoding(accept_encoding):
+    if not accept_encoding:
+        return None
+    if brotli is not None and _accepted(accept_encoding, 'br'):
+        return 'br'
+    if _accepted(accept_encoding, 'gzip'):
+        return 'gzip'
+    return None
+
+
+def compress(body, encoding):
+    if encoding == 'br':
+        return brotli.compress(body, quality=BROTLI_QUALITY)
+    return gzip.compress(body, compresslevel=GZIP_LEVEL)
+
+
+def init_app(app):
+    """Register the ETag / compression hook on a Flask app"""
+    from flask import request
+
+    @app.after_request
+    def conditional_response(response):
+        if request.method != 'GET' or response.status_code != 200 or response.direct_passthrough:
+            return response
+        if 'Content-Encoding' in response.headers:
+            return response
+
+        body = response.get_data()
+        encoding = None
+        if len(body) >= COMPRESS_MIN_BYTES:
+            encoding = choose_encoding(request.headers.get('Accept-Encoding', ''))
+            response.vary.add('Accept-Encoding')
+
+        if request.path.startswith(CONDITIONAL_PREFIXES):
+            etag, _ = response.get_etag()
+            etag = etag or content_etag(body)
+            if encoding:
+                etag = f"{etag}-{'br' if encoding == 'br' else 'gz'}"
+            response.set_etag(etag)
+            # A view may have asked for no-store (see cache.storable)
+            response.headers.setdefault('Cache-Control', 'no-cache')
+            # Answer 304 before spending time on compression
+            if etag in request.if_none_match:
+                response.status_code = 304
+                response.set_data(b'')
+                response.headers.pop('Content-Length', None)
+                return response
+
+        if encoding:
+            response.set_data(compress(body, encoding))
+            response.headers['Content-Encoding'] = encoding
+        return response
+
+    return app
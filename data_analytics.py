@@ -1,97 +1,299 @@
-import pandas as pd
-import matplotlib.pyplot as plt
-import seaborn as sns
+"""Materialized analytical views over transaction_data, transaction_items and items.
+
+The views are created by the migrations and refreshed after every import,
+or on a schedule:
+
+    python data_analytics.py --refresh                 # refresh every view once
+    python data_analytics.py --refresh --every 300     # keep refreshing stale views
+    python data_analytics.py --status                  # last refresh, duration, staleness
+    python data_analytics.py --reports --merchant ID   # sample charts into ./static
+
+Each view has a unique index so it can be refreshed CONCURRENTLY: readers
+keep seeing the previous contents instead of blocking on the refresh. Every
+refresh is recorded in analytics_refresh_log.
+"""
+import argparse
+import time
+
 from db_connection import get_db_connection
+from cache import bump_data_version
+import peers
 
-def create_analytical_views():
-    conn = get_db_connection()
-    
-    # Create aggregated sales view
-    conn.cursor().execute('''
-    CREATE OR REPLACE VIEW daily_sales AS
-    SELECT 
-        t.merchant_id,
-        DATE(t.timestamp) as sale_date,
-        SUM(ti.quantity * i.price) as total_sales,
-        COUNT(DISTINCT t.transaction_id) as transaction_count
-    FROM transactions t
-    JOIN transaction_items ti ON t.transaction_id = ti.transaction_id
-    JOIN items i ON ti.item_id = i.item_id
-    GROUP BY t.merchant_id, DATE(t.timestamp)
-    ''')
-    
-    # Create product performance view
-    conn.cursor().execute('''
-    CREATE OR REPLACE VIEW product_performance AS
-    SELECT 
-        t.merchant_id,
-        i.item_id,
-        i.name as item_name,
-        i.category,
-        SUM(ti.quantity) as total_quantity,
-        SUM(ti.quantity * i.price) as total_revenue
-    FROM transactions t
-    JOIN transaction_items ti ON t.transaction_id = ti.transaction_id
-    JOIN items i ON ti.item_id = i.item_id
-    GROUP BY t.merchant_id, i.item_id, i.name, i.category
-    ''')
-    
+# Per view: its query, the unique index CONCURRENTLY needs, further indexes
+# for the API reads, and the tables it is computed from (for staleness)
+VIEWS = {
+    'mv_daily_sales': {
+        'query': '''
+        SELECT
+            td.merchant_id,
+            DATE(td.order_time) as sale_date,
+            SUM(td.order_value) as total_sales,
+            COUNT(*) as transaction_count,
+            COUNT(DISTINCT td.eater_id) as unique_customers,
+            COALESCE(SUM(ic.item_count), 0) as items_sold
+        FROM transaction_data td
+        LEFT JOIN (
+            SELECT order_id, COUNT(*) as item_count
+            FROM transaction_items
+            GROUP BY order_id
+        ) ic ON ic.order_id = td.order_id
+        WHERE td.merchant_id IS NOT NULL
+        AND td.order_time IS NOT NULL
+        GROUP BY td.merchant_id, DATE(td.order_time)
+        ''',
+        'unique_index': ('merchant_id', 'sale_date'),
+        'indexes': [],
+        'sources': ['transaction_data', 'transaction_items'],
+    },
+    'mv_product_performance': {
+        # Each transaction_items row is one unit of the item
+        'query': '''
+        SELECT
+            i.merchant_id,
+            i.item_id,
+            i.item_name,
+            i.cuisine_tag,
+            i.item_price,
+            COUNT(ti.id) as total_quantity,
+            COUNT(ti.id) * i.item_price as total_revenue,
+            COUNT(DISTINCT ti.order_id) as order_count,
+            MAX(td.order_time) as last_ordered_at
+        FROM items i
+        LEFT JOIN transaction_items ti ON ti.item_id = i.item_id
+        LEFT JOIN transaction_data td ON td.order_id = ti.order_id
+        WHERE i.merchant_id IS NOT NULL
+        GROUP BY i.item_id, i.merchant_id, i.item_name, i.cuisine_tag, i.item_price
+        ''',
+        'unique_index': ('item_id',),
+        'indexes': [('merchant_id', 'total_revenue DESC')],
+        'sources': ['items', 'transaction_items', 'transaction_data'],
+    },
+    'mv_merchant_peers': {
+        # Every merchant's KPIs and percentile ranks among its peers, from
+        # the rollups (see peers.py)
+        'query': peers.VIEW_QUERY,
+        'unique_index': ('merchant_id',),
+        'indexes': [],
+        'sources': ['merchants', 'items', 'transaction_data'],
+    },
+}
+
+
+# The views migrations 6 and 8 create. Shipped migrations must not change,
+# so this never grows: a later view is created by a migration of its own
+# (create_analytical_views(cur, [name])), and changing a view's query takes
+# a new migration dropping and recreating it
+INITIAL_VIEWS = ('mv_daily_sales', 'mv_product_performance')
+
+
+def create_analytical_views(cur, names=INITIAL_VIEWS):
+    """Create any missing view of `names` with its indexes (used by the migrations)"""
+    for name in names:
+        view = VIEWS[name]
+        cur.execute(f"CREATE MATERIALIZED VIEW IF NOT EXISTS {name} AS {view['query']} WITH DATA")
+        cur.execute(f"CREATE UNIQUE INDEX IF NOT EXISTS {name}_key ON {name} ({', '.join(view['unique_index'])})")
+        for columns in view['indexes']:
+            suffix = '_'.join(c.split()[0] for c in columns)
+            cur.execute(f"CREATE INDEX IF NOT EXISTS {name}_{suffix} ON {name} ({', '.join(columns)})")
+
+
+def _is_populated(cur, name):
+    cur.execute("SELECT ispopulated FROM pg_matviews WHERE matviewname = %s", (name,))
+    row = cur.fetchone()
+    return bool(row and row[0])
+
+
+def _log_refresh(conn, name, started_at, seconds, concurrent, status, error=None):
+    cur = conn.cursor()
+    cur.execute('''
+    INSERT INTO analytics_refresh_log (view_name, started_at, duration_ms, row_count, concurrent, status, error)
+    VALUES (%s, %s, %s, (SELECT reltuples::BIGINT FROM pg_class WHERE oid = %s::regclass), %s, %s, %s)
+    ''', (name, started_at, int(seconds * 1000), name, concurrent, status, error))
     conn.commit()
-    conn.close()
-    
-    print("Analytical views created successfully!")
+    cur.close()
+
+
+def refresh_views(conn=None, names=None, concurrently=True):
+    """Refresh views (default: all), logging each refresh; returns the log entries"""
+    own_conn = conn is None
+    if own_conn:
+        conn = get_db_connection()
+
+    results = []
+    try:
+        for name in names or list(VIEWS):
+            cur = conn.cursor()
+            # CONCURRENTLY needs a populated view with a unique index
+            concurrent = concurrently and _is_populated(cur, name)
+            # Server clock, so staleness compares against import_state stamps
+            cur.execute("SELECT LOCALTIMESTAMP")
+            started_at = cur.fetchone()[0]
+            started = time.monotonic()
+            try:
+                cur.execute(f"REFRESH MATERIALIZED VIEW {'CONCURRENTLY ' if concurrent else ''}{name}")
+                conn.commit()
+                status, error = 'ok', None
+            except Exception as e:
+                conn.rollback()
+                status, error = 'failed', str(e).strip()
+                print(f"Error refreshing {name}: {error}")
+            seconds = time.monotonic() - started
+            cur.close()
+            # ANALYZE keeps row_count close to the real size after the refresh
+            if status == 'ok':
+                cur = conn.cursor()
+                cur.execute(f"ANALYZE {name}")
+                conn.commit()
+                cur.close()
+            _log_refresh(conn, name, started_at, seconds, concurrent, status, error)
+            print(f"  {name}: {status} in {seconds:.2f}s{' (concurrently)' if concurrent else ''}")
+            results.append({"view": name, "status": status, "seconds": round(seconds, 3),
+                            "concurrent": concurrent, "error": error})
+
+        # Cached API responses built from the old contents are now stale
+        if any(r["status"] == 'ok' for r in results):
+            cur = conn.cursor()
+            bump_data_version(cur)
+            conn.commit()
+            cur.close()
+    finally:
+        if own_conn:
+            conn.close()
+    return results
 
-def generate_sample_reports():
+
+def view_status(conn):
+    """Per view: last successful refresh, its duration, age and whether a source table changed since"""
+    cur = conn.cursor()
+    status = []
+    for name, view in VIEWS.items():
+        cur.execute('''
+        SELECT started_at, duration_ms, row_count, EXTRACT(EPOCH FROM LOCALTIMESTAMP - started_at)
+        FROM analytics_refresh_log
+        WHERE view_name = %s AND status = 'ok'
+        ORDER BY started_at DESC LIMIT 1
+        ''', (name,))
+        last = cur.fetchone()
+        # Imports stamp import_state; anything committed after the refresh
+        # started may be missing from the view
+        cur.execute("SELECT MAX(updated_at) FROM import_state WHERE table_name = ANY(%s)", (view['sources'],))
+        source_changed = cur.fetchone()[0]
+        refreshed_at = last[0] if last else None
+        status.append({
+            "view": name,
+            "refreshed_at": refreshed_at.isoformat() if refreshed_at else None,
+            "duration_ms": last[1] if last else None,
+            "rows": last[2] if last else None,
+            "age_seconds": round(float(last[3])) if last else None,
+            "source_changed_at": source_changed.isoformat() if source_changed else None,
+            "stale": refreshed_at is None or (source_changed is not None and source_changed > refreshed_at),
+        })
+    conn.rollback()
+    cur.close()
+    return status
+
+
+def refresh_stale(conn, max_age=None):
+    """Refresh the views whose sources changed since their last refresh (or older than max_age seconds)"""
+    due = [
+        s["view"] for s in view_status(conn)
+        if s["stale"] or (max_age is not None and s["age_seconds"] is not None and s["age_seconds"] >= max_age)
+    ]
+    return refresh_views(conn, due) if due else []
+
+
+def generate_sample_reports(merchant_id=None, out_dir='./static'):
     """Generate sample reports and visualizations"""
+    import os
+    import pandas as pd
+    import matplotlib
+    matplotlib.use('Agg')
+    import matplotlib.pyplot as plt
+    import seaborn as sns
+
     conn = get_db_connection()
-    
+    os.makedirs(out_dir, exist_ok=True)
+
+    if merchant_id is None:
+        merchant_id = pd.read_sql(
+            "SELECT merchant_id FROM mv_daily_sales GROUP BY merchant_id ORDER BY SUM(transaction_count) DESC LIMIT 1",
+            conn
+        ).iloc[0]['merchant_id']
+
     # Example: Get sales data for a specific merchant
     query = """
     SELECT sale_date, total_sales
-    FROM daily_sales
-    WHERE merchant_id = 1
+    FROM mv_daily_sales
+    WHERE merchant_id = %s
     ORDER BY sale_date
     """
-    
-    sales_data = pd.read_sql(query, conn)
-    
+
+    sales_data = pd.read_sql(query, conn, params=(merchant_id,))
+
     # Plot sales trend
     if not sales_data.empty:
         plt.figure(figsize=(10, 6))
         plt.plot(sales_data['sale_date'], sales_data['total_sales'])
-        plt.title('Sales Trend for Merchant #1')
+        plt.title(f'Sales Trend for Merchant {merchant_id}')
         plt.xlabel('Date')
         plt.ylabel('Total Sales')
         plt.tight_layout()
-        plt.savefig('./static/sales_trend.png')
+        plt.savefig(os.path.join(out_dir, 'sales_trend.png'))
         plt.close()
-    
+
     # Example: Get top products for a merchant
     query = """
     SELECT item_name, total_revenue
-    FROM product_performance
-    WHERE merchant_id = 1
+    FROM mv_product_performance
+    WHERE merchant_id = %s
     ORDER BY total_revenue DESC
     LIMIT 5
     """
-    
-    top_products = pd.read_sql(query, conn)
-    
+
+    top_products = pd.read_sql(query, conn, params=(merchant_id,))
+
     # Plot top products
     if not top_products.empty:
         plt.figure(figsize=(10, 6))
         sns.barplot(x='total_revenue', y='item_name', data=top_products)
-        plt.title('Top 5 Products by Revenue for Merchant #1')
+        plt.title(f'Top 5 Products by Revenue for Merchant {merchant_id}')
         plt.xlabel('Total Revenue')
         plt.ylabel('Product')
         plt.tight_layout()
-        plt.savefig('./static/top_products.png')
+        plt.savefig(os.path.join(out_dir, 'top_products.png'))
         plt.close()
-    
+
     conn.close()
-    
+
     print("Sample reports generated successfully!")
 
 if __name__ == "__main__":
-    create_analytical_views()
-    generate_sample_reports()
\ No newline at end of file
+    parser = argparse.ArgumentParser(description="Refresh and inspect the materialized analytical views")
+    parser.add_argument("--refresh", action="store_true", help="refresh the views")
+    parser.add_argument("--view", action="append", choices=list(VIEWS), help="only this view (repeatable)")
+    parser.add_argument("--every", type=int, help="keep running, refreshing stale views every N seconds")
+    parser.add_argument("--max-age", type=int, help="with --every, also refresh views older than N seconds")
+    parser.add_argument("--blocking", action="store_true", help="plain REFRESH instead of CONCURRENTLY")
+    parser.add_argument("--status", action="store_true", help="show last refresh and staleness per view")
+    parser.add_argument("--reports", action="store_true", help="write sample charts to ./static")
+    parser.add_argument("--merchant", help="merchant_id for --reports (default: busiest merchant)")
+    args = parser.parse_args()
+
+    conn = get_db_connection()
+    try:
+        if args.refresh and args.every:
+            while True:
+                refresh_stale(conn, args.max_age)
+                time.sleep(args.every)
+        elif args.refresh:
+            refresh_views(conn, args.view, concurrently=not args.blocking)
+        if args.status:
+            for s in view_status(conn):
+                print(f"{s['view']:<26} refreshed {s['refreshed_at'] or 'never'}"
+                      f"  {s['duration_ms'] if s['duration_ms'] is not None else '-'} ms"
+                      f"  rows {s['rows'] if s['rows'] is not None else '-'}"
+                      f"  {'STALE' if s['stale'] else 'fresh'}")
+        if args.reports:
+            generate_sample_reports(args.merchant)
+    finally:
+        conn.close()
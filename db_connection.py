@@ -1,14 +1,336 @@
 import os
+import threading
+import time
+from contextlib import contextmanager
+
 import psycopg2
+import psycopg2.extensions
 from dotenv import load_dotenv
 
 load_dotenv()
 
+import instrumentation  # after load_dotenv: reads its settings from the environment
+
+# Pool configuration (all overridable from the environment / .env)
+POOL_MIN_SIZE = int(os.getenv('DB_POOL_MIN', '2'))
+POOL_MAX_SIZE = int(os.getenv('DB_POOL_MAX', '20'))
+POOL_TIMEOUT = float(os.getenv('DB_POOL_TIMEOUT', '10'))          # seconds to wait for a free connection
+POOL_MAX_LIFETIME = float(os.getenv('DB_POOL_MAX_LIFETIME', '1800'))  # recycle connections older than this
+POOL_MAX_IDLE = float(os.getenv('DB_POOL_MAX_IDLE', '600'))         # close idle connections above min size
+POOL_CHECK_AFTER = float(os.getenv('DB_POOL_CHECK_AFTER', '30'))    # ping connections idle longer than this
+
+
 def get_db_connection():
+    """Open a dedicated, unpooled connection (used by long-running jobs such as imports)"""
     conn = psycopg2.connect(
         host=os.getenv('DB_HOST', 'localhost'),
         database=os.getenv('DB_NAME', 'grab_merchant_db'),
         user=os.getenv('DB_USER', 'postgres'),
         password=os.getenv('DB_PASSWORD', '123')
     )
-    return conn
\ No newline at end of file
+    return conn
+
+
+class PoolTimeout(Exception):
+    """Raised when no connection becomes available within the pool timeout"""
+
+
+class ConnectionPool:
+    """Thread-safe, fork-aware pool of psycopg2 connections"""
+
+    def __init__(self, min_size=POOL_MIN_SIZE, max_size=POOL_MAX_SIZE, timeout=POOL_TIMEOUT,
+                 max_lifetime=POOL_MAX_LIFETIME, max_idle=POOL_MAX_IDLE, check_after=POOL_CHECK_AFTER,
+                 connect=get_db_connection):
+        self.min_size = max(0, min(min_size, max_size))
+        self.max_size = max(1, max_size)
+        self.timeout = timeout
+        self.max_lifetime = max_lifetime
+        self.max_idle = max_idle
+        self.check_after = check_after
+        self._connect = connect
+        self._init_state()
+
+    def _init_state(self):
+        self._pid = os.getpid()
+        self._cond = threading.Condition(threading.Lock())
+        self._idle = []       # [(conn, created_at, last_used_at)], most recently used last
+        self._in_use = {}     # id(conn) -> (conn, created_at)
+        self._opening = 0     # connections currently being established
+        self._stats = {
+            "connections_opened": 0,
+            "connections_closed": 0,
+            "connections_recycled": 0,
+            "connections_broken": 0,
+            "health_checks_failed": 0,
+            "checkouts": 0,
+            "waits": 0,
+            "wait_time_total_ms": 0.0,
+            "wait_time_max_ms": 0.0,
+            "timeouts": 0,
+        }
+
+    # Connections inherited across fork() share their socket with the parent.
+    # Closing them in the child would terminate the parent's session, so they
+    # are only parked here and never touched again.
+    _inherited = []
+
+    def _check_fork(self):
+        if self._pid != os.getpid():
+            ConnectionPool._inherited.extend(c for c, _, _ in self._idle)
+            ConnectionPool._inherited.extend(c for c, _ in self._in_use.values())
+            self._init_state()
+
+    def _size(self):
+        return len(self._idle) + len(self._in_use) + self._opening
+
+    def _open(self):
+        conn = self._connect()
+        with self._cond:
+            self._stats["connections_opened"] += 1
+        return conn
+
+    def _close(self, conn, reason=None):
+        try:
+            conn.close()
+        except Exception:
+            pass
+        with self._cond:
+            self._stats["connections_closed"] += 1
+            if reason:
+                self._stats[reason] += 1
+
+    def _unhealthy_reason(self, conn, created_at, last_used_at, now):
+        """Cheap checks first; only ping connections that have been idle for a while"""
+        if conn.closed:
+            return "connections_broken"
+        if self.max_lifetime and now - created_at > self.max_lifetime:
+            return "connections_recycled"
+        if now - last_used_at >= self.check_after:
+            try:
+                cur = conn.cursor()
+                cur.execute("SELECT 1")
+                cur.close()
+                conn.rollback()
+            except Exception:
+                with self._cond:
+                    self._stats["health_checks_failed"] += 1
+                return "connections_broken"
+        return None
+
+    def getconn(self):
+        """Check out a healthy connection, waiting up to the pool timeout"""
+        self._check_fork()
+        started = time.monotonic()
+        deadline = started + self.timeout
+        waited = False
+
+        while True:
+            candidate = None
+            with self._cond:
+                while not self._idle and self._size() >= self.max_size:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        self._stats["timeouts"] += 1
+                        raise PoolTimeout(
+                            f"No database connection available within {self.timeout}s "
+                            f"(max_size={self.max_size})"
+                        )
+                    waited = True
+                    self._cond.wait(remaining)
+
+                # Reserve the slot while still holding the lock so concurrent
+                # callers never see the pool as smaller than it is
+                if self._idle:
+                    candidate = self._idle.pop()
+                    self._in_use[id(candidate[0])] = (candidate[0], candidate[1])
+                else:
+                    self._opening += 1
+
+            if candidate is None:
+                try:
+                    conn = self._open()
+                except Exception:
+                    with self._cond:
+                        self._opening -= 1
+                        self._cond.notify()
+                    raise
+                created_at = time.monotonic()
+                with self._cond:
+                    self._opening -= 1
+                    self._in_use[id(conn)] = (conn, created_at)
+                break
+
+            conn, created_at, last_used_at = candidate
+            reason = self._unhealthy_reason(conn, created_at, last_used_at, time.monotonic())
+            if reason is None:
+                break
+            with self._cond:
+                self._in_use.pop(id(conn), None)
+            self._close(conn, reason)
+            with self._cond:
+                self._cond.notify()
+
+        wait_ms = (time.monotonic() - started) * 1000
+        with self._cond:
+            self._stats["checkouts"] += 1
+            if waited:
+                self._stats["waits"] += 1
+            self._stats["wait_time_total_ms"] += wait_ms
+            self._stats["wait_time_max_ms"] = max(self._stats["wait_time_max_ms"], wait_ms)
+        return conn
+
+    def putconn(self, conn, discard=False):
+        """Return a connection; broken or aborted connections are closed instead of reused"""
+        if self._pid != os.getpid():
+            # Checked out before a fork; belongs to the parent's pool
+            return
+        with self._cond:
+            entry = self._in_use.get(id(conn))
+        if entry is None:
+            return
+        created_at = entry[1]
+
+        # The connection stays counted as in-use until it is back on the idle
+        # list, otherwise other threads would open replacements meanwhile
+        if not discard and not conn.closed:
+            try:
+                status = conn.info.transaction_status
+                if status == psycopg2.extensions.TRANSACTION_STATUS_UNKNOWN:
+                    discard = True
+                elif status != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+                    conn.rollback()
+            except Exception:
+                discard = True
+
+        if discard or conn.closed:
+            self._close(conn, "connections_broken")
+            with self._cond:
+                self._in_use.pop(id(conn), None)
+                self._cond.notify()
+            return
+
+        now = time.monotonic()
+        with self._cond:
+            self._in_use.pop(id(conn), None)
+            self._idle.append((conn, created_at, now))
+            expired = self._expire_idle(now)
+            self._cond.notify()
+        for stale in expired:
+            self._close(stale, "connections_recycled")
+
+    def _expire_idle(self, now):
+        """Drop connections idle past max_idle while keeping min_size around (caller holds lock)"""
+        expired = []
+        if not self.max_idle:
+            return expired
+        keep = []
+        # _idle is ordered least- to most-recently used
+        for entry in self._idle:
+            conn, _, last_used_at = entry
+            surplus = len(self._idle) - len(expired) + len(self._in_use) > self.min_size
+            if surplus and now - last_used_at > self.max_idle:
+                expired.append(conn)
+            else:
+                keep.append(entry)
+        self._idle = keep
+        return expired
+
+    def prefill(self):
+        """Open connections up to min_size (called lazily on first use, never at import time)"""
+        self._check_fork()
+        while True:
+            with self._cond:
+                if self._size() >= self.min_size:
+                    return
+                self._opening += 1
+            try:
+                conn = self._open()
+            finally:
+                with self._cond:
+                    self._opening -= 1
+            with self._cond:
+                now = time.monotonic()
+                self._idle.insert(0, (conn, now, now))
+                self._cond.notify()
+
+    def closeall(self):
+        """Close every idle connection; checked-out ones stay counted as in use
+        until putconn returns them to the pool (or closes them) as usual"""
+        self._check_fork()
+        with self._cond:
+            idle, self._idle = self._idle, []
+        for conn, _, _ in idle:
+            self._close(conn)
+
+    def stats(self):
+        with self._cond:
+            stats = dict(self._stats)
+            stats.update({
+                "pid": self._pid,
+                "min_size": self.min_size,
+                "max_size": self.max_size,
+                "size": self._size(),
+                "idle": len(self._idle),
+                "in_use": len(self._in_use),
+            })
+        stats["wait_time_avg_ms"] = (
+            stats["wait_time_total_ms"] / stats["checkouts"] if stats["checkouts"] else 0.0
+        )
+        return stats
+
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def get_pool():
+    """Process-wide pool, created lazily so pre-forking servers never share sockets"""
+    global _pool
+    if _pool is None:
+        with _pool_lock:
+            if _pool is None:
+                pool = ConnectionPool()
+                pool.prefill()
+                _pool = pool
+    return _pool
+
+
+@contextmanager
+def pooled_connection():
+    """Borrow a connection from the pool for the duration of a with-block"""
+    pool = get_pool()
+    started = time.perf_counter()
+    conn = pool.getconn()
+    instrumentation.add_phase('pool_wait', time.perf_counter() - started)
+    discard = False
+    try:
+        yield conn
+    except (psycopg2.OperationalError, psycopg2.InterfaceError):
+        discard = True
+        raise
+    finally:
+        pool.putconn(conn, discard=discard)
+
+
+# pool_stats() keys that only ever grow (exported as counters)
+POOL_COUNTERS = (
+    "connections_opened", "connections_closed", "connections_recycled", "connections_broken",
+    "health_checks_failed", "checkouts", "waits", "wait_time_total_ms", "timeouts",
+)
+
+
+def pool_stats():
+    """Pool counters for health/metrics endpoints (empty until the pool is first used)"""
+    return _pool.stats() if _pool is not None else {}
+
+
+def _reset_pool_after_fork():
+    # Children must build their own pool; the parent's sockets stay with the parent
+    global _pool_lock
+    if _pool is not None:
+        _pool._check_fork()
+    _pool_lock = threading.Lock()
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_reset_pool_after_fork)
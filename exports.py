@@ -0,0 +1,69 @@
+"""Streamed exports: a statement's rows sent as NDJSON or CSV while they are read.
+
+The statement runs on a named (server-side) cursor and rows come over
+EXPORT_BATCH_ROWS at a time, so the memory an export takes does not grow
+with its size and the first bytes leave as soon as the first batch is read,
+however many years of orders follow. asgi_server.py does the same with an
+asyncpg cursor, using the same encoding.
+
+Rows are tuples in the statement's column order; `positions` picks the
+exported ones (e.g. ?columns= of /transactions) out of them.
+"""
+import csv
+import io
+import os
+import re
+
+from serialization import dumps, json_cursor
+
+EXPORT_BATCH_ROWS = int(os.getenv('EXPORT_BATCH_ROWS', '2000'))
+
+# format -> content type
+FORMATS = {
+    'ndjson': 'application/x-ndjson',
+    'csv': 'text/csv; charset=utf-8',
+}
+
+
+def filename(name, merchant_id, fmt):
+    """Download name for Content-Disposition, e.g. transactions-M123.csv"""
+    return f"{name}-{re.sub(r'[^A-Za-z0-9_-]', '_', merchant_id)}.{fmt}"
+
+
+def _csv(rows):
+    out = io.StringIO()
+    csv.writer(out, lineterminator='\n').writerows(rows)
+    return out.getvalue().encode('utf-8')
+
+
+def header(columns, fmt):
+    """First chunk of an export: the CSV header line (NDJSON has none)"""
+    return _csv([columns]) if fmt == 'csv' else b''
+
+
+def encode(rows, columns, positions, fmt):
+    """One chunk from a batch of rows; NULLs are empty CSV fields and JSON nulls"""
+    if fmt == 'csv':
+        return _csv([[row[i] for i in positions] for row in rows])
+    return b''.join(dumps({column: row[i] for column, i in zip(columns, positions)}) + b'\n' for row in rows)
+
+
+def stream(conn, sql, params, columns, positions, fmt, name='export'):
+    """Generator of the export chunks of `sql`, read through a named cursor on `conn`"""
+    cur = json_cursor(conn, name=name)
+    try:
+        cur.execute(sql, params)
+        yield header(columns, fmt)
+        while True:
+            rows = cur.fetchmany(EXPORT_BATCH_ROWS)
+            if not rows:
+                break
+            yield encode(rows, columns, positions, fmt)
+    except Exception as e:
+        # Headers are out already; the client sees a cut-off body
+        print(f"Error streaming {name} export: {str(e)}")
+        raise
+    finally:
+        cur.close()
+        # The cursor lived in a transaction of its own
+        conn.rollback()
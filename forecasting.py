@@ -0,0 +1,341 @@
+"""Daily and hourly sales forecasts for every merchant, computed as a batch job.
+
+    python forecasting.py --run                       # forecast every merchant once
+    python forecasting.py --run --workers 8           # batches over 8 processes
+    python forecasting.py --run --every 600           # re-run whenever data_version moved
+    python forecasting.py --backtest                  # accuracy on the last FORECAST_DAYS days
+
+The job reads the last HISTORY_DAYS complete days of sales_rollup (order value
+and orders per merchant and day, with one binary COPY) into a merchants x days
+matrix and fits an additive Holt-Winters model with a damped trend and
+weekly seasonality to every row at once: the recursion runs over the days,
+each step a NumPy operation on all merchants and all candidate smoothing
+parameters, and every merchant keeps the parameters with the lowest one-step
+error. Merchants are split into FORECAST_BATCH_MERCHANTS batches run in a
+process pool, which also formats each batch's rows for the COPY into
+sales_forecasts, so the job takes longer with more merchants and less with
+more cores; the API only reads the stored results.
+
+The daily forecast is spread over the hours with the merchant's share of
+sales per hour of that weekday over the last PROFILE_WEEKS weeks. Forecasts
+start today (the day still running is not history) and carry an approximate
+80% interval from the one-step errors. Merchants with under two weeks of
+history get their average day instead.
+
+Each run replaces sales_forecasts in one transaction and is logged in
+forecast_runs with the data_version it started from; /forecast reports a
+forecast as stale once an import moved data_version past it. A run does not
+bump data_version itself: cached /forecast answers key on the latest run id
+instead (cache.SCOPE_VERSIONS), so other endpoints keep their cache.
+"""
+import argparse
+import io
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from db_connection import get_db_connection
+from columnar import read_binary_copy
+
+HISTORY_DAYS = int(os.getenv('FORECAST_HISTORY_DAYS', '182'))
+FORECAST_DAYS = int(os.getenv('FORECAST_DAYS', '30'))
+PROFILE_WEEKS = int(os.getenv('FORECAST_PROFILE_WEEKS', '8'))
+FORECAST_WORKERS = int(os.getenv('FORECAST_WORKERS', str(os.cpu_count() or 1)))
+FORECAST_BATCH_MERCHANTS = int(os.getenv('FORECAST_BATCH_MERCHANTS', '2000'))
+
+SEASON = 7
+DAMPING = 0.9
+# Candidate smoothing parameters (level, trend, season), all tried on every merchant
+ALPHAS = (0.1, 0.3, 0.5)
+BETAS = (0.0, 0.05)
+GAMMAS = (0.05, 0.2, 0.4)
+# Two-sided 80% normal interval
+Z_80 = 1.2816
+
+_MERCHANTS = "SELECT merchant_id FROM merchants ORDER BY merchant_id"
+
+# (merchant code, day, cents, orders) as BIGINTs for read_binary_copy; day 0 is
+# the first day of history
+_LOAD_DAILY = """
+COPY (
+    SELECT m.code, (r.sale_date - %(start)s::DATE)::BIGINT, (SUM(r.order_value_sum) * 100)::BIGINT, SUM(r.order_count)::BIGINT
+    FROM sales_rollup r
+    JOIN (SELECT merchant_id, ROW_NUMBER() OVER (ORDER BY merchant_id) - 1 AS code FROM merchants) m
+      ON m.merchant_id = r.merchant_id
+    WHERE r.sale_date >= %(start)s::DATE AND r.sale_date < %(end)s::DATE AND r.order_value_sum IS NOT NULL
+    GROUP BY m.code, r.sale_date
+) TO STDOUT WITH (FORMAT binary)
+"""
+
+# (merchant code, ISO weekday - 1, hour, cents)
+_LOAD_HOURLY = """
+COPY (
+    SELECT m.code, EXTRACT(ISODOW FROM r.sale_date)::BIGINT - 1, r.sale_hour::BIGINT, (SUM(r.order_value_sum) * 100)::BIGINT
+    FROM sales_rollup r
+    JOIN (SELECT merchant_id, ROW_NUMBER() OVER (ORDER BY merchant_id) - 1 AS code FROM merchants) m
+      ON m.merchant_id = r.merchant_id
+    WHERE r.sale_date >= %(profile_start)s::DATE AND r.sale_date < %(end)s::DATE AND r.order_value_sum IS NOT NULL
+    GROUP BY m.code, 2, r.sale_hour
+) TO STDOUT WITH (FORMAT binary)
+"""
+
+
+# LOADING
+
+def load_history(cur, end, history_days=HISTORY_DAYS, profile_weeks=PROFILE_WEEKS):
+    """(merchant_ids, sales (M, D), orders (M, D), hour-of-week sales (M, 7, 24)) of the days before `end`"""
+    cur.execute(_MERCHANTS)
+    merchant_ids = [row[0] for row in cur.fetchall()]
+    start = end - np.timedelta64(history_days, 'D')
+    params = {"start": str(start), "end": str(end), "profile_start": str(end - np.timedelta64(7 * profile_weeks, 'D'))}
+
+    sales = np.zeros((len(merchant_ids), history_days))
+    orders = np.zeros((len(merchant_ids), history_days))
+    daily = read_binary_copy(cur, cur.mogrify(_LOAD_DAILY, params).decode(), 4)
+    if len(daily):
+        sales[daily[:, 0], daily[:, 1]] = daily[:, 2] / 100
+        orders[daily[:, 0], daily[:, 1]] = daily[:, 3]
+
+    hour_of_week = np.zeros((len(merchant_ids), 7, 24))
+    hourly = read_binary_copy(cur, cur.mogrify(_LOAD_HOURLY, params).decode(), 4)
+    if len(hourly):
+        hour_of_week[hourly[:, 0], hourly[:, 1], hourly[:, 2]] = hourly[:, 3] / 100
+    return merchant_ids, sales, orders, hour_of_week
+
+
+# MODEL
+
+def _grid():
+    alpha, beta, gamma = (np.array(v, dtype=float) for v in zip(*[
+        (a, b, g) for a in ALPHAS for b in BETAS for g in GAMMAS
+    ]))
+    return alpha[:, None], beta[:, None], gamma[:, None]
+
+
+def fit_forecast(y, horizon):
+    """Holt-Winters forecasts of every row of y (series x days): (forecast, low, high), each (series, horizon)
+
+    Day 0 of the forecast is the day after the last column of y. A row's
+    history starts at its first non-zero day; the first week sets the
+    initial level and seasonal indices and the recursion runs from there.
+    """
+    rows, days = y.shape
+    forecast = np.zeros((rows, horizon))
+    if rows == 0:
+        return forecast, forecast.copy(), forecast.copy()
+    active_days = y != 0
+    start = np.where(active_days.any(axis=1), active_days.argmax(axis=1), days)
+    fitted = days - start >= 2 * SEASON
+
+    # Initial states from each row's first week
+    first_week = start[:, None] + np.arange(SEASON)
+    first_values = np.take_along_axis(y, np.minimum(first_week, days - 1), axis=1)
+    level0 = first_values.mean(axis=1)
+    season0 = np.zeros((rows, SEASON))
+    np.put_along_axis(season0, first_week % SEASON, first_values - level0[:, None], axis=1)
+
+    alpha, beta, gamma = _grid()
+    grid = len(alpha)
+    level = np.repeat(level0[None, :], grid, axis=0)
+    trend = np.zeros((grid, rows))
+    season = np.repeat(season0[None, :, :], grid, axis=0)
+    sse = np.zeros((grid, rows))
+    for t in range(days):
+        update = t >= start + SEASON
+        if not update.any():
+            continue
+        s = t % SEASON
+        observed = y[:, t]
+        seasonal = season[:, :, s]
+        damped = level + DAMPING * trend
+        error = observed - (damped + seasonal)
+        new_level = alpha * (observed - seasonal) + (1 - alpha) * damped
+        new_trend = beta * (new_level - level) + (1 - beta) * DAMPING * trend
+        season[:, :, s] = np.where(update, gamma * (observed - new_level) + (1 - gamma) * seasonal, seasonal)
+        level = np.where(update, new_level, level)
+        trend = np.where(update, new_trend, trend)
+        sse += np.where(update, error * error, 0.0)
+
+    # Each row keeps its best parameters
+    best = sse.argmin(axis=0)
+    pick = (best, np.arange(rows))
+    level, trend, season, best_alpha = level[pick], trend[pick], season[pick], alpha[best, 0]
+    sigma = np.sqrt(sse[pick] / np.maximum(days - start - SEASON, 1))
+
+    steps = np.arange(1, horizon + 1)
+    damped_steps = np.cumsum(DAMPING ** steps)
+    forecast = level[:, None] + trend[:, None] * damped_steps + season[:, (days - 1 + steps) % SEASON]
+    spread = Z_80 * sigma[:, None] * np.sqrt(1 + (steps - 1) * best_alpha[:, None] ** 2)
+
+    # Too little history for the model: the average day since the first order
+    if not fitted.all():
+        short = ~fitted
+        since_start = np.arange(days) >= start[short, None]
+        counts = np.maximum(since_start.sum(axis=1), 1)
+        mean = (y[short] * since_start).sum(axis=1) / counts
+        std = np.sqrt((((y[short] - mean[:, None]) * since_start) ** 2).sum(axis=1) / counts)
+        forecast[short] = mean[:, None]
+        spread[short] = Z_80 * std[:, None]
+
+    forecast = np.maximum(forecast, 0)
+    return forecast, np.maximum(forecast - spread, 0), forecast + spread
+
+
+def hour_shares(hour_of_week):
+    """Share of each hour in a weekday's sales (M, 7, 24): the weekday's own
+    profile, else the merchant's whole-week profile, else flat"""
+    day_totals = hour_of_week.sum(axis=2, keepdims=True)
+    week = hour_of_week.sum(axis=1, keepdims=True)
+    week_totals = week.sum(axis=2, keepdims=True)
+    week_shares = np.where(week_totals > 0, week / np.where(week_totals > 0, week_totals, 1), 1 / 24)
+    return np.where(day_totals > 0, hour_of_week / np.where(day_totals > 0, day_totals, 1), week_shares)
+
+
+def forecast_batch(batch):
+    """Forecasts of one batch of merchants: (sales (forecast, low, high), orders, hour shares)"""
+    sales, orders, hour_of_week, horizon = batch
+    fitted = fit_forecast(np.concatenate([sales, orders]), horizon)
+    merchants = len(sales)
+    return ([part[:merchants] for part in fitted], fitted[0][merchants:], hour_shares(hour_of_week))
+
+
+def _map_batches(func, batches, workers):
+    if workers > 1 and len(batches) > 1:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            return list(pool.map(func, batches))
+    return [func(batch) for batch in batches]
+
+
+def forecast_all(sales, orders, hour_of_week, horizon, workers=FORECAST_WORKERS, batch_size=FORECAST_BATCH_MERCHANTS):
+    """forecast_batch over merchant batches, in a process pool when there is more than one batch and worker"""
+    batches = [(sales[i:i + batch_size], orders[i:i + batch_size], hour_of_week[i:i + batch_size], horizon)
+               for i in range(0, len(sales), batch_size)]
+    results = _map_batches(forecast_batch, batches, workers)
+    if not results:
+        empty = np.zeros((0, horizon))
+        return (empty, empty, empty), empty, np.zeros((0, 7, 24))
+    return (tuple(np.concatenate([r[0][k] for r in results]) for k in range(3)),
+            np.concatenate([r[1] for r in results]),
+            np.concatenate([r[2] for r in results]))
+
+
+# STORAGE
+
+_COPY_FORECASTS = """
+COPY sales_forecasts (merchant_id, forecast_date, sales, sales_low, sales_high, orders, hourly_sales, run_id)
+FROM STDIN
+"""
+_COPY_LINE = "%s\t%s\t%.2f\t%.2f\t%.2f\t%.2f\t{" + ','.join(['%.2f'] * 24) + "}\t%d\n"
+
+
+def store_batch(batch):
+    """COPY text of one batch's forecasts (process pool worker, so formatting scales with cores too)"""
+    merchant_ids, first_day, run_id, sales, orders, hour_of_week, horizon = batch
+    (forecast, low, high), orders_forecast, shares = forecast_batch((sales, orders, hour_of_week, horizon))
+    days = first_day + np.arange(horizon)
+    weekdays = (days.view('int64') + 3) % 7  # 1970-01-01 was a Thursday
+    hourly = forecast[:, :, None] * shares[:, weekdays, :]
+    day_text = [str(day) for day in days]
+    return ''.join(
+        _COPY_LINE % (merchant_id, day_text[h], forecast[m, h], low[m, h], high[m, h], orders_forecast[m, h],
+                      *hourly[m, h], run_id)
+        for m, merchant_id in enumerate(merchant_ids) for h in range(horizon)
+    )
+
+
+def run(workers=FORECAST_WORKERS, horizon=FORECAST_DAYS, batch_size=FORECAST_BATCH_MERCHANTS):
+    """Forecast every merchant and replace the stored forecasts; returns a summary of the run"""
+    conn = get_db_connection()
+    started = time.monotonic()
+    try:
+        cur = conn.cursor()
+        # The run is current as of the data_version it started from
+        cur.execute("SELECT CURRENT_DATE, LOCALTIMESTAMP, (SELECT version FROM data_version)")
+        today, started_at, version = cur.fetchone()
+        today = np.datetime64(today, 'D')
+        merchant_ids, sales, orders, hour_of_week = load_history(cur, today)
+        cur.execute('''
+        INSERT INTO forecast_runs (started_at, first_day, horizon_days, history_days, merchants, workers, data_version)
+        VALUES (%s, %s, %s, %s, %s, %s, %s) RETURNING id
+        ''', (started_at, str(today), horizon, HISTORY_DAYS, len(merchant_ids), workers, version))
+        run_id = cur.fetchone()[0]
+        loaded = time.monotonic()
+
+        batches = [(merchant_ids[i:i + batch_size], today, run_id, sales[i:i + batch_size],
+                    orders[i:i + batch_size], hour_of_week[i:i + batch_size], horizon)
+                   for i in range(0, len(merchant_ids), batch_size)]
+        chunks = _map_batches(store_batch, batches, workers)
+        fitted = time.monotonic()
+
+        # Readers keep the previous forecasts until this commits
+        cur.execute("DELETE FROM sales_forecasts")
+        for chunk in chunks:
+            cur.copy_expert(_COPY_FORECASTS, io.StringIO(chunk))
+        # No data_version bump: that would flush every cached response. Only
+        # /forecast answers depend on the run, and their cache keys carry its id
+        seconds = time.monotonic() - started
+        cur.execute("UPDATE forecast_runs SET duration_ms = %s WHERE id = %s", (int(seconds * 1000), run_id))
+        conn.commit()
+        cur.execute("ANALYZE sales_forecasts")
+        conn.commit()
+        cur.close()
+    finally:
+        conn.close()
+    print(f"Forecast {len(merchant_ids):,} merchants x {horizon} days with {workers} workers in {seconds:.2f}s "
+          f"(load {loaded - started:.2f}s, fit {fitted - loaded:.2f}s, store {seconds - (fitted - started):.2f}s)")
+    return {"run_id": run_id, "merchants": len(merchant_ids), "seconds": round(seconds, 3), "data_version": version}
+
+
+def backtest(horizon=FORECAST_DAYS, workers=FORECAST_WORKERS):
+    """Fit on the history before the last `horizon` days and score the forecast of those days;
+    prints weighted absolute percentage errors next to a repeat-last-week baseline"""
+    conn = get_db_connection()
+    try:
+        cur = conn.cursor()
+        cur.execute("SELECT CURRENT_DATE")
+        today = np.datetime64(cur.fetchone()[0], 'D')
+        _, sales, orders, hour_of_week = load_history(cur, today, HISTORY_DAYS + horizon)
+        cur.close()
+    finally:
+        conn.close()
+    history, actual = sales[:, :-horizon], sales[:, -horizon:]
+    (forecast, low, high), _, _ = forecast_all(history, orders[:, :-horizon], hour_of_week, horizon, workers)
+    naive = history[:, -SEASON:][:, np.arange(horizon) % SEASON]
+    total = np.abs(actual).sum() or 1
+    # Merchants without history forecast 0 and would count as covered
+    selling = history.any(axis=1)
+    covered = ((actual >= low) & (actual <= high))[selling].mean() if selling.any() else 0
+    print(f"  {len(sales):,} merchants ({selling.sum():,} with sales), last {horizon} days")
+    print(f"  Holt-Winters WAPE {np.abs(forecast - actual).sum() / total:.1%}, 80% interval coverage {covered:.0%}")
+    print(f"  last-week naive WAPE {np.abs(naive - actual).sum() / total:.1%}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Forecast daily and hourly sales for every merchant")
+    parser.add_argument("--run", action="store_true", help="forecast and store the results")
+    parser.add_argument("--backtest", action="store_true", help="score forecasts of the last --days days")
+    parser.add_argument("--workers", type=int, default=FORECAST_WORKERS, help="processes fitting batches")
+    parser.add_argument("--days", type=int, default=FORECAST_DAYS, help="days to forecast")
+    parser.add_argument("--every", type=int, help="with --run, keep running: re-forecast every N seconds when data changed")
+    args = parser.parse_args()
+    if not (args.run or args.backtest):
+        parser.error("nothing to do: pass --run and/or --backtest")
+
+    if args.backtest:
+        backtest(args.days, args.workers)
+    if args.run and args.every:
+        from cache import read_data_version
+        while True:
+            # A run records the data_version it started from; an import moves it past
+            conn = get_db_connection()
+            cur = conn.cursor()
+            cur.execute("SELECT MAX(data_version) FROM forecast_runs")
+            last = cur.fetchone()[0]
+            conn.close()
+            if last is None or read_data_version() > last:
+                run(args.workers, args.days)
+            time.sleep(args.every)
+    elif args.run:
+        run(args.workers, args.days)
@@ -0,0 +1,143 @@
+"""Delivery, arrival and preparation time percentiles from per-day histograms.
+
+delivery_histograms counts each merchant's completed orders per day into
+log-spaced buckets of each duration, kept current by the importer like the
+other rollups (see rollups.py). Bucket i > 0 holds the minutes in
+(MIN_MINUTES * GAMMA^(i-1), MIN_MINUTES * GAMMA^i] and bucket 0 everything
+up to MIN_MINUTES (including the negative durations of bad timestamps).
+Histograms merge by adding counts, so the percentiles of any date range come
+from the days' buckets without reading transaction_data.
+
+A percentile is the bucket holding the nearest-rank order (as
+percentile_disc) reported at the bucket's midpoint, so it is within
+RELATIVE_ACCURACY (2%) of the exact value; values under MIN_MINUTES are
+reported as 0. Buckets grow by about 4%, so a few hundred of them span
+seconds to years and a merchant-day only stores the ones it uses.
+
+    python histograms.py --check                # percentiles against percentile_disc
+    python histograms.py --check --merchant ID
+"""
+import argparse
+import math
+import sys
+
+from db_connection import get_db_connection
+
+RELATIVE_ACCURACY = 0.02
+GAMMA = (1 + RELATIVE_ACCURACY) / (1 - RELATIVE_ACCURACY)
+MIN_MINUTES = 0.1
+PERCENTILES = (50, 90, 99)
+
+# (metric, minutes) of a completed transaction_data row `td`
+METRICS = {
+    "delivery": "EXTRACT(EPOCH FROM (td.delivery_time - td.order_time))/60",
+    "arrival": "EXTRACT(EPOCH FROM (td.driver_arrival_time - td.order_time))/60",
+    "preparation": "EXTRACT(EPOCH FROM (td.driver_pickup_time - td.driver_arrival_time))/60",
+}
+
+
+def bucket_sql(minutes):
+    """SQL: the bucket of a duration in minutes"""
+    return (f"CASE WHEN {minutes} <= {MIN_MINUTES} THEN 0 "
+            f"ELSE CEIL(LN(({minutes})::FLOAT8 / {MIN_MINUTES}) / {math.log(GAMMA)})::SMALLINT END")
+
+
+def bucket_value(bucket):
+    """Minutes a bucket stands for: within RELATIVE_ACCURACY of all of them"""
+    if bucket <= 0:
+        return 0.0
+    return MIN_MINUTES * 2 * GAMMA ** bucket / (GAMMA + 1)
+
+
+def percentiles(rows, metric, wanted=PERCENTILES):
+    """{"p50": minutes, ...} from (metric, bucket, order_count) rows sorted by bucket; None without orders"""
+    buckets = [(row['bucket'], row['order_count']) for row in rows if row['metric'] == metric]
+    total = sum(count for _, count in buckets)
+    result = {}
+    for p in wanted:
+        if not total:
+            result[f"p{p}"] = None
+            continue
+        rank, seen = math.ceil(p / 100 * total), 0
+        for bucket, count in buckets:
+            seen += count
+            if seen >= rank:
+                result[f"p{p}"] = round(bucket_value(bucket), 2)
+                break
+    return result
+
+
+_EXACT = """
+SELECT d.metric, percentile_disc(%(fractions)s::FLOAT8[]) WITHIN GROUP (ORDER BY d.minutes)
+FROM transaction_data td
+CROSS JOIN LATERAL (VALUES {metrics}) d (metric, minutes)
+WHERE td.merchant_id = %(merchant_id)s
+AND td.order_time >= %(start)s AND td.order_time < %(end)s
+AND td.delivery_time IS NOT NULL AND td.driver_arrival_time IS NOT NULL AND td.driver_pickup_time IS NOT NULL
+GROUP BY d.metric
+""".replace('{metrics}', ', '.join(f"('{name}', {sql})" for name, sql in METRICS.items()))
+
+# Whole history and every month a merchant has orders in
+_WINDOWS = """
+SELECT DISTINCT merchant_id, date_trunc('month', order_time)::DATE, (date_trunc('month', order_time) + INTERVAL '1 month')::DATE
+FROM transaction_data
+WHERE merchant_id IS NOT NULL AND (%(merchant_id)s::VARCHAR IS NULL OR merchant_id = %(merchant_id)s)
+UNION ALL
+SELECT DISTINCT merchant_id, '-infinity'::DATE, 'infinity'::DATE
+FROM transaction_data
+WHERE merchant_id IS NOT NULL AND (%(merchant_id)s::VARCHAR IS NULL OR merchant_id = %(merchant_id)s)
+"""
+
+
+def check(conn, merchant_id=None):
+    """Compare the histogram percentiles with percentile_disc; returns the number of failures"""
+    import queries
+    from serialization import fetch_rows
+
+    cur = conn.cursor()
+    cur.execute(_WINDOWS, {"merchant_id": merchant_id})
+    windows = cur.fetchall()
+    cur.close()
+    compared, failures, worst = 0, 0, 0.0
+    for merchant, start, end in windows:
+        params = {"merchant_id": merchant, "days": None, "start": start, "end": end}
+        rows = fetch_rows(conn, queries.DELIVERY_HISTOGRAM, params)
+        exact = {row['metric']: row['percentile_disc']
+                 for row in fetch_rows(conn, _EXACT, dict(params, fractions=[p / 100 for p in PERCENTILES]))}
+        for metric in METRICS:
+            got = percentiles(rows, metric)
+            expected = exact.get(metric) or [None] * len(PERCENTILES)
+            for p, value in zip(PERCENTILES, expected):
+                estimate = got[f"p{p}"]
+                compared += 1
+                if value is None or estimate is None:
+                    ok = value is None and estimate is None
+                elif value <= MIN_MINUTES:
+                    ok = estimate == 0
+                else:
+                    error = abs(estimate - float(value)) / float(value)
+                    worst = max(worst, error)
+                    # Rounding to 2 decimals adds up to 0.005 minutes
+                    ok = abs(estimate - float(value)) <= RELATIVE_ACCURACY * float(value) + 0.005
+                if not ok:
+                    print(f"  {merchant} {start}..{end} {metric} p{p}: {estimate}, exact {value}")
+                    failures += 1
+    print(f"  {compared:,} percentiles over {len(windows):,} windows, worst relative error {worst:.2%}")
+    return failures
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Check the delivery time histograms against exact percentiles")
+    parser.add_argument("--check", action="store_true", help="compare with transaction_data")
+    parser.add_argument("--merchant", help="only this merchant_id")
+    args = parser.parse_args()
+    if not args.check:
+        parser.error("nothing to do: pass --check")
+
+    conn = get_db_connection()
+    try:
+        failures = check(conn, args.merchant)
+    finally:
+        conn.close()
+    print("OK" if not failures else f"{failures} checks failed")
+    sys.exit(1 if failures else 0)
@@ -1,223 +1,149 @@
-import pandas as pd
+import argparse
 import os
 from db_connection import get_db_connection
+from migrations import apply_migrations
+from rollups import ROLLUPS
+from data_analytics import refresh_views
+from cache import bump_data_version
+from snapshots import export_snapshot
+from partitions import maintain as maintain_partitions
+from keyword_index import rebuild_index as rebuild_keyword_index
+from basket import rebuild_pairs as rebuild_item_pairs
+from bulk_loader import TABLES, DEFAULT_CHUNK_ROWS, reset_state
+from import_pipeline import (
+    DEFAULT_WORKERS, timed, choose_deferred_tables, defer_constraints, load_tables,
+    rebuild_indexes, restore_foreign_keys, remove_unreferenced, rebuild_rollups,
+    vacuum_analyze, print_timings,
+)
 
-# Define file paths
+# Directory holding merchant.csv, items.csv, transaction_data.csv,
+# transaction_items.csv and keywords.csv
 data_dir = './data'
-transaction_data_file = os.path.join(data_dir, 'transaction_data.csv')
-merchant_file = os.path.join(data_dir, 'merchant.csv')
-items_file = os.path.join(data_dir, 'items.csv')
-transaction_items_file = os.path.join(data_dir, 'transaction_items.csv')
-keywords_file = os.path.join(data_dir, 'keywords.csv')
+
+# Advisory lock key held for the whole import so two runs never interleave
+IMPORT_LOCK_KEY = 74_110_002
 
 # Function to import data to PostgreSQL
-def import_to_db():
+def import_to_db(data_dir=data_dir, chunk_rows=DEFAULT_CHUNK_ROWS, full=False,
+                 workers=DEFAULT_WORKERS, defer='auto', snapshot_dir=None):
+    """Import the CSVs incrementally.
+
+    Each table resumes after its last committed chunk, or ingests only rows
+    at/after its watermark when the file is new. `full=True` forgets all
+    checkpoints and watermarks and reprocesses every file (still as upserts).
+    Independent tables load in parallel on `workers` connections; with
+    defer='auto' foreign keys and secondary indexes of empty tables are
+    dropped for the load and rebuilt afterwards ('never' keeps them).
+    With `snapshot_dir` a columnar snapshot of the new data is exported
+    there once the import has committed.
+    """
+    timings = {}
+    reject_dir = os.path.join(data_dir, 'rejects')
     conn = get_db_connection()
     cur = conn.cursor()
-    
+
     print("Creating database tables...")
-    
-    # Create tables
-    cur.execute('''
-    CREATE TABLE IF NOT EXISTS merchants (
-        merchant_id VARCHAR(10) PRIMARY KEY,
-        merchant_name VARCHAR(100),
-        join_date VARCHAR(10),
-        city_id INTEGER
-    )
-    ''')
-    
-    cur.execute('''
-    CREATE TABLE IF NOT EXISTS items (
-        item_id INTEGER PRIMARY KEY,
-        cuisine_tag VARCHAR(50),
-        item_name VARCHAR(100),
-        item_price NUMERIC(10, 2),
-        merchant_id VARCHAR(10),
-        FOREIGN KEY (merchant_id) REFERENCES merchants (merchant_id)
-    )
-    ''')
-    
-    cur.execute('''
-    CREATE TABLE IF NOT EXISTS transaction_data (
-        order_id VARCHAR(20) PRIMARY KEY,
-        order_time TIMESTAMP,
-        driver_arrival_time TIMESTAMP,
-        driver_pickup_time TIMESTAMP,
-        delivery_time TIMESTAMP,
-        order_value NUMERIC(10, 2),
-        eater_id BIGINT,
-        merchant_id VARCHAR(10),
-        FOREIGN KEY (merchant_id) REFERENCES merchants (merchant_id)
-    )
-    ''')
-    
-    cur.execute('''
-    CREATE TABLE IF NOT EXISTS transaction_items (
-        id SERIAL PRIMARY KEY,
-        order_id VARCHAR(20),
-        item_id INTEGER,
-        merchant_id VARCHAR(10),
-        FOREIGN KEY (order_id) REFERENCES transaction_data (order_id) ON DELETE CASCADE,
-        FOREIGN KEY (item_id) REFERENCES items (item_id) ON DELETE CASCADE,
-        FOREIGN KEY (merchant_id) REFERENCES merchants (merchant_id) ON DELETE CASCADE
-    )
-    ''')
-    
-    # Fixed SQL for keywords table - renamed 'order' to 'order_count' to avoid keyword conflict
-    cur.execute('''
-    CREATE TABLE IF NOT EXISTS keywords (
-        id SERIAL PRIMARY KEY,
-        keyword VARCHAR(100),
-        view INTEGER,
-        menu INTEGER,
-        checkout INTEGER,
-        order_count INTEGER
-    )
-    ''')
-    
-    conn.commit()
+
+    # Tables and indexes are owned by the versioned migrations
+    with timed(timings, 'migrate'):
+        apply_migrations(conn)
     print("Tables created successfully.")
-    
-    # Import merchants first (since they're referenced by other tables)
-    print(f"Importing merchant data from {merchant_file}...")
-    if os.path.exists(merchant_file):
-        merchants = pd.read_csv(merchant_file)
-        print(f"Found {len(merchants)} merchants to import.")
-        
-        # Import merchants data
-        count = 0
-        for i, row in merchants.iterrows():
-            try:
-                cur.execute(
-                    "INSERT INTO merchants (merchant_id, merchant_name, join_date, city_id) VALUES (%s, %s, %s, %s)",
-                    (row['merchant_id'], row['merchant_name'], row['join_date'], row['city_id'])
-                )
-                count += 1
-            except Exception as e:
-                print(f"Error importing merchant {row['merchant_id']}: {e}")
-        
-        conn.commit()
-        print(f"Successfully imported {count} merchants.")
-    else:
-        print(f"Warning: {merchant_file} not found!")
-    
-    # Import items
-    print(f"Importing items data from {items_file}...")
-    if os.path.exists(items_file):
-        items = pd.read_csv(items_file)
-        print(f"Found {len(items)} items to import.")
-        
-        # Import items data
-        count = 0
-        for i, row in items.iterrows():
-            try:
-                cur.execute(
-                    "INSERT INTO items (item_id, cuisine_tag, item_name, item_price, merchant_id) VALUES (%s, %s, %s, %s, %s)",
-                    (row['item_id'], row['cuisine_tag'], row['item_name'], row['item_price'], row['merchant_id'])
-                )
-                count += 1
-            except Exception as e:
-                print(f"Error importing item {row['item_id']}: {e}")
-        
-        conn.commit()
-        print(f"Successfully imported {count} items.")
-    else:
-        print(f"Warning: {items_file} not found!")
-    
-    # Modified import for transaction data to handle duplicates
-    print(f"Importing transaction data from {transaction_data_file}...")
-    if os.path.exists(transaction_data_file):
-        # Create a temporary table
-        cur.execute('''
-        CREATE TEMP TABLE temp_transaction_data (
-            order_id VARCHAR(20),
-            order_time TIMESTAMP,
-            driver_arrival_time TIMESTAMP,
-            driver_pickup_time TIMESTAMP,
-            delivery_time TIMESTAMP,
-            order_value NUMERIC(10, 2),
-            eater_id BIGINT,
-            merchant_id VARCHAR(10)
-        )
-        ''')
-        
-        # Bulk copy data to temp table
-        with open(transaction_data_file, 'r') as f:
-            cur.copy_expert(f"COPY temp_transaction_data FROM STDIN CSV HEADER", f)
-        
-        # Insert into final table, discarding duplicates
-        cur.execute('''
-        INSERT INTO transaction_data
-        SELECT DISTINCT ON (order_id) *
-        FROM temp_transaction_data
-        ''')
-        
-        # Report the count
-        cur.execute("SELECT COUNT(*) FROM transaction_data")
-        count = cur.fetchone()[0]
-        
+
+    cur.execute("SELECT pg_try_advisory_lock(%s)", (IMPORT_LOCK_KEY,))
+    if not cur.fetchone()[0]:
+        conn.close()
+        raise RuntimeError("Another import is already running")
+
+    try:
+        if full:
+            print("Full import requested: clearing import checkpoints and watermarks.")
+            reset_state(cur)
         conn.commit()
-        print(f"Successfully imported {count} transactions (duplicates removed).")
-    else:
-        print(f"Warning: {transaction_data_file} not found!")
-    
-    # Import transaction items
-    print(f"Importing transaction items data from {transaction_items_file}...")
-    if os.path.exists(transaction_items_file):
-        transaction_items = pd.read_csv(transaction_items_file)
-        print(f"Found {len(transaction_items)} transaction items to import.")
-        
-        # Import transaction items
-        count = 0
-        for i, row in transaction_items.iterrows():
-            try:
-                cur.execute(
-                    "INSERT INTO transaction_items (order_id, item_id, merchant_id) VALUES (%s, %s, %s)",
-                    (row['order_id'], row['item_id'], row['merchant_id'])
-                )
-                count += 1
-                
-                # Commit every 10000 rows to avoid transaction size issues
-                if count % 10000 == 0:
-                    conn.commit()
-                    print(f"  Progress: {count} transaction items imported.")
-                    
-            except Exception as e:
-                print(f"Error importing transaction item (order: {row['order_id']}, item: {row['item_id']}): {e}")
-        
+
+        # Upcoming months get their partitions before any row needs them;
+        # the loader adds the ones older rows need
+        print("Maintaining transaction_data partitions...")
+        with timed(timings, 'partitions'):
+            maintain_partitions(conn)
+
+        with timed(timings, 'defer_constraints'):
+            deferred_tables = choose_deferred_tables(conn, list(TABLES), mode=defer)
+            if deferred_tables:
+                print(f"Deferring foreign keys and indexes on: {', '.join(deferred_tables)}")
+                defer_constraints(conn, deferred_tables)
+
+        # Parents before children since they're referenced by other tables;
+        # independent tables load side by side
+        try:
+            with timed(timings, 'load'):
+                results = load_tables(data_dir, chunk_rows, reject_dir, workers)
+        except Exception:
+            # Committed chunks stay; put the indexes and keys back so the
+            # resumed run (and the API meanwhile) is not left without them
+            print("Load failed, restoring deferred indexes and foreign keys...")
+            rebuild_indexes(workers)
+            restore_foreign_keys(workers, reject_dir)
+            remove_unreferenced(list(TABLES), workers, reject_dir)
+            rebuild_rollups(workers)
+            raise
+
+        # Also picks up anything left deferred by an interrupted earlier run
+        with timed(timings, 'rebuild_indexes'):
+            rebuild_indexes(workers)
+        with timed(timings, 'validate_foreign_keys'):
+            restore_foreign_keys(workers, reject_dir)
+            remove_unreferenced(list(results), workers, reject_dir)
+        # After validation, which may have removed orphaned orders
+        with timed(timings, 'rebuild_rollups'):
+            rebuild_rollups(workers)
+        # keywords is replaced wholesale, so the index is rebuilt every time
+        with timed(timings, 'keyword_index'):
+            rebuild_keyword_index()
+        # One pass over transaction_items, merchant by merchant
+        with timed(timings, 'item_pairs'):
+            rebuild_item_pairs()
+
+        # Refresh planner statistics and the visibility map so the covering
+        # indexes can serve index-only scans
+        print("Analyzing tables...")
+        with timed(timings, 'vacuum_analyze'):
+            vacuum_analyze(list(TABLES) + list(ROLLUPS), workers)
+
+        # Concurrent refresh: the API keeps reading the old contents meanwhile
+        print("Refreshing analytical views...")
+        with timed(timings, 'refresh_views'):
+            refresh_views()
+
+        # Invalidates cached API responses
+        bump_data_version(cur)
         conn.commit()
-        print(f"Successfully imported {count} transaction items.")
-    else:
-        print(f"Warning: {transaction_items_file} not found!")
-    
-    # Import keywords data - using the renamed column
-    print(f"Importing keywords data from {keywords_file}...")
-    if os.path.exists(keywords_file):
-        keywords = pd.read_csv(keywords_file)
-        print(f"Found {len(keywords)} keywords to import.")
-        
-        # Import keywords data
-        count = 0
-        for i, row in keywords.iterrows():
-            try:
-                cur.execute(
-                    "INSERT INTO keywords (keyword, view, menu, checkout, order_count) VALUES (%s, %s, %s, %s, %s)",
-                    (row['keyword'], row['view'], row['menu'], row['checkout'], row['order'])
-                )
-                count += 1
-            except Exception as e:
-                print(f"Error importing keyword '{row['keyword']}': {e}")
-        
+    finally:
+        conn.rollback()
+        cur.execute("SELECT pg_advisory_unlock(%s)", (IMPORT_LOCK_KEY,))
         conn.commit()
-        print(f"Successfully imported {count} keywords.")
-    else:
-        print(f"Warning: {keywords_file} not found!")
-    
-    cur.close()
-    conn.close()
-    
+        cur.close()
+        conn.close()
+
+    if snapshot_dir:
+        with timed(timings, 'snapshot'):
+            export_snapshot(snapshot_dir)
+
+    print_timings(timings, results)
     print("Data import completed!")
+    return {"tables": results, "timings": timings}
 
 if __name__ == "__main__":
-    import_to_db()
\ No newline at end of file
+    parser = argparse.ArgumentParser(description="Import the merchant CSV files into PostgreSQL")
+    parser.add_argument("--data-dir", default=data_dir, help="directory containing the CSV files")
+    parser.add_argument("--chunk-rows", type=int, default=DEFAULT_CHUNK_ROWS, help="rows per COPY chunk")
+    parser.add_argument("--full", action="store_true",
+                        help="ignore checkpoints and watermarks and reprocess every file")
+    parser.add_argument("--workers", type=int, default=DEFAULT_WORKERS,
+                        help="connections used for parallel loads and index builds")
+    parser.add_argument("--defer", choices=["auto", "never"], default="auto",
+                        help="drop foreign keys/indexes during bulk loads into empty tables")
+    parser.add_argument("--snapshot-dir", help="export a Parquet/Arrow snapshot here after the import")
+    args = parser.parse_args()
+
+    import_to_db(args.data_dir, chunk_rows=args.chunk_rows, full=args.full,
+                 workers=args.workers, defer=args.defer, snapshot_dir=args.snapshot_dir)
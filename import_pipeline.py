@@ -0,0 +1,404 @@
+"""Parallel import scheduling for import_data.
+
+Tables are loaded concurrently, each on its own connection, as soon as the
+tables they reference are done. For bulk loads the loaded tables' foreign
+keys and secondary indexes are dropped first and rebuilt afterwards in
+parallel: indexes are built once over the final data instead of being
+maintained row by row, and foreign keys are re-added NOT VALID and then
+validated in one pass each. Rollups of those tables are not maintained
+chunk by chunk either but rebuilt once at the end. Dropped definitions and
+pending rollup rebuilds are saved in import_deferred_objects so an
+interrupted import restores them next time.
+"""
+import csv
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+from contextlib import contextmanager
+
+from db_connection import get_db_connection
+from bulk_loader import TABLES, load_table
+import rollups
+
+DEFAULT_WORKERS = int(os.getenv('IMPORT_WORKERS', '4'))
+MAINTENANCE_WORK_MEM = os.getenv('IMPORT_MAINTENANCE_WORK_MEM', '256MB')
+
+
+@contextmanager
+def timed(timings, phase):
+    """Record the wall time of a pipeline phase"""
+    started = time.monotonic()
+    try:
+        yield
+    finally:
+        timings[phase] = round(timings.get(phase, 0) + time.monotonic() - started, 3)
+
+
+def _worker_connection(bulk=False):
+    conn = get_db_connection()
+    cur = conn.cursor()
+    cur.execute("SET maintenance_work_mem = %s", (MAINTENANCE_WORK_MEM,))
+    if bulk:
+        # Every chunk commits its rows together with its checkpoint, so losing
+        # the last few commits in a server crash only means re-loading them
+        cur.execute("SET synchronous_commit = off")
+    conn.commit()
+    cur.close()
+    return conn
+
+
+class _Skipped(Exception):
+    """A task not run because one of its dependencies failed"""
+
+
+def run_graph(tasks, workers=DEFAULT_WORKERS):
+    """Run {name: (callable, [dependencies])} with at most `workers` at a time.
+
+    A task starts once all of its dependencies that are part of the graph have
+    finished. If a task fails its dependents are skipped; the first error is
+    raised after everything already running has finished.
+    """
+    pending = dict(tasks)
+    running = {}
+    done, failed, results = set(), {}, {}
+
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as pool:
+        while pending or running:
+            for name in list(pending):
+                fn, deps = pending[name]
+                deps = [d for d in deps if d in tasks]
+                if any(d in failed for d in deps):
+                    failed[name] = _Skipped(f"{name} skipped: dependency failed")
+                    del pending[name]
+                elif all(d in done for d in deps):
+                    running[pool.submit(fn)] = name
+                    del pending[name]
+            if not running:
+                break
+            finished, _ = wait(list(running), return_when=FIRST_COMPLETED)
+            for future in finished:
+                name = running.pop(future)
+                try:
+                    results[name] = future.result()
+                    done.add(name)
+                except Exception as e:
+                    print(f"Error in {name}: {e}")
+                    failed[name] = e
+
+    if failed:
+        first = next(e for e in failed.values() if not isinstance(e, _Skipped))
+        raise first
+    return results
+
+
+# DEFERRED INDEXES AND FOREIGN KEYS
+
+def _secondary_indexes(cur, table):
+    # Non-unique indexes that do not back a constraint; primary keys and
+    # unique indexes stay because the merges' ON CONFLICT relies on them
+    cur.execute('''
+    SELECT ic.relname, pg_get_indexdef(ic.oid)
+    FROM pg_index x
+    JOIN pg_class ic ON ic.oid = x.indexrelid
+    WHERE x.indrelid = %s::regclass
+    AND NOT x.indisunique
+    AND NOT x.indisprimary
+    AND NOT EXISTS (SELECT 1 FROM pg_constraint c WHERE c.conindid = x.indexrelid AND c.conrelid = x.indrelid)
+    ''', (table,))
+    return cur.fetchall()
+
+
+def _foreign_keys(cur, table):
+    cur.execute('''
+    SELECT conname, pg_get_constraintdef(oid)
+    FROM pg_constraint
+    WHERE conrelid = %s::regclass AND contype = 'f'
+    ''', (table,))
+    return cur.fetchall()
+
+
+def _is_empty(cur, table):
+    cur.execute(f"SELECT NOT EXISTS (SELECT 1 FROM {table})")
+    return cur.fetchone()[0]
+
+
+def _is_partitioned(cur, table):
+    cur.execute("SELECT relkind = 'p' FROM pg_class WHERE oid = %s::regclass", (table,))
+    return cur.fetchone()[0]
+
+
+def defer_constraints(conn, tables):
+    """Drop foreign keys and secondary indexes of `tables`, saving their definitions"""
+    cur = conn.cursor()
+    deferred = []
+    for table in tables:
+        # A partitioned table's foreign keys cannot be re-added NOT VALID, so
+        # restoring them would mean one long validating lock: keep them
+        foreign_keys = [] if _is_partitioned(cur, table) else _foreign_keys(cur, table)
+        for name, definition in foreign_keys:
+            cur.execute('''
+            INSERT INTO import_deferred_objects (object_name, table_name, kind, definition)
+            VALUES (%s, %s, 'fkey', %s) ON CONFLICT (object_name) DO NOTHING
+            ''', (name, table, definition))
+            cur.execute(f'ALTER TABLE {table} DROP CONSTRAINT "{name}"')
+            deferred.append(name)
+        for name, definition in _secondary_indexes(cur, table):
+            cur.execute('''
+            INSERT INTO import_deferred_objects (object_name, table_name, kind, definition)
+            VALUES (%s, %s, 'index', %s) ON CONFLICT (object_name) DO NOTHING
+            ''', (name, table, definition))
+            cur.execute(f'DROP INDEX "{name}"')
+            deferred.append(name)
+        for name in rollups.rollups_for(table):
+            cur.execute('''
+            INSERT INTO import_deferred_objects (object_name, table_name, kind, definition)
+            VALUES (%s, %s, 'rollup', '') ON CONFLICT (object_name) DO NOTHING
+            ''', (name, table))
+            deferred.append(name)
+        # Saved definitions and drops commit together
+        conn.commit()
+    cur.close()
+    return deferred
+
+
+def choose_deferred_tables(conn, tables, mode='auto'):
+    """Tables whose constraints are worth dropping: bulk loads into empty
+    tables, not deltas (whose merges also rely on the join indexes)"""
+    if mode == 'never':
+        return []
+    cur = conn.cursor()
+    chosen = [t for t in tables if _is_empty(cur, t)]
+    conn.rollback()
+    cur.close()
+    return chosen
+
+
+def _deferred_objects(conn, kind):
+    cur = conn.cursor()
+    cur.execute('''
+    SELECT object_name, table_name, definition
+    FROM import_deferred_objects WHERE kind = %s ORDER BY table_name, object_name
+    ''', (kind,))
+    rows = cur.fetchall()
+    conn.commit()
+    cur.close()
+    return rows
+
+
+def _forget(conn, name):
+    cur = conn.cursor()
+    cur.execute("DELETE FROM import_deferred_objects WHERE object_name = %s", (name,))
+    conn.commit()
+    cur.close()
+
+
+def _rebuild_index(name, definition):
+    conn = _worker_connection()
+    try:
+        cur = conn.cursor()
+        started = time.monotonic()
+        # Indexes of partitioned tables are saved as "ON ONLY", which would
+        # leave the partitions without them
+        definition = definition.replace(" ON ONLY ", " ON ", 1)
+        cur.execute(definition.replace("CREATE INDEX ", "CREATE INDEX IF NOT EXISTS ", 1))
+        conn.commit()
+        _forget(conn, name)
+        return round(time.monotonic() - started, 3)
+    finally:
+        conn.close()
+
+
+def rebuild_indexes(workers=DEFAULT_WORKERS):
+    """Recreate every deferred index, several at a time"""
+    conn = get_db_connection()
+    try:
+        objects = _deferred_objects(conn, 'index')
+    finally:
+        conn.close()
+    tasks = {
+        name: ((lambda n=name, d=definition: _rebuild_index(n, d)), [])
+        for name, _, definition in objects
+    }
+    return run_graph(tasks, workers)
+
+
+def _fkey_columns(cur, table, name):
+    cur.execute('''
+    SELECT
+        c.confrelid::regclass::text,
+        ARRAY(SELECT a.attname FROM unnest(c.conkey) WITH ORDINALITY k(attnum, n)
+              JOIN pg_attribute a ON a.attrelid = c.conrelid AND a.attnum = k.attnum ORDER BY k.n),
+        ARRAY(SELECT a.attname FROM unnest(c.confkey) WITH ORDINALITY k(attnum, n)
+              JOIN pg_attribute a ON a.attrelid = c.confrelid AND a.attnum = k.attnum ORDER BY k.n)
+    FROM pg_constraint c
+    WHERE c.conrelid = %s::regclass AND c.conname = %s
+    ''', (table, name))
+    return cur.fetchone()
+
+
+def _remove_orphans(conn, table, name, reject_dir):
+    """Delete rows the foreign key would reject and append them to the reject file"""
+    cur = conn.cursor()
+    parent, columns, parent_columns = _fkey_columns(cur, table, name)
+    cur.close()
+    return _delete_unreferenced(conn, table, columns, parent, parent_columns,
+                                f"foreign key {name}", reject_dir)
+
+
+def _delete_unreferenced(conn, table, columns, parent, parent_columns, label, reject_dir):
+    """Delete rows of `table` without a matching `parent` row and append them to the reject file"""
+    cur = conn.cursor()
+    not_null = " AND ".join(f"c.{col} IS NOT NULL" for col in columns)
+    join = " AND ".join(f"p.{pc} = c.{col}" for col, pc in zip(columns, parent_columns))
+    cur.execute(f'''
+    DELETE FROM {table} c
+    WHERE {not_null}
+    AND NOT EXISTS (SELECT 1 FROM {parent} p WHERE {join})
+    RETURNING c.*
+    ''')
+    orphans = cur.fetchall()
+    if orphans and reject_dir:
+        os.makedirs(reject_dir, exist_ok=True)
+        with open(os.path.join(reject_dir, f"{table}.rejects.csv"), 'a', newline='') as f:
+            writer = csv.writer(f)
+            for row in orphans:
+                writer.writerow(list(row) + [f"{label}: no matching {parent} row"])
+    cur.close()
+    return len(orphans)
+
+
+def _validate_fkey(name, table, reject_dir):
+    conn = _worker_connection()
+    try:
+        cur = conn.cursor()
+        started = time.monotonic()
+        orphans = _remove_orphans(conn, table, name, reject_dir)
+        conn.commit()
+        cur.execute(f'ALTER TABLE {table} VALIDATE CONSTRAINT "{name}"')
+        conn.commit()
+        _forget(conn, name)
+        if orphans:
+            print(f"  {name}: removed {orphans:,} orphaned {table} rows")
+        return round(time.monotonic() - started, 3)
+    finally:
+        conn.close()
+
+
+def restore_foreign_keys(workers=DEFAULT_WORKERS, reject_dir=None):
+    """Re-add deferred foreign keys NOT VALID (cheap), then validate them in parallel"""
+    conn = get_db_connection()
+    try:
+        objects = _deferred_objects(conn, 'fkey')
+        cur = conn.cursor()
+        for name, table, definition in objects:
+            cur.execute("SELECT 1 FROM pg_constraint WHERE conrelid = %s::regclass AND conname = %s",
+                        (table, name))
+            if cur.fetchone() is None:
+                cur.execute(f'ALTER TABLE {table} ADD CONSTRAINT "{name}" {definition} NOT VALID')
+        conn.commit()
+        cur.close()
+    finally:
+        conn.close()
+
+    tasks = {
+        name: ((lambda n=name, t=table: _validate_fkey(n, t, reject_dir)), [])
+        for name, table, _ in objects
+    }
+    return run_graph(tasks, workers)
+
+
+def _check_references(table, columns, parent, parent_columns, reject_dir):
+    conn = _worker_connection()
+    try:
+        started = time.monotonic()
+        label = f"reference {table}({', '.join(columns)})"
+        orphans = _delete_unreferenced(conn, table, columns, parent, parent_columns, label, reject_dir)
+        conn.commit()
+        if orphans:
+            print(f"  {label}: removed {orphans:,} rows without a {parent} row")
+        return round(time.monotonic() - started, 3)
+    finally:
+        conn.close()
+
+
+def remove_unreferenced(tables, workers=DEFAULT_WORKERS, reject_dir=None):
+    """Enforce the `references` of loaded tables that no foreign key covers"""
+    tasks = {}
+    for table in tables:
+        for columns, parent, parent_columns in TABLES[table].get('references', []):
+            tasks[f"{table}.{'_'.join(columns)}"] = (
+                (lambda t=table, c=columns, p=parent, pc=parent_columns:
+                 _check_references(t, c, p, pc, reject_dir)), [])
+    return run_graph(tasks, workers)
+
+
+def _rebuild_rollup(name):
+    conn = _worker_connection()
+    try:
+        cur = conn.cursor()
+        started = time.monotonic()
+        rollups.rebuild(cur, name)
+        conn.commit()
+        cur.execute(f"ANALYZE {name}")
+        conn.commit()
+        return round(time.monotonic() - started, 3)
+    finally:
+        conn.close()
+
+
+def rebuild_rollups(workers=DEFAULT_WORKERS):
+    """Recompute every rollup left for a full rebuild by a bulk load"""
+    conn = get_db_connection()
+    try:
+        objects = _deferred_objects(conn, 'rollup')
+    finally:
+        conn.close()
+    tasks = {name: ((lambda n=name: _rebuild_rollup(n)), []) for name, _, _ in objects}
+    return run_graph(tasks, workers)
+
+
+# TABLE LOADS
+
+def _load_task(table, path, chunk_rows, reject_dir):
+    def run():
+        conn = _worker_connection(bulk=True)
+        try:
+            return load_table(conn, table, path, chunk_rows=chunk_rows, reject_dir=reject_dir)
+        finally:
+            conn.close()
+    return run
+
+
+def load_tables(data_dir, chunk_rows, reject_dir, workers=DEFAULT_WORKERS):
+    """Load every available CSV concurrently, parents before children"""
+    tasks = {}
+    for table, spec in TABLES.items():
+        path = os.path.join(data_dir, spec['file'])
+        if not os.path.exists(path):
+            print(f"Warning: {path} not found!")
+            continue
+        print(f"Queueing {table} from {path}...")
+        tasks[table] = (_load_task(table, path, chunk_rows, reject_dir), spec['depends_on'])
+    return run_graph(tasks, workers)
+
+
+def vacuum_analyze(tables, workers=DEFAULT_WORKERS):
+    """VACUUM ANALYZE tables in parallel (each needs its own autocommit connection)"""
+    def run(table):
+        conn = get_db_connection()
+        try:
+            conn.autocommit = True
+            conn.cursor().execute(f"VACUUM ANALYZE {table}")
+        finally:
+            conn.close()
+    tasks = {table: ((lambda t=table: run(t)), []) for table in tables}
+    return run_graph(tasks, workers)
+
+
+def print_timings(timings, results):
+    print("Import timing breakdown:")
+    for phase, seconds in timings.items():
+        print(f"  {phase:<24} {seconds:>9.2f}s")
+    for table, stats in results.items():
+        print(f"    load {table:<19} {stats['seconds']:>9.2f}s  "
+              f"{stats['rows_loaded']:,} loaded, {stats['rows_rejected']:,} rejected")
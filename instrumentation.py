@@ -0,0 +1,330 @@
+"""Request and statement instrumentation for the API.
+
+Both serving modes record, in memory and per process:
+
+    api_requests_total{route,status}              requests answered
+    api_request_duration_seconds{route}           latency histogram
+    api_request_phase_seconds{route,phase}        time per phase of a request:
+        pool_wait   waiting for a pooled connection
+        queries     running statements (summed, so concurrent ones add up)
+        shape       turning rows into the section payload
+        serialize   encoding the JSON body
+    api_query_duration_seconds{statement,engine}  latency histogram per statement,
+                                                  named after its queries.py constant
+    api_slow_queries_total{statement}             statements over SLOW_QUERY_MS
+
+GET /api/metrics renders them in the Prometheus text format together with
+the connection pool and response cache counters; GET /api/metrics/slow
+returns the last SLOW_QUERY_LOG_SIZE slow statements with their parameters
+and EXPLAIN plans (also printed as they happen). Routes are labelled by
+their pattern (/api/merchant/<merchant_id>/summary), never by merchant, so
+the series stay few. With several worker processes each exposes its own
+numbers.
+
+The cost is two perf_counter() calls and a dict update under a lock per
+request, phase and statement; METRICS_ENABLED=0 turns it all off. Plans
+are only fetched for statements that were already slow (plain EXPLAIN, the
+statement is not run again).
+"""
+import bisect
+import contextvars
+import os
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+
+METRICS_ENABLED = os.getenv('METRICS_ENABLED', '1') == '1'
+SLOW_QUERY_MS = float(os.getenv('SLOW_QUERY_MS', '250'))
+SLOW_QUERY_EXPLAIN = os.getenv('SLOW_QUERY_EXPLAIN', '1') == '1'
+SLOW_QUERY_LOG_SIZE = int(os.getenv('SLOW_QUERY_LOG_SIZE', '50'))
+
+# Histogram upper bounds, seconds
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+_lock = threading.Lock()
+_requests = {}        # (route, status) -> count
+_request_latency = {}  # route -> _Histogram
+_phases = {}          # (route, phase) -> [seconds, count]
+_queries = {}         # (statement, engine) -> _Histogram
+_slow_counts = {}     # statement -> count
+_slow_log = deque(maxlen=SLOW_QUERY_LOG_SIZE)
+_gauges = {}          # prefix -> (callable returning a (nested) dict of numbers, counter names)
+
+# Phase totals of the request being handled (None outside a request)
+_current = contextvars.ContextVar('request_phases', default=None)
+
+
+class _Histogram:
+    __slots__ = ('counts', 'sum', 'count')
+
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, seconds):
+        self.counts[bisect.bisect_left(BUCKETS, seconds)] += 1
+        self.sum += seconds
+        self.count += 1
+
+
+# STATEMENT NAMES
+
+_names = None
+
+
+def statement_name(sql):
+    """The queries.py constant holding `sql` ("ITEM_PERFORMANCE[revenue]" for dict entries), or "other" """
+    global _names
+    if _names is None:
+        import queries
+        names = {}
+        for name, value in vars(queries).items():
+            if not name.isupper() or name.startswith('_'):
+                continue
+            if isinstance(value, str):
+                names.setdefault(value, name)
+            elif isinstance(value, dict):
+                for key, sql_text in value.items():
+                    if isinstance(sql_text, str):
+                        names.setdefault(sql_text, f"{name}[{key}]")
+        _names = names
+    return _names.get(sql, 'other')
+
+
+# RECORDING
+
+def start_request():
+    """Begin collecting phases for the current request; returns a token for finish_request"""
+    return _current.set({}) if METRICS_ENABLED else None
+
+
+def finish_request(token, route, status, seconds):
+    if token is None:
+        return
+    phases = _current.get() or {}
+    _current.reset(token)
+    with _lock:
+        _requests[(route, status)] = _requests.get((route, status), 0) + 1
+        _request_latency.setdefault(route, _Histogram()).observe(seconds)
+        for phase, spent in phases.items():
+            total = _phases.setdefault((route, phase), [0.0, 0])
+            total[0] += spent
+            total[1] += 1
+
+
+def add_phase(phase, seconds):
+    phases = _current.get()
+    if phases is not None:
+        phases[phase] = phases.get(phase, 0.0) + seconds
+
+
+@contextmanager
+def phase(name):
+    """Time a block as one phase of the current request"""
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        add_phase(name, time.perf_counter() - started)
+
+
+@contextmanager
+def collect_phases():
+    """Phases recorded in this block go to the yielded dict instead of the
+    request's: for work on another thread (which does not see the request's
+    context), handed back to the request thread with add_phases"""
+    phases = {}
+    token = _current.set(phases if METRICS_ENABLED else None)
+    try:
+        yield phases
+    finally:
+        _current.reset(token)
+
+
+def add_phases(phases):
+    for name, seconds in phases.items():
+        add_phase(name, seconds)
+
+
+def is_slow(seconds):
+    return METRICS_ENABLED and seconds * 1000 >= SLOW_QUERY_MS
+
+
+def record_statement(sql, params, seconds, engine='postgres', plan=None):
+    """Record one statement run; slow ones go to the slow-query log with `plan` (EXPLAIN lines)"""
+    if not METRICS_ENABLED:
+        return
+    name = statement_name(sql)
+    add_phase('queries', seconds)
+    slow = is_slow(seconds)
+    with _lock:
+        _queries.setdefault((name, engine), _Histogram()).observe(seconds)
+        if slow:
+            _slow_counts[name] = _slow_counts.get(name, 0) + 1
+    if slow:
+        entry = {
+            "at": time.strftime('%Y-%m-%dT%H:%M:%S'),
+            "statement": name,
+            "engine": engine,
+            "ms": round(seconds * 1000, 2),
+            "params": params if isinstance(params, dict) else list(params or ()),
+            "sql": sql.strip() if name == 'other' else None,
+            "plan": plan,
+        }
+        _slow_log.append(entry)
+        print(f"Slow query {name} ({entry['ms']} ms) params={entry['params']}"
+              + (''.join(f"\n    {line}" for line in plan) if plan else ''))
+
+
+def explain_plan(conn, sql, params):
+    """EXPLAIN lines of a statement on a psycopg2 connection, or None when the plan is not wanted"""
+    if not SLOW_QUERY_EXPLAIN:
+        return None
+    cur = conn.cursor()
+    try:
+        cur.execute("EXPLAIN " + sql, params)
+        return [row[0] for row in cur.fetchall()]
+    except Exception as e:
+        conn.rollback()
+        return [f"EXPLAIN failed: {e}"]
+    finally:
+        cur.close()
+
+
+def run_statement(conn, sql, params, fetch):
+    """fetch(conn, sql, params), timed and recorded under the statement's name"""
+    if not METRICS_ENABLED:
+        return fetch(conn, sql, params)
+    started = time.perf_counter()
+    rows = fetch(conn, sql, params)
+    seconds = time.perf_counter() - started
+    plan = explain_plan(conn, sql, params) if is_slow(seconds) else None
+    record_statement(sql, params, seconds, plan=plan)
+    return rows
+
+
+def register_gauges(prefix, collect, counters=()):
+    """Export the numbers of collect() (a possibly nested dict) as `<prefix>_<key>` gauges;
+    the flattened keys named in counters only ever grow and are typed as counters"""
+    _gauges[prefix] = (collect, frozenset(f"{prefix}_{key}" for key in counters))
+
+
+# FLASK
+
+def init_app(app):
+    """Time every request of a Flask app under its route pattern.
+
+    Register before other after_request hooks (conditional.init_app) so
+    their work, e.g. compression, is part of the measured time.
+    """
+    from flask import request, g
+
+    @app.before_request
+    def _start():
+        g.metrics = (time.perf_counter(), start_request())
+
+    @app.after_request
+    def _finish(response):
+        started, token = g.pop('metrics', (None, None))
+        if started is not None:
+            route = request.url_rule.rule if request.url_rule is not None else 'unmatched'
+            finish_request(token, route, response.status_code, time.perf_counter() - started)
+        return response
+
+
+# EXPOSITION
+
+def _labels(**labels):
+    def escape(value):
+        return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+    return '{' + ','.join(f'{k}="{escape(v)}"' for k, v in labels.items()) + '}'
+
+
+def _histogram_lines(metric, labels, histogram):
+    lines, cumulative = [], 0
+    for bound, count in zip(BUCKETS + (float('inf'),), histogram.counts):
+        cumulative += count
+        le = '+Inf' if bound == float('inf') else repr(bound)
+        lines.append(f"{metric}_bucket{_labels(**labels, le=le)} {cumulative}")
+    lines.append(f"{metric}_sum{_labels(**labels)} {histogram.sum}")
+    lines.append(f"{metric}_count{_labels(**labels)} {histogram.count}")
+    return lines
+
+
+def _flatten(prefix, values):
+    for key, value in values.items():
+        name = f"{prefix}_{key}"
+        if isinstance(value, dict):
+            yield from _flatten(name, value)
+        elif isinstance(value, bool):
+            yield name, int(value)
+        elif isinstance(value, (int, float)):
+            yield name, value
+
+
+def render():
+    """All metrics in the Prometheus text exposition format"""
+    with _lock:
+        requests = dict(_requests)
+        latency = {route: h for route, h in _request_latency.items()}
+        phases = {key: tuple(v) for key, v in _phases.items()}
+        statements = dict(_queries)
+        slow = dict(_slow_counts)
+        lines = [
+            "# HELP api_requests_total Requests answered, by route pattern and status",
+            "# TYPE api_requests_total counter",
+        ]
+        lines += [f"api_requests_total{_labels(route=r, status=s)} {n}" for (r, s), n in sorted(requests.items())]
+        lines += [
+            "# HELP api_request_duration_seconds Request latency by route pattern",
+            "# TYPE api_request_duration_seconds histogram",
+        ]
+        for route, histogram in sorted(latency.items()):
+            lines += _histogram_lines("api_request_duration_seconds", {"route": route}, histogram)
+        lines += [
+            "# HELP api_request_phase_seconds Time spent per request phase",
+            "# TYPE api_request_phase_seconds summary",
+        ]
+        for (route, name), (total, count) in sorted(phases.items()):
+            lines.append(f"api_request_phase_seconds_sum{_labels(route=route, phase=name)} {total}")
+            lines.append(f"api_request_phase_seconds_count{_labels(route=route, phase=name)} {count}")
+        lines += [
+            "# HELP api_query_duration_seconds Statement latency by queries.py name",
+            "# TYPE api_query_duration_seconds histogram",
+        ]
+        for (name, engine), histogram in sorted(statements.items()):
+            lines += _histogram_lines("api_query_duration_seconds", {"statement": name, "engine": engine}, histogram)
+        lines += [
+            f"# HELP api_slow_queries_total Statements slower than {SLOW_QUERY_MS:g} ms",
+            "# TYPE api_slow_queries_total counter",
+        ]
+        lines += [f"api_slow_queries_total{_labels(statement=name)} {n}" for name, n in sorted(slow.items())]
+
+    for prefix, (collect, counters) in _gauges.items():
+        try:
+            values = list(_flatten(prefix, collect() or {}))
+        except Exception as e:
+            print(f"Error collecting {prefix} metrics: {str(e)}")
+            continue
+        for name, value in values:
+            kind = 'counter' if name in counters else 'gauge'
+            lines += [f"# TYPE {name} {kind}", f"{name} {value}"]
+    return '\n'.join(lines) + '\n'
+
+
+def slow_queries():
+    """The slow-query log, newest first"""
+    return list(reversed(_slow_log))
+
+
+def reset():
+    """Forget everything recorded so far"""
+    with _lock:
+        for store in (_requests, _request_latency, _phases, _queries, _slow_counts):
+            store.clear()
+        _slow_log.clear()
+
+
+PROMETHEUS_CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
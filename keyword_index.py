@@ -0,0 +1,148 @@
+"""Inverted index from search keywords to the items (and merchants) they match.
+
+keywords holds search phrases ("fried spring rolls", "spring rolls") with
+their view/menu/checkout/order funnel, but no merchant. Both the phrases and
+items.item_name are split into normalized tokens, and a keyword matches an
+item when every token of the keyword occurs in the item's name:
+
+    keyword_tokens     (token, keyword_id)  token -> keywords, for prefix search
+    keyword_merchants  (merchant_id, keyword_id, item_ids, tokens, order_count)
+                       the keywords each merchant's items match
+
+The funnel ratios are generated columns of keywords itself. The index is
+rebuilt from scratch after every import (a few thousand phrases against the
+item catalogue):
+
+    python keyword_index.py                          # rebuild
+    python keyword_index.py --search "spring r" --merchant ID
+"""
+import argparse
+import csv
+import io
+import re
+import time
+
+from db_connection import get_db_connection
+from serialization import fetch_rows
+import queries
+
+_TOKEN = re.compile(r'[a-z0-9]+')
+
+
+def normalize(token):
+    """Fold the plural 's' so "rolls" and "roll" are the same token"""
+    if len(token) > 3 and token.endswith('s') and not token.endswith('ss'):
+        return token[:-1]
+    return token
+
+
+def tokens(text):
+    """Normalized tokens of a phrase or item name, in order, without repeats"""
+    seen = []
+    for token in _TOKEN.findall((text or '').lower()):
+        token = normalize(token)
+        if token not in seen:
+            seen.append(token)
+    return seen
+
+
+def search_params(merchant_id, q, limit):
+    """Statement parameters for queries.KEYWORD_SEARCH, or None when `q` has no tokens.
+
+    Every token but the last must match a keyword token exactly; the last one
+    is the prefix being typed.
+    """
+    terms = tokens(q)
+    if not terms:
+        return None
+    return {"merchant_id": merchant_id, "tokens": terms[:-1], "prefix": terms[-1] + '%', "limit": limit}
+
+
+def _copy(cur, table, columns, rows):
+    buf = io.StringIO()
+    csv.writer(buf, lineterminator='\n').writerows(rows)
+    buf.seek(0)
+    cur.copy_expert(f"COPY {table} ({', '.join(columns)}) FROM STDIN WITH (FORMAT csv)", buf)
+
+
+def _array(values):
+    # Tokens are [a-z0-9]+ and ids integers, so nothing needs quoting
+    return '{' + ','.join(str(v) for v in values) + '}'
+
+
+def rebuild(cur):
+    """Recompute keyword_tokens and keyword_merchants; commits with the caller's transaction"""
+    cur.execute("SELECT id, keyword, order_count FROM keywords")
+    keywords = [(keyword_id, tokens(keyword), order_count) for keyword_id, keyword, order_count in cur.fetchall()]
+    cur.execute("SELECT item_id, item_name, merchant_id FROM items WHERE merchant_id IS NOT NULL")
+    items = cur.fetchall()
+
+    postings = {}
+    for item_id, item_name, _ in items:
+        for token in tokens(item_name):
+            postings.setdefault(token, set()).add(item_id)
+    merchant_of = {item_id: merchant_id for item_id, _, merchant_id in items}
+
+    token_rows, merchant_rows = [], []
+    for keyword_id, terms, order_count in keywords:
+        token_rows.extend((token, keyword_id) for token in terms)
+        if not terms:
+            continue
+        matched = set.intersection(*(postings.get(token, set()) for token in terms))
+        by_merchant = {}
+        for item_id in matched:
+            by_merchant.setdefault(merchant_of[item_id], []).append(item_id)
+        for merchant_id, item_ids in by_merchant.items():
+            merchant_rows.append((merchant_id, keyword_id, _array(sorted(item_ids)), _array(terms), order_count))
+
+    # DELETE rather than TRUNCATE: readers keep the old index until commit
+    cur.execute("DELETE FROM keyword_tokens")
+    cur.execute("DELETE FROM keyword_merchants")
+    _copy(cur, 'keyword_tokens', ['token', 'keyword_id'], token_rows)
+    _copy(cur, 'keyword_merchants', ['merchant_id', 'keyword_id', 'item_ids', 'tokens', 'order_count'], merchant_rows)
+    return {"keywords": len(keywords), "tokens": len(token_rows), "merchant_keywords": len(merchant_rows)}
+
+
+def rebuild_index(conn=None):
+    own_conn = conn is None
+    if own_conn:
+        conn = get_db_connection()
+    try:
+        cur = conn.cursor()
+        started = time.monotonic()
+        stats = rebuild(cur)
+        conn.commit()
+        cur.execute("ANALYZE keyword_tokens")
+        cur.execute("ANALYZE keyword_merchants")
+        conn.commit()
+        cur.close()
+        print(f"  keyword index: {stats['keywords']:,} keywords, {stats['merchant_keywords']:,} "
+              f"merchant matches in {time.monotonic() - started:.2f}s")
+        return stats
+    finally:
+        if own_conn:
+            conn.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Rebuild or query the keyword index")
+    parser.add_argument("--search", help="typeahead query to run instead of rebuilding")
+    parser.add_argument("--merchant", help="merchant_id to search for")
+    parser.add_argument("--limit", type=int, default=10)
+    args = parser.parse_args()
+
+    conn = get_db_connection()
+    try:
+        if args.search is None:
+            rebuild_index(conn)
+        else:
+            params = search_params(args.merchant, args.search, args.limit)
+            started = time.perf_counter()
+            rows = fetch_rows(conn, queries.KEYWORD_SEARCH, params) if params else []
+            elapsed = (time.perf_counter() - started) * 1000
+            for row in rows:
+                print(f"  {row['keyword']:<40} {row['order_count']:>6} orders  "
+                      f"{row['conversion_rate']:6.2f}%  items {row['item_ids']}")
+            print(f"{len(rows)} keywords in {elapsed:.2f} ms")
+    finally:
+        conn.close()
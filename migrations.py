@@ -0,0 +1,625 @@
+"""Versioned schema migrations and per-endpoint EXPLAIN reports.
+
+Usage:
+    python migrations.py                      # apply pending migrations
+    python migrations.py --status             # list applied / pending versions
+    python migrations.py --explain [--merchant ID] [--analyze]
+"""
+import argparse
+import json
+
+from db_connection import get_db_connection
+import queries
+import rollups
+import data_analytics
+import partitions
+import keyword_index
+import basket
+
+# Arbitrary key for pg_advisory_lock so concurrent importers/servers never
+# apply the same migration twice
+MIGRATION_LOCK_KEY = 74_110_001
+
+# Each migration is (version, name, steps). A step is either a SQL string or a
+# callable taking a cursor. Every migration runs in its own transaction and is
+# recorded in schema_migrations; steps should still be idempotent so a
+# database created before this module existed can be brought under version
+# control.
+MIGRATIONS = [
+    (1, "base_schema", [
+        '''
+        CREATE TABLE IF NOT EXISTS merchants (
+            merchant_id VARCHAR(10) PRIMARY KEY,
+            merchant_name VARCHAR(100),
+            join_date VARCHAR(10),
+            city_id INTEGER
+        )
+        ''',
+        '''
+        CREATE TABLE IF NOT EXISTS items (
+            item_id INTEGER PRIMARY KEY,
+            cuisine_tag VARCHAR(50),
+            item_name VARCHAR(100),
+            item_price NUMERIC(10, 2),
+            merchant_id VARCHAR(10),
+            FOREIGN KEY (merchant_id) REFERENCES merchants (merchant_id)
+        )
+        ''',
+        '''
+        CREATE TABLE IF NOT EXISTS transaction_data (
+            order_id VARCHAR(20) PRIMARY KEY,
+            order_time TIMESTAMP,
+            driver_arrival_time TIMESTAMP,
+            driver_pickup_time TIMESTAMP,
+            delivery_time TIMESTAMP,
+            order_value NUMERIC(10, 2),
+            eater_id BIGINT,
+            merchant_id VARCHAR(10),
+            FOREIGN KEY (merchant_id) REFERENCES merchants (merchant_id)
+        )
+        ''',
+        '''
+        CREATE TABLE IF NOT EXISTS transaction_items (
+            id SERIAL PRIMARY KEY,
+            order_id VARCHAR(20),
+            item_id INTEGER,
+            merchant_id VARCHAR(10),
+            FOREIGN KEY (order_id) REFERENCES transaction_data (order_id) ON DELETE CASCADE,
+            FOREIGN KEY (item_id) REFERENCES items (item_id) ON DELETE CASCADE,
+            FOREIGN KEY (merchant_id) REFERENCES merchants (merchant_id) ON DELETE CASCADE
+        )
+        ''',
+        # 'order' is renamed to 'order_count' to avoid the keyword conflict
+        '''
+        CREATE TABLE IF NOT EXISTS keywords (
+            id SERIAL PRIMARY KEY,
+            keyword VARCHAR(100),
+            view INTEGER,
+            menu INTEGER,
+            checkout INTEGER,
+            order_count INTEGER
+        )
+        ''',
+    ]),
+    (2, "hot_path_indexes", [
+        # summary, sales/daily, sales/hourly, sales/metrics: merchant + time
+        # range, answered from the index alone once the table is vacuumed
+        '''
+        CREATE INDEX IF NOT EXISTS idx_transaction_data_merchant_time
+        ON transaction_data (merchant_id, order_time) INCLUDE (order_value, order_id)
+        ''',
+        # insights delivery averages only look at completed orders
+        '''
+        CREATE INDEX IF NOT EXISTS idx_transaction_data_merchant_completed
+        ON transaction_data (merchant_id)
+        INCLUDE (order_time, driver_arrival_time, driver_pickup_time, delivery_time)
+        WHERE delivery_time IS NOT NULL
+          AND driver_arrival_time IS NOT NULL
+          AND driver_pickup_time IS NOT NULL
+        ''',
+        # insights repeat-customer rate groups a merchant's orders by eater
+        '''
+        CREATE INDEX IF NOT EXISTS idx_transaction_data_merchant_eater
+        ON transaction_data (merchant_id, eater_id)
+        ''',
+        # items/performance and top cuisines join items -> transaction_items
+        '''
+        CREATE INDEX IF NOT EXISTS idx_transaction_items_item
+        ON transaction_items (item_id) INCLUDE (order_id)
+        ''',
+        # transaction_items -> transaction_data join, and ON DELETE CASCADE
+        '''
+        CREATE INDEX IF NOT EXISTS idx_transaction_items_order
+        ON transaction_items (order_id)
+        ''',
+        '''
+        CREATE INDEX IF NOT EXISTS idx_items_merchant
+        ON items (merchant_id) INCLUDE (item_name, item_price, cuisine_tag)
+        ''',
+        '''
+        CREATE INDEX IF NOT EXISTS idx_keywords_order_count
+        ON keywords (order_count DESC)
+        ''',
+        "ANALYZE transaction_data",
+        "ANALYZE transaction_items",
+        "ANALYZE items",
+    ]),
+    (3, "import_state", [
+        # One row per table: the checkpoint of the last committed chunk and
+        # the order_time watermark used by incremental imports
+        '''
+        CREATE TABLE IF NOT EXISTS import_state (
+            table_name VARCHAR(50) PRIMARY KEY,
+            source_file TEXT,
+            status VARCHAR(20) NOT NULL DEFAULT 'pending',
+            byte_offset BIGINT NOT NULL DEFAULT 0,
+            fingerprint VARCHAR(40),
+            rows_committed BIGINT NOT NULL DEFAULT 0,
+            watermark_time TIMESTAMP,
+            watermark_order_id VARCHAR(20),
+            run_since TIMESTAMP,
+            run_max_time TIMESTAMP,
+            run_max_order_id VARCHAR(20),
+            run_baseline_id BIGINT,
+            started_at TIMESTAMP,
+            updated_at TIMESTAMP
+        )
+        ''',
+    ]),
+    (4, "import_deferred_objects", [
+        # Definitions of indexes and foreign keys dropped for a bulk load, kept
+        # until they are rebuilt so an interrupted import can restore them
+        '''
+        CREATE TABLE IF NOT EXISTS import_deferred_objects (
+            object_name VARCHAR(100) PRIMARY KEY,
+            table_name VARCHAR(50) NOT NULL,
+            kind VARCHAR(10) NOT NULL,
+            definition TEXT NOT NULL,
+            deferred_at TIMESTAMP NOT NULL DEFAULT NOW()
+        )
+        ''',
+    ]),
+    (5, "sales_rollup", [
+        # Hourly buckets per merchant backing the sales endpoints; kept
+        # current by the importer (see rollups.py)
+        '''
+        CREATE TABLE IF NOT EXISTS sales_rollup (
+            merchant_id VARCHAR(10) NOT NULL,
+            sale_date DATE NOT NULL,
+            sale_hour SMALLINT NOT NULL,
+            order_count INTEGER NOT NULL,
+            order_value_sum NUMERIC(14, 2),
+            order_value_count INTEGER NOT NULL,
+            completed_count INTEGER NOT NULL,
+            delivery_minutes_sum NUMERIC,
+            arrival_minutes_sum NUMERIC,
+            preparation_minutes_sum NUMERIC,
+            PRIMARY KEY (merchant_id, sale_date, sale_hour)
+        )
+        ''',
+        lambda cur: rollups.rebuild(cur, 'sales_rollup'),
+        "ANALYZE sales_rollup",
+    ]),
+    (6, "analytical_views", [
+        # One row per refresh of a materialized view (see data_analytics.py)
+        '''
+        CREATE TABLE IF NOT EXISTS analytics_refresh_log (
+            id SERIAL PRIMARY KEY,
+            view_name VARCHAR(100) NOT NULL,
+            started_at TIMESTAMP NOT NULL,
+            duration_ms INTEGER NOT NULL,
+            row_count BIGINT,
+            concurrent BOOLEAN NOT NULL,
+            status VARCHAR(20) NOT NULL,
+            error TEXT
+        )
+        ''',
+        '''
+        CREATE INDEX IF NOT EXISTS idx_analytics_refresh_log_view
+        ON analytics_refresh_log (view_name, started_at DESC)
+        ''',
+        data_analytics.create_analytical_views,
+    ]),
+    (7, "data_version", [
+        # Single row bumped by imports and view refreshes; the API cache keys
+        # responses by it (see cache.py)
+        '''
+        CREATE TABLE IF NOT EXISTS data_version (
+            id BOOLEAN PRIMARY KEY DEFAULT TRUE CHECK (id),
+            version BIGINT NOT NULL DEFAULT 1,
+            bumped_at TIMESTAMP NOT NULL DEFAULT NOW()
+        )
+        ''',
+        "INSERT INTO data_version (id) VALUES (TRUE) ON CONFLICT (id) DO NOTHING",
+    ]),
+    (8, "partition_transaction_data", [
+        # Monthly range partitions on order_time (see partitions.py); the
+        # rolling-window endpoints then read only the months they cover
+        partitions.partition_transaction_data,
+        # The indexes of migration 2 again, now partitioned indexes that
+        # every current and future partition gets
+        '''
+        CREATE INDEX IF NOT EXISTS idx_transaction_data_merchant_time
+        ON transaction_data (merchant_id, order_time) INCLUDE (order_value, order_id)
+        ''',
+        '''
+        CREATE INDEX IF NOT EXISTS idx_transaction_data_merchant_completed
+        ON transaction_data (merchant_id)
+        INCLUDE (order_time, driver_arrival_time, driver_pickup_time, delivery_time)
+        WHERE delivery_time IS NOT NULL
+          AND driver_arrival_time IS NOT NULL
+          AND driver_pickup_time IS NOT NULL
+        ''',
+        '''
+        CREATE INDEX IF NOT EXISTS idx_transaction_data_merchant_eater
+        ON transaction_data (merchant_id, eater_id)
+        ''',
+        # order_id alone is no longer the primary key; joins from
+        # transaction_items and the importer's merges look orders up by it
+        '''
+        CREATE INDEX IF NOT EXISTS idx_transaction_data_order
+        ON transaction_data (order_id)
+        ''',
+        data_analytics.create_analytical_views,
+        "ANALYZE transaction_data",
+    ]),
+    (9, "keyword_index", [
+        # Funnel ratios computed once per keywords row instead of per request
+        '''
+        ALTER TABLE keywords
+        ADD COLUMN IF NOT EXISTS conversion_rate DOUBLE PRECISION GENERATED ALWAYS AS (
+            CASE WHEN view > 0 THEN order_count::DOUBLE PRECISION / view * 100 ELSE 0 END) STORED,
+        ADD COLUMN IF NOT EXISTS menu_rate DOUBLE PRECISION GENERATED ALWAYS AS (
+            CASE WHEN view > 0 THEN menu::DOUBLE PRECISION / view * 100 ELSE 0 END) STORED,
+        ADD COLUMN IF NOT EXISTS checkout_rate DOUBLE PRECISION GENERATED ALWAYS AS (
+            CASE WHEN menu > 0 THEN checkout::DOUBLE PRECISION / menu * 100 ELSE 0 END) STORED,
+        ADD COLUMN IF NOT EXISTS order_rate DOUBLE PRECISION GENERATED ALWAYS AS (
+            CASE WHEN checkout > 0 THEN order_count::DOUBLE PRECISION / checkout * 100 ELSE 0 END) STORED
+        ''',
+        # Inverted index of keyword tokens and the keywords each merchant's
+        # items match (see keyword_index.py). Tokens sort bytewise so the
+        # primary key also serves LIKE 'prefix%'.
+        '''
+        CREATE TABLE IF NOT EXISTS keyword_tokens (
+            token TEXT COLLATE "C" NOT NULL,
+            keyword_id INTEGER NOT NULL,
+            PRIMARY KEY (token, keyword_id)
+        )
+        ''',
+        '''
+        CREATE TABLE IF NOT EXISTS keyword_merchants (
+            merchant_id VARCHAR(10) NOT NULL,
+            keyword_id INTEGER NOT NULL,
+            item_ids INTEGER[] NOT NULL,
+            tokens TEXT[] NOT NULL,
+            order_count INTEGER,
+            PRIMARY KEY (merchant_id, keyword_id)
+        )
+        ''',
+        '''
+        CREATE INDEX IF NOT EXISTS idx_keyword_merchants_top
+        ON keyword_merchants (merchant_id, order_count DESC NULLS LAST)
+        ''',
+        keyword_index.rebuild,
+    ]),
+    (10, "item_sales_daily", [
+        # Units sold and orders per item and day, kept current by the
+        # importer like sales_rollup; the primary key covers the item
+        # performance reads
+        '''
+        CREATE TABLE IF NOT EXISTS item_sales_daily (
+            item_id INTEGER NOT NULL,
+            sale_date DATE NOT NULL,
+            quantity INTEGER NOT NULL,
+            order_count INTEGER NOT NULL,
+            PRIMARY KEY (item_id, sale_date) INCLUDE (quantity, order_count)
+        )
+        ''',
+        lambda cur: rollups.rebuild(cur, 'item_sales_daily'),
+        "ANALYZE item_sales_daily",
+    ]),
+    (11, "customer_sketches", [
+        # Per merchant-day HyperLogLog registers of eater_id (see
+        # sketches.py) and per merchant-eater order counts, both kept
+        # current by the importer; they replace the repeat-customer self-join
+        '''
+        CREATE TABLE IF NOT EXISTS eater_sketches (
+            merchant_id VARCHAR(10) NOT NULL,
+            sale_date DATE NOT NULL,
+            register SMALLINT NOT NULL,
+            rank SMALLINT NOT NULL,
+            PRIMARY KEY (merchant_id, sale_date, register) INCLUDE (rank)
+        )
+        ''',
+        '''
+        CREATE TABLE IF NOT EXISTS merchant_eaters (
+            merchant_id VARCHAR(10) NOT NULL,
+            eater_id BIGINT NOT NULL,
+            order_count INTEGER NOT NULL,
+            first_order DATE NOT NULL,
+            PRIMARY KEY (merchant_id, eater_id) INCLUDE (order_count, first_order)
+        )
+        ''',
+        lambda cur: rollups.rebuild(cur, 'eater_sketches'),
+        lambda cur: rollups.rebuild(cur, 'merchant_eaters'),
+        "ANALYZE eater_sketches",
+        "ANALYZE merchant_eaters",
+    ]),
+    (12, "delivery_histograms", [
+        # Completed orders per merchant-day in log-spaced buckets of each
+        # duration (see histograms.py), kept current by the importer
+        '''
+        CREATE TABLE IF NOT EXISTS delivery_histograms (
+            merchant_id VARCHAR(10) NOT NULL,
+            sale_date DATE NOT NULL,
+            metric VARCHAR(12) NOT NULL,
+            bucket SMALLINT NOT NULL,
+            order_count INTEGER NOT NULL,
+            PRIMARY KEY (merchant_id, sale_date, metric, bucket) INCLUDE (order_count)
+        )
+        ''',
+        lambda cur: rollups.rebuild(cur, 'delivery_histograms'),
+        "ANALYZE delivery_histograms",
+    ]),
+    (13, "transactions_keyset", [
+        # order_id joins the key of the merchant + time index, so a
+        # /transactions page is one index range read from its cursor in
+        # (order_time, order_id) order, without sorting ties; the other
+        # statements only use the leading columns
+        '''
+        CREATE INDEX IF NOT EXISTS idx_transaction_data_merchant_time_order
+        ON transaction_data (merchant_id, order_time, order_id) INCLUDE (order_value)
+        ''',
+        "DROP INDEX IF EXISTS idx_transaction_data_merchant_time",
+        "ANALYZE transaction_data",
+    ]),
+    (14, "merchant_peers", [
+        # KPIs and peer percentile ranks of every merchant, refreshed with
+        # the other views after each import (see peers.py)
+        lambda cur: data_analytics.create_analytical_views(cur, ['mv_merchant_peers']),
+        "ANALYZE mv_merchant_peers",
+    ]),
+    (15, "sales_forecasts", [
+        # One row per forecasting job run (see forecasting.py), with the
+        # data_version its forecasts are current for
+        '''
+        CREATE TABLE IF NOT EXISTS forecast_runs (
+            id SERIAL PRIMARY KEY,
+            started_at TIMESTAMP NOT NULL,
+            first_day DATE NOT NULL,
+            horizon_days INTEGER NOT NULL,
+            history_days INTEGER NOT NULL,
+            merchants INTEGER NOT NULL,
+            workers INTEGER NOT NULL,
+            duration_ms INTEGER,
+            data_version BIGINT NOT NULL
+        )
+        ''',
+        # The latest run's forecasts, replaced as a whole by every run
+        '''
+        CREATE TABLE IF NOT EXISTS sales_forecasts (
+            merchant_id VARCHAR(10) NOT NULL,
+            forecast_date DATE NOT NULL,
+            sales DOUBLE PRECISION NOT NULL,
+            sales_low DOUBLE PRECISION NOT NULL,
+            sales_high DOUBLE PRECISION NOT NULL,
+            orders DOUBLE PRECISION NOT NULL,
+            hourly_sales DOUBLE PRECISION[] NOT NULL,
+            run_id INTEGER NOT NULL,
+            PRIMARY KEY (merchant_id, forecast_date)
+        )
+        ''',
+    ]),
+    (16, "item_pairs", [
+        # Each item's most frequently co-ordered items (see basket.py),
+        # rebuilt after every import; a /pairs request is one range of the
+        # primary key
+        '''
+        CREATE TABLE IF NOT EXISTS item_pairs (
+            item_id INTEGER NOT NULL,
+            rank SMALLINT NOT NULL,
+            paired_item_id INTEGER NOT NULL,
+            pair_orders INTEGER NOT NULL,
+            item_orders INTEGER NOT NULL,
+            merchant_orders INTEGER NOT NULL,
+            support DOUBLE PRECISION NOT NULL,
+            confidence DOUBLE PRECISION NOT NULL,
+            lift DOUBLE PRECISION NOT NULL,
+            PRIMARY KEY (item_id, rank)
+        )
+        ''',
+        basket.rebuild,
+        "ANALYZE item_pairs",
+    ]),
+]
+
+# Large tables whose sequential scans the EXPLAIN report calls out
+HOT_TABLES = ("transaction_data", "transaction_items", "sales_rollup", "item_sales_daily",
+              "eater_sketches", "delivery_histograms", "sales_forecasts")
+# Partitions this small (the default one, next month's) are read
+# sequentially whatever the indexes; those scans are not called out
+SMALL_PARTITION_ROWS = 1000
+
+
+def _ensure_migrations_table(conn):
+    cur = conn.cursor()
+    cur.execute('''
+    CREATE TABLE IF NOT EXISTS schema_migrations (
+        version INTEGER PRIMARY KEY,
+        name VARCHAR(100) NOT NULL,
+        applied_at TIMESTAMP NOT NULL DEFAULT NOW()
+    )
+    ''')
+    conn.commit()
+    cur.close()
+
+
+def applied_versions(conn):
+    _ensure_migrations_table(conn)
+    cur = conn.cursor()
+    cur.execute("SELECT version FROM schema_migrations")
+    versions = {row[0] for row in cur.fetchall()}
+    cur.close()
+    conn.commit()
+    return versions
+
+
+def apply_migrations(conn=None, target=None):
+    """Apply every pending migration up to `target` (default: latest)"""
+    own_conn = conn is None
+    if own_conn:
+        conn = get_db_connection()
+
+    _ensure_migrations_table(conn)
+    cur = conn.cursor()
+    applied = []
+    try:
+        cur.execute("SELECT pg_advisory_lock(%s)", (MIGRATION_LOCK_KEY,))
+        conn.commit()
+        done = applied_versions(conn)
+
+        for version, name, steps in MIGRATIONS:
+            if version in done or (target is not None and version > target):
+                continue
+            print(f"Applying migration {version}: {name}...")
+            try:
+                for step in steps:
+                    if callable(step):
+                        step(cur)
+                    else:
+                        cur.execute(step)
+                cur.execute(
+                    "INSERT INTO schema_migrations (version, name) VALUES (%s, %s)",
+                    (version, name)
+                )
+                conn.commit()
+            except Exception as e:
+                conn.rollback()
+                print(f"Error applying migration {version} ({name}): {e}")
+                raise
+            applied.append(version)
+    finally:
+        cur.execute("SELECT pg_advisory_unlock(%s)", (MIGRATION_LOCK_KEY,))
+        conn.commit()
+        cur.close()
+        if own_conn:
+            conn.close()
+
+    if applied:
+        print(f"Applied migrations: {', '.join(str(v) for v in applied)}")
+    return applied
+
+
+def migration_status(conn):
+    done = applied_versions(conn)
+    return [
+        {"version": version, "name": name, "applied": version in done}
+        for version, name, _ in MIGRATIONS
+    ]
+
+
+def _plan_nodes(node, found=None):
+    """Flatten an EXPLAIN (FORMAT JSON) plan tree into its scan/join nodes"""
+    if found is None:
+        found = []
+    found.append({
+        "node": node.get("Node Type"),
+        "relation": node.get("Relation Name"),
+        "index": node.get("Index Name"),
+        "rows": node.get("Actual Rows", node.get("Plan Rows")),
+    })
+    for child in node.get("Plans", []):
+        _plan_nodes(child, found)
+    return found
+
+
+def _sample_merchant(conn):
+    cur = conn.cursor()
+    cur.execute('''
+    SELECT merchant_id FROM transaction_data
+    GROUP BY merchant_id ORDER BY COUNT(*) DESC LIMIT 1
+    ''')
+    row = cur.fetchone()
+    cur.close()
+    return row[0] if row else None
+
+
+def _partition_parents(cur):
+    """{partition or partition index: (parent, estimated rows)}"""
+    cur.execute('''
+    SELECT c.relname, p.relname, c.reltuples FROM pg_inherits i
+    JOIN pg_class c ON c.oid = i.inhrelid
+    JOIN pg_class p ON p.oid = i.inhparent
+    WHERE p.relkind IN ('p', 'I')
+    ''')
+    return {name: (parent, rows) for name, parent, rows in cur.fetchall()}
+
+
+def explain_endpoints(conn, merchant_id=None, analyze=False, endpoints=None):
+    """EXPLAIN every statement behind the API endpoints for one merchant.
+
+    Returns {endpoint: [{"query", "seq_scans", "indexes", "partitions", "total_ms", "plan"}]}.
+    `seq_scans` lists the hot tables that were read sequentially, which is what
+    the indexes above are meant to prevent. `partitions` maps each partitioned
+    table to the partitions the plan still reads after pruning (out of how
+    many exist), e.g. {"transaction_data": [2, 8]}.
+    """
+    if merchant_id is None:
+        merchant_id = _sample_merchant(conn)
+    options = "ANALYZE, BUFFERS, FORMAT JSON" if analyze else "FORMAT JSON"
+
+    report = {}
+    cur = conn.cursor()
+    partitions = _partition_parents(cur)
+    parents = {name: parent for name, (parent, _) in partitions.items()}
+    totals = {}
+    for parent in parents.values():
+        totals[parent] = totals.get(parent, 0) + 1
+    for endpoint, statements in queries.ENDPOINT_QUERIES.items():
+        if endpoints and endpoint not in endpoints:
+            continue
+        report[endpoint] = []
+        for name, sql, make_params in statements:
+            cur.execute(f"EXPLAIN ({options}) {sql}", make_params(merchant_id))
+            plan = cur.fetchone()[0][0]
+            nodes = _plan_nodes(plan["Plan"])
+            # A scan of a partition (or its index) counts as one of its table
+            for n in nodes:
+                n["table"] = parents.get(n["relation"], n["relation"])
+            scanned = {}
+            for n in nodes:
+                if n["relation"] in parents:
+                    scanned.setdefault(n["table"], set()).add(n["relation"])
+            report[endpoint].append({
+                "query": name,
+                "seq_scans": sorted({
+                    n["table"] for n in nodes
+                    if n["node"] == "Seq Scan" and n["table"] in HOT_TABLES
+                    and partitions.get(n["relation"], (None, SMALL_PARTITION_ROWS))[1] >= SMALL_PARTITION_ROWS
+                }),
+                "indexes": sorted({parents.get(n["index"], n["index"]) for n in nodes if n["index"]}),
+                "partitions": {table: [len(names), totals[table]] for table, names in scanned.items()},
+                "total_ms": plan.get("Execution Time"),
+                "plan": plan,
+            })
+    conn.rollback()
+    cur.close()
+    return report
+
+
+def print_explain_report(report):
+    for endpoint, entries in report.items():
+        print(f"/{endpoint}")
+        for entry in entries:
+            status = "SEQ SCAN on " + ", ".join(entry["seq_scans"]) if entry["seq_scans"] else "ok"
+            timing = f" {entry['total_ms']:.2f} ms" if entry["total_ms"] is not None else ""
+            indexes = ", ".join(entry["indexes"]) or "-"
+            pruning = "".join(f"  [{table}: {read}/{total} partitions]"
+                              for table, (read, total) in entry["partitions"].items())
+            print(f"  {entry['query']:<20} {status:<40} indexes: {indexes}{pruning}{timing}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Apply schema migrations or inspect query plans")
+    parser.add_argument("--status", action="store_true", help="show applied and pending migrations")
+    parser.add_argument("--explain", action="store_true", help="EXPLAIN the API queries per endpoint")
+    parser.add_argument("--merchant", help="merchant_id to explain with (default: busiest merchant)")
+    parser.add_argument("--analyze", action="store_true", help="use EXPLAIN ANALYZE (runs the queries)")
+    parser.add_argument("--json", action="store_true", help="print the full EXPLAIN report as JSON")
+    args = parser.parse_args()
+
+    conn = get_db_connection()
+    try:
+        if args.status:
+            for m in migration_status(conn):
+                print(f"{m['version']:>4}  {m['name']:<30} {'applied' if m['applied'] else 'pending'}")
+        elif args.explain:
+            report = explain_endpoints(conn, args.merchant, analyze=args.analyze)
+            if args.json:
+                print(json.dumps(report, indent=2, default=str))
+            else:
+                print_explain_report(report)
+        else:
+            apply_migrations(conn)
+    finally:
+        conn.close()
@@ -43,25 +43,35 @@ const HomeScreen = ({ navigation, route }) => {
 
   useEffect(() => {
     if (selectedMerchant) {
-      loadMerchantData();
-      loadSalesData();
+      loadDashboard();
     } else {
       navigation.replace('MerchantLogin');
     }
   }, [selectedMerchant]);
 
-  useEffect(() => {
-    if (merchantId) {
-      fetchSalesMetrics();
-    }
-  }, [merchantId]);
-
-  
-  const loadMerchantData = async () => {
+  // Summary, sales metrics and the last 30 days of sales in one request; the
+  // server runs the underlying queries concurrently
+  const loadDashboard = async () => {
     try {
       setLoading(true);
-      const response = await axios.get(`${API_URL}/api/merchant/${selectedMerchant}/summary`);
-      setMerchantData(response.data);
+      const response = await axios.get(
+        `${API_URL}/api/merchant/${selectedMerchant}/dashboard?sections=summary,sales_metrics,sales_daily&days=30`
+      );
+      const { sections, errors } = response.data;
+
+      if (errors.summary) {
+        throw new Error(errors.summary.error);
+      }
+      setMerchantData(sections.summary);
+      setSalesMetrics(sections.sales_metrics || {});
+
+      if (sections.sales_daily) {
+        setSalesData(sections.sales_daily);
+        setSalesError(null);
+      } else {
+        console.error('Error fetching sales data:', errors.sales_daily);
+        setSalesError('Could not load sales data');
+      }
       setLoading(false);
     } catch (error) {
       console.error('Error fetching merchant data:', error);
@@ -74,29 +84,9 @@ const HomeScreen = ({ navigation, route }) => {
     }
   };
 
-  const fetchSalesMetrics = async () => {
-    try {
-      const response = await axios.get(`${API_URL}/api/merchant/${merchantId}/sales/metrics`);
-      setSalesMetrics(response.data);
-    } catch (error) {
-      console.error('Error fetching sales metrics:', error);
-    }
-  };
-  
-  const loadSalesData = async () => {
-    try {
-      const response = await axios.get(`${API_URL}/api/merchant/${selectedMerchant}/sales/daily?days=30`);
-      setSalesData(response.data);
-      setSalesError(null);
-    } catch (error) {
-      console.error('Error fetching sales data:', error);
-      setSalesError('Could not load sales data');
-    }
-  };
-
   const onRefresh = async () => {
     setRefreshing(true);
-    await Promise.all([loadMerchantData(), loadSalesData()]);
+    await loadDashboard();
     setRefreshing(false);
   };
 
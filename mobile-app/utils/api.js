@@ -1,9 +1,28 @@
 const API_BASE_URL = "http://192.168.68.114/api";
 
+// Last payload and ETag per path. The server answers 304 Not Modified with an
+// empty body when If-None-Match still matches, so unchanged screens reuse the
+// stored payload instead of downloading it again. (gzip is negotiated by the
+// platform's networking stack, which also decompresses transparently.)
+const etagCache = new Map();
+
 export async function fetchData(path) {
   try {
-    const response = await fetch(`${API_BASE_URL}${path}`);
-    return await response.json();
+    const cached = etagCache.get(path);
+    const response = await fetch(`${API_BASE_URL}${path}`, {
+      headers: cached ? { "If-None-Match": cached.etag } : {},
+    });
+    if (response.status === 304 && cached) {
+      return cached.data;
+    }
+    const data = await response.json();
+    const etag = response.headers.get("ETag");
+    if (response.ok && etag) {
+      etagCache.set(path, { etag, data });
+    } else {
+      etagCache.delete(path);
+    }
+    return data;
   } catch (error) {
     console.error("API Fetch Error:", error);
     return null;
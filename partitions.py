@@ -0,0 +1,337 @@
+"""Monthly range partitions of transaction_data.
+
+transaction_data is partitioned by RANGE (order_time) into one table per
+month, transaction_data_pYYYY_MM, plus transaction_data_default for rows no
+monthly partition covers (far-off or mistyped timestamps). The rolling
+window queries (order_time >= NOW() - ...) then only scan the partitions of
+their window, whatever the total history.
+
+    python partitions.py                        # create upcoming partitions, apply retention
+    python partitions.py --list                 # partitions, bounds and row estimates
+    python partitions.py --retention-months 24  # detach partitions older than two years
+
+Partitions are created PARTITION_PREMAKE months ahead of the current one,
+and by the importer for the months a chunk touches, as long as the month
+lies within PARTITION_BACKFILL_MONTHS of today; rows of other months stay
+in the default partition. With PARTITION_RETENTION_MONTHS set, partitions
+that ended before that many months ago are detached and moved, with their
+orders' transaction_items, to PARTITION_ARCHIVE_SCHEMA (dropped when it is
+empty); the rollup buckets they fed are recomputed.
+"""
+import argparse
+import datetime
+import os
+import re
+
+from db_connection import get_db_connection
+from cache import bump_data_version
+import rollups
+
+PARENT = 'transaction_data'
+DEFAULT_PARTITION = 'transaction_data_default'
+PARTITION_PREMAKE = int(os.getenv('PARTITION_PREMAKE', '3'))
+PARTITION_BACKFILL_MONTHS = int(os.getenv('PARTITION_BACKFILL_MONTHS', '36'))
+# 0 keeps every partition
+PARTITION_RETENTION_MONTHS = int(os.getenv('PARTITION_RETENTION_MONTHS', '0'))
+PARTITION_ARCHIVE_SCHEMA = os.getenv('PARTITION_ARCHIVE_SCHEMA', 'archive')
+
+# Serializes partition DDL between the importer and scheduled maintenance
+PARTITION_LOCK_KEY = 74_110_003
+
+_BOUNDS = re.compile(r"FROM \('([^']+)'\) TO \('([^']+)'\)")
+
+
+def _month(value):
+    return datetime.date(value.year, value.month, 1)
+
+
+def _add_months(month, count):
+    index = month.year * 12 + month.month - 1 + count
+    return datetime.date(index // 12, index % 12 + 1, 1)
+
+
+def partition_name(month):
+    return f"{PARENT}_p{month:%Y_%m}"
+
+
+def is_partitioned(cur):
+    cur.execute("SELECT relkind = 'p' FROM pg_class WHERE oid = to_regclass(%s)", (PARENT,))
+    row = cur.fetchone()
+    return bool(row and row[0])
+
+
+def list_partitions(cur):
+    """[{name, start, end, rows}] of the monthly partitions, oldest first, then the default"""
+    cur.execute('''
+    SELECT c.relname, pg_get_expr(c.relpartbound, c.oid), c.reltuples::BIGINT
+    FROM pg_inherits i
+    JOIN pg_class c ON c.oid = i.inhrelid
+    WHERE i.inhparent = %s::regclass
+    ''', (PARENT,))
+    partitions = []
+    for name, bound, rows in cur.fetchall():
+        match = _BOUNDS.search(bound)
+        start, end = (datetime.datetime.fromisoformat(b).date() for b in match.groups()) if match else (None, None)
+        partitions.append({"name": name, "start": start, "end": end, "rows": max(rows, 0)})
+    partitions.sort(key=lambda p: (p["start"] is None, p["start"] or datetime.date.min))
+    return partitions
+
+
+def _current_month(cur):
+    # Server clock, the one NOW() in the API queries reads
+    cur.execute("SELECT LOCALTIMESTAMP::DATE")
+    return _month(cur.fetchone()[0])
+
+
+def create_partition(cur, month):
+    """Create and attach the partition of `month`, moving its rows out of the default partition"""
+    name = partition_name(month)
+    start, end = month.isoformat(), _add_months(month, 1).isoformat()
+    cur.execute(f"CREATE TABLE {name} (LIKE {PARENT} INCLUDING DEFAULTS INCLUDING CONSTRAINTS)")
+    # Attaching checks that no default-partition row belongs to the new range
+    cur.execute(f'''
+    WITH moved AS (
+        DELETE FROM {DEFAULT_PARTITION}
+        WHERE order_time >= %s AND order_time < %s
+        RETURNING *
+    )
+    INSERT INTO {name} SELECT * FROM moved
+    ''', (start, end))
+    cur.execute(f"ALTER TABLE {PARENT} ATTACH PARTITION {name} FOR VALUES FROM ('{start}') TO ('{end}')")
+    return name
+
+
+def ensure_partitions(cur, months, premake=PARTITION_PREMAKE):
+    """Create the missing partitions among `months` that lie within the backfill/premake window"""
+    current = _current_month(cur)
+    history = PARTITION_BACKFILL_MONTHS
+    if PARTITION_RETENTION_MONTHS > 0:
+        # Nor partitions that retention would detach again
+        history = min(history, PARTITION_RETENTION_MONTHS)
+    first, last = _add_months(current, -history), _add_months(current, premake)
+    wanted = sorted({_month(m) for m in months if m is not None and first <= _month(m) <= last})
+    existing = {p["start"] for p in list_partitions(cur)}
+    if all(m in existing for m in wanted):
+        return []
+
+    # Held until the caller commits; re-read once another session's DDL is visible
+    cur.execute("SELECT pg_advisory_xact_lock(%s)", (PARTITION_LOCK_KEY,))
+    existing = {p["start"] for p in list_partitions(cur)}
+    return [create_partition(cur, m) for m in wanted if m not in existing]
+
+
+def ensure_for_stage(cur, stage):
+    """Create the partitions a staged chunk of transaction_data rows is about to land in"""
+    cur.execute(f"SELECT DISTINCT date_trunc('month', order_time)::DATE FROM {stage} WHERE order_time IS NOT NULL")
+    return ensure_partitions(cur, [row[0] for row in cur.fetchall()])
+
+
+def _split_default(cur):
+    cur.execute(f"SELECT DISTINCT date_trunc('month', order_time)::DATE FROM {DEFAULT_PARTITION}")
+    return ensure_partitions(cur, [row[0] for row in cur.fetchall()])
+
+
+def _archive(cur, name, archive_schema):
+    """Detach one partition and move (or drop) it with its orders' items"""
+    cur.execute(f"ALTER TABLE {PARENT} DETACH PARTITION {name}")
+    # The orders are gone from transaction_data now, so the rollups
+    # recompute their buckets without them
+    for rollup in rollups.rollups_for(PARENT):
+        rollups.prepare_touched(cur, rollup)
+        rollups.record_touched(cur, rollup, name, PARENT)
+        rollups.refresh_touched(cur, rollup)
+
+    items = name.replace(PARENT, 'transaction_items', 1)
+    if archive_schema:
+        # A month archived before (and loaded again since) is appended to
+        cur.execute(f"CREATE SCHEMA IF NOT EXISTS {archive_schema}")
+        cur.execute(f"CREATE TABLE IF NOT EXISTS {archive_schema}.{items} (LIKE transaction_items)")
+        cur.execute(f'''
+        INSERT INTO {archive_schema}.{items}
+        SELECT ti.* FROM transaction_items ti WHERE ti.order_id IN (SELECT order_id FROM {name})
+        ''')
+    cur.execute(f"DELETE FROM transaction_items ti USING {name} p WHERE ti.order_id = p.order_id")
+    if not archive_schema:
+        cur.execute(f"DROP TABLE {name}")
+        return
+    cur.execute("SELECT to_regclass(%s) IS NOT NULL", (f"{archive_schema}.{name}",))
+    if cur.fetchone()[0]:
+        cur.execute(f"INSERT INTO {archive_schema}.{name} SELECT * FROM {name}")
+        cur.execute(f"DROP TABLE {name}")
+    else:
+        cur.execute(f"ALTER TABLE {name} SET SCHEMA {archive_schema}")
+
+
+def maintain(conn, premake=PARTITION_PREMAKE, retention_months=PARTITION_RETENTION_MONTHS,
+             archive_schema=PARTITION_ARCHIVE_SCHEMA):
+    """Create the next `premake` months, split the default partition and apply retention.
+
+    Returns {"created": [...], "detached": [...]}; commits.
+    """
+    cur = conn.cursor()
+    try:
+        cur.execute("SELECT pg_advisory_xact_lock(%s)", (PARTITION_LOCK_KEY,))
+        current = _current_month(cur)
+        premake = max(premake, 0)
+        created = ensure_partitions(cur, [_add_months(current, n) for n in range(premake + 1)], premake)
+        created += _split_default(cur)
+
+        detached = []
+        if retention_months > 0:
+            cutoff = _add_months(current, -retention_months)
+            for partition in list_partitions(cur):
+                if partition["end"] is not None and partition["end"] <= cutoff:
+                    _archive(cur, partition["name"], archive_schema)
+                    detached.append(partition["name"])
+            if detached:
+                # Older orders just left every endpoint's answers
+                bump_data_version(cur)
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        cur.close()
+
+    for name in created:
+        print(f"  created partition {name}")
+    for name in detached:
+        where = f"moved to {archive_schema}" if archive_schema else "dropped"
+        print(f"  detached partition {name} ({where})")
+    return {"created": created, "detached": detached}
+
+
+def partition_transaction_data(cur):
+    """Migration step: rebuild an unpartitioned transaction_data as a partitioned table.
+
+    The primary key becomes (order_id, order_time), since a unique constraint
+    on a partitioned table has to include the partition key, so the foreign
+    key transaction_items.order_id -> transaction_data is dropped (the
+    importer removes items of unknown orders instead). The materialized
+    views reading the table are dropped here and recreated by the migration.
+    Orders without an order_time fit no partition; they are archived, not
+    dropped (see _archive_undated).
+    """
+    if is_partitioned(cur):
+        return
+    import data_analytics
+    for view in data_analytics.VIEWS:
+        cur.execute(f"DROP MATERIALIZED VIEW IF EXISTS {view}")
+
+    cur.execute('''
+    SELECT conrelid::regclass::text, conname FROM pg_constraint
+    WHERE confrelid = %s::regclass AND contype = 'f'
+    ''', (PARENT,))
+    for table, name in cur.fetchall():
+        cur.execute(f'ALTER TABLE {table} DROP CONSTRAINT "{name}"')
+    cur.execute('''
+    DELETE FROM import_deferred_objects
+    WHERE kind = 'fkey' AND definition LIKE %s
+    ''', (f"%REFERENCES {PARENT}(%",))
+
+    # Free the index names for the partitioned table's indexes
+    old = f"{PARENT}_unpartitioned"
+    cur.execute(f"ALTER TABLE {PARENT} RENAME TO {old}")
+    cur.execute('''
+    SELECT i.relname, x.indisprimary FROM pg_index x JOIN pg_class i ON i.oid = x.indexrelid
+    WHERE x.indrelid = %s::regclass
+    ''', (old,))
+    for name, primary in cur.fetchall():
+        if primary:
+            cur.execute(f'ALTER INDEX "{name}" RENAME TO {old}_pkey')
+        else:
+            cur.execute(f'DROP INDEX "{name}"')
+
+    cur.execute(f'''
+    CREATE TABLE {PARENT} (
+        order_id VARCHAR(20) NOT NULL,
+        order_time TIMESTAMP NOT NULL,
+        driver_arrival_time TIMESTAMP,
+        driver_pickup_time TIMESTAMP,
+        delivery_time TIMESTAMP,
+        order_value NUMERIC(10, 2),
+        eater_id BIGINT,
+        merchant_id VARCHAR(10),
+        CONSTRAINT {PARENT}_pkey PRIMARY KEY (order_id, order_time),
+        CONSTRAINT {PARENT}_merchant_id_fkey FOREIGN KEY (merchant_id) REFERENCES merchants (merchant_id)
+    ) PARTITION BY RANGE (order_time)
+    ''')
+    cur.execute(f"CREATE TABLE {DEFAULT_PARTITION} PARTITION OF {PARENT} DEFAULT")
+
+    cur.execute(f"SELECT DISTINCT date_trunc('month', order_time)::DATE FROM {old}")
+    months = [row[0] for row in cur.fetchall()]
+    current = _current_month(cur)
+    ensure_partitions(cur, months + [_add_months(current, n) for n in range(PARTITION_PREMAKE + 1)])
+
+    cur.execute(f"INSERT INTO {PARENT} SELECT * FROM {old} WHERE order_time IS NOT NULL")
+    _archive_undated(cur, old)
+    cur.execute(f"DROP TABLE {old}")
+
+
+def _archive_undated(cur, old, archive_schema=PARTITION_ARCHIVE_SCHEMA):
+    """Move the orders of `old` without an order_time, which no partition takes,
+    to {archive_schema}.transaction_data_undated with their items, and
+    recompute the rollup rows they fed"""
+    cur.execute(f"SELECT COUNT(*) FROM {old} WHERE order_time IS NULL")
+    undated = cur.fetchone()[0]
+    if not undated:
+        return
+    orders = f"{archive_schema}.{PARENT}_undated"
+    items = f"{archive_schema}.transaction_items_undated"
+    cur.execute(f"CREATE SCHEMA IF NOT EXISTS {archive_schema}")
+    cur.execute(f"CREATE TABLE IF NOT EXISTS {orders} (LIKE {old})")
+    cur.execute(f"INSERT INTO {orders} SELECT * FROM {old} WHERE order_time IS NULL")
+    cur.execute(f"CREATE TABLE IF NOT EXISTS {items} (LIKE transaction_items)")
+    cur.execute(f'''
+    INSERT INTO {items}
+    SELECT ti.* FROM transaction_items ti
+    WHERE ti.order_id IN (SELECT order_id FROM {old} WHERE order_time IS NULL)
+    ''')
+    moved_items = cur.rowcount
+    cur.execute(f'''
+    DELETE FROM transaction_items ti USING {old} o
+    WHERE ti.order_id = o.order_id AND o.order_time IS NULL
+    ''')
+    # transaction_data no longer has them; rollups built before this
+    # migration recompute what they counted (customer counts, mostly)
+    for rollup in rollups.rollups_for(PARENT):
+        cur.execute("SELECT to_regclass(%s) IS NOT NULL", (rollup,))
+        if cur.fetchone()[0]:
+            rollups.prepare_touched(cur, rollup)
+            rollups.record_touched(cur, rollup, orders, PARENT)
+            rollups.refresh_touched(cur, rollup)
+    print(f"  moved {undated:,} orders without an order_time (not allowed by the partition key) "
+          f"and their {moved_items:,} items to {orders}")
+
+
+def print_partitions(partitions):
+    for p in partitions:
+        bounds = f"{p['start']} .. {p['end']}" if p["start"] else "default"
+        print(f"  {p['name']:<32} {bounds:<26} ~{p['rows']:,} rows")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Manage the monthly partitions of transaction_data")
+    parser.add_argument("--list", action="store_true", help="list partitions instead of maintaining them")
+    parser.add_argument("--premake", type=int, default=PARTITION_PREMAKE,
+                        help="months past the current one to create ahead of time")
+    parser.add_argument("--retention-months", type=int, default=PARTITION_RETENTION_MONTHS,
+                        help="detach partitions that ended more than this many months ago (0: keep all)")
+    parser.add_argument("--archive-schema", default=PARTITION_ARCHIVE_SCHEMA,
+                        help="schema detached partitions move to ('' drops them)")
+    args = parser.parse_args()
+
+    conn = get_db_connection()
+    try:
+        if not args.list:
+            result = maintain(conn, args.premake, args.retention_months, args.archive_schema)
+            if result["detached"]:
+                from data_analytics import refresh_views
+                print("Refreshing analytical views...")
+                refresh_views(conn)
+        cur = conn.cursor()
+        print_partitions(list_partitions(cur))
+        conn.rollback()
+        cur.close()
+    finally:
+        conn.close()
@@ -0,0 +1,180 @@
+"""Peer benchmarking: each merchant's KPIs ranked against similar merchants.
+
+mv_merchant_peers (see data_analytics.py) is computed for every merchant at
+once, in one grouped statement over the rollups, and refreshed after every
+import like the other materialized views. /api/merchant/<id>/peers is then a
+lookup of one row, whatever the number of merchants.
+
+KPIs, over the PEER_WINDOW_DAYS days up to the refresh (repeat rate over
+the whole history):
+
+    sales           order value sum                     (sales_rollup)
+    aov             average order value                 (sales_rollup)
+    prep_minutes    driver arrival to pickup, average   (sales_rollup)
+    repeat_rate     % of customers with >1 order        (merchant_eaters)
+
+Each KPI is ranked in two peer groups: the merchant's city (merchants.city_id)
+and its city and cuisine, the cuisine being the cuisine_tag most of its
+items carry. A percentile is the share of the other merchants in the group
+doing worse (percent_rank), oriented so that 100 is best: shorter
+preparation ranks higher. Merchants without a value for a KPI (no orders in
+the window) are not ranked on it and do not count against the others; a
+merchant alone in its group has no percentile.
+
+    python peers.py --check                 # view against per-merchant queries
+    python peers.py --merchant ID           # one merchant's row
+"""
+import argparse
+import os
+import sys
+
+from db_connection import get_db_connection
+
+PEER_WINDOW_DAYS = int(os.getenv('PEER_WINDOW_DAYS', '30'))
+
+# kpi -> True when higher is better
+KPIS = {
+    "sales": True,
+    "aov": True,
+    "prep_minutes": False,
+    "repeat_rate": True,
+}
+
+# group -> the merchants it partitions by
+GROUPS = {
+    "city": "k.city_id",
+    "peer": "k.city_id, k.cuisine_tag",
+}
+
+
+def _percentile_sql(kpi, group):
+    order = 'ASC' if KPIS[kpi] else 'DESC'
+    return (f"CASE WHEN COUNT(k.{kpi}) OVER (PARTITION BY {GROUPS[group]}) > 1 AND k.{kpi} IS NOT NULL "
+            f"THEN ROUND((100 * percent_rank() OVER ("
+            f"PARTITION BY {GROUPS[group]}, k.{kpi} IS NULL ORDER BY k.{kpi} {order}))::NUMERIC, 1) END "
+            f"AS {kpi}_{group}_percentile")
+
+
+def _group_size_sql(kpi, group):
+    return (f"COUNT(k.{kpi}) OVER (PARTITION BY {GROUPS[group]}) AS {kpi}_{group}_merchants")
+
+
+VIEW_QUERY = f'''
+WITH kpis AS (
+    SELECT
+        m.merchant_id,
+        m.city_id,
+        c.cuisine_tag,
+        COALESCE(s.order_count, 0) AS order_count,
+        CASE WHEN s.order_count > 0 THEN COALESCE(s.sales, 0) END AS sales,
+        s.sales / NULLIF(s.value_count, 0) AS aov,
+        s.preparation_minutes / NULLIF(s.completed_count, 0) AS prep_minutes,
+        e.repeat_customers * 100.0 / NULLIF(e.customers, 0) AS repeat_rate
+    FROM merchants m
+    LEFT JOIN (
+        SELECT
+            merchant_id,
+            SUM(order_count) AS order_count,
+            SUM(order_value_sum) AS sales,
+            SUM(order_value_count) AS value_count,
+            SUM(preparation_minutes_sum) AS preparation_minutes,
+            SUM(completed_count) AS completed_count
+        FROM sales_rollup
+        WHERE sale_date >= CURRENT_DATE - {PEER_WINDOW_DAYS}
+        GROUP BY merchant_id
+    ) s ON s.merchant_id = m.merchant_id
+    LEFT JOIN (
+        SELECT merchant_id, COUNT(*) AS customers, COUNT(*) FILTER (WHERE order_count > 1) AS repeat_customers
+        FROM merchant_eaters
+        GROUP BY merchant_id
+    ) e ON e.merchant_id = m.merchant_id
+    LEFT JOIN (
+        SELECT DISTINCT ON (merchant_id) merchant_id, cuisine_tag
+        FROM items
+        WHERE cuisine_tag IS NOT NULL
+        GROUP BY merchant_id, cuisine_tag
+        ORDER BY merchant_id, COUNT(*) DESC, cuisine_tag
+    ) c ON c.merchant_id = m.merchant_id
+)
+SELECT
+    k.*,
+    CURRENT_DATE - {PEER_WINDOW_DAYS} AS window_start,
+    {', '.join(_percentile_sql(kpi, group) for kpi in KPIS for group in GROUPS)},
+    {', '.join(_group_size_sql(kpi, group) for kpi in KPIS for group in GROUPS)}
+FROM kpis k
+'''
+
+# The same KPIs one merchant at a time from transaction_data, for --check
+_EXACT_KPIS = '''
+SELECT
+    SUM(order_value) AS sales,
+    AVG(order_value) AS aov,
+    AVG(EXTRACT(EPOCH FROM (driver_pickup_time - driver_arrival_time))/60) FILTER (
+        WHERE delivery_time IS NOT NULL AND driver_arrival_time IS NOT NULL AND driver_pickup_time IS NOT NULL
+    ) AS prep_minutes,
+    (SELECT COUNT(*) FILTER (WHERE n > 1) * 100.0 / NULLIF(COUNT(*), 0)
+     FROM (SELECT COUNT(*) AS n FROM transaction_data
+           WHERE merchant_id = %(merchant_id)s AND eater_id IS NOT NULL GROUP BY eater_id) x) AS repeat_rate
+FROM transaction_data
+WHERE merchant_id = %(merchant_id)s AND order_time >= %(start)s
+'''
+
+
+def _percentile(value, others, higher_is_better):
+    """percent_rank of `value` among the group's values (including itself), 0-100"""
+    if value is None:
+        return None
+    values = [v for v in others if v is not None]
+    if len(values) < 2:
+        return None
+    worse = sum(1 for v in values if (v < value if higher_is_better else v > value))
+    return round(100 * worse / (len(values) - 1), 1)
+
+
+def check(conn):
+    """Compare the view with per-merchant KPIs and ranks computed here; returns the number of failures"""
+    from serialization import fetch_rows
+
+    rows = fetch_rows(conn, "SELECT * FROM mv_merchant_peers")
+    failures = 0
+    for row in rows:
+        exact = fetch_rows(conn, _EXACT_KPIS, {"merchant_id": row['merchant_id'], "start": row['window_start']})[0]
+        for kpi, higher_is_better in KPIS.items():
+            got, expected = row[kpi], exact[kpi]
+            if (got is None) != (expected is None) or (got is not None and abs(got - expected) > 1e-6 * max(1, abs(expected))):
+                print(f"  {row['merchant_id']} {kpi}: {got}, expected {expected}")
+                failures += 1
+            for group, columns in (("city", ('city_id',)), ("peer", ('city_id', 'cuisine_tag'))):
+                others = [r[kpi] for r in rows if all(r[c] == row[c] for c in columns)]
+                expected_rank = _percentile(got, others, higher_is_better)
+                got_rank = row[f"{kpi}_{group}_percentile"]
+                if (got_rank is None) != (expected_rank is None) or (got_rank is not None and abs(got_rank - expected_rank) > 0.051):
+                    print(f"  {row['merchant_id']} {kpi} {group} percentile: {got_rank}, expected {expected_rank}")
+                    failures += 1
+    print(f"  {len(rows):,} merchants compared")
+    return failures
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Check or show the merchant peer benchmarks")
+    parser.add_argument("--check", action="store_true", help="compare mv_merchant_peers with transaction_data")
+    parser.add_argument("--merchant", help="print this merchant's row")
+    args = parser.parse_args()
+    if not (args.check or args.merchant):
+        parser.error("nothing to do: pass --check and/or --merchant")
+
+    conn = get_db_connection()
+    try:
+        failures = 0
+        if args.merchant:
+            from serialization import fetch_rows
+            for row in fetch_rows(conn, "SELECT * FROM mv_merchant_peers WHERE merchant_id = %s", (args.merchant,)):
+                for key, value in row.items():
+                    print(f"  {key:<28} {value}")
+        if args.check:
+            failures = check(conn)
+    finally:
+        conn.close()
+    if args.check:
+        print("OK" if not failures else f"{failures} checks failed")
+    sys.exit(1 if failures else 0)
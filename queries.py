@@ -0,0 +1,412 @@
+"""SQL used by the API routes.
+
+Kept in one place so the routes, the migration EXPLAIN report and any other
+serving path all run exactly the same statements.
+"""
+import sketches
+
+# HOME SCREEN
+MERCHANT_INFO = "SELECT * FROM merchants WHERE merchant_id = %s"
+
+# Whole-history and per-day figures come straight from sales_rollup (see
+# rollups.py); orders without an order_time are not counted
+SALES_SUMMARY = """
+SELECT
+    SUM(r.order_value_sum) as total_sales,
+    COALESCE(SUM(r.order_count), 0) as transaction_count,
+    COUNT(DISTINCT r.sale_date) as active_days,
+    SUM(r.order_value_sum) / NULLIF(SUM(r.order_value_count), 0) as avg_transaction_value
+FROM sales_rollup r
+WHERE r.merchant_id = %(merchant_id)s
+"""
+
+TODAY_SALES = """
+SELECT
+    SUM(r.order_value_sum) as today_sales,
+    COALESCE(SUM(r.order_count), 0) as today_orders
+FROM sales_rollup r
+WHERE r.merchant_id = %(merchant_id)s
+AND r.sale_date = CURRENT_DATE
+"""
+
+# SALES REPORT SCREEN
+def _sales_between(lo, hi):
+    """Per-day sales of one merchant over order_time in [lo, hi).
+
+    Hour buckets lying wholly inside the range are read from sales_rollup and
+    only the orders of the partial hours at either end are read raw, so the
+    totals match aggregating transaction_data directly.
+    """
+    bucket = "r.sale_date + make_interval(hours => r.sale_hour)"
+    hour = "date_trunc('hour', td.order_time)"
+    return f"""
+    SELECT r.sale_date, r.order_count, r.order_value_sum, r.order_value_count
+    FROM sales_rollup r
+    WHERE r.merchant_id = %(merchant_id)s
+    AND r.sale_date BETWEEN ({lo})::DATE AND ({hi})::DATE
+    AND {bucket} >= {lo}
+    AND {bucket} + INTERVAL '1 hour' <= {hi}
+    UNION ALL
+    SELECT DATE(td.order_time), 1, td.order_value, (td.order_value IS NOT NULL)::INTEGER
+    FROM transaction_data td
+    WHERE td.merchant_id = %(merchant_id)s
+    AND ((td.order_time >= {lo}
+          AND td.order_time < LEAST(date_trunc('hour', {lo}) + INTERVAL '1 hour', {hi}))
+      OR (td.order_time >= GREATEST(date_trunc('hour', {hi}), date_trunc('hour', {lo}) + INTERVAL '1 hour')
+          AND td.order_time < {hi}))
+    AND NOT ({hour} >= {lo} AND {hour} + INTERVAL '1 hour' <= {hi})
+    """
+
+
+# NOW() is converted the way the raw comparison `order_time >= NOW() - ...`
+# converts it; 'infinity' stands for "no upper bound"
+_DAYS_AGO = "(NOW() - %(days)s * INTERVAL '1 day')::TIMESTAMP"
+_UNTIL_DAYS_AGO = "(NOW() - %(until_days)s * INTERVAL '1 day')::TIMESTAMP"
+_NO_END = "'infinity'::TIMESTAMP"
+
+DAILY_SALES = f"""
+SELECT
+    s.sale_date,
+    SUM(s.order_value_sum) as daily_sales,
+    SUM(s.order_count) as transaction_count
+FROM ({_sales_between(_DAYS_AGO, _NO_END)}) s
+GROUP BY s.sale_date
+ORDER BY s.sale_date
+"""
+
+HOURLY_SALES = """
+SELECT
+    r.sale_hour as hour_of_day,
+    SUM(r.order_value_sum) as hourly_sales,
+    SUM(r.order_count) as order_count
+FROM sales_rollup r
+WHERE r.merchant_id = %(merchant_id)s
+GROUP BY r.sale_hour
+ORDER BY hour_of_day
+"""
+
+_PERIOD_METRICS = """
+SELECT
+    SUM(s.order_value_sum) as total_sales,
+    COALESCE(SUM(s.order_count), 0) as order_count,
+    SUM(s.order_value_sum) / NULLIF(SUM(s.order_value_count), 0) as avg_order_value
+FROM ({sales}) s
+"""
+
+PERIOD_METRICS_CURRENT = _PERIOD_METRICS.format(sales=_sales_between(_DAYS_AGO, _NO_END))
+
+PERIOD_METRICS_PREVIOUS = _PERIOD_METRICS.format(sales=_sales_between(_DAYS_AGO, _UNTIL_DAYS_AGO))
+
+# PRODUCTS SCREEN
+MERCHANT_ITEMS = """
+SELECT
+    i.item_id,
+    i.item_name,
+    i.item_price,
+    i.cuisine_tag
+FROM items i
+WHERE i.merchant_id = %s
+"""
+
+# Per item of the merchant over whole days, from item_sales_daily (see
+# rollups.py): sale_date from `start` (default: the last `days` days and
+# today) up to but excluding `end` (default: no end). Items without sales
+# in the window are listed with zeros. Sorted by `sort` (order_count, i.e.
+# units, or revenue), then item_id; `after_value`/`after_id` continue after
+# the last row of the previous page and `limit` NULL means all.
+_ITEM_PERFORMANCE = """
+SELECT * FROM (
+    SELECT
+        i.item_id,
+        i.item_name,
+        i.item_price,
+        COALESCE(s.quantity, 0) as order_count,
+        COALESCE(s.orders, 0) as orders,
+        COALESCE(COALESCE(s.quantity, 0) * i.item_price, 0) as revenue
+    FROM items i
+    LEFT JOIN (
+        SELECT r.item_id, SUM(r.quantity) as quantity, SUM(r.order_count) as orders
+        FROM items ri
+        JOIN item_sales_daily r ON r.item_id = ri.item_id
+        WHERE ri.merchant_id = %(merchant_id)s
+        AND r.sale_date >= COALESCE(%(start)s::DATE, CURRENT_DATE - %(days)s::INTEGER)
+        AND (%(end)s::DATE IS NULL OR r.sale_date < %(end)s::DATE)
+        GROUP BY r.item_id
+    ) s ON s.item_id = i.item_id
+    WHERE i.merchant_id = %(merchant_id)s
+) x
+WHERE %(after_value)s::NUMERIC IS NULL
+OR x.{sort} < %(after_value)s::NUMERIC
+OR (x.{sort} = %(after_value)s::NUMERIC AND x.item_id > %(after_id)s::INTEGER)
+ORDER BY x.{sort} DESC, x.item_id
+LIMIT %(limit)s
+"""
+
+ITEM_PERFORMANCE = {sort: _ITEM_PERFORMANCE.replace('{sort}', sort) for sort in ('order_count', 'revenue')}
+
+# INSIGHTS SCREEN
+DELIVERY_METRICS = """
+SELECT
+    SUM(r.delivery_minutes_sum) / NULLIF(SUM(r.completed_count), 0) as avg_delivery_time,
+    SUM(r.arrival_minutes_sum) / NULLIF(SUM(r.completed_count), 0) as avg_arrival_time,
+    SUM(r.preparation_minutes_sum) / NULLIF(SUM(r.completed_count), 0) as avg_preparation_time
+FROM sales_rollup r
+WHERE r.merchant_id = %(merchant_id)s
+"""
+
+# Windows of the insights screen: from `start` (default: `days` days before
+# today) up to but excluding `end`
+_INSIGHTS_WINDOW = """
+AND {date} >= COALESCE(%(start)s::DATE, CURRENT_DATE - %(days)s::INTEGER)
+AND (%(end)s::DATE IS NULL OR {date} < %(end)s::DATE)
+"""
+
+DELIVERY_METRICS_WINDOW = DELIVERY_METRICS + _INSIGHTS_WINDOW.format(date='r.sale_date')
+
+# Completed orders per duration bucket (see histograms.py), for the
+# percentiles; the whole history when `days` and `start` are both NULL
+DELIVERY_HISTOGRAM = """
+SELECT h.metric, h.bucket, SUM(h.order_count) as order_count
+FROM delivery_histograms h
+WHERE h.merchant_id = %(merchant_id)s
+AND h.sale_date >= COALESCE(%(start)s::DATE, CURRENT_DATE - %(days)s::INTEGER, '-infinity')
+AND (%(end)s::DATE IS NULL OR h.sale_date < %(end)s::DATE)
+GROUP BY h.metric, h.bucket
+ORDER BY h.metric, h.bucket
+"""
+
+# Whole-history customers and those with more than one order, from
+# merchant_eaters (see rollups.py)
+REPEAT_CUSTOMERS = """
+SELECT
+    COUNT(*) as total_customers,
+    COUNT(*) FILTER (WHERE order_count > 1) as repeat_customers
+FROM merchant_eaters
+WHERE merchant_id = %(merchant_id)s
+"""
+
+# Customers of a window: estimated from the merged eater sketches (see
+# sketches.py), and exactly those whose first order falls in the window
+CUSTOMER_WINDOW = f"""
+SELECT
+    (SELECT {sketches.estimate_sql('r.rank')}
+     FROM (
+        SELECT s.register, MAX(s.rank) as rank
+        FROM eater_sketches s
+        WHERE s.merchant_id = %(merchant_id)s
+        {_INSIGHTS_WINDOW.format(date='s.sale_date')}
+        GROUP BY s.register
+     ) r) as customers,
+    (SELECT COUNT(*)
+     FROM merchant_eaters e
+     WHERE e.merchant_id = %(merchant_id)s
+     {_INSIGHTS_WINDOW.format(date='e.first_order')}) as new_customers
+"""
+
+TOP_CUISINES = """
+SELECT
+    i.cuisine_tag,
+    COUNT(ti.order_id) as order_count
+FROM items i
+JOIN transaction_items ti ON i.item_id = ti.item_id
+WHERE i.merchant_id = %s
+GROUP BY i.cuisine_tag
+ORDER BY order_count DESC
+LIMIT 5
+"""
+
+# CHAT SCREEN
+# Keywords matching the merchant's items (see keyword_index.py), funnel
+# ratios precomputed as generated columns of keywords
+_KEYWORD_COLUMNS = """
+    k.keyword, k.view, k.menu, k.checkout, k.order_count,
+    k.conversion_rate, k.menu_rate, k.checkout_rate, k.order_rate,
+    km.item_ids
+"""
+
+MERCHANT_KEYWORDS = f"""
+SELECT {_KEYWORD_COLUMNS}
+FROM keyword_merchants km
+JOIN keywords k ON k.id = km.keyword_id
+WHERE km.merchant_id = %(merchant_id)s
+ORDER BY km.order_count DESC NULLS LAST, k.keyword
+LIMIT %(limit)s
+"""
+
+# Typeahead: keywords with every token of `tokens` and a token starting
+# with `prefix` (the word being typed)
+KEYWORD_SEARCH = f"""
+SELECT {_KEYWORD_COLUMNS}
+FROM keyword_merchants km
+JOIN keywords k ON k.id = km.keyword_id
+WHERE km.merchant_id = %(merchant_id)s
+AND km.tokens @> %(tokens)s::TEXT[]
+AND km.keyword_id IN (SELECT keyword_id FROM keyword_tokens WHERE token LIKE %(prefix)s)
+ORDER BY km.order_count DESC NULLS LAST, k.keyword
+LIMIT %(limit)s
+"""
+
+# ANALYTICS (materialized views, see data_analytics.py)
+ANALYTICS_DAILY = """
+SELECT sale_date, total_sales, transaction_count, unique_customers, items_sold
+FROM mv_daily_sales
+WHERE merchant_id = %(merchant_id)s
+AND sale_date >= CURRENT_DATE - %(days)s::INTEGER
+ORDER BY sale_date
+"""
+
+ANALYTICS_PRODUCTS = """
+SELECT item_id, item_name, cuisine_tag, item_price, total_quantity, total_revenue, order_count, last_ordered_at
+FROM mv_product_performance
+WHERE merchant_id = %(merchant_id)s
+ORDER BY total_revenue DESC
+LIMIT %(limit)s
+"""
+
+# KPIs and peer percentile ranks (see peers.py); one row per merchant
+MERCHANT_PEERS = """
+SELECT *
+FROM mv_merchant_peers
+WHERE merchant_id = %(merchant_id)s
+"""
+
+# Stored forecasts from today on (see forecasting.py)
+SALES_FORECAST = """
+SELECT forecast_date, sales, sales_low, sales_high, orders, hourly_sales
+FROM sales_forecasts
+WHERE merchant_id = %(merchant_id)s
+AND forecast_date >= CURRENT_DATE
+ORDER BY forecast_date
+LIMIT %(days)s
+"""
+
+# A run's row commits together with its forecasts, so the latest run is
+# the one sales_forecasts holds
+FORECAST_RUN = """
+SELECT r.started_at, r.data_version, r.data_version < v.version as stale
+FROM forecast_runs r
+CROSS JOIN data_version v
+ORDER BY r.id DESC
+LIMIT 1
+"""
+
+# An item of the merchant with its stored pairs (see basket.py); one row with
+# NULL pair columns when it has none
+ITEM_PAIRS = """
+SELECT
+    i.item_id,
+    i.item_name,
+    p.rank,
+    p.paired_item_id,
+    pi.item_name AS paired_item_name,
+    pi.item_price AS paired_item_price,
+    p.pair_orders,
+    p.item_orders,
+    p.merchant_orders,
+    p.support,
+    p.confidence,
+    p.lift
+FROM items i
+LEFT JOIN item_pairs p ON p.item_id = i.item_id AND p.rank <= %(limit)s
+LEFT JOIN items pi ON pi.item_id = p.paired_item_id
+WHERE i.item_id = %(item_id)s AND i.merchant_id = %(merchant_id)s
+ORDER BY p.rank
+"""
+
+ANALYTICS_REFRESHED_AT = """
+SELECT MAX(started_at) as refreshed_at
+FROM analytics_refresh_log
+WHERE view_name = %(view)s AND status = 'ok'
+"""
+
+# EXPORT
+# A merchant's orders oldest first, a page at a time: each page starts right
+# after the (order_time, order_id) of the previous one's last row, so deep
+# pages cost as little as the first (no OFFSET). `end` is exclusive.
+TRANSACTION_COLUMNS = ('order_id', 'order_time', 'driver_arrival_time', 'driver_pickup_time',
+                       'delivery_time', 'order_value', 'eater_id')
+
+TRANSACTIONS = f"""
+SELECT {', '.join(f'td.{column}' for column in TRANSACTION_COLUMNS)}
+FROM transaction_data td
+WHERE td.merchant_id = %(merchant_id)s
+AND td.order_time >= COALESCE(%(start)s::DATE, '-infinity')
+AND (%(end)s::DATE IS NULL OR td.order_time < %(end)s::DATE)
+AND (%(after_time)s::TIMESTAMP IS NULL
+     OR (td.order_time, td.order_id) > (%(after_time)s::TIMESTAMP, %(after_id)s::VARCHAR))
+-- Implied by the above, but lets the months before the cursor be pruned
+AND td.order_time >= COALESCE(%(after_time)s::TIMESTAMP, '-infinity')
+ORDER BY td.order_time, td.order_id
+LIMIT %(limit)s
+"""
+
+# UTILITY
+LIST_MERCHANTS = "SELECT merchant_id, merchant_name FROM merchants LIMIT 100"
+
+
+# Statements behind each endpoint, with a function building sample parameters
+# for a merchant. Used by `python migrations.py --explain`.
+ENDPOINT_QUERIES = {
+    "summary": [
+        ("merchant_info", MERCHANT_INFO, lambda m: (m,)),
+        ("sales_summary", SALES_SUMMARY, lambda m: {"merchant_id": m}),
+        ("today_sales", TODAY_SALES, lambda m: {"merchant_id": m}),
+    ],
+    "sales/daily": [
+        ("daily_sales", DAILY_SALES, lambda m: {"merchant_id": m, "days": 30}),
+    ],
+    "sales/hourly": [
+        ("hourly_sales", HOURLY_SALES, lambda m: {"merchant_id": m}),
+    ],
+    "sales/metrics": [
+        ("period_current", PERIOD_METRICS_CURRENT, lambda m: {"merchant_id": m, "days": 7}),
+        ("period_previous", PERIOD_METRICS_PREVIOUS, lambda m: {"merchant_id": m, "days": 14, "until_days": 7}),
+    ],
+    "items": [
+        ("merchant_items", MERCHANT_ITEMS, lambda m: (m,)),
+    ],
+    "items/performance": [
+        ("item_performance", ITEM_PERFORMANCE['order_count'],
+         lambda m: {"merchant_id": m, "days": 30, "start": None, "end": None,
+                    "after_value": None, "after_id": None, "limit": 20}),
+    ],
+    "items/pairs": [
+        ("item_pairs", ITEM_PAIRS, lambda m: {"merchant_id": m, "item_id": 0, "limit": 10}),
+    ],
+    "insights": [
+        ("delivery_metrics", DELIVERY_METRICS, lambda m: {"merchant_id": m}),
+        ("delivery_window", DELIVERY_METRICS_WINDOW,
+         lambda m: {"merchant_id": m, "days": 30, "start": None, "end": None}),
+        ("delivery_histogram", DELIVERY_HISTOGRAM, lambda m: {"merchant_id": m, "days": None, "start": None, "end": None}),
+        ("repeat_customers", REPEAT_CUSTOMERS, lambda m: {"merchant_id": m}),
+        ("customer_window", CUSTOMER_WINDOW, lambda m: {"merchant_id": m, "days": 30, "start": None, "end": None}),
+        ("top_cuisines", TOP_CUISINES, lambda m: (m,)),
+    ],
+    "keywords": [
+        ("merchant_keywords", MERCHANT_KEYWORDS, lambda m: {"merchant_id": m, "limit": 20}),
+    ],
+    "keywords/search": [
+        ("keyword_search", KEYWORD_SEARCH,
+         lambda m: {"merchant_id": m, "tokens": ["spring"], "prefix": "r%", "limit": 10}),
+    ],
+    "peers": [
+        ("mv_merchant_peers", MERCHANT_PEERS, lambda m: {"merchant_id": m}),
+    ],
+    "forecast": [
+        ("sales_forecast", SALES_FORECAST, lambda m: {"merchant_id": m, "days": 7}),
+        ("forecast_run", FORECAST_RUN, lambda m: {}),
+    ],
+    "transactions": [
+        ("transactions", TRANSACTIONS,
+         lambda m: {"merchant_id": m, "start": None, "end": None, "after_time": None, "after_id": None, "limit": 101}),
+        ("transactions_after", TRANSACTIONS,
+         lambda m: {"merchant_id": m, "start": None, "end": None,
+                    "after_time": "2024-01-01T00:00:00", "after_id": "", "limit": 101}),
+    ],
+    "analytics/daily": [
+        ("mv_daily_sales", ANALYTICS_DAILY, lambda m: {"merchant_id": m, "days": 30}),
+    ],
+    "analytics/products": [
+        ("mv_product_performance", ANALYTICS_PRODUCTS, lambda m: {"merchant_id": m, "limit": 20}),
+    ],
+}
@@ -0,0 +1,338 @@
+"""Pre-aggregated rollups of transaction_data.
+
+sales_rollup holds one row per (merchant_id, sale_date, sale_hour) with the
+order count, order value sum/count and the delivery-time sums of completed
+orders, so the sales endpoints read a few hundred rows instead of a
+merchant's whole order history. item_sales_daily holds the units sold and
+orders per (item_id, sale_date) for the item performance endpoint.
+eater_sketches and merchant_eaters back the customer metrics (see
+sketches.py) and delivery_histograms the delivery time percentiles (see
+histograms.py).
+
+The importer keeps rollups current bucket by bucket: before a chunk is
+merged it records the hour buckets the chunk will change (the new buckets
+of inserted or modified orders and the old buckets of modified ones), and
+after the merge those buckets are recomputed from transaction_data in the
+same transaction. Recomputing instead of adding deltas keeps re-sent and
+corrected orders exact. Bulk loads skip this and rebuild the rollup once at
+the end (see import_pipeline).
+"""
+from db_connection import get_db_connection
+import histograms
+import sketches
+
+# Orders without an order_time or merchant_id belong to no bucket
+_SALES_ROLLUP_SELECT = '''
+SELECT
+    td.merchant_id,
+    DATE(td.order_time) AS sale_date,
+    EXTRACT(HOUR FROM td.order_time)::SMALLINT AS sale_hour,
+    COUNT(*) AS order_count,
+    SUM(td.order_value) AS order_value_sum,
+    COUNT(td.order_value) AS order_value_count,
+    COUNT(*) FILTER (WHERE {completed}) AS completed_count,
+    SUM(EXTRACT(EPOCH FROM (td.delivery_time - td.order_time))/60) FILTER (WHERE {completed}) AS delivery_minutes_sum,
+    SUM(EXTRACT(EPOCH FROM (td.driver_arrival_time - td.order_time))/60) FILTER (WHERE {completed}) AS arrival_minutes_sum,
+    SUM(EXTRACT(EPOCH FROM (td.driver_pickup_time - td.driver_arrival_time))/60) FILTER (WHERE {completed}) AS preparation_minutes_sum
+FROM transaction_data td
+{join}
+WHERE td.order_time IS NOT NULL AND td.merchant_id IS NOT NULL
+GROUP BY 1, 2, 3
+'''.replace('{completed}', '''td.delivery_time IS NOT NULL
+        AND td.driver_arrival_time IS NOT NULL
+        AND td.driver_pickup_time IS NOT NULL''')
+
+# Each transaction_items row is one unit of the item
+_ITEM_SALES_SELECT = '''
+SELECT
+    ti.item_id,
+    DATE(td.order_time) AS sale_date,
+    COUNT(*) AS quantity,
+    COUNT(DISTINCT td.order_id) AS order_count
+FROM transaction_items ti
+JOIN transaction_data td ON td.order_id = ti.order_id
+{join}
+WHERE ti.item_id IS NOT NULL
+GROUP BY 1, 2
+'''
+
+# The set registers of each merchant-day's eater sketch (see sketches.py)
+_EATER_SKETCH_SELECT = f'''
+SELECT
+    td.merchant_id,
+    DATE(td.order_time) AS sale_date,
+    {sketches.register_sql('td.eater_id')} AS register,
+    MAX({sketches.rank_sql('td.eater_id')}) AS rank
+FROM transaction_data td
+{{join}}
+WHERE td.eater_id IS NOT NULL AND td.merchant_id IS NOT NULL
+GROUP BY 1, 2, 3
+'''
+
+_MERCHANT_EATERS_SELECT = '''
+SELECT
+    td.merchant_id,
+    td.eater_id,
+    COUNT(*) AS order_count,
+    MIN(td.order_time)::DATE AS first_order
+FROM transaction_data td
+{join}
+WHERE td.eater_id IS NOT NULL AND td.merchant_id IS NOT NULL
+GROUP BY 1, 2
+'''
+
+# Completed orders per merchant-day, duration and bucket, all three
+# durations in one pass (see histograms.py)
+_DELIVERY_HISTOGRAM_SELECT = f'''
+SELECT
+    td.merchant_id,
+    DATE(td.order_time) AS sale_date,
+    d.metric,
+    {histograms.bucket_sql('d.minutes')} AS bucket,
+    COUNT(*) AS order_count
+FROM transaction_data td
+{{join}}
+CROSS JOIN LATERAL (VALUES {', '.join(f"('{name}', {sql})" for name, sql in histograms.METRICS.items())})
+    AS d (metric, minutes)
+WHERE td.merchant_id IS NOT NULL
+AND {{completed}}
+GROUP BY 1, 2, 3, 4
+'''.replace('{completed}', '''td.delivery_time IS NOT NULL
+    AND td.driver_arrival_time IS NOT NULL
+    AND td.driver_pickup_time IS NOT NULL''')
+
+# Per rollup: the session-local table collecting touched buckets and its
+# columns, SQL recording the buckets a staged chunk of each source table will
+# change ({stage}), and SQL recomputing the touched buckets / everything
+ROLLUPS = {
+    'sales_rollup': {
+        'touched': 'touched_sales_buckets',
+        'touched_columns': 'merchant_id VARCHAR(10), bucket TIMESTAMP',
+        'record': {'transaction_data': '''
+            INSERT INTO touched_sales_buckets (merchant_id, bucket)
+            SELECT v.merchant_id, date_trunc('hour', v.order_time)
+            FROM {stage} s
+            LEFT JOIN transaction_data td ON td.order_id = s.order_id
+            CROSS JOIN LATERAL (VALUES (s.merchant_id, s.order_time), (td.merchant_id, td.order_time))
+                AS v (merchant_id, order_time)
+            WHERE v.order_time IS NOT NULL AND v.merchant_id IS NOT NULL
+            AND (td.order_id IS NULL
+                 OR (td.order_time, td.driver_arrival_time, td.driver_pickup_time, td.delivery_time,
+                     td.order_value, td.merchant_id)
+                    IS DISTINCT FROM (s.order_time, s.driver_arrival_time, s.driver_pickup_time,
+                                      s.delivery_time, s.order_value, s.merchant_id))
+        '''},
+        'refresh': [
+            '''
+            DELETE FROM sales_rollup r
+            USING (SELECT DISTINCT merchant_id, bucket FROM touched_sales_buckets) t
+            WHERE r.merchant_id = t.merchant_id
+            AND r.sale_date = t.bucket::DATE
+            AND r.sale_hour = EXTRACT(HOUR FROM t.bucket)
+            ''',
+            'INSERT INTO sales_rollup ' + _SALES_ROLLUP_SELECT.replace('{join}', '''
+            JOIN (SELECT DISTINCT merchant_id, bucket FROM touched_sales_buckets) t
+              ON td.merchant_id = t.merchant_id
+             AND td.order_time >= t.bucket
+             AND td.order_time < t.bucket + INTERVAL '1 hour'
+            '''),
+            "TRUNCATE touched_sales_buckets",
+        ],
+        'rebuild': [
+            "TRUNCATE sales_rollup",
+            'INSERT INTO sales_rollup ' + _SALES_ROLLUP_SELECT.replace('{join}', ''),
+        ],
+    },
+    'item_sales_daily': {
+        'touched': 'touched_item_days',
+        'touched_columns': 'item_id INTEGER, sale_date DATE',
+        'record': {
+            # Items about to be added: their order's day
+            'transaction_items': '''
+                INSERT INTO touched_item_days (item_id, sale_date)
+                SELECT DISTINCT s.item_id, DATE(td.order_time)
+                FROM {stage} s
+                JOIN transaction_data td ON td.order_id = s.order_id
+                WHERE s.item_id IS NOT NULL
+            ''',
+            # Orders moving to another day (or leaving, see partitions.py):
+            # the items already loaded for them change both days
+            'transaction_data': '''
+                INSERT INTO touched_item_days (item_id, sale_date)
+                SELECT DISTINCT ti.item_id, DATE(v.order_time)
+                FROM {stage} s
+                JOIN transaction_items ti ON ti.order_id = s.order_id
+                LEFT JOIN transaction_data td ON td.order_id = s.order_id
+                CROSS JOIN LATERAL (VALUES (s.order_time), (td.order_time)) AS v (order_time)
+                WHERE v.order_time IS NOT NULL AND ti.item_id IS NOT NULL
+                AND (td.order_id IS NULL OR DATE(td.order_time) IS DISTINCT FROM DATE(s.order_time))
+            ''',
+        },
+        'refresh': [
+            '''
+            DELETE FROM item_sales_daily r
+            USING (SELECT DISTINCT item_id, sale_date FROM touched_item_days) t
+            WHERE r.item_id = t.item_id AND r.sale_date = t.sale_date
+            ''',
+            'INSERT INTO item_sales_daily ' + _ITEM_SALES_SELECT.replace('{join}', '''
+            JOIN (SELECT DISTINCT item_id, sale_date FROM touched_item_days) t
+              ON ti.item_id = t.item_id
+             AND td.order_time >= t.sale_date
+             AND td.order_time < t.sale_date + 1
+            '''),
+            "TRUNCATE touched_item_days",
+        ],
+        'rebuild': [
+            "TRUNCATE item_sales_daily",
+            'INSERT INTO item_sales_daily ' + _ITEM_SALES_SELECT.replace('{join}', ''),
+        ],
+    },
+    'eater_sketches': {
+        'touched': 'touched_eater_days',
+        'touched_columns': 'merchant_id VARCHAR(10), sale_date DATE',
+        'record': {'transaction_data': '''
+            INSERT INTO touched_eater_days (merchant_id, sale_date)
+            SELECT DISTINCT v.merchant_id, DATE(v.order_time)
+            FROM {stage} s
+            LEFT JOIN transaction_data td ON td.order_id = s.order_id
+            CROSS JOIN LATERAL (VALUES (s.merchant_id, s.order_time), (td.merchant_id, td.order_time))
+                AS v (merchant_id, order_time)
+            WHERE v.order_time IS NOT NULL AND v.merchant_id IS NOT NULL
+            AND (td.order_id IS NULL
+                 OR (DATE(td.order_time), td.eater_id, td.merchant_id)
+                    IS DISTINCT FROM (DATE(s.order_time), s.eater_id, s.merchant_id))
+        '''},
+        'refresh': [
+            '''
+            DELETE FROM eater_sketches r
+            USING (SELECT DISTINCT merchant_id, sale_date FROM touched_eater_days) t
+            WHERE r.merchant_id = t.merchant_id AND r.sale_date = t.sale_date
+            ''',
+            'INSERT INTO eater_sketches ' + _EATER_SKETCH_SELECT.replace('{join}', '''
+            JOIN (SELECT DISTINCT merchant_id, sale_date FROM touched_eater_days) t
+              ON td.merchant_id = t.merchant_id
+             AND td.order_time >= t.sale_date
+             AND td.order_time < t.sale_date + 1
+            '''),
+            "TRUNCATE touched_eater_days",
+        ],
+        'rebuild': [
+            "TRUNCATE eater_sketches",
+            'INSERT INTO eater_sketches ' + _EATER_SKETCH_SELECT.replace('{join}', ''),
+        ],
+    },
+    'merchant_eaters': {
+        'touched': 'touched_merchant_eaters',
+        'touched_columns': 'merchant_id VARCHAR(10), eater_id BIGINT',
+        'record': {'transaction_data': '''
+            INSERT INTO touched_merchant_eaters (merchant_id, eater_id)
+            SELECT DISTINCT v.merchant_id, v.eater_id
+            FROM {stage} s
+            LEFT JOIN transaction_data td ON td.order_id = s.order_id
+            CROSS JOIN LATERAL (VALUES (s.merchant_id, s.eater_id), (td.merchant_id, td.eater_id))
+                AS v (merchant_id, eater_id)
+            WHERE v.eater_id IS NOT NULL AND v.merchant_id IS NOT NULL
+            AND (td.order_id IS NULL
+                 OR (DATE(td.order_time), td.eater_id, td.merchant_id)
+                    IS DISTINCT FROM (DATE(s.order_time), s.eater_id, s.merchant_id))
+        '''},
+        'refresh': [
+            '''
+            DELETE FROM merchant_eaters r
+            USING (SELECT DISTINCT merchant_id, eater_id FROM touched_merchant_eaters) t
+            WHERE r.merchant_id = t.merchant_id AND r.eater_id = t.eater_id
+            ''',
+            'INSERT INTO merchant_eaters ' + _MERCHANT_EATERS_SELECT.replace('{join}', '''
+            JOIN (SELECT DISTINCT merchant_id, eater_id FROM touched_merchant_eaters) t
+              ON td.merchant_id = t.merchant_id AND td.eater_id = t.eater_id
+            '''),
+            "TRUNCATE touched_merchant_eaters",
+        ],
+        'rebuild': [
+            "TRUNCATE merchant_eaters",
+            'INSERT INTO merchant_eaters ' + _MERCHANT_EATERS_SELECT.replace('{join}', ''),
+        ],
+    },
+    'delivery_histograms': {
+        'touched': 'touched_delivery_days',
+        'touched_columns': 'merchant_id VARCHAR(10), sale_date DATE',
+        'record': {'transaction_data': '''
+            INSERT INTO touched_delivery_days (merchant_id, sale_date)
+            SELECT DISTINCT v.merchant_id, DATE(v.order_time)
+            FROM {stage} s
+            LEFT JOIN transaction_data td ON td.order_id = s.order_id
+            CROSS JOIN LATERAL (VALUES (s.merchant_id, s.order_time), (td.merchant_id, td.order_time))
+                AS v (merchant_id, order_time)
+            WHERE v.order_time IS NOT NULL AND v.merchant_id IS NOT NULL
+            AND (td.order_id IS NULL
+                 OR (td.order_time, td.driver_arrival_time, td.driver_pickup_time, td.delivery_time, td.merchant_id)
+                    IS DISTINCT FROM (s.order_time, s.driver_arrival_time, s.driver_pickup_time,
+                                      s.delivery_time, s.merchant_id))
+        '''},
+        'refresh': [
+            '''
+            DELETE FROM delivery_histograms r
+            USING (SELECT DISTINCT merchant_id, sale_date FROM touched_delivery_days) t
+            WHERE r.merchant_id = t.merchant_id AND r.sale_date = t.sale_date
+            ''',
+            'INSERT INTO delivery_histograms ' + _DELIVERY_HISTOGRAM_SELECT.replace('{join}', '''
+            JOIN (SELECT DISTINCT merchant_id, sale_date FROM touched_delivery_days) t
+              ON td.merchant_id = t.merchant_id
+             AND td.order_time >= t.sale_date
+             AND td.order_time < t.sale_date + 1
+            '''),
+            "TRUNCATE touched_delivery_days",
+        ],
+        'rebuild': [
+            "TRUNCATE delivery_histograms",
+            'INSERT INTO delivery_histograms ' + _DELIVERY_HISTOGRAM_SELECT.replace('{join}', ''),
+        ],
+    },
+}
+
+
+def rollups_for(table):
+    """Names of the rollups aggregating `table`"""
+    return [name for name, spec in ROLLUPS.items() if table in spec['record']]
+
+
+def prepare_touched(cur, name):
+    spec = ROLLUPS[name]
+    cur.execute(f"CREATE TEMP TABLE IF NOT EXISTS {spec['touched']} ({spec['touched_columns']})")
+
+
+def record_touched(cur, name, stage, table):
+    """Remember the buckets the staged rows of `table` are about to change"""
+    cur.execute(ROLLUPS[name]['record'][table].format(stage=stage))
+
+
+def refresh_touched(cur, name):
+    """Recompute the recorded buckets from the source table"""
+    for step in ROLLUPS[name]['refresh']:
+        cur.execute(step)
+
+
+def rebuild(cur, name):
+    """Recompute a whole rollup from the source table"""
+    for step in ROLLUPS[name]['rebuild']:
+        cur.execute(step)
+    cur.execute("DELETE FROM import_deferred_objects WHERE object_name = %s AND kind = 'rollup'", (name,))
+
+
+def is_deferred(cur, name):
+    """True while a bulk load has left the rollup waiting for a full rebuild"""
+    cur.execute("SELECT 1 FROM import_deferred_objects WHERE object_name = %s AND kind = 'rollup'", (name,))
+    return cur.fetchone() is not None
+
+
+if __name__ == "__main__":
+    conn = get_db_connection()
+    try:
+        cur = conn.cursor()
+        for name in ROLLUPS:
+            print(f"Rebuilding {name}...")
+            rebuild(cur, name)
+            conn.commit()
+        cur.close()
+    finally:
+        conn.close()
@@ -0,0 +1,794 @@
+"""Endpoint sections: what each screen section queries and how it is shaped.
+
+A section is split in two so the statements can be run however the caller
+likes (one after another on one connection for the single routes, all at
+once on pooled connections for /dashboard):
+
+    params(args)              request arguments the section understands
+    plan(merchant_id, p)      {name: (sql, params)} statements to run
+    shape(merchant_id, p, r)  JSON payload from the results {name: rows}
+
+`shape` raises SectionError for the 404 answers of the original routes.
+Results are lists of row dicts from serialization.fetch_rows, whose values
+are already JSON-ready (NUMERIC as float, dates and timestamps as ISO
+strings). With ANALYTICS_ENGINE=columnar the sales statements are answered
+from memory instead (see columnar.py), with the same rows.
+"""
+import base64
+import binascii
+import datetime
+import json
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from db_connection import pooled_connection, PoolTimeout, POOL_MAX_SIZE
+from serialization import fetch_rows
+import histograms
+import instrumentation
+import keyword_index
+import peers
+import queries
+
+if os.getenv('ANALYTICS_ENGINE', 'sql') == 'columnar':
+    import columnar  # loads numpy; only when enabled
+else:
+    columnar = None
+
+# Threads running dashboard statements; each holds a pooled connection while
+# its statement runs, so there is no point in having more than the pool
+DASHBOARD_WORKERS = POOL_MAX_SIZE
+
+
+class SectionError(Exception):
+    """A section answer other than 200 (e.g. merchant not found)"""
+
+    def __init__(self, status, payload):
+        super().__init__(payload.get("error") or payload.get("message"))
+        self.status = status
+        self.payload = payload
+
+
+def _float(value, default=0):
+    return float(value) if value is not None else default
+
+
+def _int(value, default=0):
+    return int(value) if value is not None else default
+
+
+def _arg(args, name, default):
+    return args.get(name, default=default, type=int)
+
+
+# HOME SCREEN
+
+def plan_summary(merchant_id, p):
+    return {
+        "merchant_info": (queries.MERCHANT_INFO, (merchant_id,)),
+        "sales_summary": (queries.SALES_SUMMARY, {"merchant_id": merchant_id}),
+        "today_sales": (queries.TODAY_SALES, {"merchant_id": merchant_id}),
+    }
+
+
+def shape_summary(merchant_id, p, r):
+    merchant_info, sales_summary, today_sales = r["merchant_info"], r["sales_summary"], r["today_sales"]
+    if not merchant_info:
+        raise SectionError(404, {"error": "Merchant not found"})
+    merchant, sales, today = merchant_info[0], sales_summary[0], today_sales[0]
+    return {
+        "merchant_id": merchant_id,
+        "name": merchant['merchant_name'],
+        "join_date": merchant['join_date'],
+        "city_id": _int(merchant['city_id'], None),
+        "total_sales": _float(sales['total_sales']),
+        "transaction_count": _int(sales['transaction_count']),
+        "active_days": _int(sales['active_days']),
+        "avg_transaction_value": _float(sales['avg_transaction_value']),
+        "today_sales": _float(today['today_sales']),
+        "today_orders": _int(today['today_orders'])
+    }
+
+
+# SALES REPORT SCREEN
+
+def plan_daily_sales(merchant_id, p):
+    return {"daily_sales": (queries.DAILY_SALES, {"merchant_id": merchant_id, "days": p["days"]})}
+
+
+def shape_daily_sales(merchant_id, p, r):
+    return [
+        {
+            "date": row['sale_date'],
+            "sales": float(row['daily_sales']),
+            "transactions": int(row['transaction_count'])
+        }
+        for row in r["daily_sales"]
+    ]
+
+
+def plan_hourly_sales(merchant_id, p):
+    return {"hourly_sales": (queries.HOURLY_SALES, {"merchant_id": merchant_id})}
+
+
+def shape_hourly_sales(merchant_id, p, r):
+    return [
+        {
+            "hour": int(row['hour_of_day']),
+            "sales": float(row['hourly_sales']),
+            "orders": int(row['order_count'])
+        }
+        for row in r["hourly_sales"]
+    ]
+
+
+def plan_sales_metrics(merchant_id, p):
+    period = p["period"]
+    return {
+        # Current period vs. previous period of the same length
+        "current": (queries.PERIOD_METRICS_CURRENT, {"merchant_id": merchant_id, "days": period}),
+        "previous": (queries.PERIOD_METRICS_PREVIOUS,
+                     {"merchant_id": merchant_id, "days": period*2, "until_days": period}),
+    }
+
+
+def shape_sales_metrics(merchant_id, p, r):
+    current, previous = r["current"][0], r["previous"][0]
+    current_sales, previous_sales = _float(current['total_sales']), _float(previous['total_sales'])
+    current_orders, previous_orders = _int(current['order_count']), _int(previous['order_count'])
+    current_aov, previous_aov = _float(current['avg_order_value']), _float(previous['avg_order_value'])
+
+    # Calculate percentage changes
+    sales_change = ((current_sales - previous_sales) / previous_sales * 100) if previous_sales > 0 else 0
+    order_change = ((current_orders - previous_orders) / previous_orders * 100) if previous_orders > 0 else 0
+    aov_change = ((current_aov - previous_aov) / previous_aov * 100) if previous_aov > 0 else 0
+
+    return {
+        "total_sales": current_sales,
+        "sales_change": sales_change,
+        "total_orders": current_orders,
+        "orders_change": order_change,
+        "avg_order_value": current_aov,
+        "aov_change": aov_change,
+        "period_days": p["period"]
+    }
+
+
+# PRODUCTS SCREEN
+
+def plan_items(merchant_id, p):
+    return {"items": (queries.MERCHANT_ITEMS, (merchant_id,))}
+
+
+def shape_items(merchant_id, p, r):
+    items = r["items"]
+    if not items:
+        raise SectionError(404, {"message": "No items found for this merchant"})
+    return {"items": [
+        {
+            "item_id": row['item_id'],
+            "name": row['item_name'],
+            "price": row['item_price'],
+            "cuisine_tag": row['cuisine_tag']
+        }
+        for row in items
+    ]}
+
+
+ITEM_SORTS = ('order_count', 'revenue')
+
+
+def encode_cursor(*values):
+    return base64.urlsafe_b64encode(json.dumps(values).encode()).decode().rstrip('=')
+
+
+def decode_cursor(cursor):
+    """Values of an encode_cursor() string; ValueError when it is not one"""
+    try:
+        return json.loads(base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)))
+    except (TypeError, binascii.Error, UnicodeDecodeError, json.JSONDecodeError) as e:
+        raise ValueError(f"Invalid cursor: {cursor}") from e
+
+
+def _date_arg(args, name):
+    value = args.get(name)
+    try:
+        return datetime.date.fromisoformat(value).isoformat() if value else None
+    except ValueError:
+        raise ValueError(f"{name} must be a YYYY-MM-DD date") from None
+
+
+def item_performance_params(args):
+    """?days=N or ?from=YYYY-MM-DD[&to=YYYY-MM-DD], ?sort=order_count|revenue, ?limit=K, ?cursor=..."""
+    p = {"days": _arg(args, 'days', 30), "sort": args.get('sort', 'order_count'),
+         "limit": _arg(args, 'limit', None), "cursor": args.get('cursor')}
+    try:
+        p["start"], p["end"] = _date_arg(args, 'from'), _date_arg(args, 'to')
+        if p["sort"] not in ITEM_SORTS:
+            raise ValueError(f"sort must be one of: {', '.join(ITEM_SORTS)}")
+        if p["limit"] is not None and p["limit"] < 1:
+            raise ValueError("limit must be positive")
+        p["after"] = decode_cursor(p["cursor"]) if p["cursor"] else [None, None]
+        if not isinstance(p["after"], list) or len(p["after"]) != 2:
+            raise ValueError(f"Invalid cursor: {p['cursor']}")
+    except ValueError as e:
+        p["error"] = str(e)
+    return p
+
+
+def plan_item_performance(merchant_id, p):
+    if "error" in p:
+        return {}
+    after_value, after_id = p["after"]
+    return {"items": (queries.ITEM_PERFORMANCE[p["sort"]], {
+        "merchant_id": merchant_id, "days": p["days"], "start": p["start"], "end": p["end"],
+        "after_value": after_value, "after_id": after_id,
+        # One row past the page tells whether there is a next one
+        "limit": p["limit"] + 1 if p["limit"] is not None else None,
+    })}
+
+
+def shape_item_performance(merchant_id, p, r):
+    if "error" in p:
+        raise SectionError(400, {"error": p["error"]})
+    rows = r["items"]
+    next_cursor = None
+    if p["limit"] is not None and len(rows) > p["limit"]:
+        rows = rows[:p["limit"]]
+        next_cursor = encode_cursor(rows[-1][p["sort"]], rows[-1]['item_id']) if rows else None
+    return {
+        "items": [
+            {
+                "item_id": row['item_id'],
+                "name": row['item_name'],
+                "price": row['item_price'],
+                "order_count": row['order_count'],
+                "orders": row['orders'],
+                "revenue": row['revenue'] if row['item_price'] is not None else None
+            }
+            for row in rows
+        ],
+        "next_cursor": next_cursor,
+    }
+
+
+def item_pairs_params(args):
+    """item_id (from the path) and ?limit=N of its stored pairs (default 10)"""
+    p = {"item_id": args.get('item_id', type=int), "limit": _arg(args, 'limit', 10)}
+    if p["item_id"] is None:
+        p["error"] = "item_id is required"
+    elif p["limit"] < 1:
+        p["error"] = "limit must be positive"
+    return p
+
+
+def plan_item_pairs(merchant_id, p):
+    if "error" in p:
+        return {}
+    return {"pairs": (queries.ITEM_PAIRS, {"merchant_id": merchant_id, "item_id": p["item_id"], "limit": p["limit"]})}
+
+
+def shape_item_pairs(merchant_id, p, r):
+    if "error" in p:
+        raise SectionError(400, {"error": p["error"]})
+    if not r["pairs"]:
+        raise SectionError(404, {"error": "Item not found"})
+    first = r["pairs"][0]
+    return {
+        "merchant_id": merchant_id,
+        "item_id": first['item_id'],
+        "name": first['item_name'],
+        "item_orders": first['item_orders'],
+        "merchant_orders": first['merchant_orders'],
+        "pairs": [
+            {
+                "item_id": row['paired_item_id'],
+                "name": row['paired_item_name'],
+                "price": row['paired_item_price'],
+                "orders": row['pair_orders'],
+                "support": round(row['support'], 4),
+                "confidence": round(row['confidence'], 4),
+                "lift": round(row['lift'], 2),
+            }
+            for row in r["pairs"] if row['rank'] is not None
+        ],
+    }
+
+
+# INSIGHTS SCREEN
+
+def insights_params(args):
+    """Whole history by default; ?days=N or ?from=YYYY-MM-DD[&to=YYYY-MM-DD] for a window"""
+    p = {"window": any(name in args for name in ('days', 'from', 'to')), "days": _arg(args, 'days', 30)}
+    try:
+        p["start"], p["end"] = _date_arg(args, 'from'), _date_arg(args, 'to')
+    except ValueError as e:
+        p["error"] = str(e)
+    return p
+
+
+def plan_insights(merchant_id, p):
+    if "error" in p:
+        return {}
+    window = {"merchant_id": merchant_id, "days": p["days"], "start": p["start"], "end": p["end"]}
+    if p["window"]:
+        delivery = (queries.DELIVERY_METRICS_WINDOW, window)
+        customers = (queries.CUSTOMER_WINDOW, window)
+    else:
+        delivery = (queries.DELIVERY_METRICS, {"merchant_id": merchant_id})
+        customers = (queries.REPEAT_CUSTOMERS, {"merchant_id": merchant_id})
+        window = dict(window, days=None)
+    return {
+        "delivery_metrics": delivery,
+        "delivery_histogram": (queries.DELIVERY_HISTOGRAM, window),
+        "customer_metrics": customers,
+        "cuisine_data": (queries.TOP_CUISINES, (merchant_id,)),
+    }
+
+
+def _customer_metrics(p, customers):
+    if not p["window"]:
+        total_customers = _int(customers['total_customers'])
+        repeat_customers = _int(customers['repeat_customers'])
+        repeat_rate = (repeat_customers / total_customers * 100) if total_customers > 0 else 0
+        return {
+            "total_unique_customers": total_customers,
+            "repeat_customers": repeat_customers,
+            "repeat_rate_percent": repeat_rate
+        }
+    # The customer count is a sketch estimate (about 1.6% standard error,
+    # see sketches.py); the new customers are exact and part of it, so the
+    # returning customers carry the estimate's whole error
+    new_customers = _int(customers['new_customers'])
+    total_customers = max(_int(customers['customers']), new_customers)
+    returning_customers = total_customers - new_customers
+    returning_rate = (returning_customers / total_customers * 100) if total_customers > 0 else 0
+    return {
+        "total_unique_customers": total_customers,
+        "new_customers": new_customers,
+        "returning_customers": returning_customers,
+        "returning_rate_percent": returning_rate,
+        "estimated": True
+    }
+
+
+def shape_insights(merchant_id, p, r):
+    if "error" in p:
+        raise SectionError(400, {"error": p["error"]})
+    delivery = r["delivery_metrics"][0]
+
+    return {
+        "delivery_metrics": {
+            "avg_delivery_time_min": _float(delivery['avg_delivery_time']),
+            "avg_arrival_time_min": _float(delivery['avg_arrival_time']),
+            "avg_preparation_time_min": _float(delivery['avg_preparation_time']),
+            # From the duration histograms, within 2% (see histograms.py)
+            "percentiles": {
+                f"{metric}_time_min": histograms.percentiles(r["delivery_histogram"], metric)
+                for metric in histograms.METRICS
+            }
+        },
+        "customer_metrics": _customer_metrics(p, r["customer_metrics"][0]),
+        "top_cuisine_tags": [
+            {"tag": row['cuisine_tag'], "order_count": row['order_count']}
+            for row in r["cuisine_data"]
+        ]
+    }
+
+
+# CHAT SCREEN
+
+def keywords_params(args):
+    """?limit=N of the merchant's keywords (default 20)"""
+    p = {"limit": _arg(args, 'limit', 20)}
+    if p["limit"] < 1:
+        p["error"] = "limit must be positive"
+    return p
+
+
+def keyword_search_params(args):
+    """?q=... typed so far and ?limit=N (default 10)"""
+    p = {"q": args.get('q', ''), "limit": _arg(args, 'limit', 10)}
+    if p["limit"] < 1:
+        p["error"] = "limit must be positive"
+    return p
+
+
+def plan_keywords(merchant_id, p):
+    if "error" in p:
+        return {}
+    # The keywords matching this merchant's items (see keyword_index.py)
+    return {"keywords": (queries.MERCHANT_KEYWORDS, {"merchant_id": merchant_id, "limit": p["limit"]})}
+
+
+def _keyword(row):
+    return {
+        "keyword": row['keyword'],
+        "views": row['view'],
+        "menu_views": row['menu'],
+        "checkouts": row['checkout'],
+        "orders": row['order_count'],
+        "conversion_rate": row['conversion_rate'],
+        "menu_rate": row['menu_rate'],
+        "checkout_rate": row['checkout_rate'],
+        "order_rate": row['order_rate'],
+        "item_ids": row['item_ids'],
+    }
+
+
+def shape_keywords(merchant_id, p, r):
+    if "error" in p:
+        raise SectionError(400, {"error": p["error"]})
+    return {"keywords": [_keyword(row) for row in r["keywords"]]}
+
+
+def plan_keyword_search(merchant_id, p):
+    if "error" in p:
+        return {}
+    params = keyword_index.search_params(merchant_id, p["q"], p["limit"])
+    return {"keywords": (queries.KEYWORD_SEARCH, params)} if params else {}
+
+
+def shape_keyword_search(merchant_id, p, r):
+    if "error" in p:
+        raise SectionError(400, {"error": p["error"]})
+    if "keywords" not in r:
+        raise SectionError(400, {"error": "Query parameter q needs at least one letter or digit"})
+    return {"query": p["q"], "keywords": [_keyword(row) for row in r["keywords"]]}
+
+
+# ANALYTICS (materialized views)
+
+def plan_analytics_daily(merchant_id, p):
+    return {
+        "days": (queries.ANALYTICS_DAILY, {"merchant_id": merchant_id, "days": p["days"]}),
+        "refreshed": (queries.ANALYTICS_REFRESHED_AT, {"view": "mv_daily_sales"}),
+    }
+
+
+def _refreshed_at(rows):
+    return rows[0]['refreshed_at']
+
+
+def shape_analytics_daily(merchant_id, p, r):
+    return {
+        "days": [
+            {
+                "date": row['sale_date'],
+                "sales": _float(row['total_sales']),
+                "transactions": row['transaction_count'],
+                "unique_customers": row['unique_customers'],
+                "items_sold": int(row['items_sold'])
+            }
+            for row in r["days"]
+        ],
+        "refreshed_at": _refreshed_at(r["refreshed"]),
+    }
+
+
+def analytics_products_params(args):
+    """?limit=N items by revenue (default 20)"""
+    p = {"limit": _arg(args, 'limit', 20)}
+    if p["limit"] < 1:
+        p["error"] = "limit must be positive"
+    return p
+
+
+def plan_analytics_products(merchant_id, p):
+    if "error" in p:
+        return {}
+    return {
+        "items": (queries.ANALYTICS_PRODUCTS, {"merchant_id": merchant_id, "limit": p["limit"]}),
+        "refreshed": (queries.ANALYTICS_REFRESHED_AT, {"view": "mv_product_performance"}),
+    }
+
+
+def shape_analytics_products(merchant_id, p, r):
+    if "error" in p:
+        raise SectionError(400, {"error": p["error"]})
+    return {
+        "items": [
+            {
+                "item_id": row['item_id'],
+                "name": row['item_name'],
+                "cuisine_tag": row['cuisine_tag'],
+                "price": row['item_price'],
+                "quantity": row['total_quantity'],
+                "revenue": _float(row['total_revenue']),
+                "order_count": row['order_count'],
+                "last_ordered_at": row['last_ordered_at']
+            }
+            for row in r["items"]
+        ],
+        "refreshed_at": _refreshed_at(r["refreshed"]),
+    }
+
+
+def forecast_params(args):
+    """?days=N of the stored forecast (default 7)"""
+    p = {"days": _arg(args, 'days', 7)}
+    if p["days"] < 1:
+        p["error"] = "days must be positive"
+    return p
+
+
+def plan_forecast(merchant_id, p):
+    if "error" in p:
+        return {}
+    return {
+        "forecast": (queries.SALES_FORECAST, {"merchant_id": merchant_id, "days": p["days"]}),
+        "run": (queries.FORECAST_RUN, {}),
+    }
+
+
+def shape_forecast(merchant_id, p, r):
+    if "error" in p:
+        raise SectionError(400, {"error": p["error"]})
+    if not r["forecast"]:
+        raise SectionError(404, {"error": "No forecast for this merchant"})
+    run = r["run"][0]
+    return {
+        "merchant_id": merchant_id,
+        "generated_at": run['started_at'],
+        "data_version": run['data_version'],
+        "stale": run['stale'],
+        "total_sales": round(sum(row['sales'] for row in r["forecast"]), 2),
+        "total_orders": round(sum(row['orders'] for row in r["forecast"]), 2),
+        "days": [
+            {
+                "date": row['forecast_date'],
+                "sales": row['sales'],
+                "sales_low": row['sales_low'],
+                "sales_high": row['sales_high'],
+                "orders": row['orders'],
+                "hourly_sales": row['hourly_sales'],
+            }
+            for row in r["forecast"]
+        ],
+    }
+
+
+def plan_peers(merchant_id, p):
+    return {
+        "peers": (queries.MERCHANT_PEERS, {"merchant_id": merchant_id}),
+        "refreshed": (queries.ANALYTICS_REFRESHED_AT, {"view": "mv_merchant_peers"}),
+    }
+
+
+def shape_peers(merchant_id, p, r):
+    if not r["peers"]:
+        raise SectionError(404, {"error": "Merchant not found"})
+    row = r["peers"][0]
+    return {
+        "merchant_id": merchant_id,
+        "window_start": row['window_start'],
+        "peer_groups": {
+            "city": {"city_id": row['city_id']},
+            "peer": {"city_id": row['city_id'], "cuisine_tag": row['cuisine_tag']},
+        },
+        "kpis": {
+            kpi: {
+                "value": round(row[kpi], 2) if row[kpi] is not None else None,
+                **{group: {"percentile": row[f"{kpi}_{group}_percentile"], "merchants": row[f"{kpi}_{group}_merchants"]}
+                   for group in peers.GROUPS},
+            }
+            for kpi in peers.KPIS
+        },
+        "refreshed_at": _refreshed_at(r["refreshed"]),
+    }
+
+
+# EXPORT
+
+TRANSACTION_FORMATS = ('json', 'ndjson', 'csv')
+TRANSACTION_PAGE_SIZE = 100
+TRANSACTION_MAX_PAGE = 1000
+
+
+def _transactions_after(cursor):
+    """(order_time, order_id) a transactions cursor points after"""
+    after = decode_cursor(cursor)
+    try:
+        if isinstance(after, list) and len(after) == 2 and isinstance(after[1], str):
+            datetime.datetime.fromisoformat(after[0])
+            return after
+    except (TypeError, ValueError):
+        pass
+    raise ValueError(f"Invalid cursor: {cursor}")
+
+
+def transactions_params(args):
+    """?from=YYYY-MM-DD&to=YYYY-MM-DD, ?columns=order_id,order_value,..., ?limit=N&cursor=...,
+    ?format=json|ndjson|csv (the streamed formats are not paged unless ?limit is given)"""
+    p = {"format": args.get('format', 'json'), "limit": _arg(args, 'limit', None), "cursor": args.get('cursor')}
+    requested = args.get('columns')
+    p["columns"] = [c.strip() for c in requested.split(',') if c.strip()] if requested else list(queries.TRANSACTION_COLUMNS)
+    try:
+        p["start"], p["end"] = _date_arg(args, 'from'), _date_arg(args, 'to')
+        if p["format"] not in TRANSACTION_FORMATS:
+            raise ValueError(f"format must be one of: {', '.join(TRANSACTION_FORMATS)}")
+        if not p["columns"] or any(c not in queries.TRANSACTION_COLUMNS for c in p["columns"]):
+            raise ValueError(f"columns must be some of: {', '.join(queries.TRANSACTION_COLUMNS)}")
+        if p["limit"] is not None and p["limit"] < 1:
+            raise ValueError("limit must be positive")
+        if p["format"] == 'json' and (p["limit"] or 0) > TRANSACTION_MAX_PAGE:
+            raise ValueError(f"limit must be at most {TRANSACTION_MAX_PAGE} (?format=ndjson or csv streams more)")
+        p["after"] = _transactions_after(p["cursor"]) if p["cursor"] else [None, None]
+    except ValueError as e:
+        p["error"] = str(e)
+    return p
+
+
+def transactions_statement(merchant_id, p, limit):
+    """(sql, params) of the merchant's orders after p's cursor, at most `limit` (None: all)"""
+    after_time, after_id = p["after"]
+    return queries.TRANSACTIONS, {
+        "merchant_id": merchant_id, "start": p["start"], "end": p["end"],
+        "after_time": after_time, "after_id": after_id, "limit": limit,
+    }
+
+
+def _page_size(p):
+    return min(p["limit"] or TRANSACTION_PAGE_SIZE, TRANSACTION_MAX_PAGE)
+
+
+def plan_transactions(merchant_id, p):
+    if "error" in p:
+        return {}
+    # One row past the page tells whether there is a next one
+    return {"transactions": transactions_statement(merchant_id, p, _page_size(p) + 1)}
+
+
+def shape_transactions(merchant_id, p, r):
+    if "error" in p:
+        raise SectionError(400, {"error": p["error"]})
+    rows = r["transactions"]
+    next_cursor = None
+    if len(rows) > _page_size(p):
+        rows = rows[:_page_size(p)]
+        next_cursor = encode_cursor(rows[-1]['order_time'], rows[-1]['order_id'])
+    return {
+        "merchant_id": merchant_id,
+        "transactions": [{column: row[column] for column in p["columns"]} for row in rows],
+        "next_cursor": next_cursor,
+    }
+
+
+# name -> (params, plan, shape); the names are the dashboard's `sections`
+SECTIONS = {
+    "summary": (lambda args: {}, plan_summary, shape_summary),
+    "sales_daily": (lambda args: {"days": _arg(args, 'days', 30)}, plan_daily_sales, shape_daily_sales),
+    "sales_hourly": (lambda args: {}, plan_hourly_sales, shape_hourly_sales),
+    "sales_metrics": (lambda args: {"period": _arg(args, 'period', 7)}, plan_sales_metrics, shape_sales_metrics),
+    "items": (lambda args: {}, plan_items, shape_items),
+    "items_performance": (item_performance_params, plan_item_performance, shape_item_performance),
+    "item_pairs": (item_pairs_params, plan_item_pairs, shape_item_pairs),
+    "insights": (insights_params, plan_insights, shape_insights),
+    "keywords": (keywords_params, plan_keywords, shape_keywords),
+    "keyword_search": (keyword_search_params, plan_keyword_search, shape_keyword_search),
+    "analytics_daily": (lambda args: {"days": _arg(args, 'days', 30)}, plan_analytics_daily, shape_analytics_daily),
+    "analytics_products": (analytics_products_params, plan_analytics_products, shape_analytics_products),
+    "peers": (lambda args: {}, plan_peers, shape_peers),
+    "forecast": (forecast_params, plan_forecast, shape_forecast),
+    "transactions": (transactions_params, plan_transactions, shape_transactions),
+}
+
+# What HomeScreen needs when the client does not choose
+DEFAULT_DASHBOARD_SECTIONS = ["summary", "sales_metrics", "sales_daily"]
+
+
+def in_memory(sql):
+    """True when the columnar engine answers this statement"""
+    return columnar is not None and columnar.handles(sql)
+
+
+def _answer_in_memory(sql, sql_params):
+    started = time.perf_counter()
+    rows = columnar.answer(sql, sql_params)
+    instrumentation.record_statement(sql, sql_params, time.perf_counter() - started, engine='columnar')
+    return rows
+
+
+def _fetch(conn, sql, sql_params):
+    if in_memory(sql):
+        return _answer_in_memory(sql, sql_params)
+    return instrumentation.run_statement(conn, sql, sql_params, fetch_rows)
+
+
+def run_section(conn, name, merchant_id, args):
+    """Run one section's statements in turn on `conn` and shape the result"""
+    params, plan, shape = SECTIONS[name]
+    p = params(args)
+    results = {
+        key: _fetch(conn, sql, sql_params)
+        for key, (sql, sql_params) in plan(merchant_id, p).items()
+    }
+    with instrumentation.phase('shape'):
+        return shape(merchant_id, p, results)
+
+
+_executor = None
+
+
+def _get_executor():
+    global _executor
+    if _executor is None:
+        _executor = ThreadPoolExecutor(max_workers=DASHBOARD_WORKERS, thread_name_prefix='dashboard')
+    return _executor
+
+
+def _timed_query(sql, sql_params):
+    """(rows, seconds, finished at, phases) of one statement, run on a dashboard thread;
+    its pool_wait/queries phases are returned for the request thread to add"""
+    started = time.monotonic()
+    with instrumentation.collect_phases() as phases:
+        if in_memory(sql):
+            rows = _answer_in_memory(sql, sql_params)
+        else:
+            with pooled_connection() as conn:
+                rows = instrumentation.run_statement(conn, sql, sql_params, fetch_rows)
+    finished = time.monotonic()
+    return rows, finished - started, finished, phases
+
+
+def dashboard_failed(result):
+    """True when a dashboard section failed on the server side (not a 4xx
+    of its arguments); such answers are not cached"""
+    return any(error.get("status", 500) >= 500 for error in result["errors"].values())
+
+
+def run_dashboard(merchant_id, names, args):
+    """Run the statements of every requested section concurrently, each on its
+    own pooled connection, then shape each section as its results complete.
+
+    Returns {"sections", "errors", "timings_ms", "total_ms"}; a failing section
+    only lands in "errors". Section timings are measured from the start of the
+    request to its last statement finishing, so the slowest statement bounds
+    the total.
+    """
+    started = time.monotonic()
+    executor = _get_executor()
+
+    pending = {}
+    for name in names:
+        params, plan, _ = SECTIONS[name]
+        p = params(args)
+        futures = {
+            key: executor.submit(_timed_query, sql, sql_params)
+            for key, (sql, sql_params) in plan(merchant_id, p).items()
+        }
+        pending[name] = (p, futures)
+
+    sections, errors, timings = {}, {}, {}
+    for name, (p, futures) in pending.items():
+        shape = SECTIONS[name][2]
+        try:
+            results = {key: future.result()[0] for key, future in futures.items()}
+            with instrumentation.phase('shape'):
+                sections[name] = shape(merchant_id, p, results)
+        except SectionError as e:
+            errors[name] = dict(e.payload, status=e.status)
+        except PoolTimeout:
+            # The same answer a single route gives when the pool is exhausted
+            errors[name] = {"error": "Server busy, please retry", "status": 503}
+        except Exception as e:
+            print(f"Error in dashboard section {name}: {str(e)}")
+            errors[name] = {"error": str(e), "status": 500}
+        done = [future.result() for future in futures.values() if future.exception() is None]
+        for d in done:
+            instrumentation.add_phases(d[3])
+        timings[name] = {
+            "queries_ms": {
+                key: round(future.result()[1] * 1000, 2)
+                for key, future in futures.items() if future.exception() is None
+            },
+            "ready_ms": round((max((d[2] for d in done), default=started) - started) * 1000, 2),
+        }
+
+    return {
+        "merchant_id": merchant_id,
+        "sections": sections,
+        "errors": errors,
+        "timings_ms": timings,
+        "total_ms": round((time.monotonic() - started) * 1000, 2),
+    }
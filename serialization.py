@@ -0,0 +1,89 @@
+"""Cursor-to-JSON path for the API, without pandas.
+
+Rows are fetched with per-cursor typecasters so values arrive already in
+their JSON form: NUMERIC as float, DATE as "YYYY-MM-DD" and TIMESTAMP as
+the same ISO 8601 string datetime.isoformat() gives, straight from
+Postgres' text output without building Decimal/datetime objects first
+(TIMESTAMPTZ keeps the default datetime conversion; the encoder handles
+it). Responses are encoded with orjson when it is installed, falling back
+to the standard json module.
+"""
+import json
+
+import psycopg2.extensions
+
+import instrumentation
+
+try:
+    import orjson
+except ImportError:  # optional; json is used when missing
+    orjson = None
+
+
+def _to_float(value, cur):
+    return float(value) if value is not None else None
+
+
+def _to_date(value, cur):
+    # Postgres' default DateStyle (ISO) already prints YYYY-MM-DD
+    return value
+
+
+def iso_timestamp(value):
+    """Postgres TIMESTAMP text -> datetime.isoformat() text"""
+    value = value.replace(' ', 'T', 1)
+    # Postgres drops trailing zeros of the fraction; isoformat() prints six digits
+    if '.' in value:
+        whole, fraction = value.split('.', 1)
+        value = f"{whole}.{fraction:0<6}"
+    return value
+
+
+def _to_timestamp(value, cur):
+    return iso_timestamp(value) if value is not None else None
+
+
+_oid = psycopg2.extensions
+JSON_TYPES = [
+    _oid.new_type(_oid.DECIMAL.values, 'JSON_NUMERIC', _to_float),
+    _oid.new_type(_oid.DATE.values, 'JSON_DATE', _to_date),
+    _oid.new_type((1114,), 'JSON_TIMESTAMP', _to_timestamp),
+]
+
+
+def json_cursor(conn, name=None):
+    """Cursor whose NUMERIC/DATE/TIMESTAMP values come back JSON-ready
+    (a named, server-side cursor when `name` is given)"""
+    cur = conn.cursor(name) if name else conn.cursor()
+    for json_type in JSON_TYPES:
+        psycopg2.extensions.register_type(json_type, cur)
+    return cur
+
+
+def fetch_rows(conn, sql, params=None):
+    """Run a statement and return its rows as a list of dicts"""
+    cur = json_cursor(conn)
+    try:
+        cur.execute(sql, params)
+        columns = [d[0] for d in cur.description]
+        return [dict(zip(columns, row)) for row in cur.fetchall()]
+    finally:
+        cur.close()
+
+
+def _default(value):
+    return value.isoformat() if hasattr(value, 'isoformat') else str(value)
+
+
+def dumps(payload):
+    """Encode a payload to JSON bytes"""
+    if orjson is not None:
+        return orjson.dumps(payload, option=orjson.OPT_NON_STR_KEYS)
+    return json.dumps(payload, separators=(',', ':'), default=_default).encode('utf-8')
+
+
+def json_response(payload, status=200):
+    from flask import Response
+    with instrumentation.phase('serialize'):
+        body = dumps(payload)
+    return Response(body, status=status, mimetype='application/json')
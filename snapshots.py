@@ -0,0 +1,396 @@
+"""Columnar snapshots of transaction_data and transaction_items for offline jobs.
+
+    python snapshots.py --export                    # new snapshot under SNAPSHOT_DIR
+    python snapshots.py --list                      # partitions of the latest snapshot
+    python snapshots.py --scan transaction_data --merchant ID --from 2024-01-01 --to 2024-02-01
+
+Offline jobs (reports, forecasting, backfills) read a snapshot instead of
+querying Postgres or re-parsing the CSVs, and only touch the columns and
+partitions they ask for.
+
+Layout of one snapshot (SNAPSHOT_DIR/<name>/):
+
+    manifest.json                                    data version, schemas,
+                                                     partitions with min/max stats
+    transaction_data/merchant_id=<id>/month=<YYYY-MM>/part-0.parquet
+    transaction_items/merchant_id=<id>/month=<YYYY-MM>/part-0.parquet
+
+Items are partitioned by the month of their order, and their files carry
+that order_time so they can be pruned the same way. Rows without a merchant
+or an order_time go to the __HIVE_DEFAULT_PARTITION__ partition. Files are
+Parquet with column statistics (SNAPSHOT_FORMAT=parquet), or uncompressed
+Arrow IPC (SNAPSHOT_FORMAT=arrow), which readers map zero-copy.
+SNAPSHOT_DIR/LATEST names the newest complete snapshot; it is switched only
+after the manifest is written, and the SNAPSHOT_KEEP newest are kept.
+
+Needs the optional pyarrow package.
+"""
+import argparse
+import json
+import os
+import shutil
+import tempfile
+import time
+from datetime import datetime
+from urllib.parse import quote
+
+from db_connection import get_db_connection
+
+try:
+    import pyarrow as pa
+    import pyarrow.compute as pc
+    import pyarrow.csv as pa_csv
+    import pyarrow.parquet as pq
+except ImportError:  # optional; only needed for snapshots
+    pa = None
+
+SNAPSHOT_DIR = os.getenv('SNAPSHOT_DIR', './snapshots')
+SNAPSHOT_FORMAT = os.getenv('SNAPSHOT_FORMAT', 'parquet')
+SNAPSHOT_KEEP = int(os.getenv('SNAPSHOT_KEEP', '2'))
+# Size of the CSV blocks read back from COPY; bounds memory, not file sizes
+SNAPSHOT_BLOCK_BYTES = int(os.getenv('SNAPSHOT_BLOCK_BYTES', str(64 << 20)))
+
+NULL_PARTITION = '__HIVE_DEFAULT_PARTITION__'
+
+# Per table: the exported columns (name, Arrow type, SQL), the FROM clause,
+# and the SQL of the partition keys
+TABLES = {
+    'transaction_data': {
+        'columns': [
+            ('order_id', 'string', 'td.order_id'),
+            ('order_time', 'timestamp', 'td.order_time'),
+            ('driver_arrival_time', 'timestamp', 'td.driver_arrival_time'),
+            ('driver_pickup_time', 'timestamp', 'td.driver_pickup_time'),
+            ('delivery_time', 'timestamp', 'td.delivery_time'),
+            ('order_value', 'decimal', 'td.order_value'),
+            ('eater_id', 'int64', 'td.eater_id'),
+            ('merchant_id', 'string', 'td.merchant_id'),
+        ],
+        'from': 'transaction_data td',
+        'merchant': 'td.merchant_id',
+    },
+    'transaction_items': {
+        'columns': [
+            ('id', 'int32', 'ti.id'),
+            ('order_id', 'string', 'ti.order_id'),
+            ('item_id', 'int32', 'ti.item_id'),
+            ('merchant_id', 'string', 'ti.merchant_id'),
+            ('order_time', 'timestamp', 'td.order_time'),
+        ],
+        # The partition month is the month of the order
+        'from': 'transaction_items ti LEFT JOIN transaction_data td ON td.order_id = ti.order_id',
+        'merchant': 'ti.merchant_id',
+    },
+}
+_MONTH = "to_char(td.order_time, 'YYYY-MM')"
+
+
+def _require_pyarrow():
+    if pa is None:
+        raise RuntimeError("Snapshots need the pyarrow package")
+
+
+def _arrow_type(kind):
+    return {
+        'string': pa.string(),
+        'timestamp': pa.timestamp('us'),
+        'decimal': pa.decimal128(10, 2),
+        'int64': pa.int64(),
+        'int32': pa.int32(),
+    }[kind]
+
+
+def _schema(table):
+    return pa.schema([(name, _arrow_type(kind)) for name, kind, _ in TABLES[table]['columns']])
+
+
+# EXPORT
+
+def _copy_to_file(cur, table, spool):
+    spec = TABLES[table]
+    cur.copy_expert(f'''
+    COPY (
+        SELECT {', '.join(sql for _, _, sql in spec['columns'])}
+        FROM {spec['from']}
+        ORDER BY {spec['merchant']} NULLS LAST, {_MONTH} NULLS LAST, td.order_time
+    ) TO STDOUT WITH (FORMAT csv, NULL '\\N')
+    ''', spool)
+    spool.flush()
+    spool.seek(0)
+
+
+def _partition_counts(cur, table):
+    """(merchant_id, month, rows) per partition, in the order _copy_to_file writes them"""
+    spec = TABLES[table]
+    cur.execute(f'''
+    SELECT {spec['merchant']}, {_MONTH}, COUNT(*)
+    FROM {spec['from']}
+    GROUP BY 1, 2
+    ORDER BY 1 NULLS LAST, 2 NULLS LAST
+    ''')
+    return cur.fetchall()
+
+
+class _PartitionWriter:
+    """One partition file plus the min/max statistics of its columns"""
+
+    def __init__(self, path, schema, fmt):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.path = path
+        self.rows = 0
+        self.stats = {}
+        if fmt == 'arrow':
+            self._sink = pa.OSFile(path, 'wb')
+            self._writer = pa.ipc.new_file(self._sink, schema)
+        else:
+            self._sink = None
+            self._writer = pq.ParquetWriter(path, schema, compression='zstd', write_statistics=True)
+
+    def write(self, batch):
+        if self._sink is None:
+            self._writer.write_table(pa.Table.from_batches([batch]))
+        else:
+            self._writer.write_batch(batch)
+        self.rows += batch.num_rows
+        for name, column in zip(batch.schema.names, batch.columns):
+            if pa.types.is_string(column.type):
+                continue
+            bounds = pc.min_max(column).as_py()
+            if bounds['min'] is None:
+                continue
+            low, high = self.stats.get(name, (bounds['min'], bounds['max']))
+            self.stats[name] = (min(low, bounds['min']), max(high, bounds['max']))
+
+    def close(self):
+        self._writer.close()
+        if self._sink is not None:
+            self._sink.close()
+        return {
+            "rows": self.rows,
+            "bytes": os.path.getsize(self.path),
+            "stats": {name: [_json_value(low), _json_value(high)] for name, (low, high) in self.stats.items()},
+        }
+
+
+def _json_value(value):
+    if hasattr(value, 'isoformat'):
+        return value.isoformat()
+    return value if isinstance(value, int) else str(value)
+
+
+def _export_table(cur, table, out_dir, fmt, spool_dir):
+    schema = _schema(table)
+    counts = _partition_counts(cur, table)
+    with tempfile.TemporaryFile(dir=spool_dir) as spool:
+        _copy_to_file(cur, table, spool)
+        reader = pa_csv.open_csv(
+            spool,
+            read_options=pa_csv.ReadOptions(column_names=schema.names, block_size=SNAPSHOT_BLOCK_BYTES),
+            convert_options=pa_csv.ConvertOptions(
+                column_types=schema, null_values=['\\N'], strings_can_be_null=True, quoted_strings_can_be_null=False,
+            ),
+        )
+
+        # The rows arrive sorted by partition, in the order of `counts`:
+        # cut each block into the partitions it spans
+        partitions = []
+        pending = iter(counts)
+        writer, remaining = None, 0
+        for batch in reader:
+            offset = 0
+            while offset < batch.num_rows:
+                if remaining == 0:
+                    merchant_id, month, remaining = next(pending)
+                    path = os.path.join(
+                        table,
+                        f"merchant_id={quote(merchant_id, safe='') if merchant_id is not None else NULL_PARTITION}",
+                        f"month={month or NULL_PARTITION}",
+                        f"part-0.{fmt}",
+                    )
+                    writer = _PartitionWriter(os.path.join(out_dir, path), schema, fmt)
+                    partitions.append({"merchant_id": merchant_id, "month": month, "path": path})
+                take = min(remaining, batch.num_rows - offset)
+                writer.write(batch.slice(offset, take))
+                offset += take
+                remaining -= take
+                if remaining == 0:
+                    partitions[-1].update(writer.close())
+        if remaining or next(pending, None) is not None:
+            raise RuntimeError(f"{table}: exported rows do not match the partition counts")
+
+    return {
+        "columns": {name: kind for name, kind, _ in TABLES[table]['columns']},
+        "rows": sum(p["rows"] for p in partitions),
+        "partitions": partitions,
+    }
+
+
+def export_snapshot(root=SNAPSHOT_DIR, fmt=SNAPSHOT_FORMAT, tables=tuple(TABLES)):
+    """Write a new snapshot of `tables` from one consistent view of the database; returns its name"""
+    _require_pyarrow()
+    if fmt not in ('parquet', 'arrow'):
+        raise ValueError(f"Unknown snapshot format: {fmt}")
+    started = time.monotonic()
+    os.makedirs(root, exist_ok=True)
+
+    conn = get_db_connection()
+    # Every table and its partition counts from the same snapshot
+    conn.set_session(isolation_level='REPEATABLE READ', readonly=True)
+    try:
+        cur = conn.cursor()
+        cur.execute("SELECT version FROM data_version")
+        row = cur.fetchone()
+        version = row[0] if row else 0
+        name = f"v{version}-{datetime.now().strftime('%Y%m%dT%H%M%S')}"
+        out_dir = os.path.join(root, name)
+        work_dir = out_dir + '.partial'
+        shutil.rmtree(work_dir, ignore_errors=True)
+        os.makedirs(work_dir)
+
+        manifest = {"name": name, "data_version": version, "format": fmt,
+                    "created_at": datetime.now().isoformat(), "tables": {}}
+        for table in tables:
+            print(f"Exporting {table}...")
+            manifest["tables"][table] = _export_table(cur, table, work_dir, fmt, root)
+            info = manifest["tables"][table]
+            print(f"  {table}: {info['rows']:,} rows in {len(info['partitions'])} partitions")
+        cur.close()
+        conn.rollback()
+    except Exception:
+        shutil.rmtree(work_dir, ignore_errors=True)
+        raise
+    finally:
+        conn.close()
+
+    with open(os.path.join(work_dir, 'manifest.json'), 'w') as f:
+        json.dump(manifest, f, indent=1)
+    os.replace(work_dir, out_dir)
+    _write_latest(root, name)
+    _prune(root, SNAPSHOT_KEEP)
+    print(f"Snapshot {name} written in {time.monotonic() - started:.2f}s")
+    return name
+
+
+def _write_latest(root, name):
+    tmp = os.path.join(root, 'LATEST.tmp')
+    with open(tmp, 'w') as f:
+        f.write(name)
+    os.replace(tmp, os.path.join(root, 'LATEST'))
+
+
+def _prune(root, keep):
+    names = sorted(
+        (n for n in os.listdir(root) if os.path.isfile(os.path.join(root, n, 'manifest.json'))),
+        key=lambda n: os.path.getmtime(os.path.join(root, n, 'manifest.json')),
+    )
+    for name in names[:-keep] if keep > 0 else []:
+        shutil.rmtree(os.path.join(root, name), ignore_errors=True)
+
+
+# READ
+
+def _as_datetime(value):
+    if value is None or isinstance(value, datetime):
+        return value
+    return datetime.fromisoformat(str(value))
+
+
+class Snapshot:
+    """A written snapshot: its manifest, partition pruning and memory-mapped reads"""
+
+    def __init__(self, root=SNAPSHOT_DIR, name=None):
+        _require_pyarrow()
+        if name is None:
+            with open(os.path.join(root, 'LATEST')) as f:
+                name = f.read().strip()
+        self.path = os.path.join(root, name)
+        with open(os.path.join(self.path, 'manifest.json')) as f:
+            self.manifest = json.load(f)
+        self.name = name
+        self.format = self.manifest["format"]
+        self.data_version = self.manifest["data_version"]
+
+    def partitions(self, table, merchant_ids=None, start=None, end=None):
+        """Partitions that may hold rows of `merchant_ids` with start <= order_time < end"""
+        start, end = _as_datetime(start), _as_datetime(end)
+        wanted = set(merchant_ids) if merchant_ids is not None else None
+        selected = []
+        for part in self.manifest["tables"][table]["partitions"]:
+            if wanted is not None and part["merchant_id"] not in wanted:
+                continue
+            if start is not None or end is not None:
+                bounds = part["stats"].get("order_time")
+                if bounds is None:
+                    continue
+                low, high = _as_datetime(bounds[0]), _as_datetime(bounds[1])
+                if (start is not None and high < start) or (end is not None and low >= end):
+                    continue
+            selected.append(part)
+        return selected
+
+    def _read_partition(self, path, columns):
+        path = os.path.join(self.path, path)
+        if self.format == 'arrow':
+            # Zero-copy: the columns point into the mapped file
+            table = pa.ipc.open_file(pa.memory_map(path)).read_all()
+            return table.select(columns) if columns else table
+        return pq.read_table(path, columns=columns, memory_map=True)
+
+    def read(self, table, columns=None, merchant_ids=None, start=None, end=None):
+        """Rows of the pruned partitions as one pyarrow Table, filtered to the order_time range"""
+        start, end = _as_datetime(start), _as_datetime(end)
+        ranged = start is not None or end is not None
+        wanted = list(columns) if columns else None
+        if wanted and ranged and 'order_time' not in wanted:
+            wanted.append('order_time')
+
+        parts = [self._read_partition(p["path"], wanted) for p in self.partitions(table, merchant_ids, start, end)]
+        schema = _schema(table)
+        if wanted:
+            schema = pa.schema([schema.field(name) for name in wanted])
+        result = pa.concat_tables(parts) if parts else schema.empty_table()
+
+        if ranged:
+            mask = pc.is_valid(result['order_time'])
+            if start is not None:
+                mask = pc.and_(mask, pc.greater_equal(result['order_time'], pa.scalar(start, pa.timestamp('us'))))
+            if end is not None:
+                mask = pc.and_(mask, pc.less(result['order_time'], pa.scalar(end, pa.timestamp('us'))))
+            result = result.filter(mask)
+        if columns and list(columns) != result.column_names:
+            result = result.select(list(columns))
+        return result
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Export and inspect columnar snapshots")
+    parser.add_argument("--root", default=SNAPSHOT_DIR, help="directory holding the snapshots")
+    parser.add_argument("--export", action="store_true", help="write a new snapshot")
+    parser.add_argument("--format", choices=["parquet", "arrow"], default=SNAPSHOT_FORMAT)
+    parser.add_argument("--list", action="store_true", help="show the partitions of the latest snapshot")
+    parser.add_argument("--scan", choices=list(TABLES), help="read a table of the latest snapshot")
+    parser.add_argument("--merchant", action="append", help="with --scan/--list: only this merchant (repeatable)")
+    parser.add_argument("--from", dest="start", help="with --scan: order_time >= this date/time")
+    parser.add_argument("--to", dest="end", help="with --scan: order_time < this date/time")
+    parser.add_argument("--columns", help="with --scan: comma-separated columns to read")
+    args = parser.parse_args()
+
+    if args.export:
+        export_snapshot(args.root, args.format)
+    if args.list:
+        snapshot = Snapshot(args.root)
+        print(f"{snapshot.name} (data version {snapshot.data_version}, {snapshot.format})")
+        for table in snapshot.manifest["tables"]:
+            for part in snapshot.partitions(table, args.merchant):
+                bounds = part["stats"].get("order_time", ["-", "-"])
+                print(f"  {part['path']:<70} {part['rows']:>9,} rows  {bounds[0]} .. {bounds[1]}")
+    if args.scan:
+        snapshot = Snapshot(args.root)
+        columns = args.columns.split(',') if args.columns else None
+        selected = snapshot.partitions(args.scan, args.merchant, args.start, args.end)
+        started = time.monotonic()
+        result = snapshot.read(args.scan, columns, args.merchant, args.start, args.end)
+        print(f"{result.num_rows:,} rows from {len(selected)} of "
+              f"{len(snapshot.manifest['tables'][args.scan]['partitions'])} partitions "
+              f"in {(time.monotonic() - started) * 1000:.1f} ms")
+        print(result.slice(0, 5).to_pylist())
@@ -0,0 +1,274 @@
+"""Synthetic merchant data in the layout import_data.py reads.
+
+Writes merchant.csv, items.csv, transaction_data.csv, transaction_items.csv
+and keywords.csv (plus manifest.json describing the run) with the shapes of
+the real files, at any multiple of their size:
+
+    python synthetic_data.py --out /tmp/synthetic-10x --scale 10
+    python synthetic_data.py --out /tmp/synthetic-10x --scale 10 --seed 7 --end 2026-06-30
+
+Scale 1 is about the real dataset: 100 merchants, ~500 items, 50,000 orders
+over `--days` days and ~4,500 keywords. The same seed, scale, days and end
+date always produce the same files. The data is skewed like production:
+
+    merchants   Zipf popularity, so a few merchants take most orders
+    time        lunch and dinner peaks, busier Fridays/Saturdays, growth
+    eaters      heavy users order far more often, and most orders go to a
+                merchant the eater has ordered from before
+    items       each menu has favourites; orders hold 1-6 units
+    durations   per-merchant preparation times, long-tailed delivery, a
+                few orders never delivered (empty times)
+
+Rows are streamed to the CSVs, so 100x (5M orders) needs little memory.
+"""
+import argparse
+import csv
+import datetime
+import itertools
+import json
+import math
+import os
+import random
+import time
+from collections import deque
+
+MERCHANTS_PER_SCALE = 100
+ORDERS_PER_SCALE = 50_000
+KEYWORDS_PER_SCALE = 4_500
+
+# Zipf exponents: merchants by popularity, eaters by order frequency,
+# dishes within a menu
+MERCHANT_SKEW = 1.1
+EATER_SKEW = 0.8
+ITEM_SKEW = 1.2
+# Share of orders going to a merchant's earlier customer
+REPEAT_SHARE = 0.6
+# Orders per eater, on average
+ORDERS_PER_EATER = 6
+UNDELIVERED_SHARE = 0.02
+CITIES = 10
+
+HOUR_WEIGHTS = [1, 0.5, 0.3, 0.2, 0.2, 0.4, 1.5, 3, 4, 3.5, 5, 9,
+                11, 8, 4, 3.5, 4, 6, 10, 11, 8, 5, 3, 2]
+WEEKDAY_WEIGHTS = [0.9, 0.85, 0.9, 0.95, 1.2, 1.3, 1.1]   # Monday first
+
+CUISINES = {
+    "American": (["Cheeseburger", "Chicken Wings", "Hot Dog", "BBQ Ribs", "Club Sandwich", "Mac and Cheese"], 6, 16),
+    "BBQ": (["Brisket Plate", "Pulled Pork", "Smoked Sausage", "Turkey Leg", "Burnt Ends"], 9, 22),
+    "Chinese": (["Fried Rice", "Spring Rolls", "Kung Pao Chicken", "Dumplings", "Chow Mein", "Sweet and Sour Pork"], 5, 14),
+    "Japanese": (["Salmon Sushi", "Chicken Teriyaki", "Ramen", "Tempura", "Gyoza", "Katsu Curry"], 7, 20),
+    "Thai": (["Pad Thai", "Green Curry", "Tom Yum Soup", "Mango Sticky Rice", "Basil Chicken"], 6, 15),
+    "Indian": (["Butter Chicken", "Lamb Biryani", "Garlic Naan", "Samosa", "Paneer Tikka", "Dal Makhani"], 4, 16),
+    "Italian": (["Margherita Pizza", "Spaghetti Carbonara", "Lasagna", "Garlic Bread", "Tiramisu"], 5, 18),
+    "Mexican": (["Beef Tacos", "Chicken Burrito", "Nachos", "Quesadilla", "Churros"], 4, 13),
+    "Bakery": (["Plain Bagel", "Blueberry Muffin", "Croissant", "Cinnamon Roll", "Banana Bread"], 2, 7),
+    "Beverages": (["Iced Latte", "Bubble Tea", "Lemonade", "Mango Smoothie", "Hot Chocolate"], 2, 6),
+    "Side": (["French Fries", "Onion Rings", "Coleslaw", "Corn on the Cob", "Side Salad"], 2, 6),
+}
+MODIFIERS = ["Spicy", "Crispy", "Grilled", "Fried", "Smoked", "Classic", "Double", "Mini",
+             "Honey Glazed", "Garlic", "Lemon Pepper", "Cheesy", "Vegan", "Family Size"]
+NAME_FIRST = ["Golden", "Happy", "Lucky", "Urban", "Little", "Big", "Red", "Green", "Royal",
+              "Sunny", "Corner", "Old Town", "Blue", "Silver", "Spice", "Fresh"]
+NAME_SECOND = ["Kitchen", "Wok", "Grill", "Bistro", "House", "Diner", "Bakery", "Cafe",
+               "Express", "Garden", "Shack", "Corner", "Eatery", "Pit", "Bar", "Table"]
+SEARCH_WORDS = ["near me", "delivery", "cheap", "best", "promo", "late night", "halal", "set", "combo", "large"]
+
+
+def _zipf_cum_weights(n, skew):
+    return list(itertools.accumulate(1 / (rank ** skew) for rank in range(1, n + 1)))
+
+
+def _writer(out_dir, name, header):
+    f = open(os.path.join(out_dir, name), 'w', newline='')
+    w = csv.writer(f)
+    w.writerow(header)
+    return f, w
+
+
+def _merchants(rng, count):
+    ids, names = set(), set()
+    merchants = []
+    while len(merchants) < count:
+        merchant_id = f"{rng.randrange(16 ** 5):05x}"
+        if merchant_id in ids:
+            continue
+        base = f"{rng.choice(NAME_FIRST)} {rng.choice(NAME_SECOND)}"
+        name, n = base, 2
+        while name in names:
+            name, n = f"{base} {n}", n + 1
+        ids.add(merchant_id)
+        names.add(name)
+        joined = datetime.date(2012, 1, 1) + datetime.timedelta(days=rng.randrange(10 * 365))
+        merchants.append({
+            "merchant_id": merchant_id,
+            "merchant_name": name,
+            "join_date": joined.strftime('%d%m%Y'),
+            "city_id": min(int(rng.paretovariate(1.2)), CITIES),
+            "cuisines": rng.sample(sorted(CUISINES), k=rng.choice([1, 1, 2, 2, 3])),
+            # Average minutes from driver arrival to pickup
+            "prep_minutes": rng.uniform(4, 15),
+        })
+    return merchants
+
+
+def _menus(rng, merchants):
+    """Items per merchant, most popular first"""
+    item_id = 0
+    menus = {}
+    for m in merchants:
+        menu, seen = [], set()
+        for _ in range(rng.randint(2, 8)):
+            tag = rng.choice(m["cuisines"] + (["Side", "Beverages"] if rng.random() < 0.3 else []))
+            dishes, low, high = CUISINES[tag]
+            dish = rng.choice(dishes)
+            name = f"{rng.choice(MODIFIERS)} {dish}" if rng.random() < 0.6 else dish
+            if name in seen:
+                continue
+            seen.add(name)
+            item_id += 1
+            menu.append({"item_id": item_id, "cuisine_tag": tag, "item_name": name,
+                         "item_price": round(rng.uniform(low, high) * 4) / 4})
+        menus[m["merchant_id"]] = menu
+    return menus
+
+
+def _keywords(rng, items, count):
+    """Search phrases built from item names, with a view -> order funnel"""
+    phrases = []
+    seen = set()
+    words = [item["item_name"].lower().split() for item in items]
+    for _ in range(count * 20):
+        if len(phrases) >= count:
+            break
+        name = rng.choice(words)
+        start = rng.randrange(len(name))
+        phrase = ' '.join(name[start:start + rng.randint(1, 3)])
+        if rng.random() < 0.25:
+            phrase = f"{phrase} {rng.choice(SEARCH_WORDS)}"
+        if phrase in seen:
+            continue
+        seen.add(phrase)
+        view = int(rng.paretovariate(0.9) * 50)
+        menu = int(view * rng.uniform(0.15, 0.45))
+        checkout = int(menu * rng.uniform(0.2, 0.5))
+        phrases.append((phrase, view, menu, checkout, int(checkout * rng.uniform(0.03, 0.4))))
+    return phrases
+
+
+def _order_times(rng, days, end, total):
+    """Order timestamps in time order, `total` of them over the `days` days up to `end`"""
+    first = end - datetime.timedelta(days=days - 1)
+    dates = [first + datetime.timedelta(days=d) for d in range(days)]
+    # 50% growth over the period on top of the weekly cycle
+    weights = [WEEKDAY_WEIGHTS[day.weekday()] * (1 + 0.5 * i / max(days - 1, 1)) for i, day in enumerate(dates)]
+    scale = total / sum(weights)
+    hour_cum = list(itertools.accumulate(HOUR_WEIGHTS))
+    produced = 0
+    for day, cumulative in zip(dates, itertools.accumulate(weights)):
+        count = round(cumulative * scale) - produced
+        produced += count
+        stamps = sorted(
+            datetime.datetime.combine(day, datetime.time(hour, rng.randrange(60), rng.randrange(60)))
+            for hour in rng.choices(range(24), cum_weights=hour_cum, k=count)
+        )
+        yield from stamps
+
+
+def _stamp(value):
+    return value.strftime('%Y-%m-%d %H:%M:%S') if value else ''
+
+
+def generate(out_dir, scale=1.0, seed=0, days=365, end=None):
+    """Write the five CSVs and manifest.json to `out_dir`; returns the manifest"""
+    started = time.monotonic()
+    rng = random.Random(seed)
+    end = end or datetime.date.today()
+    os.makedirs(out_dir, exist_ok=True)
+
+    merchants = _merchants(rng, max(1, round(MERCHANTS_PER_SCALE * scale)))
+    menus = _menus(rng, merchants)
+    items = [dict(item, merchant_id=m) for m, menu in menus.items() for item in menu]
+    keywords = _keywords(rng, items, round(KEYWORDS_PER_SCALE * scale))
+    total_orders = max(1, round(ORDERS_PER_SCALE * scale))
+
+    f, w = _writer(out_dir, 'merchant.csv', ['merchant_id', 'merchant_name', 'join_date', 'city_id'])
+    with f:
+        w.writerows((m["merchant_id"], m["merchant_name"], m["join_date"], m["city_id"]) for m in merchants)
+    f, w = _writer(out_dir, 'items.csv', ['item_id', 'cuisine_tag', 'item_name', 'item_price', 'merchant_id'])
+    with f:
+        w.writerows((i["item_id"], i["cuisine_tag"], i["item_name"], i["item_price"], i["merchant_id"]) for i in items)
+    f, w = _writer(out_dir, 'keywords.csv', ['', 'keyword', 'view', 'menu', 'checkout', 'order'])
+    with f:
+        w.writerows((n,) + phrase for n, phrase in enumerate(keywords))
+
+    # Popularity is independent of the order merchants were generated in
+    rng.shuffle(merchants)
+    merchant_cum = _zipf_cum_weights(len(merchants), MERCHANT_SKEW)
+    eater_pool = max(1, total_orders // ORDERS_PER_EATER)
+    eater_cum = _zipf_cum_weights(eater_pool, EATER_SKEW)
+    # Eater ids are shuffled so frequent eaters are not simply the low ids
+    eater_ids = list(range(1, eater_pool + 1))
+    rng.shuffle(eater_ids)
+    regulars = {m["merchant_id"]: deque(maxlen=500) for m in merchants}
+    item_cum = {m: _zipf_cum_weights(len(menu), ITEM_SKEW) for m, menu in menus.items()}
+
+    width = max(7, len(str(total_orders)))
+    rows = {"merchants": len(merchants), "items": len(items), "keywords": len(keywords),
+            "transaction_data": 0, "transaction_items": 0}
+    orders_f, orders = _writer(out_dir, 'transaction_data.csv',
+                               ['order_id', 'order_time', 'driver_arrival_time', 'driver_pickup_time',
+                                'delivery_time', 'order_value', 'eater_id', 'merchant_id'])
+    lines_f, lines = _writer(out_dir, 'transaction_items.csv', ['order_id', 'item_id', 'merchant_id'])
+    with orders_f, lines_f:
+        for n, order_time in enumerate(_order_times(rng, days, end, total_orders)):
+            m = rng.choices(merchants, cum_weights=merchant_cum)[0]
+            merchant_id = m["merchant_id"]
+            known = regulars[merchant_id]
+            if known and rng.random() < REPEAT_SHARE:
+                eater_id = rng.choice(known)
+            else:
+                eater_id = eater_ids[rng.choices(range(eater_pool), cum_weights=eater_cum)[0]]
+                known.append(eater_id)
+
+            order_id = f"o{n:0{width}d}"
+            units = rng.choices(menus[merchant_id], cum_weights=item_cum[merchant_id],
+                                k=min(1 + int(rng.expovariate(0.7)), 6)) if menus[merchant_id] else []
+            arrival = order_time + datetime.timedelta(minutes=rng.lognormvariate(math.log(8), 0.4))
+            pickup = arrival + datetime.timedelta(minutes=rng.lognormvariate(math.log(m["prep_minutes"]), 0.35))
+            delivery = pickup + datetime.timedelta(minutes=rng.lognormvariate(math.log(18), 0.45))
+            if rng.random() < UNDELIVERED_SHARE:
+                pickup = delivery = None
+            value = round(sum(item["item_price"] for item in units) * rng.uniform(1.0, 1.15), 2)
+            orders.writerow((order_id, _stamp(order_time), _stamp(arrival), _stamp(pickup),
+                             _stamp(delivery), f"{value:.2f}", eater_id, merchant_id))
+            lines.writerows((order_id, item["item_id"], merchant_id) for item in units)
+            rows["transaction_data"] += 1
+            rows["transaction_items"] += len(units)
+
+    manifest = {
+        "generator": "synthetic_data.py",
+        "scale": scale,
+        "seed": seed,
+        "days": days,
+        "end": end.isoformat(),
+        "rows": rows,
+        "seconds": round(time.monotonic() - started, 2),
+    }
+    with open(os.path.join(out_dir, 'manifest.json'), 'w') as f:
+        json.dump(manifest, f, indent=2)
+    return manifest
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Generate synthetic merchant CSVs for load testing")
+    parser.add_argument("--out", required=True, help="directory to write the CSV files to")
+    parser.add_argument("--scale", type=float, default=1.0, help="size relative to the real dataset (50,000 orders)")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--days", type=int, default=365, help="days of orders")
+    parser.add_argument("--end", type=datetime.date.fromisoformat, default=None,
+                        help="last order date, YYYY-MM-DD (default: today)")
+    args = parser.parse_args()
+
+    manifest = generate(args.out, args.scale, args.seed, args.days, args.end)
+    print(f"Wrote {', '.join(f'{n:,} {table}' for table, n in manifest['rows'].items())} "
+          f"to {args.out} in {manifest['seconds']:.1f}s")
@@ -0,0 +1,107 @@
+import time
+
+import pytest
+
+import api_server
+import cache
+import sections
+from db_connection import PoolTimeout
+from sections import SectionError
+
+
+def _plan(sql):
+    return lambda merchant_id, p: {} if "error" in p else {"rows": (sql, {"merchant_id": merchant_id})}
+
+
+def _shape(merchant_id, p, r):
+    if "error" in p:
+        raise SectionError(400, {"error": p["error"]})
+    return {"merchant_id": merchant_id, "rows": r["rows"]}
+
+
+def _limit_params(args):
+    p = {"limit": args.get('limit', default=5, type=int)}
+    if p["limit"] < 1:
+        p["error"] = "limit must be positive"
+    return p
+
+
+# Statement -> rows, or the exception the dashboard thread raises
+STATEMENTS = {
+    "ok": [{"n": 1}, {"n": 2}],
+    "other": [{"n": 3}],
+    "busy": PoolTimeout("no connection within 0.1s"),
+    "broken": RuntimeError("relation does not exist"),
+}
+
+SECTIONS = {
+    "first": (_limit_params, _plan("ok"), _shape),
+    "second": (lambda args: {}, _plan("other"), _shape),
+    "busy": (lambda args: {}, _plan("busy"), _shape),
+    "broken": (lambda args: {}, _plan("broken"), _shape),
+}
+
+
+def _timed_query(sql, sql_params):
+    outcome = STATEMENTS[sql]
+    if isinstance(outcome, Exception):
+        raise outcome
+    return outcome, 0.001, time.monotonic(), {}
+
+
+@pytest.fixture
+def client(monkeypatch):
+    monkeypatch.setattr(sections, 'SECTIONS', SECTIONS)
+    monkeypatch.setattr(sections, 'DEFAULT_DASHBOARD_SECTIONS', ["first", "second"])
+    monkeypatch.setattr(sections, '_timed_query', _timed_query)
+    monkeypatch.setattr(cache, 'read_data_version', lambda: 1)
+    cache.configure_cache(cache.ResponseCache(shared=cache.MemoryBackend(), enabled=True))
+    yield api_server.app.test_client()
+    cache.configure_cache(None)
+
+
+def test_dashboard_runs_the_default_sections(client):
+    response = client.get('/api/merchant/m1/dashboard')
+    assert response.status_code == 200
+    body = response.get_json()
+    assert body["sections"] == {"first": {"merchant_id": 'm1', "rows": STATEMENTS["ok"]},
+                                "second": {"merchant_id": 'm1', "rows": STATEMENTS["other"]}}
+    assert body["errors"] == {}
+    assert set(body["timings_ms"]) == {"first", "second"}
+    assert set(body["timings_ms"]["first"]["queries_ms"]) == {"rows"}
+    assert 'no-store' not in response.headers.get('Cache-Control', '')
+    assert client.get('/api/merchant/m1/dashboard').headers['X-Cache'] == 'HIT'
+
+
+def test_dashboard_picks_sections_and_passes_arguments(client):
+    body = client.get('/api/merchant/m1/dashboard?sections=second, first&limit=0').get_json()
+    assert list(body["sections"]) == ["second"]
+    # An argument a section rejects is that section's 400, not the dashboard's
+    assert body["errors"] == {"first": {"error": "limit must be positive", "status": 400}}
+
+
+def test_dashboard_rejects_unknown_sections(client):
+    response = client.get('/api/merchant/m1/dashboard?sections=first,nope')
+    assert response.status_code == 400
+    assert response.get_json() == {"error": "Unknown sections: nope", "available": list(SECTIONS)}
+
+
+def test_dashboard_partial_failure_is_not_stored(client):
+    url = '/api/merchant/m1/dashboard?sections=first,busy,broken'
+    response = client.get(url)
+    assert response.status_code == 200
+    body = response.get_json()
+    assert list(body["sections"]) == ["first"]
+    assert body["errors"] == {
+        "busy": {"error": "Server busy, please retry", "status": 503},
+        "broken": {"error": "relation does not exist", "status": 500},
+    }
+    assert body["timings_ms"]["busy"]["queries_ms"] == {}
+    assert response.headers['Cache-Control'] == 'no-store'
+    assert client.get(url).headers['X-Cache'] == 'MISS'
+
+
+def test_dashboard_with_only_argument_errors_is_cached(client):
+    url = '/api/merchant/m1/dashboard?sections=first&limit=0'
+    assert client.get(url).headers.get('Cache-Control') == 'no-cache'
+    assert client.get(url).headers['X-Cache'] == 'HIT'
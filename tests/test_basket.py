@@ -0,0 +1,32 @@
+import pytest
+
+from basket import _merchant_lines, score
+
+
+def test_score_confidence_lift_and_ranking():
+    # 10 orders: A in 5, B in 4, C in 2; A+B together 4 times, A+C twice
+    pairs = score({'A': 5, 'B': 4, 'C': 2}, {('A', 'B'): 4, ('A', 'C'): 2}, 10, top_n=5, min_orders=2)
+    assert pairs['B'] == [('A', 4, 0.4, 1.0, 2.0)]
+    assert pairs['C'] == [('A', 2, 0.2, 1.0, 2.0)]
+    # A -> B: confidence 0.8, A -> C: 0.4; ranked by confidence
+    assert [(other, n) for other, n, *_ in pairs['A']] == [('B', 4), ('C', 2)]
+    other, n, support, confidence, lift = pairs['A'][0]
+    assert (support, confidence) == (0.4, 0.8)
+    assert lift == pytest.approx(0.8 * 10 / 4)
+
+
+def test_score_min_orders_and_top_n():
+    item_orders = {'A': 6, 'B': 3, 'C': 3, 'D': 3}
+    pair_orders = {('A', 'B'): 3, ('A', 'C'): 3, ('A', 'D'): 1}
+    pairs = score(item_orders, pair_orders, 6, top_n=1, min_orders=2)
+    assert 'D' not in pairs
+    # B and C tie on confidence and lift; the item id breaks the tie
+    assert [other for other, *_ in pairs['A']] == ['B']
+
+
+def test_merchant_lines_rank_pairs_for_copy():
+    lines = list(_merchant_lines({'A': 5, 'B': 4, 'C': 2}, {('A', 'B'): 4, ('A', 'C'): 2}, 10))
+    a = [line.split('\t') for line in lines if line.startswith('A\t')]
+    assert [(rank, other, n, item_orders, orders) for _, rank, other, n, item_orders, orders, *_ in a] == [
+        ('1', 'B', '4', '5', '10'), ('2', 'C', '2', '5', '10')]
+    assert all(line.endswith('\n') and line.count('\t') == 8 for line in lines)
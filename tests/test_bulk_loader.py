@@ -0,0 +1,206 @@
+import datetime
+import os
+
+import pytest
+
+import bulk_loader
+from bulk_loader import TABLES, file_fingerprint, load_table, newest_row, plan_run, read_chunks, transform_rows
+
+HEADER = "order_id,order_time,driver_arrival_time,driver_pickup_time,delivery_time,order_value,eater_id,merchant_id\n"
+
+
+def _order(i):
+    return f'o{i:04d},2026-01-01 10:{i % 60:02d}:00,,,,{i}.50,{i},m1\n'
+
+
+@pytest.fixture
+def orders_csv(tmp_path):
+    path = tmp_path / "transaction_data.csv"
+    path.write_text(HEADER + ''.join(_order(i) for i in range(10)))
+    return str(path)
+
+
+def _all_rows(path, chunk_rows, start_offset=None):
+    return [row for _, rows, _ in read_chunks(path, chunk_rows, start_offset) for row in rows]
+
+
+def test_read_chunks_sizes_and_offsets(orders_csv):
+    chunks = list(read_chunks(orders_csv, chunk_rows=4))
+    assert [len(rows) for _, rows, _ in chunks] == [4, 4, 2]
+    assert all(header[0] == 'order_id' for header, _, _ in chunks)
+    assert chunks[-1][2] == os.path.getsize(orders_csv)
+    with open(orders_csv, 'rb') as f:
+        data = f.read()
+    # Every end offset is a line boundary
+    assert all(data[offset - 1:offset] == b'\n' for _, _, offset in chunks)
+
+
+def test_read_chunks_keeps_quoted_multiline_fields_together(tmp_path):
+    path = tmp_path / "keywords.csv"
+    path.write_text('keyword,order\n"spring\nrolls",1\n"fried\n\nrice",2\nnoodles,3\n')
+    chunks = list(read_chunks(str(path), chunk_rows=1))
+    rows = [row for _, rows, _ in chunks for row in rows]
+    assert rows == [['spring\nrolls', '1'], ['fried\n\nrice', '2'], ['noodles', '3']]
+    # A chunk never ends inside a quoted field
+    assert [len(rows) for _, rows, _ in chunks] == [1, 1, 1]
+
+
+def test_resume_from_mid_file_checkpoint(orders_csv):
+    """A run interrupted after its first chunk carries on from the checkpoint, reading every row once"""
+    header, first_rows, offset = next(read_chunks(orders_csv, chunk_rows=3))
+    state = {
+        'source_file': os.path.abspath(orders_csv), 'status': 'running', 'byte_offset': offset,
+        'fingerprint': file_fingerprint(orders_csv, offset), 'run_since': None, 'watermark_time': None,
+    }
+    start_offset, since, resumed = plan_run(None, 'transaction_data', orders_csv, state)
+    assert (start_offset, since, resumed) == (offset, None, True)
+
+    rest = _all_rows(orders_csv, 3, start_offset)
+    assert first_rows + rest == _all_rows(orders_csv, 3)
+    assert [row[0] for row in first_rows + rest] == [f'o{i:04d}' for i in range(10)]
+
+
+def test_completed_file_with_appended_rows_continues_after_old_end(orders_csv):
+    size = os.path.getsize(orders_csv)
+    state = {
+        'source_file': os.path.abspath(orders_csv), 'status': 'completed', 'byte_offset': size,
+        'fingerprint': file_fingerprint(orders_csv, size), 'run_since': None, 'watermark_time': None,
+    }
+    with open(orders_csv, 'a') as f:
+        f.write(_order(10) + _order(11))
+    start_offset, since, resumed = plan_run(None, 'transaction_data', orders_csv, state)
+    assert (start_offset, resumed) == (size, True)
+    assert [row[0] for row in _all_rows(orders_csv, 50, start_offset)] == ['o0010', 'o0011']
+
+
+def test_rewritten_file_is_rescanned_from_the_watermark(orders_csv):
+    size = os.path.getsize(orders_csv)
+    watermark = datetime.datetime(2026, 1, 1, 10, 5)
+    state = {
+        'source_file': os.path.abspath(orders_csv), 'status': 'completed', 'byte_offset': size,
+        'fingerprint': file_fingerprint(orders_csv, size), 'run_since': None, 'watermark_time': watermark,
+    }
+    with open(orders_csv, 'r+') as f:
+        f.seek(len(HEADER))
+        f.write(_order(0).replace('o0000', 'x0000'))
+    assert plan_run(None, 'transaction_data', orders_csv, state) == (0, watermark, False)
+
+
+def test_file_shorter_than_checkpoint_is_not_resumed(orders_csv):
+    state = {
+        'source_file': os.path.abspath(orders_csv), 'status': 'running', 'byte_offset': 10 ** 6,
+        'fingerprint': 'x', 'run_since': None, 'watermark_time': None,
+    }
+    assert plan_run(None, 'transaction_data', orders_csv, state) == (0, None, False)
+
+
+def test_no_state_starts_at_the_beginning(orders_csv):
+    assert plan_run(None, 'transaction_data', orders_csv, None) == (0, None, False)
+
+
+def test_fingerprint_covers_header_and_bytes_before_offset(orders_csv, monkeypatch):
+    offset = os.path.getsize(orders_csv)
+    before = file_fingerprint(orders_csv, offset)
+    with open(orders_csv, 'a') as f:
+        f.write(_order(10))
+    # Appending does not change what precedes the checkpoint
+    assert file_fingerprint(orders_csv, offset) == before
+    with open(orders_csv, 'r+') as f:
+        f.write(HEADER.replace('order_id', 'order_ID'))
+    assert file_fingerprint(orders_csv, offset) != before
+
+    # Only the last FINGERPRINT_BYTES before the offset are hashed
+    monkeypatch.setattr(bulk_loader, 'FINGERPRINT_BYTES', 8)
+    with open(orders_csv, 'rb') as f:
+        data = bytearray(f.read())
+    data[len(HEADER) + 1] = ord('Z')
+    with open(orders_csv, 'wb') as f:
+        f.write(data)
+    small = file_fingerprint(orders_csv, offset)
+    data[len(HEADER) + 2] = ord('Y')
+    with open(orders_csv, 'wb') as f:
+        f.write(data)
+    assert file_fingerprint(orders_csv, offset) == small
+
+
+def _rows(*orders):
+    spec = TABLES['transaction_data']
+    header = HEADER.strip().split(',')
+    return transform_rows(spec, header, [list(o) for o in orders], [])
+
+
+def test_newest_row_is_the_latest_time():
+    rows = _rows(
+        ('a', '2026-01-01 09:59:59', '', '', '', '1', '1', 'm1'),
+        ('c', '2026-01-01 11:00:00', '', '', '', '1', '1', 'm1'),
+        ('b', '2026-01-01 10:00:00', '', '', '', '1', '1', 'm1'),
+    )
+    assert newest_row(TABLES['transaction_data'], rows) == (datetime.datetime(2026, 1, 1, 11), 'c')
+
+
+def test_newest_row_breaks_time_ties_on_order_id():
+    rows = _rows(
+        ('o2', '2026-01-01 10:00:00', '', '', '', '1', '1', 'm1'),
+        ('o9', '2026-01-01 10:00:00', '', '', '', '1', '1', 'm1'),
+        ('o5', '2026-01-01 10:00:00', '', '', '', '1', '1', 'm1'),
+    )
+    assert newest_row(TABLES['transaction_data'], rows) == (datetime.datetime(2026, 1, 1, 10), 'o9')
+
+
+def test_newest_row_ignores_unparseable_times():
+    rows = _rows(('a', 'not a time', '', '', '', '1', '1', 'm1'), ('b', '', '', '', '', '1', '1', 'm1'))
+    assert newest_row(TABLES['transaction_data'], rows) is None
+    assert newest_row(TABLES['merchants'], [('m1', 'M', '2020-01-01', 1)]) is None
+
+
+class _Cursor:
+    def execute(self, sql, params=None):
+        pass
+
+    def close(self):
+        pass
+
+
+class _Connection:
+    def cursor(self):
+        return _Cursor()
+
+    def commit(self):
+        pass
+
+
+def test_rescan_merges_resent_orders_older_than_the_watermark(orders_csv, monkeypatch):
+    """A rewritten file re-sending an old order with its driver times filled in gets it to the merge"""
+    watermark = datetime.datetime(2026, 1, 1, 10, 5)
+    state = {
+        'source_file': os.path.abspath(orders_csv), 'status': 'completed', 'byte_offset': 1,
+        'fingerprint': 'an earlier file', 'rows_committed': 10, 'watermark_time': watermark,
+        'watermark_order_id': 'o0005', 'run_since': None, 'run_max_time': None, 'run_max_order_id': None,
+        'run_baseline_id': None, 'started_at': None,
+    }
+    with open(orders_csv, 'w') as f:
+        f.write(HEADER)
+        f.write('o0001,2026-01-01 10:01:00,2026-01-01 10:09:00,2026-01-01 10:15:00,2026-01-01 10:40:00,1.50,1,m1\n')
+        f.write(_order(12))
+    merged, saved = [], []
+    monkeypatch.setattr(bulk_loader.rollups, 'rollups_for', lambda table: [])
+    monkeypatch.setattr(bulk_loader, 'get_state', lambda cur, table: state)
+    monkeypatch.setattr(bulk_loader, 'save_state', lambda cur, table, **fields: saved.append(fields))
+    monkeypatch.setattr(bulk_loader, 'load_batch',
+                        lambda cur, table, rows, rejects, params: merged.append((rows, params)) or len(rows))
+
+    stats = load_table(_Connection(), 'transaction_data', orders_csv)
+    (rows, params), = merged
+    assert params['since'] == watermark
+    assert [row[0] for row in rows] == ['o0001', 'o0012']
+    assert rows[0][2:5] == ('2026-01-01 10:09:00', '2026-01-01 10:15:00', '2026-01-01 10:40:00')
+    assert stats['rows_loaded'] == 2
+    assert (saved[-1]['watermark_time'], saved[-1]['watermark_order_id']) == (datetime.datetime(2026, 1, 1, 10, 12), 'o0012')
+
+
+def test_transform_rows_rejects_bad_values():
+    rejects = []
+    rows = transform_rows(TABLES['merchants'], ['merchant_id', 'merchant_name', 'join_date', 'city_id'],
+                          [['m1', 'A', '2020-01-01', '3.0'], ['m2', 'B', '', 'x'], ['m3']], rejects)
+    assert rows == [('m1', 'A', '2020-01-01', 3)]
+    assert [row[0] for row, _ in rejects] == ['m2', 'm3']
@@ -0,0 +1,150 @@
+import pytest
+from flask import Flask, jsonify
+
+import cache
+from cache import LRUCache, MemoryBackend, ResponseCache, cached
+
+
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(cache.time, 'monotonic', clock)
+    return clock
+
+
+def test_lru_entries_expire_after_their_ttl(clock):
+    lru = LRUCache(max_entries=4)
+    lru.set('a', 'A', ttl=10)
+    clock.now += 9.9
+    assert lru.get('a') == 'A'
+    clock.now += 0.1
+    assert lru.get('a') is None
+    assert lru.stats() == {
+        "entries": 0, "max_entries": 4, "hits": 1, "misses": 1, "hit_rate": 0.5, "evictions": 0, "expirations": 1}
+
+
+def test_lru_evicts_the_least_recently_used(clock):
+    lru = LRUCache(max_entries=2)
+    lru.set('a', 'A', 60)
+    lru.set('b', 'B', 60)
+    assert lru.get('a') == 'A'
+    lru.set('c', 'C', 60)
+    assert lru.get('b') is None
+    assert (lru.get('a'), lru.get('c')) == ('A', 'C')
+    assert lru.stats()["evictions"] == 1
+
+
+def test_memory_backend_expires_entries(clock):
+    backend = MemoryBackend()
+    backend.set('k', 'v', 5)
+    assert backend.get('k') == 'v'
+    clock.now += 5
+    assert backend.get('k') is None
+
+
+def test_shared_hits_are_copied_to_the_local_tier(clock):
+    shared = MemoryBackend()
+    ResponseCache(shared=shared).set('k', 'v', 60)
+    other = ResponseCache(shared=shared)
+    assert other.get('k', ttl=60) == 'v'
+    assert other.local.get('k') == 'v'
+    assert other.stats()["shared"] == {"backend": 'memory', "hits": 1, "misses": 0, "errors": 0}
+
+
+def test_shared_backend_errors_are_misses():
+    class Broken:
+        name = 'broken'
+
+        def get(self, key):
+            raise ConnectionError("down")
+
+        def set(self, key, value, ttl):
+            raise ConnectionError("down")
+
+    responses = ResponseCache(shared=Broken())
+    responses.set('k', 'v', 60)
+    assert responses.get('other') is None
+    assert responses.stats()["shared"]["errors"] == 2
+
+
+def test_key_changes_with_the_data_version():
+    responses = ResponseCache()
+    args = ('daily_sales', {'merchant_id': 'm1'}, [('days', '7')])
+    assert responses.key(*args, version=1) == 'v1|daily_sales|merchant_id=m1?days=7'
+    assert responses.key(*args, version=2) != responses.key(*args, version=1)
+
+
+def test_key_does_not_confuse_escaped_and_separate_arguments():
+    responses = ResponseCache()
+    one = responses.key('keyword_search', {'merchant_id': 'm1'}, [('limit', '5&q=a')], version=1)
+    two = responses.key('keyword_search', {'merchant_id': 'm1'}, [('limit', '5'), ('q', 'a')], version=1)
+    assert one != two
+    pipe = responses.key('item_pairs', {'merchant_id': 'm1|item_id=2'}, [], version=1)
+    assert pipe != responses.key('item_pairs', {'merchant_id': 'm1', 'item_id': 2}, [], version=1)
+
+
+def test_key_ignores_query_argument_order():
+    responses = ResponseCache()
+    assert (responses.key('daily_sales', {}, [('b', '2'), ('a', '1')], version=1)
+            == responses.key('daily_sales', {}, [('a', '1'), ('b', '2')], version=1))
+
+
+@pytest.fixture
+def app(monkeypatch):
+    version = {"value": 1}
+    monkeypatch.setattr(cache, 'read_data_version', lambda: version["value"])
+    monkeypatch.setattr(cache, 'CACHE_VERSION_CHECK', 0)
+    cache.configure_cache(ResponseCache(shared=MemoryBackend(), enabled=True))
+    calls = []
+
+    app = Flask(__name__)
+
+    @app.route('/api/merchant/<merchant_id>/keywords/search')
+    @cached
+    def keyword_search(merchant_id):
+        from flask import request
+        calls.append(request.args.get('q'))
+        response = jsonify({"q": request.args.get('q'), "calls": len(calls)})
+        if request.args.get('q') == 'broken':
+            response.headers['Cache-Control'] = 'no-store'
+        return response
+
+    app.version, app.calls = version, calls
+    yield app
+    cache.configure_cache(None)
+
+
+def test_cached_view_hits_until_the_data_version_changes(app):
+    client = app.test_client()
+    first = client.get('/api/merchant/m1/keywords/search?q=noodle')
+    again = client.get('/api/merchant/m1/keywords/search?q=noodle')
+    assert (first.headers['X-Cache'], again.headers['X-Cache']) == ('MISS', 'HIT')
+    assert again.get_json() == first.get_json() and again.headers['ETag'] == first.headers['ETag']
+
+    app.version["value"] = 2
+    assert client.get('/api/merchant/m1/keywords/search?q=noodle').headers['X-Cache'] == 'MISS'
+    assert len(app.calls) == 2
+
+
+def test_cached_view_keeps_escaped_queries_apart(app):
+    client = app.test_client()
+    client.get('/api/merchant/m1/keywords/search?limit=5&q=a')
+    response = client.get('/api/merchant/m1/keywords/search?limit=5%26q%3Da')
+    assert response.headers['X-Cache'] == 'MISS'
+    assert response.get_json()["q"] is None
+
+
+def test_cached_view_does_not_store_no_store_responses(app):
+    client = app.test_client()
+    for _ in range(2):
+        response = client.get('/api/merchant/m1/keywords/search?q=broken')
+        assert response.headers['X-Cache'] == 'MISS'
+    assert app.calls == ['broken', 'broken']
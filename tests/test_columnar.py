@@ -0,0 +1,152 @@
+from datetime import datetime, timedelta
+from decimal import Decimal
+
+import numpy as np
+import pytest
+
+import queries
+from columnar import EPOCH, HANDLERS, ColumnarEngine, minutes_sum, numeric_div
+
+# order_id, merchant_id, order_time, order_value, driver_arrival_time, driver_pickup_time, delivery_time
+ORDERS = [
+    ('a1', 'm1', '2026-02-28 12:10:00', '10.00', '2026-02-28 12:17:30', '2026-02-28 12:25:12', '2026-02-28 12:41:07'),
+    ('a2', 'm1', '2026-02-28 12:45:00', '20.01', '2026-02-28 12:50:00', '2026-02-28 12:57:00', '2026-02-28 13:10:20'),
+    ('a3', 'm1', '2026-02-28 23:59:59', None, None, None, None),
+    ('a4', 'm1', '2026-03-01 09:05:00', '5.50', '2026-03-01 09:08:01', '2026-03-01 09:15:04', '2026-03-01 09:17:00'),
+    ('a5', 'm1', '2026-03-01 12:29:59', '0.33', None, None, None),
+    ('a6', 'm1', '2026-02-17 08:00:00', '7.77', None, None, None),
+    ('a7', 'm1', '2026-02-22 12:30:00', '3.00', None, None, None),
+    ('a8', 'm1', '2026-02-15 12:29:00', '1.00', None, None, None),
+    ('a9', 'm1', '2026-01-10 18:00:00', '100.00', '2026-01-10 18:10:00', '2026-01-10 18:20:00', '2026-01-10 18:45:30'),
+    ('a10', 'm1', '2026-02-25 10:00:00', None, None, None, None),
+    ('b1', 'm2', '2026-03-01 10:00:00', '9.99', '2026-03-01 10:02:00', '2026-03-01 10:04:00', '2026-03-01 10:08:00'),
+]
+
+# LOCALTIMESTAMP for the statements below; the windows start mid-hour
+NOW = '2026-03-01 12:30:00'
+
+# The rows queries.py returns for ORDERS (through sales_rollup) at NOW
+EXPECTED = [
+    (queries.DAILY_SALES, {'merchant_id': 'm1', 'days': 1}, [
+        {'sale_date': '2026-02-28', 'daily_sales': 20.01, 'transaction_count': 2},
+        {'sale_date': '2026-03-01', 'daily_sales': 5.83, 'transaction_count': 2},
+    ]),
+    (queries.DAILY_SALES, {'merchant_id': 'm1', 'days': 7}, [
+        {'sale_date': '2026-02-22', 'daily_sales': 3.0, 'transaction_count': 1},
+        {'sale_date': '2026-02-25', 'daily_sales': None, 'transaction_count': 1},
+        {'sale_date': '2026-02-28', 'daily_sales': 30.01, 'transaction_count': 3},
+        {'sale_date': '2026-03-01', 'daily_sales': 5.83, 'transaction_count': 2},
+    ]),
+    (queries.DAILY_SALES, {'merchant_id': 'm1', 'days': 30}, [
+        {'sale_date': '2026-02-15', 'daily_sales': 1.0, 'transaction_count': 1},
+        {'sale_date': '2026-02-17', 'daily_sales': 7.77, 'transaction_count': 1},
+        {'sale_date': '2026-02-22', 'daily_sales': 3.0, 'transaction_count': 1},
+        {'sale_date': '2026-02-25', 'daily_sales': None, 'transaction_count': 1},
+        {'sale_date': '2026-02-28', 'daily_sales': 30.01, 'transaction_count': 3},
+        {'sale_date': '2026-03-01', 'daily_sales': 5.83, 'transaction_count': 2},
+    ]),
+    (queries.DAILY_SALES, {'merchant_id': 'm1', 'days': 365}, [
+        {'sale_date': '2026-01-10', 'daily_sales': 100.0, 'transaction_count': 1},
+        {'sale_date': '2026-02-15', 'daily_sales': 1.0, 'transaction_count': 1},
+        {'sale_date': '2026-02-17', 'daily_sales': 7.77, 'transaction_count': 1},
+        {'sale_date': '2026-02-22', 'daily_sales': 3.0, 'transaction_count': 1},
+        {'sale_date': '2026-02-25', 'daily_sales': None, 'transaction_count': 1},
+        {'sale_date': '2026-02-28', 'daily_sales': 30.01, 'transaction_count': 3},
+        {'sale_date': '2026-03-01', 'daily_sales': 5.83, 'transaction_count': 2},
+    ]),
+    (queries.DAILY_SALES, {'merchant_id': 'm2', 'days': 1}, [{'sale_date': '2026-03-01', 'daily_sales': 9.99, 'transaction_count': 1}]),
+    (queries.DAILY_SALES, {'merchant_id': 'nobody', 'days': 1}, []),
+    (queries.HOURLY_SALES, {'merchant_id': 'm1'}, [
+        {'hour_of_day': 8, 'hourly_sales': 7.77, 'order_count': 1},
+        {'hour_of_day': 9, 'hourly_sales': 5.5, 'order_count': 1},
+        {'hour_of_day': 10, 'hourly_sales': None, 'order_count': 1},
+        {'hour_of_day': 12, 'hourly_sales': 34.34, 'order_count': 5},
+        {'hour_of_day': 18, 'hourly_sales': 100.0, 'order_count': 1},
+        {'hour_of_day': 23, 'hourly_sales': None, 'order_count': 1},
+    ]),
+    (queries.HOURLY_SALES, {'merchant_id': 'm2'}, [{'hour_of_day': 10, 'hourly_sales': 9.99, 'order_count': 1}]),
+    (queries.HOURLY_SALES, {'merchant_id': 'nobody'}, []),
+    (queries.PERIOD_METRICS_CURRENT, {'merchant_id': 'm1', 'days': 1}, [{'total_sales': 25.84, 'order_count': 4, 'avg_order_value': 8.613333333333333}]),
+    (queries.PERIOD_METRICS_CURRENT, {'merchant_id': 'm1', 'days': 7}, [{'total_sales': 38.84, 'order_count': 7, 'avg_order_value': 7.768}]),
+    (queries.PERIOD_METRICS_CURRENT, {'merchant_id': 'm1', 'days': 30}, [{'total_sales': 47.61, 'order_count': 9, 'avg_order_value': 6.801428571428572}]),
+    (queries.PERIOD_METRICS_CURRENT, {'merchant_id': 'm1', 'days': 365}, [{'total_sales': 147.61, 'order_count': 10, 'avg_order_value': 18.45125}]),
+    (queries.PERIOD_METRICS_CURRENT, {'merchant_id': 'm2', 'days': 1}, [{'total_sales': 9.99, 'order_count': 1, 'avg_order_value': 9.99}]),
+    (queries.PERIOD_METRICS_CURRENT, {'merchant_id': 'nobody', 'days': 1}, [{'total_sales': None, 'order_count': 0, 'avg_order_value': None}]),
+    (queries.PERIOD_METRICS_PREVIOUS, {'merchant_id': 'm1', 'days': 2, 'until_days': 1}, [{'total_sales': 10.0, 'order_count': 1, 'avg_order_value': 10.0}]),
+    (queries.PERIOD_METRICS_PREVIOUS, {'merchant_id': 'm1', 'days': 14, 'until_days': 7}, [{'total_sales': 7.77, 'order_count': 1, 'avg_order_value': 7.77}]),
+    (queries.PERIOD_METRICS_PREVIOUS, {'merchant_id': 'm2', 'days': 2, 'until_days': 1}, [{'total_sales': None, 'order_count': 0, 'avg_order_value': None}]),
+    (queries.PERIOD_METRICS_PREVIOUS, {'merchant_id': 'nobody', 'days': 2, 'until_days': 1}, [{'total_sales': None, 'order_count': 0, 'avg_order_value': None}]),
+    (queries.DELIVERY_METRICS, {'merchant_id': 'm1'}, [
+        {'avg_delivery_time': 28.4875, 'avg_arrival_time': 6.379166666666666, 'avg_preparation_time': 7.9375},
+    ]),
+    (queries.DELIVERY_METRICS, {'merchant_id': 'm2'}, [{'avg_delivery_time': 8.0, 'avg_arrival_time': 2.0, 'avg_preparation_time': 2.0}]),
+    (queries.DELIVERY_METRICS, {'merchant_id': 'nobody'}, [{'avg_delivery_time': None, 'avg_arrival_time': None, 'avg_preparation_time': None}]),
+]
+
+
+def _us(text):
+    return (datetime.fromisoformat(text) - EPOCH) // timedelta(microseconds=1)
+
+
+def engine(orders=ORDERS):
+    """The arrays ColumnarEngine.load reads, built from ORDERS"""
+    orders = sorted(orders, key=lambda o: (o[1], o[2]))
+    merchants = sorted({o[1] for o in orders})
+    offsets, completed_offsets, completed = [0], [0], []
+    for merchant_id in merchants:
+        mine = [o for o in orders if o[1] == merchant_id]
+        done = [o for o in mine if None not in o[4:]]
+        offsets.append(offsets[-1] + len(mine))
+        completed_offsets.append(completed_offsets[-1] + len(done))
+        completed += [(_us(delivery) - _us(at), _us(arrival) - _us(at), _us(pickup) - _us(arrival))
+                      for _, _, at, _, arrival, pickup, delivery in done]
+    completed = np.array(completed, dtype=np.int64).reshape(-1, 3)
+    return ColumnarEngine(
+        merchants, np.array(offsets, dtype=np.int64),
+        np.array([_us(o[2]) for o in orders], dtype=np.int64),
+        np.array([int(Decimal(o[3]) * 100) if o[3] is not None else 0 for o in orders], dtype=np.int64),
+        np.array([o[3] is not None for o in orders]),
+        np.array(completed_offsets, dtype=np.int64),
+        {name: completed[:, i] for i, name in enumerate(('delivery', 'arrival', 'preparation'))},
+        version=1, timezone='UTC',
+    )
+
+
+@pytest.mark.parametrize('sql, params, expected', EXPECTED)
+def test_statements_match_the_sql_path(sql, params, expected):
+    assert HANDLERS[sql](engine(), params, _us(NOW)) == expected
+
+
+def test_every_handled_statement_is_covered():
+    assert set(HANDLERS) == {sql for sql, _, _ in EXPECTED}
+
+
+# Postgres' text for cents / 100 / count: rounded to the numeric division
+# scale, which float division does not always reproduce
+@pytest.mark.parametrize('cents, count, postgres', [
+    (144272510, 4663, '309.3984773750804203'),
+    (909925048, 517, '17600.097640232108'),
+    (507069465, 3110, '1630.4484405144694534'),
+    (846885254, 1720, '4923.7514767441860465'),
+    (2584, 3, '8.6133333333333333'),
+])
+def test_numeric_div_rounds_like_postgres(cents, count, postgres):
+    assert numeric_div(cents, 2, count) == float(postgres)
+
+
+def test_float_division_alone_would_differ():
+    assert 144272510 / 100 / 4663 != float('309.3984773750804203')
+
+
+# SUM(EXTRACT(EPOCH FROM d) / 60) as Postgres prints it, for durations in seconds
+@pytest.mark.parametrize('seconds, postgres', [
+    ([450, 300, 181, 600], '25.5166666666666667'),
+    ([1, 59, 61], '2.01666666666666670000'),
+    ([0, 7], '0.11666666666666666667'),
+    ([-30, 90], '1.00000000000000000000'),
+    ([18007], '300.1166666666666667'),
+])
+def test_minutes_sum_is_exact(seconds, postgres):
+    total, scale = minutes_sum(np.array(seconds, dtype=np.int64) * 1_000_000)
+    whole, fraction = postgres.split('.')
+    assert (total, scale) == (int(whole + fraction), len(fraction))
@@ -0,0 +1,100 @@
+import gzip
+import types
+
+import pytest
+from flask import Flask, Response, jsonify
+
+import conditional
+from conditional import choose_encoding, content_etag
+
+BIG = {"rows": [{"sale_date": f"2026-01-{day:02d}", "daily_sales": day * 10.5} for day in range(1, 29)] * 3}
+
+
+@pytest.fixture
+def client():
+    app = Flask(__name__)
+    conditional.init_app(app)
+
+    @app.route('/api/merchant/<merchant_id>/small')
+    def small(merchant_id):
+        return jsonify({"merchant_id": merchant_id})
+
+    @app.route('/api/merchant/<merchant_id>/big')
+    def big(merchant_id):
+        return jsonify(BIG)
+
+    @app.route('/api/merchant/<merchant_id>/export')
+    def export(merchant_id):
+        response = Response((f"row {i}\n" for i in range(2000)), mimetype='text/csv')
+        response.direct_passthrough = True
+        return response
+
+    @app.route('/api/health')
+    def health():
+        return jsonify({"status": "ok"})
+
+    return app.test_client()
+
+
+def test_matching_if_none_match_is_an_empty_304(client):
+    first = client.get('/api/merchant/m1/small')
+    etag = first.headers['ETag'].strip('"')
+    assert etag == content_etag(first.get_data())
+    assert first.headers['Cache-Control'] == 'no-cache'
+
+    again = client.get('/api/merchant/m1/small', headers={'If-None-Match': f'"{etag}"'})
+    assert again.status_code == 304
+    assert again.get_data() == b''
+    assert again.headers['ETag'] == first.headers['ETag']
+
+    stale = client.get('/api/merchant/m1/small', headers={'If-None-Match': '"something-else"'})
+    assert stale.status_code == 200 and stale.get_json() == {"merchant_id": 'm1'}
+
+
+def test_small_bodies_are_not_compressed(client):
+    response = client.get('/api/merchant/m1/small', headers={'Accept-Encoding': 'gzip'})
+    assert 'Content-Encoding' not in response.headers
+    assert not response.headers['ETag'].endswith('-gz"')
+
+
+def test_gzip_gets_its_own_etag(client):
+    plain = client.get('/api/merchant/m1/big')
+    zipped = client.get('/api/merchant/m1/big', headers={'Accept-Encoding': 'gzip, deflate'})
+    assert zipped.headers['Content-Encoding'] == 'gzip'
+    assert zipped.headers['ETag'] == plain.headers['ETag'][:-1] + '-gz"'
+    assert 'Accept-Encoding' in zipped.headers['Vary'] and 'Accept-Encoding' in plain.headers['Vary']
+    assert gzip.decompress(zipped.get_data()) == plain.get_data()
+
+    # Each representation revalidates against its own ETag
+    headers = {'Accept-Encoding': 'gzip', 'If-None-Match': zipped.headers['ETag']}
+    assert client.get('/api/merchant/m1/big', headers=headers).status_code == 304
+    headers = {'If-None-Match': zipped.headers['ETag']}
+    assert client.get('/api/merchant/m1/big', headers=headers).status_code == 200
+
+
+def test_brotli_is_preferred_when_installed(client, monkeypatch):
+    monkeypatch.setattr(conditional, 'brotli', types.SimpleNamespace(compress=lambda body, quality: b'br:' + body))
+    plain = client.get('/api/merchant/m1/big')
+    response = client.get('/api/merchant/m1/big', headers={'Accept-Encoding': 'gzip, br'})
+    assert response.headers['Content-Encoding'] == 'br'
+    assert response.headers['ETag'] == plain.headers['ETag'][:-1] + '-br"'
+    assert response.get_data() == b'br:' + plain.get_data()
+
+
+def test_refused_encodings_are_not_used(monkeypatch):
+    monkeypatch.setattr(conditional, 'brotli', None)
+    assert choose_encoding('br, gzip;q=0') is None
+    assert choose_encoding('gzip; q=0.5') == 'gzip'
+    assert choose_encoding('') is None
+
+
+def test_streamed_responses_are_left_alone(client):
+    response = client.get('/api/merchant/m1/export', headers={'Accept-Encoding': 'gzip'})
+    assert response.status_code == 200
+    assert 'ETag' not in response.headers
+    assert 'Content-Encoding' not in response.headers
+    assert response.get_data().decode().splitlines()[-1] == 'row 1999'
+
+
+def test_routes_outside_the_merchant_api_get_no_etag(client):
+    assert 'ETag' not in client.get('/api/health').headers
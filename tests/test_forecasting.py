@@ -0,0 +1,64 @@
+import numpy as np
+import pytest
+
+from forecasting import SEASON, fit_forecast, forecast_all, hour_shares
+
+
+def test_fit_forecast_constant_series():
+    y = np.full((1, 8 * SEASON), 100.0)
+    forecast, low, high = fit_forecast(y, 14)
+    assert forecast.shape == low.shape == high.shape == (1, 14)
+    assert forecast == pytest.approx(np.full((1, 14), 100.0), abs=1e-6)
+
+
+def test_fit_forecast_repeats_the_weekly_pattern():
+    week = np.array([50.0, 60, 70, 80, 90, 150, 200])
+    y = np.tile(week, 12)[None, :]
+    forecast, low, high = fit_forecast(y, 2 * SEASON)
+    # Day 0 of the forecast follows the last day of y, the last day of a week
+    assert forecast[0] == pytest.approx(np.tile(week, 2), rel=0.02)
+    assert (low <= forecast).all() and (forecast <= high).all()
+
+
+def test_fit_forecast_short_history_is_the_mean_since_the_first_order():
+    y = np.zeros((2, 4 * SEASON))
+    y[0, -SEASON:] = [10, 20, 30, 40, 50, 60, 70]
+    y[1] = 100
+    forecast, low, high = fit_forecast(y, 3)
+    assert forecast[0] == pytest.approx([40, 40, 40])
+    assert forecast[1] == pytest.approx([100, 100, 100], abs=1e-6)
+    assert (low >= 0).all() and (low <= forecast).all() and (forecast <= high).all()
+
+
+def test_fit_forecast_never_negative_and_handles_empty_input():
+    y = np.tile(np.linspace(300, 0, 5 * SEASON), (3, 1))
+    forecast, low, _ = fit_forecast(y, 30)
+    assert (forecast >= 0).all() and (low >= 0).all()
+
+    forecast, low, high = fit_forecast(np.zeros((0, 30)), 5)
+    assert forecast.shape == low.shape == high.shape == (0, 5)
+
+
+def test_hour_shares_fall_back_to_the_week_then_flat():
+    hours = np.zeros((2, 7, 24))
+    hours[0, 0, 12] = 30
+    hours[0, 0, 18] = 10
+    hours[0, 3, 9] = 40
+    shares = hour_shares(hours)
+    assert shares[0, 0, 12] == pytest.approx(0.75)
+    # A weekday without sales takes the merchant's whole-week profile
+    assert shares[0, 1, 9] == pytest.approx(0.5) and shares[0, 1, 12] == pytest.approx(0.375)
+    # No sales at all: flat
+    assert shares[1] == pytest.approx(np.full((7, 24), 1 / 24))
+    assert shares.sum(axis=2) == pytest.approx(np.ones((2, 7)))
+
+
+def test_forecast_all_batches_match_one_batch():
+    rng = np.random.default_rng(7)
+    sales = rng.gamma(5, 20, (5, 6 * SEASON))
+    orders = rng.poisson(10, (5, 6 * SEASON)).astype(float)
+    hours = rng.poisson(2, (5, 7, 24)).astype(float)
+    whole = forecast_all(sales, orders, hours, 10, workers=1, batch_size=5)
+    batched = forecast_all(sales, orders, hours, 10, workers=1, batch_size=2)
+    for a, b in zip(whole[0] + whole[1:], batched[0] + batched[1:]):
+        assert np.allclose(a, b)
@@ -0,0 +1,135 @@
+import math
+import re
+
+import pytest
+
+import instrumentation
+from instrumentation import BUCKETS, finish_request, record_statement, register_gauges, render, start_request
+
+SAMPLE = re.compile(r'^([a-zA-Z_:][a-zA-Z0-9_:]*)(?:\{(.*)\})? (\S+)$')
+LABEL = re.compile(r'([a-zA-Z_][a-zA-Z0-9_]*)="((?:[^"\\\n]|\\[\\"n])*)"(,|$)')
+
+
+def _unescape(value):
+    return re.sub(r'\\(.)', lambda m: '\n' if m.group(1) == 'n' else m.group(1), value)
+
+
+def _parse_labels(text):
+    labels, pos = {}, 0
+    while pos < len(text):
+        match = LABEL.match(text, pos)
+        assert match, f"bad label set {text!r}"
+        labels[match.group(1)] = _unescape(match.group(2))
+        pos = match.end()
+    return labels
+
+
+def parse(text):
+    """{metric family: type} and [(name, labels, value)], asserting the text is valid exposition"""
+    assert text.endswith('\n')
+    types, samples = {}, []
+    for line in text[:-1].split('\n'):
+        if line.startswith('# TYPE '):
+            _, _, name, kind = line.split(' ')
+            assert kind in ('counter', 'gauge', 'histogram', 'summary')
+            assert name not in types, f"{name} typed twice"
+            types[name] = kind
+        elif line.startswith('# HELP '):
+            continue
+        else:
+            match = SAMPLE.match(line)
+            assert match, f"bad sample line {line!r}"
+            name, labels, value = match.groups()
+            family = re.sub(r'_(bucket|sum|count)$', '', name)
+            assert name in types or family in types, f"{name} sampled before its TYPE line"
+            samples.append((name, _parse_labels(labels or ''), float(value)))
+    return types, samples
+
+
+@pytest.fixture(autouse=True)
+def metrics(monkeypatch):
+    monkeypatch.setattr(instrumentation, 'METRICS_ENABLED', True)
+    monkeypatch.setattr(instrumentation, '_gauges', {})
+    instrumentation.reset()
+    yield
+    instrumentation.reset()
+
+
+def _request(route, status, seconds):
+    finish_request(start_request(), route, status, seconds)
+
+
+def test_histogram_buckets_are_cumulative_and_end_at_inf():
+    for seconds in (0.0005, 0.003, 0.003, 0.2, 30.0):
+        _request('/api/merchant/<merchant_id>', 200, seconds)
+    types, samples = parse(render())
+    assert types['api_request_duration_seconds'] == 'histogram'
+
+    buckets = [(labels['le'], value) for name, labels, value in samples if name == 'api_request_duration_seconds_bucket']
+    assert [le for le, _ in buckets] == [repr(b) for b in BUCKETS] + ['+Inf']
+    counts = [value for _, value in buckets]
+    assert counts == sorted(counts)
+    assert dict(buckets)['0.001'] == 1
+    assert dict(buckets)['0.005'] == 3
+    assert dict(buckets)['10.0'] == 4
+
+    (count,) = [value for name, _, value in samples if name == 'api_request_duration_seconds_count']
+    (total,) = [value for name, _, value in samples if name == 'api_request_duration_seconds_sum']
+    assert dict(buckets)['+Inf'] == count == 5
+    assert math.isclose(total, 30.2065)
+
+
+def test_label_values_are_escaped():
+    route = 'a "quoted"\\path\nwith a newline'
+    _request(route, 503, 0.01)
+    text = render()
+    assert '\\"quoted\\"\\\\path\\nwith' in text
+    _, samples = parse(text)
+    assert ('api_requests_total', {'route': route, 'status': '503'}, 1.0) in samples
+    assert all(labels['route'] == route for name, labels, _ in samples if name.startswith('api_request_duration'))
+
+
+def test_statements_are_labelled_by_name_and_engine():
+    record_statement("SELECT 1", None, 0.002)
+    record_statement("SELECT 1", None, 0.004, engine='columnar')
+    _, samples = parse(render())
+    counts = {(labels['statement'], labels['engine']): value
+              for name, labels, value in samples if name == 'api_query_duration_seconds_count'}
+    assert set(engine for _, engine in counts) == {'postgres', 'columnar'}
+    assert all(value == 1 for value in counts.values())
+
+
+def test_registered_counters_and_gauges_are_typed_apart():
+    stats = {"checkouts": 7, "size": 3, "local": {"hits": 4, "entries": 2, "hit_rate": None},
+             "enabled": True, "backend": "memory"}
+    register_gauges('api_test', lambda: stats, counters=('checkouts', 'local_hits'))
+    types, samples = parse(render())
+    assert types['api_test_checkouts'] == 'counter'
+    assert types['api_test_local_hits'] == 'counter'
+    assert types['api_test_size'] == 'gauge'
+    assert types['api_test_local_entries'] == 'gauge'
+    assert types['api_test_enabled'] == 'gauge'
+    # Strings and missing values are not numbers and are left out
+    assert 'api_test_local_hit_rate' not in types and 'api_test_backend' not in types
+    values = {name: value for name, _, value in samples if name.startswith('api_test_')}
+    assert values == {'api_test_checkouts': 7, 'api_test_size': 3, 'api_test_local_hits': 4,
+                      'api_test_local_entries': 2, 'api_test_enabled': 1}
+
+
+def test_a_failing_collector_does_not_break_the_page():
+    def broken():
+        raise RuntimeError("pool gone")
+    register_gauges('api_broken', broken)
+    register_gauges('api_ok', lambda: {"size": 1})
+    types, _ = parse(render())
+    assert types['api_ok_size'] == 'gauge'
+    assert not any(name.startswith('api_broken') for name in types)
+
+
+def test_pool_and_cache_counter_keys_exist_in_their_stats():
+    from cache import CACHE_COUNTERS, LRUCache, MemoryBackend, ResponseCache
+    from db_connection import POOL_COUNTERS, ConnectionPool
+    cache = ResponseCache(LRUCache(4), MemoryBackend())
+    assert set(CACHE_COUNTERS) <= {name[len('x_'):] for name, _ in instrumentation._flatten('x', cache.stats())}
+    pool = ConnectionPool(min_size=0, connect=None)
+    assert set(POOL_COUNTERS) <= set(pool.stats())
@@ -0,0 +1,19 @@
+from keyword_index import normalize, search_params, tokens
+
+
+def test_normalize_folds_the_plural_s():
+    assert normalize('rolls') == 'roll'
+    assert normalize('glass') == 'glass'
+    # Short words keep their 's'
+    assert [normalize(t) for t in ('bus', 'gas')] == ['bus', 'gas']
+
+
+def test_tokens_fold_plurals_and_drop_repeats():
+    assert tokens("Spring Rolls, spring roll & 2 Glass") == ['spring', 'roll', '2', 'glass']
+    assert tokens(None) == []
+
+
+def test_search_params_last_token_is_a_prefix():
+    assert search_params('m1', 'Spring Rol', 5) == {
+        "merchant_id": 'm1', "tokens": ['spring'], "prefix": 'rol%', "limit": 5}
+    assert search_params('m1', ' , ', 5) is None
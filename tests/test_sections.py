@@ -0,0 +1,55 @@
+import pytest
+from werkzeug.datastructures import MultiDict
+
+from sections import (SectionError, decode_cursor, encode_cursor, item_performance_params,
+                      plan_item_performance, shape_item_performance)
+
+
+def test_cursor_roundtrip():
+    cursor = encode_cursor('2026-01-01T10:00:00', 'o0042')
+    assert '=' not in cursor
+    assert decode_cursor(cursor) == ['2026-01-01T10:00:00', 'o0042']
+
+
+@pytest.mark.parametrize('cursor', ['not a cursor!', 'x', encode_cursor('a')[:-2] + '~~'])
+def test_invalid_cursor_raises_value_error(cursor):
+    with pytest.raises(ValueError, match='Invalid cursor'):
+        decode_cursor(cursor)
+
+
+@pytest.mark.parametrize('query, error', [
+    ('sort=price', 'sort must be one of'),
+    ('limit=0', 'limit must be positive'),
+    ('cursor=abc', 'Invalid cursor'),
+    ('cursor=' + encode_cursor(1, 2, 3), 'Invalid cursor'),
+    ('from=2026-13-01', ''),
+])
+def test_item_performance_params_rejects_bad_arguments(query, error):
+    name, value = query.split('=', 1)
+    p = item_performance_params(MultiDict({name: value}))
+    assert error in p["error"]
+    assert plan_item_performance('m1', p) == {}
+    with pytest.raises(SectionError) as e:
+        shape_item_performance('m1', p, {})
+    assert e.value.status == 400
+
+
+def _item(item_id, order_count):
+    return {"item_id": item_id, "item_name": f"item {item_id}", "item_price": 2.0,
+            "order_count": order_count, "orders": order_count, "revenue": 2.0 * order_count}
+
+
+def test_item_performance_pages_with_a_keyset_cursor():
+    p = item_performance_params(MultiDict({'limit': '2'}))
+    sql, params = plan_item_performance('m1', p)["items"]
+    # One row past the page tells whether there is a next one
+    assert params["limit"] == 3 and params["after_value"] is None
+
+    page = shape_item_performance('m1', p, {"items": [_item(7, 30), _item(3, 20), _item(5, 10)]})
+    assert [item["item_id"] for item in page["items"]] == [7, 3]
+    assert decode_cursor(page["next_cursor"]) == [20, 3]
+
+    p = item_performance_params(MultiDict({'limit': '2', 'cursor': page["next_cursor"]}))
+    assert plan_item_performance('m1', p)["items"][1]["after_value"] == 20
+    last = shape_item_performance('m1', p, {"items": [_item(5, 10)]})
+    assert last["next_cursor"] is None
@@ -0,0 +1,36 @@
+import datetime
+import decimal
+import json
+
+import pytest
+
+import serialization
+from serialization import dumps, iso_timestamp
+
+
+@pytest.mark.parametrize('value, expected', [
+    ('2026-01-01 10:00:00', '2026-01-01T10:00:00'),
+    ('2026-01-01 10:00:00.5', '2026-01-01T10:00:00.500000'),
+    ('2026-01-01 10:00:00.123456', '2026-01-01T10:00:00.123456'),
+])
+def test_iso_timestamp_matches_isoformat(value, expected):
+    assert iso_timestamp(value) == expected
+    assert iso_timestamp(value) == datetime.datetime.fromisoformat(value).isoformat()
+
+
+def test_typecasters_pass_null_through():
+    assert serialization._to_timestamp(None, None) is None
+    assert serialization._to_float(None, None) is None
+    assert serialization._to_float('12.50', None) == 12.5
+
+
+@pytest.mark.parametrize('use_orjson', [True, False])
+def test_dumps_encodes_dates_and_decimals(use_orjson, monkeypatch):
+    if not use_orjson:
+        monkeypatch.setattr(serialization, 'orjson', None)
+    elif serialization.orjson is None:
+        pytest.skip("orjson is not installed")
+    payload = {"day": datetime.date(2026, 1, 2), "at": datetime.datetime(2026, 1, 2, 3, 4, 5), "n": 1.5}
+    assert json.loads(dumps(payload)) == {"day": "2026-01-02", "at": "2026-01-02T03:04:05", "n": 1.5}
+    if not use_orjson:
+        assert json.loads(dumps({"v": decimal.Decimal('2.50')})) == {"v": "2.50"}